@@ -0,0 +1,131 @@
+"""Compares the end to end latency of the paho and asyncio MQTT client backends
+
+Each backend subscribes to a topic and bounces a message off the broker: every message it
+receives is published again from within its on message callback, so each round trip measures
+publish -> broker -> delivery -> callback on that backend.
+
+Examples:
+
+    To compare both backends against a broker on this machine:
+
+        .. code-block:: console
+
+            python benchmarks/latency.py --host 127.0.0.1 --port 1883 --messages 5000 --qos 1
+"""
+import argparse
+import statistics
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from mqtt_remote.asyncio_client import AsyncioMQTTClient
+from mqtt_remote.mqtt_client import MQTTClient
+
+
+
+BACKENDS = {'paho': MQTTClient, 'asyncio': AsyncioMQTTClient}
+TOPIC = 'mqtt_remote/benchmark/latency'
+
+
+
+def measure(backend, host, port, messages, qos, user_name='', password=''):
+    """Returns the round trip latencies, in seconds, of one backend
+
+    Args:
+        backend (str): 'paho' or 'asyncio'
+        host (str): The host name or IP address of the broker
+        port (int): The port of the broker
+        messages (int): The number of round trips measured
+        qos (int): The Quality Of Service of the messages
+        user_name (str, optional): The user name required to access the broker. Defaults to ''.
+        password (str, optional): The password required to access the broker. Defaults to ''.
+
+    Returns:
+        list[float]: The round trip latencies
+
+    Raises:
+        TimeoutError: if the client doesn't subscribe or the round trips don't complete in time
+    """
+    latencies = []
+    finished = threading.Event()
+    sent = [0.0]
+    client = BACKENDS[backend](user_name, password, host, port, 60, [(TOPIC, qos)],
+                               f'mqtt_remote_benchmark_{backend}', True, mqtt.MQTTv311, 'tcp',
+                               False)
+
+    def on_message(msg):
+        now = time.perf_counter()
+        latencies.append(now - sent[0])
+        if len(latencies) >= messages:
+            finished.set()
+            return
+        sent[0] = time.perf_counter()
+        client.publish(TOPIC, msg.payload, qos, False)
+
+    client.on_message_callbacks.add(on_message)
+    client.initialise()
+    client.start('non_blocking')
+    try:
+        deadline = time.monotonic() + 10
+        while not client._subscribed:  # pylint: disable=W0212
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{backend} client didn't subscribe to '{TOPIC}'")
+            time.sleep(0.01)
+
+        sent[0] = time.perf_counter()
+        client.publish(TOPIC, b'x' * 64, qos, False)
+        if not finished.wait(max(30, messages / 100)):
+            raise TimeoutError(f'{backend} client completed {len(latencies)} of {messages} '
+                               'round trips')
+    finally:
+        client.stop()
+
+    return latencies
+
+
+def summarise(backend, latencies):
+    """Returns a one line summary of the latencies, in milliseconds
+
+    Args:
+        backend (str): The name of the backend
+        latencies (list[float]): The round trip latencies, in seconds
+
+    Returns:
+        str: The summary
+    """
+    ordered = sorted(latencies)
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    return ''.join([f'{backend:>8}: n={len(ordered)} ',
+                    f'mean={statistics.mean(ordered) * 1000:.3f} ms ',
+                    f'median={statistics.median(ordered) * 1000:.3f} ms ',
+                    f'p99={p99 * 1000:.3f} ms ',
+                    f'max={ordered[-1] * 1000:.3f} ms'])
+
+
+def main():
+    """Runs the benchmark from the command line
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--host', default='127.0.0.1', help='broker host (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=1883, help='broker port (default: 1883)')
+    parser.add_argument('--user', default='', help='broker user name')
+    parser.add_argument('--password', default='', help='broker password')
+    parser.add_argument('--messages', type=int, default=2000,
+                        help='round trips per backend (default: 2000)')
+    parser.add_argument('--qos', type=int, choices=[0, 1, 2], default=0,
+                        help='quality of service (default: 0)')
+    parser.add_argument('--backend', choices=['paho', 'asyncio', 'both'], default='both',
+                        help='backend(s) to measure (default: both)')
+    args = parser.parse_args()
+
+    backends = list(BACKENDS) if args.backend == 'both' else [args.backend]
+    for backend in backends:
+        latencies = measure(backend, args.host, args.port, args.messages, args.qos,
+                            args.user, args.password)
+        print(summarise(backend, latencies))
+
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 import requests
 
-from mqtt_remote.message import CommandMessageCallback
+from mqtt_remote.message import CommandMessageCallback, ReplyPayloadSchema
 
 
 
@@ -12,14 +12,19 @@ class PublicIP(CommandMessageCallback):
 
         {"command": "public_ip",
          "attributes": {"return_message": {"topic": <str>,
-                                           "qos": <int>,
+                                           "qos": <int: 0 to 2>,
                                            "retain": <bool>}}}
+
+    The "return_message" can be left out if the reply is to be sent to an MQTT 5 response
+    topic, with its correlation data, or to a "response_topic" at the top level of the
+    payload, see 'mqtt_remote.message.reply_address'
     """
     def __init__(self):
         """Constructor
         """
         self._message_name = 'public_ip'
         self.mqtt_publish = None
+        self.payload_schema = ReplyPayloadSchema()
 
     @property
     def message_name(self):
@@ -42,12 +47,9 @@ class PublicIP(CommandMessageCallback):
         """
         public_ip = requests.get('https://api.ipify.org').text
 
-        topic = inbound_message.payload['attributes']['return_message']['topic']
         payload = f'Public IP: {public_ip}'
-        qos = inbound_message.payload['attributes']['return_message']['qos']
-        retain = inbound_message.payload['attributes']['return_message']['retain']
 
-        self.mqtt_publish(topic, payload, qos, retain)
+        self.reply(inbound_message, payload)
 
 
 
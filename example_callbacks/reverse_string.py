@@ -1,4 +1,10 @@
-from mqtt_remote.message import CommandMessageCallback
+import json
+
+from mqtt_remote.message import (CommandMessageCallback,
+                                 PayloadField,
+                                 ReplyPayloadSchema,
+                                 group_by_reply_address,
+                                 publish_reply)
 
 
 
@@ -10,15 +16,20 @@ class ReverseString(CommandMessageCallback):
         {"command": "reverse_string",
         "attributes": {"string_to_reverse": <str>,
                        "return_message": {"topic": <str>,
-                                          "qos": <int>,
+                                          "qos": <int: 0 to 2>,
                                           "retain": <bool>}}}
 
+    The "return_message" can be left out if the reply is to be sent to an MQTT 5 response
+    topic, with its correlation data, or to a "response_topic" at the top level of the
+    payload, see 'mqtt_remote.message.reply_address'
     """
     def __init__(self):
         """Constructor
         """
         self._message_name = 'reverse_string'
         self.mqtt_publish = None
+        self.payload_schema = ReplyPayloadSchema(
+            PayloadField('string_to_reverse', ['attributes', 'string_to_reverse'], str))
 
     @property
     def message_name(self):
@@ -39,12 +50,24 @@ class ReverseString(CommandMessageCallback):
             inbound_message (CommandMessage): The CommandMessage with a 'payload['command']'
                 value that matches with self._message_name
         """
-        string_to_reverse = inbound_message.payload['attributes']['string_to_reverse']
-        reversed_string = string_to_reverse[::-1]
+        reversed_string = inbound_message.arguments.string_to_reverse[::-1]
+
+        self.reply(inbound_message, reversed_string)
+
+    def execute_batch(self, inbound_messages):
+        """The code to be executed when a batch of matching MQTT messages is received
 
-        outbound_topic = inbound_message.payload['attributes']['return_message']['topic']
-        outbound_payload = reversed_string
-        outbound_qos = inbound_message.payload['attributes']['return_message']['qos']
-        outbound_retain = inbound_message.payload['attributes']['return_message']['retain']
+        Only used when batching is enabled in the 'dispatch' section of the config. A single
+        MQTT message, containing a JSON list of the reversed strings in the order they were
+        requested, is published to each distinct reply address in the batch
+
+        Args:
+            inbound_messages (list): The CommandMessages with a 'payload['command']' value
+                that matches with self._message_name
+        """
+        groups = group_by_reply_address(inbound_messages)
 
-        self.mqtt_publish(outbound_topic, outbound_payload, outbound_qos, outbound_retain)
+        for address, command_messages in groups.items():
+            outbound_payload = json.dumps([command_message.arguments.string_to_reverse[::-1]
+                                           for command_message in command_messages])
+            publish_reply(self.mqtt_publish, address, outbound_payload)
@@ -1,4 +1,10 @@
-from mqtt_remote.message import CommandMessageCallback
+import json
+
+from mqtt_remote.message import (CommandMessageCallback,
+                                 PayloadField,
+                                 ReplyPayloadSchema,
+                                 group_by_reply_address,
+                                 publish_reply)
 
 
 
@@ -9,11 +15,15 @@ class SumPositiveInts(CommandMessageCallback):
     Requires an inbound message MQTT payload of the form:
 
         {"command": "sum_positive_ints",
-         "attributes": {"integer_one": <int>,
-                        "integer_two": <int>,
+         "attributes": {"integer_one": <int: >= 1>,
+                        "integer_two": <int: >= 1>,
                         "return_message": {"topic": <str>,
-                                           "qos": <int>,
+                                           "qos": <int: 0 to 2>,
                                            "retain": <bool>}}}
+
+    The "return_message" can be left out if the reply is to be sent to an MQTT 5 response
+    topic, with its correlation data, or to a "response_topic" at the top level of the
+    payload, see 'mqtt_remote.message.reply_address'
     """
     def __init__(self):
         """Constructor
@@ -22,6 +32,9 @@ class SumPositiveInts(CommandMessageCallback):
         self._message_name = 'sum_positive_ints' # required
         # self.config = None # optional
         self.mqtt_publish = None # optional
+        self.payload_schema = ReplyPayloadSchema( # optional
+            PayloadField('integer_one', ['attributes', 'integer_one'], int, minimum=1),
+            PayloadField('integer_two', ['attributes', 'integer_two'], int, minimum=1))
 
     @property
     def message_name(self):
@@ -42,13 +55,27 @@ class SumPositiveInts(CommandMessageCallback):
             inbound_message (CommandMessage): The CommandMessage with a 'payload['command']'
                 value that matches with self._message_name
         """
-        integer_one = int(inbound_message.payload['attributes']['integer_one'])
-        integer_two = int(inbound_message.payload['attributes']['integer_two'])
-        outbound_topic = inbound_message.payload['attributes']['return_message']['topic']
-        outbound_qos = inbound_message.payload['attributes']['return_message']['qos']
-        outbound_retain = inbound_message.payload['attributes']['return_message']['retain']
+        arguments = inbound_message.arguments
+
+        outbound_payload = str(arguments.integer_one + arguments.integer_two)
+
+        self.reply(inbound_message, outbound_payload)
 
-        sum = integer_one + integer_two
-        outbound_payload = str(sum)
+    def execute_batch(self, inbound_messages):
+        """The code to be executed when a batch of matching MQTT messages is received
+
+        Only used when batching is enabled in the 'dispatch' section of the config. A single
+        MQTT message, containing a JSON list of the sums in the order they were
+        requested, is published to each distinct reply address in the batch
+
+        Args:
+            inbound_messages (list): The CommandMessages with a 'payload['command']' value
+                that matches with self._message_name
+        """
+        groups = group_by_reply_address(inbound_messages)
 
-        self.mqtt_publish(outbound_topic, outbound_payload, outbound_qos, outbound_retain)
\ No newline at end of file
+        for address, command_messages in groups.items():
+            sums = [command_message.arguments.integer_one + command_message.arguments.integer_two
+                    for command_message in command_messages]
+            outbound_payload = json.dumps(sums)
+            publish_reply(self.mqtt_publish, address, outbound_payload)
@@ -3,7 +3,9 @@
 from abc import ABC, abstractmethod
 from pathlib import Path
 import logging
+import os
 import platform
+import shutil
 
 PLATFORM = platform.system()
 
@@ -16,8 +18,9 @@ if PLATFORM == 'Linux':
     import pulsectl
 
 from mqtt_remote.message import (CommandMessageCallback,
-                                 valid_payload_value,
-                                 log_wrong_command_message_form)
+                                 PayloadField,
+                                 PayloadSchema,
+                                 ReplyPayloadSchema)
 
 
 
@@ -73,6 +76,15 @@ class LocalAudioFilePlayer(CommandMessageCallback):
     Requires an inbound message MQTT payload of the form:
 
         {"command": "play_local_audio_file", "attributes": {"audio_file": <str>}}
+
+    The audio file can also be pushed to the computer by sending the payload above, along
+    with the contents of the file, as a chunked transfer, e.g. with:
+
+        mqtt_remote.message.publish_chunked(publish, topic, audio_file_contents, qos, retain,
+                                            chunk_size, payload)
+
+    in which case the file is saved into the audio file directory, under the name given by
+    'audio_file', before it's played.
     """
     def __init__(self, audio_file_player=None, audio_file_dir=None):
         """Constructor
@@ -84,8 +96,9 @@ class LocalAudioFilePlayer(CommandMessageCallback):
                 specified in the MQTT message is expected to be present. Defaults to None.
         """
         self._message_name = 'play_local_audio_file'
-        self._required_message_form = ''.join([f'{{"command": "{self._message_name}", ',
-                                               '"attributes": {"audio_file": "<str>"}}'])
+        self.payload_schema = PayloadSchema(
+            PayloadField('audio_file', ['attributes', 'audio_file'], str))
+        self._required_message_form = self.payload_schema.message_form(self._message_name)
 
         if audio_file_player is None:
             self.audio_file_player = VLCAudioFilePlayer()
@@ -122,12 +135,50 @@ class LocalAudioFilePlayer(CommandMessageCallback):
             inbound_message (CommandMessage): The CommandMessage that matched with this
                 class
         """
-        audio_file = inbound_message.payload['attributes']['audio_file']
+        audio_file = inbound_message.arguments.audio_file
         audio_file_to_play = str((Path(self.audio_file_dir) / audio_file).resolve())
         self.audio_file_player.play_file(audio_file_to_play)
 
         logger.info(f"Sent the following file to the audio file player: '{audio_file_to_play}'")
 
+    def _save_attached_audio_file(self, inbound_message):
+        """Saves an audio file delivered by a chunked transfer into the audio file directory
+
+        An existing file is never overwritten, and a file that can't be saved completely is
+        removed
+
+        Args:
+            inbound_message (CommandMessage): The CommandMessage that matched with this
+                class
+
+        Returns:
+            bool:
+                True: the audio file was saved
+                False: the audio file name wasn't a plain file name, or a file with that name
+                    already exists, so it wasn't saved
+        """
+        audio_file = inbound_message.arguments.audio_file
+
+        if audio_file in ('', '.', '..') or Path(audio_file).name != audio_file:
+            logger.warning(f"Pushed audio file not saved, '{audio_file}' isn't a plain file name")
+            return False
+
+        audio_file_to_save = str((Path(self.audio_file_dir) / audio_file).resolve())
+        try:
+            with open(audio_file_to_save, 'xb') as file:
+                try:
+                    shutil.copyfileobj(inbound_message.attachment, file)
+                except BaseException:
+                    file.close()
+                    os.remove(audio_file_to_save)
+                    raise
+        except FileExistsError:
+            logger.warning(f"Pushed audio file not saved, '{audio_file_to_save}' already exists")
+            return False
+
+        logger.info(f"Saved pushed audio file to: '{audio_file_to_save}'")
+        return True
+
     def execute(self, inbound_message):
         """The code to be executed when a matching CommandMessage is received by
            CommandMessageCallbackCaller
@@ -136,11 +187,11 @@ class LocalAudioFilePlayer(CommandMessageCallback):
             inbound_message (CommandMessage): The CommandMessage that matched with this
                 class
         """
-        audio_file_valid = valid_payload_value(inbound_message, ['attributes', 'audio_file'], str)
-        if audio_file_valid:
-            self._play_local_audio_file(inbound_message)
-        else:
-            log_wrong_command_message_form(self._message_name, self._required_message_form)
+        if inbound_message.attachment is not None:
+            if not self._save_attached_audio_file(inbound_message):
+                return
+
+        self._play_local_audio_file(inbound_message)
 
 
 
@@ -269,7 +320,7 @@ class ChangeSpeakerVolume(CommandMessageCallback):
 
     Requires an inbound message MQTT payload of the form:
 
-        {"command": "change_speaker_volume", "attributes": {"vol_percent": <int>}}
+        {"command": "change_speaker_volume", "attributes": {"vol_percent": <int: 0 to 100>}}
 
     """
     def __init__(self, platform_os=None, set_speaker_volume=None):
@@ -282,8 +333,9 @@ class ChangeSpeakerVolume(CommandMessageCallback):
                 must be from a class that inherits from ComputerVolume. Defaults to None.
         """
         self._message_name = 'change_speaker_volume'
-        self._required_message_form = ''.join([f'{{"command": "{self._message_name}", ',
-                                               '"attributes": {"vol_percent": <int>}}'])
+        self.payload_schema = PayloadSchema(
+            PayloadField('vol_percent', ['attributes', 'vol_percent'], int, 0, 100))
+        self._required_message_form = self.payload_schema.message_form(self._message_name)
 
         if platform_os is None:
             platform_os = PLATFORM
@@ -324,14 +376,9 @@ class ChangeSpeakerVolume(CommandMessageCallback):
             inbound_message (CommandMessage): The CommandMessage that matched with this
                 class
         """
-        volume_percent_valid = valid_payload_value(
-            inbound_message, ['attributes', 'vol_percent'], int)
-        if volume_percent_valid:
-            volume_percent = inbound_message.payload['attributes']['vol_percent']
-            self.set_speaker_volume(volume_percent)
-            logger.info(f"Requested that speaker volume is changed to: '{volume_percent}%'")
-        else:
-            log_wrong_command_message_form(self.message_name, self._required_message_form)
+        volume_percent = inbound_message.arguments.vol_percent
+        self.set_speaker_volume(volume_percent)
+        logger.info(f"Requested that speaker volume is changed to: '{volume_percent}%'")
 
 
 
@@ -344,8 +391,12 @@ class GetSpeakerVolume(CommandMessageCallback):
 
         {"command": "get_speaker_volume",
          "attributes": {"return_message": {"topic": <str>,
-                                           "qos": <int>,
+                                           "qos": <int: 0 to 2>,
                                            "retain": <bool>}}}
+
+    The "return_message" can be left out if the reply is to be sent to an MQTT 5 response
+    topic, with its correlation data, or to a "response_topic" at the top level of the
+    payload, see 'mqtt_remote.message.reply_address'
     """
     def __init__(self, platform_os=None, get_speaker_volume=None):
         """Constructor
@@ -357,11 +408,8 @@ class GetSpeakerVolume(CommandMessageCallback):
                 be from a class that inherits from ComputerVolume. Defaults to None.
         """
         self._message_name = 'get_speaker_volume'
-        self._required_message_form = ''.join([f'{{"command": "{self._message_name}", ',
-                                               '"attributes": {"return_message": {'
-                                                    '"topic": <str>,'
-                                                    '"qos": <int>'
-                                                    '"retain": <bool>}}}'])
+        self.payload_schema = ReplyPayloadSchema()
+        self._required_message_form = self.payload_schema.message_form(self._message_name)
         self.mqtt_publish = None
 
         if platform_os is None:
@@ -420,28 +468,6 @@ class GetSpeakerVolume(CommandMessageCallback):
 
         return volume_message
 
-    def _inbound_message_values_valid(self, inbound_message):
-        """Checks to see if required inbound message values are valid
-
-        Args:
-            inbound_message (CommandMessage): The CommandMessage that matched with this
-                class
-
-        Returns:
-            bool:
-                True: all required inbound message values are valid
-                False: one or more required inbound message values are not valid
-        """
-        topic_valid = valid_payload_value(
-            inbound_message, ['attributes', 'return_message', 'topic'], str)
-        qos_valid = valid_payload_value(
-            inbound_message, ['attributes', 'return_message', 'qos'], int)
-        retain_valid = valid_payload_value(
-            inbound_message, ['attributes', 'return_message', 'retain'], bool)
-
-        return all([topic_valid, qos_valid, retain_valid])
-
-
     def _publish_volume_mqtt_message(self, inbound_message, outbound_payload):
         """Publishes the outbound MQTT message containing data on the current volume(s)
 
@@ -450,17 +476,8 @@ class GetSpeakerVolume(CommandMessageCallback):
                 class
             outbound_payload (str): The payload for the outbound MQTT message
         """
-        if self._inbound_message_values_valid(inbound_message):
-            topic = inbound_message.payload['attributes']['return_message']['topic']
-            qos = inbound_message.payload['attributes']['return_message']['qos']
-            retain = inbound_message.payload['attributes']['return_message']['retain']
-
-            # pylint: disable=not-callable
-            self.mqtt_publish(topic, outbound_payload, qos, retain)
-            # pylint: enable=not-callable
+        if self.reply(inbound_message, outbound_payload):
             logger.info("Speaker volume published using details supplied")
-        else:
-            log_wrong_command_message_form(self.message_name, self._required_message_form)
 
 
     def execute(self, inbound_message):
@@ -11,6 +11,7 @@ def command_msg():
     cmd_msg.payload = None
     cmd_msg.qos = 0
     cmd_msg.retain = False
+    cmd_msg.attachment = None
 
     return cmd_msg
 
@@ -6,11 +6,24 @@
 
 from unittest.mock import patch, Mock, call
 from pathlib import Path
+import io
 import platform
 
 import pytest
 
 import mqtt_remote_audio.audio as audio
+from mqtt_remote.message import CommandMessage, CommandMessageCallbackCaller
+
+
+
+def call_via_callback_caller(callback, payload):
+    callback_caller = CommandMessageCallbackCaller()
+    callback_caller.add_callback(payload['command'], callback.execute, callback.payload_schema)
+    callback_caller.callback_caller(CommandMessage('topic', payload, 0, False))
+
+
+def extract_arguments(callback, command_msg):
+    return callback.payload_schema.compile().extract(command_msg)
 
 
 
@@ -59,7 +72,7 @@ class TestLocalAudioFilePlayer:
     def test_required_message_form(self):
         msg_name = 'play_local_audio_file'
         required_message_form = ''.join([f'{{"command": "{msg_name}", ',
-                                         '"attributes": {"audio_file": "<str>"}}'])
+                                         '"attributes": {"audio_file": <str>}}'])
         mock_player = Mock()
 
         play_local_audio_file = audio.LocalAudioFilePlayer(mock_player)
@@ -76,6 +89,7 @@ class TestLocalAudioFilePlayer:
         command_msg.payload = payload
 
         play_local_audio_file = audio.LocalAudioFilePlayer(mock_player, audio_dir)
+        command_msg.arguments = extract_arguments(play_local_audio_file, command_msg)
         play_local_audio_file.execute(command_msg)
 
         play_local_audio_file.audio_file_player.play_file.assert_called_once_with(audio_path)
@@ -83,21 +97,96 @@ class TestLocalAudioFilePlayer:
                                                   f"file player: '{audio_path}'"]))
 
 
+    def test_execute_attached_audio_file(self, audio_file, command_msg, tmp_path):
+        mock_player = Mock()
+
+        command_msg.payload = {"command": "name", "attributes": {"audio_file": audio_file}}
+        command_msg.attachment = io.BytesIO(b'audio data')
+
+        play_local_audio_file = audio.LocalAudioFilePlayer(mock_player, str(tmp_path))
+        command_msg.arguments = extract_arguments(play_local_audio_file, command_msg)
+        play_local_audio_file.execute(command_msg)
+
+        audio_path = str((tmp_path / audio_file).resolve())
+        assert Path(audio_path).read_bytes() == b'audio data'
+        mock_player.play_file.assert_called_once_with(audio_path)
+
+
+    def test_execute_attached_audio_file_not_plain_name(self, command_msg, tmp_path):
+        mock_player = Mock()
+
+        command_msg.payload = {"command": "name", "attributes": {"audio_file": "../file.mp3"}}
+        command_msg.attachment = io.BytesIO(b'audio data')
+
+        play_local_audio_file = audio.LocalAudioFilePlayer(mock_player, str(tmp_path))
+        command_msg.arguments = extract_arguments(play_local_audio_file, command_msg)
+        play_local_audio_file.execute(command_msg)
+
+        assert not (tmp_path.parent / 'file.mp3').exists()
+        mock_player.play_file.assert_not_called()
+
+
+    @pytest.mark.parametrize('name', ['', '.', '..'])
+    def test_execute_attached_audio_file_no_name(self, name, command_msg, tmp_path):
+        mock_player = Mock()
+
+        command_msg.payload = {"command": "name", "attributes": {"audio_file": name}}
+        command_msg.attachment = io.BytesIO(b'audio data')
+
+        play_local_audio_file = audio.LocalAudioFilePlayer(mock_player, str(tmp_path))
+        command_msg.arguments = extract_arguments(play_local_audio_file, command_msg)
+        play_local_audio_file.execute(command_msg)
+
+        mock_player.play_file.assert_not_called()
+
+
+    def test_execute_attached_audio_file_exists(self, audio_file, command_msg, tmp_path):
+        mock_player = Mock()
+        (tmp_path / audio_file).write_bytes(b'original')
+
+        command_msg.payload = {"command": "name", "attributes": {"audio_file": audio_file}}
+        command_msg.attachment = io.BytesIO(b'audio data')
+
+        play_local_audio_file = audio.LocalAudioFilePlayer(mock_player, str(tmp_path))
+        command_msg.arguments = extract_arguments(play_local_audio_file, command_msg)
+        play_local_audio_file.execute(command_msg)
+
+        assert (tmp_path / audio_file).read_bytes() == b'original'
+        mock_player.play_file.assert_not_called()
+
+
+    def test_execute_attached_audio_file_copy_fails(self, audio_file, command_msg, tmp_path):
+        mock_player = Mock()
+        attachment = Mock()
+        attachment.read.side_effect = OSError('spool lost')
+
+        command_msg.payload = {"command": "name", "attributes": {"audio_file": audio_file}}
+        command_msg.attachment = attachment
+
+        play_local_audio_file = audio.LocalAudioFilePlayer(mock_player, str(tmp_path))
+        command_msg.arguments = extract_arguments(play_local_audio_file, command_msg)
+        with pytest.raises(OSError):
+            play_local_audio_file.execute(command_msg)
+
+        assert not (tmp_path / audio_file).exists()
+
+
     @patch('mqtt_remote.message.logger')
     def test_execute_command_message_wrong_attribute(self, mock_logger, audio_file, audio_dir,
                                                      command_msg):
         mock_player = Mock()
 
-        payload = {"command": "name", "attributes": {"SOUND_file": audio_file}}
-        command_msg.payload = payload
+        payload = {"command": "play_local_audio_file", "attributes": {"SOUND_file": audio_file}}
 
         play_local_audio_file = audio.LocalAudioFilePlayer(mock_player, audio_dir)
-        play_local_audio_file.execute(command_msg)
+        call_via_callback_caller(play_local_audio_file, payload)
+
+        mock_player.play_file.assert_not_called()
 
         mock_logger.error.assert_any_call(''.join(['A CommandMessage for the callback: \'play_local_audio_file\'',
                                                    'must be of the form:\n{"command": ',
                                                    '"play_local_audio_file", "attributes": ',
-                                                   '{"audio_file": "<str>"}}']))
+                                                   '{"audio_file": <str>}}']))
 
 
     @patch('mqtt_remote.message.logger')
@@ -105,16 +194,16 @@ class TestLocalAudioFilePlayer:
         mock_player = Mock()
 
         audio_file = 12345
-        payload = {"command": "name", "attributes": {"audio_file": audio_file}}
-        command_msg.payload = payload
+        payload = {"command": "play_local_audio_file", "attributes": {"audio_file": audio_file}}
 
         play_local_audio_file = audio.LocalAudioFilePlayer(mock_player, audio_dir)
-        play_local_audio_file.execute(command_msg)
+        call_via_callback_caller(play_local_audio_file, payload)
 
+        mock_player.play_file.assert_not_called()
         mock_logger.error.assert_any_call(''.join(['A CommandMessage for the callback: \'play_local_audio_file\'',
                                                    'must be of the form:\n{"command": ',
                                                    '"play_local_audio_file", "attributes": ',
-                                                   '{"audio_file": "<str>"}}']))
+                                                   '{"audio_file": <str>}}']))
 
 
 
@@ -206,6 +295,7 @@ class TestChangeSpeakerVolume:
 
         volume_changer = audio.ChangeSpeakerVolume(platform_os=platform_os,
                                              set_speaker_volume=mock_speaker_vol_setter)
+        command_msg.arguments = extract_arguments(volume_changer, command_msg)
         volume_changer.execute(command_msg)
 
         mock_speaker_vol_setter.assert_called_with(volume_percent)
@@ -214,13 +304,14 @@ class TestChangeSpeakerVolume:
     @patch('mqtt_remote.message.logger')
     def test_execute_command_message_wrong_attribute(self, mock_logger, command_msg,
                                                      volume_percent, platform_os):
-        payload = {"command": "name", "attributes": {'vol_SCALAR': volume_percent}}
-        command_msg.payload = payload
+        payload = {"command": "change_speaker_volume", "attributes": {'vol_SCALAR': volume_percent}}
         mock_speaker_vol_setter = Mock()
 
         volume_changer = audio.ChangeSpeakerVolume(platform_os=platform_os,
                                              set_speaker_volume=mock_speaker_vol_setter)
-        volume_changer.execute(command_msg)
+        call_via_callback_caller(volume_changer, payload)
+
+        mock_speaker_vol_setter.assert_not_called()
 
         error_message = ''.join([f'A CommandMessage for the callback: \'{volume_changer.message_name}\'',
                                  f'must be of the form:\n{volume_changer.required_message_form}'])
@@ -230,19 +321,35 @@ class TestChangeSpeakerVolume:
     @patch('mqtt_remote.message.logger')
     def test_execute_command_message_wrong_type(self, mock_logger, command_msg,
                                                 volume_percent, platform_os):
-        payload = {"command": "name", "attributes": {'vol_percent': str(volume_percent)}}
-        command_msg.payload = payload
+        payload = {"command": "change_speaker_volume", "attributes": {'vol_percent': str(volume_percent)}}
         mock_speaker_vol_setter = Mock()
 
         volume_changer = audio.ChangeSpeakerVolume(platform_os=platform_os,
                                              set_speaker_volume=mock_speaker_vol_setter)
-        volume_changer.execute(command_msg)
+        call_via_callback_caller(volume_changer, payload)
+
+        mock_speaker_vol_setter.assert_not_called()
 
         error_message = ''.join([f'A CommandMessage for the callback: \'{volume_changer.message_name}\'',
                                  f'must be of the form:\n{volume_changer.required_message_form}'])
         mock_logger.error.assert_any_call(error_message)
 
 
+    @patch('mqtt_remote.message.logger')
+    def test_execute_command_message_out_of_range(self, mock_logger, platform_os):
+        payload = {"command": "change_speaker_volume", "attributes": {'vol_percent': 101}}
+        mock_speaker_vol_setter = Mock()
+
+        volume_changer = audio.ChangeSpeakerVolume(platform_os=platform_os,
+                                             set_speaker_volume=mock_speaker_vol_setter)
+        call_via_callback_caller(volume_changer, payload)
+
+        mock_speaker_vol_setter.assert_not_called()
+        error_message = ''.join([f'A CommandMessage for the callback: \'{volume_changer.message_name}\'',
+                                 f'must be of the form:\n{volume_changer.required_message_form}'])
+        mock_logger.error.assert_any_call(error_message)
+
+
     def test_other_volume(self):
         mock_other_volume = Mock()
 
@@ -263,7 +370,7 @@ class TestChangeSpeakerVolume:
     def test_required_message_form(self, platform_os):
         message_name = 'change_speaker_volume'
         required_message = ''.join([f'{{"command": "{message_name}", ',
-                                    '"attributes": {"vol_percent": <int>}}'])
+                                    '"attributes": {"vol_percent": <int: 0 to 100>}}'])
 
         volume_changer = audio.ChangeSpeakerVolume(platform_os, '')
 
@@ -281,31 +388,55 @@ class TestGetSpeakerVolume:
                                "attributes": {"return_message": {"topic": "topic",
                                                                  "qos": 0,
                                                                  "retain": False}}}
+        command_msg.response_topic = None
 
         get_speaker_volume = audio.GetSpeakerVolume(platform_os, mock_get_speaker_volume)
         get_speaker_volume.mqtt_publish = mock_mqtt_publish
+        command_msg.arguments = extract_arguments(get_speaker_volume, command_msg)
         get_speaker_volume.execute(command_msg)
 
         mock_mqtt_publish.assert_called_with(command_msg.topic, expected_volume_message,
                                              command_msg.qos, command_msg.retain)
 
 
-    def test_execute_incorrect_message(self, command_msg, volume_percent, platform_os):
+    def test_execute_incorrect_message(self, volume_percent, platform_os):
+        mock_mqtt_publish = Mock()
         mock_get_speaker_volume = Mock()
         mock_get_speaker_volume.return_value = [['Master', [volume_percent]]]
-        command_msg.payload = {"command": "get_speaker_volume",
-                               "attributes": {"return_message": {"TOPIC_WRONG": "topic",
-                                                                 "qos": 0,
-                                                                 "retain": False}}}
+        payload = {"command": "get_speaker_volume",
+                   "attributes": {"return_message": {"TOPIC_WRONG": "topic",
+                                                     "qos": 0,
+                                                     "retain": False}}}
 
-        with patch('mqtt_remote_audio.audio.log_wrong_command_message_form') as mock_log_wrong_command_message_form:
+        with patch('mqtt_remote.message.log_wrong_command_message_form') as mock_log_wrong_command_message_form:
             get_speaker_volume = audio.GetSpeakerVolume(platform_os, mock_get_speaker_volume)
-            get_speaker_volume.execute(command_msg)
+            get_speaker_volume.mqtt_publish = mock_mqtt_publish
+            call_via_callback_caller(get_speaker_volume, payload)
 
+        mock_mqtt_publish.assert_not_called()
         mock_log_wrong_command_message_form.assert_called_with(get_speaker_volume.message_name,
                                                get_speaker_volume.required_message_form)
 
 
+    def test_execute_response_topic(self, volume_percent, platform_os):
+        mock_mqtt_publish = Mock()
+        mock_get_speaker_volume = Mock()
+        mock_get_speaker_volume.return_value = [['Master', [volume_percent]]]
+        command_msg = CommandMessage('topic', {"command": "get_speaker_volume",
+                                               "attributes": {}}, 1, False)
+        command_msg.response_topic = 'reply'
+        command_msg.correlation_data = b'1'
+
+        get_speaker_volume = audio.GetSpeakerVolume(platform_os, mock_get_speaker_volume)
+        get_speaker_volume.mqtt_publish = mock_mqtt_publish
+        command_msg.arguments = extract_arguments(get_speaker_volume, command_msg)
+        get_speaker_volume.execute(command_msg)
+
+        assert command_msg.arguments is not None
+        assert mock_mqtt_publish.call_args[0][0::2] == ('reply', 1)
+        assert mock_mqtt_publish.call_args[1]['properties'].CorrelationData == b'1'
+
+
     def test_other_volume(self):
         mock_other_volume = Mock()
 
@@ -325,8 +456,8 @@ class TestGetSpeakerVolume:
     def test_required_message_form(self, platform_os):
         required_message_form = ''.join(['{"command": "get_speaker_volume", ',
                                          '"attributes": {"return_message": {'
-                                         '"topic": <str>,'
-                                         '"qos": <int>'
+                                         '"topic": <str>, '
+                                         '"qos": <int: 0 to 2>, '
                                          '"retain": <bool>}}}'])
         mock_get_speaker_volume = Mock()
 
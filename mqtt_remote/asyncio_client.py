@@ -0,0 +1,916 @@
+"""Asyncio MQTT client related functionality
+
+An alternative to mqtt_client.MQTTClient that speaks MQTT 3.1 / 3.1.1 over TCP using asyncio
+streams instead of paho's network loop. Receiving a message, calling the on message callbacks
+and publishing from them all happen on the one event loop thread, without locks or handing
+messages between threads. Coroutines returned by callbacks can be scheduled as tasks on the same
+loop, see 'event_loop', whilst callbacks that block run on the dispatch engine's worker threads.
+
+Examples:
+
+    To create, initialise and start an asyncio MQTT client (it takes the same arguments as
+    mqtt_client.MQTTClient):
+
+        .. code-block:: python
+
+            mqtt_software_client = AsyncioMQTTClient(broker_user_name, broker_password,
+                                                     broker_ip, broker_port, broker_keepalive,
+                                                     subscription_topics, mqtt_client_id,
+                                                     mqtt_clean_session, mqtt_protocol,
+                                                     mqtt_transport, log_client)
+            mqtt_software_client.on_message_callbacks.add(callback)
+            mqtt_software_client.initialise()
+            mqtt_software_client.start('blocking')
+
+
+    To publish a message, from any thread:
+
+        .. code-block:: python
+
+            mqtt_software_client.publish(topic, message, qos, retain)
+
+
+    To wait for the broker to acknowledge a QoS 1 message:
+
+        .. code-block:: python
+
+            latency = mqtt_software_client.publish(topic, message, 1, retain).wait(timeout=5)
+"""
+from collections import deque, OrderedDict
+import asyncio
+import itertools
+import logging
+import struct
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from mqtt_remote import metrics
+from mqtt_remote.histogram import LatencyHistogram
+from mqtt_remote.middleware import MiddlewarePipeline
+from mqtt_remote.mqtt_client import CallbackSet, OutboundQueueFullError, PublishHandle
+from mqtt_remote.reconnect import ReconnectSupervisor
+
+
+
+# pylint: disable=C0103
+logger = logging.getLogger(__name__)
+# pylint: enable=C0103
+
+
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+PUBREC = 0x50
+PUBREL = 0x62
+PUBCOMP = 0x70
+SUBSCRIBE = 0x82
+SUBACK = 0x90
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+MAX_REMAINING_LENGTH = 268435455
+
+
+
+def encode_remaining_length(length):
+    """Returns the MQTT variable length encoding of a packet's remaining length
+
+    Args:
+        length (int): The remaining length
+
+    Returns:
+        bytes: The encoded length
+
+    Raises:
+        ValueError: if the length is too large for an MQTT packet
+    """
+    if length > MAX_REMAINING_LENGTH:
+        raise ValueError(f'MQTT packet too large ({length} bytes)')
+
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(string):
+    """Returns the MQTT encoding of a UTF-8 string, or bytes, prefixed with its length
+    """
+    encoded = string.encode('utf-8') if isinstance(string, str) else string
+    return struct.pack('!H', len(encoded)) + encoded
+
+
+def encode_packet(first_byte, body=b''):
+    """Returns an MQTT packet
+
+    Args:
+        first_byte (int): The packet type and flags
+        body (bytes, optional): The variable header and payload. Defaults to b''.
+
+    Returns:
+        bytes: The packet
+    """
+    return bytes([first_byte]) + encode_remaining_length(len(body)) + body
+
+
+async def read_packet(reader):
+    """Reads an MQTT packet
+
+    Args:
+        reader (asyncio.StreamReader): The stream to read from
+
+    Returns:
+        Tuple[int, bytes]: The packet type and flags, and the variable header and payload
+
+    Raises:
+        asyncio.IncompleteReadError: if the connection is closed part way through a packet
+        ValueError: if the packet's remaining length is malformed
+    """
+    first_byte = (await reader.readexactly(1))[0]
+
+    length = 0
+    for shift in range(0, 28, 7):
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) << shift
+        if not byte & 0x80:
+            break
+    else:
+        raise ValueError('Malformed MQTT packet remaining length')
+
+    body = await reader.readexactly(length) if length else b''
+    return first_byte, body
+
+
+def payload_bytes(payload):
+    """Returns a publish payload as bytes, accepting the same payload types as paho
+
+    Raises:
+        TypeError: if the payload is of an unsupported type
+    """
+    if payload is None:
+        return b''
+    if isinstance(payload, (bytes, bytearray)):
+        return bytes(payload)
+    if isinstance(payload, str):
+        return payload.encode('utf-8')
+    if isinstance(payload, (int, float)):
+        return str(payload).encode('ascii')
+    raise TypeError('payload must be a string, bytearray, int, float or None.')
+
+
+
+class _Outgoing:
+    """A message published through the client but not yet confirmed as sent
+    """
+    __slots__ = ('mid', 'qos', 'packet', 'handle', 'journal_entry', 'released')
+
+    def __init__(self, mid, topic, payload, qos, retain, handle, journal_entry=None):
+        body = encode_string(topic)
+        if qos:
+            body += struct.pack('!H', mid)
+        self.mid = mid
+        self.qos = qos
+        self.packet = encode_packet(PUBLISH | qos << 1 | int(bool(retain)),
+                                    body + payload_bytes(payload))
+        self.handle = handle
+        self.handle.mid = mid
+        self.journal_entry = journal_entry
+        self.released = False
+
+
+    @property
+    def published(self):
+        return self.handle.published
+
+
+
+class AsyncioMQTTClient:
+    """MQTT client built on asyncio streams
+
+    Offers the same methods and attributes as mqtt_client.MQTTClient. 'mqtt_transport' must be
+    'tcp' and 'mqtt_protocol' MQTT 3.1 or 3.1.1. Publishes made on the event loop thread are
+    written straight to the connection; publishes made on other threads are handed to the event
+    loop. Everything written during one iteration of the event loop is sent together, or, if
+    'coalesce_window' is set, everything written within the window.
+
+    Attributes:
+        See mqtt_client.MQTTClient
+    """
+    def __init__(self, broker_user_name, broker_password,
+                 broker_ip, broker_port, broker_keepalive,
+                 subscription_topics, mqtt_client_id,
+                 mqtt_clean_session, mqtt_protocol,
+                 mqtt_transport, log_client, coalesce_window=0,
+                 max_inflight=20, max_queued=0, queue_full_policy='block',
+                 queue_full_timeout=5.0, journal=None, reconnect_supervisor=None,
+                 receive_maximum=0, topic_alias_maximum=0, delivery_timeout=0):
+        """Constructor
+
+        Args:
+            See mqtt_client.MQTTClient. 'receive_maximum' and 'topic_alias_maximum' are
+            accepted for compatibility but unused as they only apply to MQTT 5.
+            'delivery_timeout' is accepted but unused as the client's message ids are its own
+            and its inflight messages are bounded by 'max_inflight'.
+
+        Raises:
+            ValueError: if an unacceptable queue_full_policy is provided
+        """
+        if queue_full_policy not in ('block', 'drop', 'raise'):
+            raise ValueError(''.join(['AsyncioMQTTClient \'queue_full_policy\' argument can ',
+                                      'only be \'block\', \'drop\' or \'raise\'']))
+
+        self.broker_user_name = broker_user_name
+        self.broker_password = broker_password
+        self.broker_ip = broker_ip
+        self.broker_port = broker_port
+        self.broker_keepalive = broker_keepalive
+        self.subscription_topics = subscription_topics
+        self.mqtt_client_id = mqtt_client_id
+        self.mqtt_clean_session = mqtt_clean_session
+        self.mqtt_protocol = mqtt_protocol
+        self.mqtt_transport = mqtt_transport
+        self.log_client = log_client
+        self.coalesce_window = coalesce_window
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.queue_full_policy = queue_full_policy
+        self.queue_full_timeout = queue_full_timeout
+        self.journal = journal
+        self.reconnect_supervisor = reconnect_supervisor or ReconnectSupervisor()
+        self.receive_maximum = receive_maximum
+        self.topic_alias_maximum = topic_alias_maximum
+        self.delivery_timeout = delivery_timeout
+        self.delivery_latency = LatencyHistogram()
+
+        self.middleware = MiddlewarePipeline()
+        self.on_message_callbacks = CallbackSet()
+        self.initialised = False
+
+        self._loop = None
+        self._loop_thread = None
+        self._loop_thread_id = None
+        self._run_task = None
+        self._stopping = None
+        self._finished = threading.Event()
+
+        self._reader = None
+        self._writer = None
+        self._write_buffer = bytearray()
+        self._flush_scheduled = False
+        self._connected = False
+        self._subscribed = False
+        self._subscription_mid = None
+        self._last_received = 0.0
+
+        self._mids = itertools.count()
+        self._handoff = deque()
+        self._queued = deque()
+        self._inflight = OrderedDict()
+        self._inbound_qos2 = set()
+
+        self._space_condition = threading.Condition()
+        self._blocked_publishers = 0
+        self._outbound_stats = {'sent': 0, 'dropped': 0, 'blocked': 0, 'expired': 0,
+                                'time_in_queue_total': 0.0, 'time_in_queue_max': 0.0}
+
+
+    def initialise(self):
+        """Gets the client ready to start
+
+        Raises:
+            ValueError: if the transport isn't 'tcp' or the protocol isn't MQTT 3.1 or 3.1.1
+        """
+        if self.mqtt_transport != 'tcp':
+            raise ValueError('AsyncioMQTTClient only supports the \'tcp\' transport')
+
+        if self.mqtt_protocol not in (mqtt.MQTTv31, mqtt.MQTTv311):
+            raise ValueError('AsyncioMQTTClient only supports MQTT 3.1 and 3.1.1')
+
+        if self.journal is not None:
+            self.journal.open()
+
+        self._loop = asyncio.new_event_loop()
+        self.initialised = True
+
+
+    def start(self, loop_type):
+        """Starts the client
+
+        The client keeps trying to connect to the broker, waiting between attempts as decided
+        by 'self.reconnect_supervisor', until it succeeds and reconnects whenever the
+        connection is lost
+
+        Args:
+            loop_type (str): determines in which mode the client is run:
+                'blocking': the event loop runs on the calling thread until the client stops
+                'non_blocking': the event loop runs on a new thread
+
+        Raises:
+            RuntimeError: if the client has not been initialised prior to using this method
+            ValueError: if an unacceptable loop_type is provided
+        """
+        if not self.initialised:
+            raise RuntimeError('AsyncioMQTTClient has not been initialised')
+
+        if loop_type not in ('blocking', 'non_blocking'):
+            error = ''.join(['AsyncioMQTTClient.start() \'loop_type\' argument ',
+                             'can only be \'blocking\' or \'non_blocking\''])
+            raise ValueError(error)
+
+        self._stopping = asyncio.Event()
+        self._finished.clear()
+        self._run_task = self._loop.create_task(self._run())
+
+        logger.info("AsyncioMQTTClient has started")
+
+        if loop_type == 'blocking':
+            self._run_loop()
+        else:
+            self._loop_thread = threading.Thread(target=self._run_loop, daemon=True,
+                                                 name='mqtt_remote_asyncio')
+            self._loop_thread.start()
+
+
+    def _run_loop(self):
+        self._loop_thread_id = threading.get_ident()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._run_task)
+        finally:
+            self._loop_thread_id = None
+            self._finished.set()
+
+
+    def stop(self):
+        """Stops the client, disconnecting from the broker
+
+        Messages already written are sent first
+        """
+        if self._run_task is not None:
+            if self._on_loop_thread():
+                self._begin_shutdown()
+                return
+
+            if self._loop.is_running():
+                self._loop.call_soon_threadsafe(self._begin_shutdown)
+                self._finished.wait()
+            else:
+                self._begin_shutdown()
+                self._loop.run_until_complete(self._run_task)
+
+            if self._loop_thread is not None:
+                self._loop_thread.join()
+                self._loop_thread = None
+            self._run_task = None
+
+        if self.journal is not None:
+            self.journal.close()
+
+        logger.info("AsyncioMQTTClient has stopped")
+
+
+    def _begin_shutdown(self):
+        """Disconnects from the broker, which ends '_run', on the event loop thread
+        """
+        self._stopping.set()
+
+        if self._writer is not None:
+            self._write(encode_packet(DISCONNECT))
+            self._flush_writes()
+            self._close_connection()
+
+
+    @property
+    def event_loop(self):
+        """asyncio.AbstractEventLoop: The event loop the client runs on, None until initialised
+        """
+        return self._loop
+
+
+    def _on_loop_thread(self):
+        return threading.get_ident() == self._loop_thread_id
+
+
+    def pending_publish_count(self):
+        """Returns the number of published messages not yet confirmed as sent to the broker
+
+        Returns:
+            int: The number of pending publishes
+        """
+        return len(self._handoff) + len(self._queued) + len(self._inflight)
+
+
+    @property
+    def subscribed(self):
+        """bool: Whether the broker has confirmed the client's subscriptions on the current
+        connection
+        """
+        return self._subscribed
+
+
+    def connection_metrics(self):
+        """Returns metrics describing the connection to the broker
+
+        Returns:
+            dict: See 'ReconnectSupervisor.metrics'
+        """
+        return self.reconnect_supervisor.metrics()
+
+
+    def outbound_metrics(self):
+        """Returns metrics describing the outbound queue
+
+        Returns:
+            dict: See 'mqtt_client.MQTTClient.outbound_metrics'
+        """
+        stats = dict(self._outbound_stats)
+        oldest = None
+        for pending in (self._handoff, self._queued, self._inflight.values()):
+            for outgoing in list(pending)[:1]:
+                if oldest is None or outgoing.published < oldest:
+                    oldest = outgoing.published
+
+        time_in_queue_total = stats.pop('time_in_queue_total')
+        stats['time_in_queue_avg'] = time_in_queue_total / stats['sent'] if stats['sent'] else 0.0
+        stats['queue_depth'] = self.pending_publish_count()
+        stats['inflight'] = len(self._inflight)
+        stats['oldest_age'] = time.monotonic() - oldest if oldest is not None else 0.0
+        stats['delivery_latency_p50'] = self.delivery_latency.percentile(50)
+        stats['delivery_latency_p99'] = self.delivery_latency.percentile(99)
+        return stats
+
+
+    def _admit_publish(self):
+        """Applies the queue full policy if the outbound queue is full
+
+        Returns:
+            bool: True if the message can be published, False if it must be dropped
+
+        Raises:
+            OutboundQueueFullError: if the queue is full and the policy is 'raise'
+        """
+        if not self.max_queued or self.pending_publish_count() < self.max_queued:
+            return True
+
+        if self.queue_full_policy == 'raise':
+            raise OutboundQueueFullError(f'Outbound queue is full (max_queued: '
+                                         f'{self.max_queued})')
+
+        if self.queue_full_policy == 'block' and not self._on_loop_thread():
+            self._outbound_stats['blocked'] += 1
+            deadline = time.monotonic() + self.queue_full_timeout
+            with self._space_condition:
+                self._blocked_publishers += 1
+                try:
+                    while self.pending_publish_count() >= self.max_queued:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        # Acknowledgements notify without taking the condition's lock first, so
+                        # a notification can be missed; waiting in short steps bounds the delay
+                        self._space_condition.wait(min(remaining, 0.05))
+                    else:
+                        return True
+                finally:
+                    self._blocked_publishers -= 1
+
+        self._outbound_stats['dropped'] += 1
+        metrics.MESSAGES_DROPPED.inc(labels=('outbound_queue_full',))
+        logger.warning(f"Outbound queue is full: message dropped (max_queued: {self.max_queued})")
+        return False
+
+
+    def _new_outgoing(self, topic, message, qos, retain, handle=None):
+        metrics.MESSAGES_PUBLISHED.inc()
+        mid = next(self._mids) % 65535 + 1
+        journal_entry = None
+        if self.journal is not None and qos > 0:
+            journal_entry = self.journal.append(topic, message, qos, retain)
+        return _Outgoing(mid, topic, message, qos, retain, handle or PublishHandle(topic, qos),
+                         journal_entry)
+
+
+    def _submit(self, outgoing):
+        """Sends an outgoing message from the event loop thread, or hands it to the event loop
+        """
+        if self._on_loop_thread():
+            self._enqueue(outgoing)
+        else:
+            self._handoff.append(outgoing)
+            self._loop.call_soon_threadsafe(self._take_handoff)
+
+
+    def publish(self, topic, message, qos, retain):
+        """Requests that the client sends an MQTT message to the broker for publishing
+
+        Args:
+            See mqtt_client.MQTTClient.publish
+
+        Returns:
+            mqtt_client.PublishHandle: Resolves once the message is confirmed as sent, or fails
+                if the message was dropped
+
+        Raises:
+            RuntimeError: if the client has not been initialised prior to using this method
+            OutboundQueueFullError: if the outbound queue is full and the queue full policy is
+                'raise'
+        """
+        if not self.initialised:
+            raise RuntimeError('AsyncioMQTTClient has not been initialised')
+
+        handle = PublishHandle(topic, qos)
+        if self._admit_publish():
+            self._submit(self._new_outgoing(topic, message, qos, retain, handle))
+        else:
+            handle._fail('Outbound queue is full: message dropped')
+        return handle
+
+
+    def publish_many(self, messages):
+        """Requests that the client sends several MQTT messages to the broker for publishing
+
+        Args:
+            messages (Iterable[Tuple]): [(<topic>, <message>, <qos>, <retain>), (...)]
+
+        Returns:
+            list[mqtt_client.PublishHandle]: A handle for each message, in the same order as
+                'messages', failed for any message dropped because the outbound queue was full
+
+        Raises:
+            RuntimeError: if the client has not been initialised prior to using this method
+            OutboundQueueFullError: if the outbound queue is full and the queue full policy is
+                'raise'
+        """
+        if not self.initialised:
+            raise RuntimeError('AsyncioMQTTClient has not been initialised')
+
+        handles = []
+        for topic, message, qos, retain in messages:
+            handle = PublishHandle(topic, qos)
+            if self._admit_publish():
+                self._submit(self._new_outgoing(topic, message, qos, retain, handle))
+            else:
+                handle._fail('Outbound queue is full: message dropped')
+            handles.append(handle)
+
+        logger.debug("%d messages submitted for sending", len(handles))
+        return handles
+
+
+    def _take_handoff(self):
+        while self._handoff:
+            self._enqueue(self._handoff.popleft())
+
+
+    def _enqueue(self, outgoing):
+        """Sends a QoS 0 message, or queues a QoS 1 or 2 message until an inflight slot is free
+        """
+        if outgoing.qos:
+            self._queued.append(outgoing)
+            self._send_queued()
+            return
+
+        if not self._connected:
+            self._outbound_stats['dropped'] += 1
+            metrics.MESSAGES_DROPPED.inc(labels=('not_connected',))
+            logger.warning("".join(["Message publishing: preperation error or ",
+                                    "problem connecting to MQTT Broker: ",
+                                    f"{mqtt.error_string(mqtt.MQTT_ERR_NO_CONN)} ",
+                                    f"(mid: {outgoing.mid})"]))
+            outgoing.handle._fail(mqtt.error_string(mqtt.MQTT_ERR_NO_CONN))
+            return
+
+        self._write(outgoing.packet)
+        self._sent(outgoing)
+
+
+    def _send_queued(self):
+        while (self._connected and self._queued
+               and (not self.max_inflight or len(self._inflight) < self.max_inflight)):
+            outgoing = self._queued.popleft()
+            self._inflight[outgoing.mid] = outgoing
+            self._write(outgoing.packet)
+
+
+    def _sent(self, outgoing):
+        """Records a message confirmed as sent
+        """
+        delivered = time.monotonic()
+        time_in_queue = delivered - outgoing.published
+        self.delivery_latency.observe(time_in_queue)
+        metrics.PUBLISH_LATENCY.observe(time_in_queue)
+        self._outbound_stats['sent'] += 1
+        self._outbound_stats['time_in_queue_total'] += time_in_queue
+        self._outbound_stats['time_in_queue_max'] = max(self._outbound_stats['time_in_queue_max'],
+                                                        time_in_queue)
+
+        if outgoing.journal_entry is not None:
+            self.journal.acknowledge(outgoing.journal_entry)
+
+        if self._blocked_publishers:
+            with self._space_condition:
+                self._space_condition.notify_all()
+
+        outgoing.handle._deliver(delivered)
+
+        logger.debug("Message successfully sent to the MQTT Broker (mid: %s)", outgoing.mid)
+
+
+    def _write(self, packet):
+        """Buffers a packet, to be written with everything else written in this iteration of
+        the event loop, or within the coalesce window
+        """
+        self._write_buffer += packet
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            if self.coalesce_window:
+                self._loop.call_later(self.coalesce_window, self._flush_writes)
+            else:
+                self._loop.call_soon(self._flush_writes)
+
+
+    def _flush_writes(self):
+        self._flush_scheduled = False
+        if self._write_buffer and self._writer is not None and not self._writer.is_closing():
+            self._writer.write(bytes(self._write_buffer))
+        self._write_buffer.clear()
+
+
+    def _close_connection(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+    async def _run(self):
+        """Connects to the broker and processes the connection until the client is stopped,
+        reconnecting whenever the connection is lost
+        """
+        while not self._stopping.is_set():
+            try:
+                await self._connect()
+            except (OSError, EOFError, ValueError, asyncio.TimeoutError) as error:
+                self._connection_lost()
+                if self._stopping.is_set():
+                    break
+                delay = self.reconnect_supervisor.connection_failed()
+                logger.warning(''.join([f"Unable to connect to MQTT Broker ({error}), ",
+                                        f"retrying in {delay:.1f} s"]))
+                await self._wait_unless_stopping(delay)
+                continue
+
+            if self._stopping.is_set():
+                self._begin_shutdown()
+                self._connection_lost()
+                break
+
+            try:
+                await self._process_connection()
+            except (OSError, EOFError, ValueError, asyncio.TimeoutError):
+                pass
+            finally:
+                self._connection_lost()
+
+            if self._stopping.is_set():
+                break
+
+            delay = self.reconnect_supervisor.disconnected()
+            logger.warning(''.join(["Unexpected loss of connection to MQTT Broker, ",
+                                    f"reconnecting in {delay:.1f} s"]))
+            await self._wait_unless_stopping(delay)
+
+
+    async def _wait_unless_stopping(self, delay):
+        try:
+            await asyncio.wait_for(self._stopping.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+
+    def _connect_packet(self):
+        if self.mqtt_protocol == mqtt.MQTTv31:
+            variable_header = encode_string('MQIsdp') + bytes([3])
+        else:
+            variable_header = encode_string('MQTT') + bytes([4])
+
+        flags = 0x02 if self.mqtt_clean_session else 0
+        payload = encode_string(self.mqtt_client_id)
+        if self.broker_user_name:
+            flags |= 0x80
+            payload += encode_string(self.broker_user_name)
+            if self.broker_password is not None:
+                flags |= 0x40
+                payload += encode_string(self.broker_password)
+
+        variable_header += bytes([flags]) + struct.pack('!H', self.broker_keepalive)
+        return encode_packet(CONNECT, variable_header + payload)
+
+
+    async def _connect(self):
+        """Opens the connection to the broker and waits for it to accept the session
+
+        Raises:
+            ConnectionRefusedError: if the broker refuses the session
+        """
+        timeout = self.reconnect_supervisor.connect_timeout
+        address = self.reconnect_supervisor.address(self.broker_ip, self.broker_port)
+
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(address, self.broker_port), timeout)
+        self._writer.write(self._connect_packet())
+
+        packet_type, body = await asyncio.wait_for(read_packet(self._reader), timeout)
+        if packet_type != CONNACK or len(body) != 2:
+            raise ValueError('MQTT Broker did not reply with a CONNACK')
+
+        if body[1] != 0:
+            logger.warning(f"{mqtt.connack_string(body[1])}")
+            raise ConnectionRefusedError(mqtt.connack_string(body[1]))
+
+        logger.info("Connection accepted by MQTT Broker")
+        self._connected = True
+        self._last_received = time.monotonic()
+        downtime = self.reconnect_supervisor.connected()
+        if downtime is not None:
+            logger.info(f"Reconnected to MQTT Broker after {downtime:.1f} s")
+
+        self._subscribe()
+        self._resend_inflight()
+        self._replay_journal()
+        self._take_handoff()
+        self._send_queued()
+
+
+    def _subscribe(self):
+        subscriptions = [sub[0] for sub in self.subscription_topics]
+        self._subscription_mid = next(self._mids) % 65535 + 1
+
+        body = struct.pack('!H', self._subscription_mid)
+        for topic, qos in self.subscription_topics:
+            body += encode_string(topic) + bytes([qos])
+        self._write(encode_packet(SUBSCRIBE, body))
+
+        logger.info(''.join([f"Subscribe request for {subscriptions} successfully",
+                             f" submitted to MQTT Broker (mid: {self._subscription_mid})"]))
+
+
+    def _resend_inflight(self):
+        """Sends the messages that were inflight when the connection was lost again
+        """
+        for outgoing in self._inflight.values():
+            if outgoing.released:
+                self._write(encode_packet(PUBREL, struct.pack('!H', outgoing.mid)))
+            else:
+                self._write(bytes([outgoing.packet[0] | 0x08]) + outgoing.packet[1:])
+
+
+    def _replay_journal(self):
+        """Queues the journaled messages the client doesn't hold, i.e. those journaled before a
+        restart
+        """
+        if self.journal is None:
+            return
+
+        held = {outgoing.journal_entry
+                for pending in (self._handoff, self._queued, self._inflight.values())
+                for outgoing in pending}
+        entries = [entry for entry in self.journal.pending() if entry[0] not in held]
+        if entries:
+            logger.info(f"Replaying {len(entries)} journaled messages")
+
+        for journal_entry, topic, message, qos, retain in entries:
+            self._queued.append(_Outgoing(next(self._mids) % 65535 + 1, topic, message, qos,
+                                          retain, PublishHandle(topic, qos), journal_entry))
+
+
+    def _connection_lost(self):
+        self._connected = False
+        self._subscribed = False
+        self._write_buffer.clear()
+        self._close_connection()
+        self._reader = None
+        self._writer = None
+
+
+    async def _process_connection(self):
+        """Processes packets from the broker, and sends keep alive pings, until the connection
+        is lost or closed
+        """
+        keep_alive = None
+        if self.broker_keepalive:
+            keep_alive = self._loop.create_task(self._keep_alive())
+
+        try:
+            while True:
+                packet_type, body = await read_packet(self._reader)
+                self._last_received = time.monotonic()
+                self._process_packet(packet_type, body)
+        finally:
+            if keep_alive is not None:
+                keep_alive.cancel()
+
+
+    async def _keep_alive(self):
+        """Pings the broker every keepalive period, closing the connection if nothing has been
+        received from the broker for one and a half periods
+        """
+        while True:
+            await asyncio.sleep(self.broker_keepalive)
+            if time.monotonic() - self._last_received > 1.5 * self.broker_keepalive:
+                logger.warning("No response from MQTT Broker within the keepalive period")
+                self._close_connection()
+                return
+            self._write(encode_packet(PINGREQ))
+
+
+    def _process_packet(self, packet_type, body):
+        kind = packet_type & 0xF0
+
+        if kind == PUBLISH:
+            self._process_publish(packet_type, body)
+        elif kind in (PUBACK, PUBCOMP):
+            outgoing = self._inflight.pop(struct.unpack('!H', body[:2])[0], None)
+            if outgoing is not None:
+                self._sent(outgoing)
+                self._send_queued()
+        elif kind == PUBREC:
+            mid = struct.unpack('!H', body[:2])[0]
+            if mid in self._inflight:
+                self._inflight[mid].released = True
+            self._write(encode_packet(PUBREL, body[:2]))
+        elif kind == PUBREL & 0xF0:
+            self._inbound_qos2.discard(struct.unpack('!H', body[:2])[0])
+            self._write(encode_packet(PUBCOMP, body[:2]))
+        elif kind == SUBACK:
+            self._process_suback(body)
+
+
+    def _process_suback(self, body):
+        subscriptions = [sub[0] for sub in self.subscription_topics]
+        mid = struct.unpack('!H', body[:2])[0]
+
+        if mid == self._subscription_mid and 0x80 not in body[2:]:
+            logger.info(''.join([f"Subscribe request for {subscriptions} ",
+                                 f"successfully processed by MQTT Broker (mid: {mid})"]))
+            self._subscribed = True
+        else:
+            logger.warning(''.join([f"MQTT Broker reports subscribe request for {subscriptions}",
+                                    f" was unsuccessful (mid: {mid})"]))
+
+
+    def _process_publish(self, packet_type, body):
+        qos = (packet_type >> 1) & 0x03
+        topic_length = struct.unpack('!H', body[:2])[0]
+        position = 2 + topic_length
+        mid = 0
+        if qos:
+            mid = struct.unpack('!H', body[position:position + 2])[0]
+            position += 2
+
+        message = mqtt.MQTTMessage(mid, body[2:2 + topic_length])
+        message.payload = body[position:]
+        message.qos = qos
+        message.retain = bool(packet_type & 0x01)
+        message.dup = bool(packet_type & 0x08)
+
+        if qos == 2:
+            self._write(encode_packet(PUBREC, body[position - 2:position]))
+            if mid in self._inbound_qos2:
+                return
+            self._inbound_qos2.add(mid)
+
+        self._on_message(message)
+
+        if qos == 1:
+            self._write(encode_packet(PUBACK, body[position - 2:position]))
+
+
+    def _on_message(self, message):
+        """Passes a received message through the middleware stages and then to each of the on
+        message callbacks
+        """
+        metrics.MESSAGES_RECEIVED.inc()
+        middleware = self.middleware
+        if not middleware and not self.on_message_callbacks:
+            warning = ''.join(["MQTT message received but no 'on_message_callbacks' are set ",
+                               "for AsyncioMQTTClient"])
+            logger.warning(warning)
+            return
+
+        if middleware:
+            try:
+                middleware.process(message)
+            except Exception: # pylint: disable=broad-except
+                logger.exception('Unhandled exception in a middleware stage')
+
+        for callback in self.on_message_callbacks:
+            try:
+                callback(message)
+            except Exception: # pylint: disable=broad-except
+                logger.exception('Unhandled exception in an on message callback')
@@ -0,0 +1,378 @@
+"""Command audit journal related functionality
+
+The audit journal is an append only binary file with a record of every CommandMessage
+dispatched: when it was dispatched, how long its callback took, the outcome, its topic, its
+command and its payload. Each record is prefixed with its length, so a reader can skip
+records it isn't interested in without decoding them. The file is rotated when it reaches
+'max_size' bytes, like a rotating log file.
+
+Examples:
+
+    To create a journal of up to 6 files of 10 MiB each:
+
+        .. code-block:: python
+
+            audit_journal = AuditJournal('audit.bin', max_size=10485760, max_backups=5)
+            audit_journal.open()
+
+
+    To record a dispatched CommandMessage:
+
+        .. code-block:: python
+
+            audit_journal.append(command_message, OUTCOME_OK, latency)
+
+
+    To read the records back, e.g. after an incident:
+
+        .. code-block:: python
+
+            for audit_record in read_audit_journal('audit.bin'):
+                print(audit_record.command, audit_record.outcome, audit_record.latency)
+
+
+    To do the same from the command line, printing the records as JSON lines:
+
+        .. code-block:: none
+
+            mr_audit audit.bin.1 audit.bin --command volume_up --outcome error
+
+
+Attributes:
+    MAGIC (bytes): The bytes each audit journal file starts with
+    OUTCOME_OK (str): The outcome of a CommandMessage whose callback returned
+    OUTCOME_ERROR (str): The outcome of a CommandMessage whose callback raised an exception
+    OUTCOME_EXPIRED (str): The outcome of a CommandMessage dropped because its MQTT 5 message
+        expiry interval passed before it was dispatched
+    OUTCOME_REJECTED (str): The outcome of a CommandMessage that no callback was called for,
+        because none is registered for its command or its payload didn't match the schema
+"""
+from collections import namedtuple
+import argparse
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+
+from mqtt_remote import message
+
+
+
+# pylint: disable=C0103
+logger = logging.getLogger(__name__)
+# pylint: enable=C0103
+
+
+
+MAGIC = b'MRAUDIT1'
+
+OUTCOME_OK = 'ok'
+OUTCOME_ERROR = 'error'
+OUTCOME_EXPIRED = 'expired'
+OUTCOME_REJECTED = 'rejected'
+
+_OUTCOME_CODES = {OUTCOME_OK: 0, OUTCOME_ERROR: 1, OUTCOME_EXPIRED: 2, OUTCOME_REJECTED: 3}
+_OUTCOMES = {code: outcome for outcome, code in _OUTCOME_CODES.items()}
+
+# <record length> <timestamp> <latency> <outcome code> <topic length> <command length>
+_RECORD_HEADER = struct.Struct('>IdfBHH')
+_LENGTH = struct.Struct('>I')
+
+AuditRecord = namedtuple('AuditRecord', ['timestamp', 'latency', 'outcome', 'topic', 'command',
+                                         'payload'])
+
+
+
+class AuditJournal:
+    """An append only, rotating, binary journal of the CommandMessages dispatched
+
+    Records are buffered in memory and written to the file by a background thread every
+    'flush_interval' seconds, and by 'append' if one is due, so appending doesn't cost a system
+    call per record and the last records before an idle period don't wait for the next one.
+    Errors writing the file are logged and counted, never raised, so a full disk can't stop
+    CommandMessages being dispatched.
+
+    Attributes:
+        path (str): The path of the current journal file. Rotated files have '.1', '.2', ...
+            appended, '.1' being the most recent.
+        max_size (int): The size, in bytes, at which the file is rotated. 0 means no limit.
+        max_backups (int): The number of rotated files kept
+        flush_interval (float): The maximum time, in seconds, that a record waits in memory
+        written (int): The number of records appended
+        failed (int): The number of records that couldn't be written
+    """
+    def __init__(self, path, max_size=10485760, max_backups=5, flush_interval=1.0):
+        """Constructor
+
+        Args:
+            path (str): The path of the journal file
+            max_size (int, optional): The size, in bytes, at which the file is rotated.
+                Defaults to 10485760.
+            max_backups (int, optional): The number of rotated files kept. Defaults to 5.
+            flush_interval (float, optional): The maximum time, in seconds, that a record
+                waits in memory. Defaults to 1.0.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.max_backups = max_backups
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.failed = 0
+
+        self._lock = threading.Lock()
+        self._file = None
+        self._size = 0
+        self._flushed = 0.0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+
+    def open(self):
+        """Opens the journal file, creating it if required, to append to, and starts writing
+        the records in memory every 'flush_interval' seconds
+        """
+        with self._lock:
+            if self._file is None:
+                self._open()
+
+        if self.flush_interval > 0 and self._thread is None:
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name='mqtt_remote_audit')
+            self._thread.start()
+
+
+    def _run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+
+    def _open(self):
+        """Opens the journal file, writing MAGIC if it's empty. The caller must hold
+        'self._lock'
+        """
+        self._file = open(self.path, 'ab')
+        self._size = self._file.tell()
+        if not self._size:
+            self._file.write(MAGIC)
+            self._size = len(MAGIC)
+        self._flushed = time.monotonic()
+
+
+    def close(self):
+        """Writes the records still in memory and closes the journal file
+        """
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+        with self._lock:
+            if self._file is None:
+                return
+            try:
+                self._file.close()
+            except OSError as error:
+                logger.warning(f"Audit journal '{self.path}' could not be closed: {error}")
+            self._file = None
+
+
+    def flush(self):
+        """Writes the records still in memory to the journal file
+        """
+        with self._lock:
+            if self._file is not None:
+                self._flush(time.monotonic())
+
+
+    def _flush(self, now):
+        """Writes the records in memory to the file. The caller must hold 'self._lock'
+        """
+        self._flushed = now
+        try:
+            self._file.flush()
+        except OSError as error:
+            self.failed += 1
+            logger.warning(f"Audit journal '{self.path}' could not be written: {error}")
+
+
+    def _rotate(self):
+        """Closes the file, shifts the rotated files along and starts a new file. The caller
+        must hold 'self._lock'
+        """
+        self._file.close()
+
+        for number in range(self.max_backups - 1, 0, -1):
+            source = f'{self.path}.{number}'
+            if os.path.exists(source):
+                os.replace(source, f'{self.path}.{number + 1}')
+
+        if self.max_backups:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+
+        self._open()
+
+
+    def append(self, command_message, outcome, latency, timestamp=None):
+        """Adds a record of a dispatched CommandMessage to the end of the journal
+
+        Does nothing if the journal hasn't been opened
+
+        Args:
+            command_message (CommandMessage): The CommandMessage dispatched
+            outcome (str): OUTCOME_OK, OUTCOME_ERROR, OUTCOME_EXPIRED or OUTCOME_REJECTED
+            latency (float): The time, in seconds, the callback took
+            timestamp (float, optional): The 'time.time()' time it was dispatched. Defaults to
+                None, i.e. now.
+        """
+        record = encode_record(command_message, outcome, latency, timestamp)
+
+        with self._lock:
+            if self._file is None:
+                return
+
+            try:
+                if self.max_size and self._size + len(record) > self.max_size:
+                    self._rotate()
+                self._file.write(record)
+            except OSError as error:
+                self.failed += 1
+                logger.warning(f"Audit journal '{self.path}' could not be written: {error}")
+                return
+
+            self._size += len(record)
+            self.written += 1
+
+            now = time.monotonic()
+            if now - self._flushed >= self.flush_interval:
+                self._flush(now)
+
+
+
+def encode_record(command_message, outcome, latency, timestamp=None):
+    """Encodes a record of a dispatched CommandMessage
+
+    Args:
+        command_message (CommandMessage): The CommandMessage dispatched
+        outcome (str): OUTCOME_OK, OUTCOME_ERROR, OUTCOME_EXPIRED or OUTCOME_REJECTED
+        latency (float): The time, in seconds, the callback took
+        timestamp (float, optional): The 'time.time()' time it was dispatched. Defaults to None,
+            i.e. now.
+
+    Returns:
+        bytes: The record, prefixed with its length
+    """
+    topic = str(command_message.topic).encode('utf-8')[:0xFFFF]
+    command = str(command_message.payload['command']).encode('utf-8')[:0xFFFF]
+    payload = json.dumps(message.redacted_payload(command_message.payload),
+                         separators=(',', ':'), default=str).encode('utf-8')
+
+    length = _RECORD_HEADER.size - _LENGTH.size + len(topic) + len(command) + len(payload)
+    header = _RECORD_HEADER.pack(length, time.time() if timestamp is None else timestamp,
+                                 latency, _OUTCOME_CODES[outcome], len(topic), len(command))
+    return b''.join([header, topic, command, payload])
+
+
+def read_audit_journal(path, command=None, outcome=None):
+    """Reads the records of an audit journal file, oldest first
+
+    Records can be filtered by command and outcome without decoding their payloads. A record
+    cut short, e.g. by the process being killed whilst writing it, ends the file.
+
+    Args:
+        path (str): The path of the journal file
+        command (str, optional): Only return the records of this command. Defaults to None.
+        outcome (str, optional): Only return the records with this outcome. Defaults to None.
+
+    Yields:
+        AuditRecord: 'timestamp': the 'time.time()' time it was dispatched,
+            'latency': the time, in seconds, the callback took,
+            'outcome': OUTCOME_OK, OUTCOME_ERROR, OUTCOME_EXPIRED or
+                OUTCOME_REJECTED,
+            'topic' and 'command': the CommandMessage's topic and command,
+            'payload': the CommandMessage's payload, encoded as JSON
+
+    Raises:
+        ValueError: if the file isn't an audit journal
+    """
+    command_bytes = None if command is None else command.encode('utf-8')
+
+    with open(path, 'rb') as journal_file:
+        if journal_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"'{path}' is not an MQTT Remote audit journal")
+
+        while True:
+            length_bytes = journal_file.read(_LENGTH.size)
+            if len(length_bytes) < _LENGTH.size:
+                return
+
+            length = _LENGTH.unpack(length_bytes)[0]
+            body = journal_file.read(length)
+            if len(body) < length:
+                return
+
+            (_, timestamp, latency, outcome_code, topic_length,
+             command_length) = _RECORD_HEADER.unpack_from(length_bytes + body)
+            record_outcome = _OUTCOMES.get(outcome_code, str(outcome_code))
+            if outcome is not None and record_outcome != outcome:
+                continue
+
+            start = _RECORD_HEADER.size - _LENGTH.size
+            record_command = body[start + topic_length:start + topic_length + command_length]
+            if command_bytes is not None and record_command != command_bytes:
+                continue
+
+            yield AuditRecord(timestamp, latency, record_outcome,
+                              body[start:start + topic_length].decode('utf-8', 'replace'),
+                              record_command.decode('utf-8', 'replace'),
+                              body[start + topic_length + command_length:])
+
+
+def parse_arguments(argv=None):
+    """Parses the command line arguments of 'mr_audit'
+
+    Args:
+        argv (list[str], optional): The arguments. Defaults to None, i.e. sys.argv[1:].
+
+    Returns:
+        argparse.Namespace: The parsed arguments
+    """
+    parser = argparse.ArgumentParser(prog='mr_audit',
+                                     description=''.join(['Prints the records of MQTT Remote ',
+                                                          'audit journal files as JSON lines']))
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='the journal files, in the order they\'re printed')
+    parser.add_argument('--command', default=None,
+                        help='only print the records of this command')
+    parser.add_argument('--outcome', default=None, choices=list(_OUTCOME_CODES),
+                        help='only print the records with this outcome')
+    return parser.parse_args(argv)
+
+
+def auto_audit(argv=None):
+    """Prints the records of audit journal files from the command line as JSON lines
+
+    This is the entry point for 'mr_audit'
+
+    Args:
+        argv (list[str], optional): The command line arguments. Defaults to None, i.e.
+            sys.argv[1:].
+
+    Returns:
+        int: 0
+    """
+    arguments = parse_arguments(argv)
+
+    for path in arguments.paths:
+        for audit_record in read_audit_journal(path, arguments.command, arguments.outcome):
+            record = audit_record._asdict()
+            record['payload'] = json.loads(audit_record.payload)
+            sys.stdout.write(json.dumps(record))
+            sys.stdout.write('\n')
+
+    return 0
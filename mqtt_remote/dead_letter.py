@@ -0,0 +1,270 @@
+"""Dead letter related functionality
+
+Examples:
+
+    To create a dead letter handler that publishes failures to a dead letter topic and
+    quarantines messages after three failures:
+
+        .. code-block:: python
+
+            dead_letter_handler = DeadLetterHandler(publish_function, 'mqtt_remote/dead_letter',
+                                                    quarantine_threshold=3)
+
+
+    To skip a quarantined raw MQTT message:
+
+        .. code-block:: python
+
+            fingerprint = dead_letter_handler.fingerprint(raw_message)
+            if dead_letter_handler.quarantined(fingerprint):
+                return
+
+
+    To record a failure to convert a raw MQTT message:
+
+        .. code-block:: python
+
+            dead_letter_handler.conversion_failed(raw_message, fingerprint, error)
+
+
+    To record a failure to execute the callback for a CommandMessage:
+
+        .. code-block:: python
+
+            dead_letter_handler.execution_failed(command_message, error)
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from mqtt_remote import message
+
+
+
+# pylint: disable=C0103
+logger = logging.getLogger(__name__)
+# pylint: enable=C0103
+
+
+
+class DeadLetterHandler:
+    """Counts conversion and execution failures, publishes them in a compact form to a dead
+    letter topic and quarantines messages that fail repeatedly
+
+    Messages are identified by a fingerprint, a digest of their topic and raw payload. Once a
+    fingerprint has failed 'quarantine_threshold' times it's quarantined and further messages
+    with the same fingerprint are skipped before they're decoded. Both the failure counts and
+    the quarantine are bounded, least recently used entries being evicted first.
+
+    Attributes:
+        mqtt_publish (Callable): A callable object to publish MQTT messages
+        topic (str): The dead letter topic. An empty string disables publishing.
+        qos (int): The Quality Of Service of dead letter messages
+        quarantine_threshold (int): The number of failures after which a fingerprint is
+            quarantined. 0 disables the quarantine.
+        quarantine_size (int): The maximum number of fingerprints tracked
+        quarantine_duration (float): The time, in seconds, that a fingerprint stays
+            quarantined. 0 means until it's evicted.
+        payload_excerpt (int): The maximum number of payload bytes included in a dead letter
+        max_per_second (int): The maximum number of dead letters published per second. Further
+            failures are still counted but not published. 0 means no limit.
+        counts (dict): The number of 'conversion' failures, 'execution' failures, 'quarantined'
+            messages skipped and dead letters 'suppressed' by 'max_per_second'
+    """
+    def __init__(self, mqtt_publish=None, topic='', qos=0, quarantine_threshold=3,
+                 quarantine_size=1024, quarantine_duration=300, payload_excerpt=256,
+                 max_per_second=10, clock=time.monotonic):
+        """Constructor
+
+        Args:
+            mqtt_publish (Callable, optional): A callable object to publish MQTT messages.
+                Defaults to None.
+            topic (str, optional): The dead letter topic. Defaults to ''.
+            qos (int, optional): The Quality Of Service of dead letter messages. Defaults to 0.
+            quarantine_threshold (int, optional): The number of failures after which a
+                fingerprint is quarantined. Defaults to 3.
+            quarantine_size (int, optional): The maximum number of fingerprints tracked.
+                Defaults to 1024.
+            quarantine_duration (float, optional): The time, in seconds, that a fingerprint
+                stays quarantined. Defaults to 300.
+            payload_excerpt (int, optional): The maximum number of payload bytes included in a
+                dead letter. Defaults to 256.
+            max_per_second (int, optional): The maximum number of dead letters published per
+                second. Defaults to 10.
+            clock (Callable, optional): Returns the current time in seconds. Defaults to
+                time.monotonic.
+        """
+        self.mqtt_publish = mqtt_publish
+        self.topic = topic
+        self.qos = qos
+        self.quarantine_threshold = quarantine_threshold
+        self.quarantine_size = quarantine_size
+        self.quarantine_duration = quarantine_duration
+        self.payload_excerpt = payload_excerpt
+        self.max_per_second = max_per_second
+        self.counts = {'conversion': 0, 'execution': 0, 'quarantined': 0, 'suppressed': 0}
+
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = OrderedDict()
+        self._quarantine = OrderedDict()
+        self._window_start = None
+        self._window_published = 0
+
+
+    @staticmethod
+    def _payload_bytes(payload):
+        if isinstance(payload, bytes):
+            return payload
+        return str(payload).encode('utf-8')
+
+
+    def fingerprint(self, raw_message):
+        """Returns the fingerprint of a raw MQTT message
+
+        Args:
+            raw_message (paho.mqtt.client.MQTTMessage): The raw MQTT message
+
+        Returns:
+            str: The fingerprint
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(str(raw_message.topic).encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(self._payload_bytes(raw_message.payload))
+        return digest.hexdigest()
+
+
+    def quarantined(self, fingerprint):
+        """Checks whether a fingerprint is quarantined, counting the check as a skipped message
+        if it is
+
+        Args:
+            fingerprint (str): The fingerprint of a raw MQTT message
+
+        Returns:
+            bool: True if the fingerprint is quarantined
+        """
+        if fingerprint not in self._quarantine:
+            return False
+
+        with self._lock:
+            expiry = self._quarantine.get(fingerprint)
+            if expiry is None:
+                return False
+
+            if expiry and expiry <= self._clock():
+                del self._quarantine[fingerprint]
+                logger.info(f"Message '{fingerprint}' released from quarantine")
+                return False
+
+            self._quarantine.move_to_end(fingerprint)
+            self.counts['quarantined'] += 1
+            return True
+
+
+    def conversion_failed(self, raw_message, fingerprint, error):
+        """Records a failure to convert a raw MQTT message into a CommandMessage
+
+        Args:
+            raw_message (paho.mqtt.client.MQTTMessage): The raw MQTT message
+            fingerprint (str): The fingerprint of the raw MQTT message
+            error (Exception, str): The reason for the failure
+        """
+        self._record('conversion', fingerprint, raw_message.topic,
+                     self._payload_bytes(raw_message.payload), None, error)
+
+
+    def execution_failed(self, command_message, error):
+        """Records a failure whilst executing the callback for a CommandMessage
+
+        Args:
+            command_message (CommandMessage): The CommandMessage
+            error (Exception): The exception raised by the callback
+        """
+        logger.error(f"Callback for '{command_message.payload['command']}' failed",
+                     exc_info=error)
+        payload = json.dumps(message.redacted_payload(command_message.payload),
+                             default=str).encode('utf-8')
+        self._record('execution', command_message.fingerprint, command_message.topic, payload,
+                     command_message.payload['command'], error)
+
+
+    def _record(self, stage, fingerprint, topic, payload, command, error):
+        """Counts a failure, quarantines its fingerprint if required and publishes a dead
+        letter
+        """
+        with self._lock:
+            self.counts[stage] += 1
+            failures = self._count_failure(fingerprint)
+            publish = topic != self.topic and self._publish_allowed()
+
+        logger.debug(f"{stage.capitalize()} failure {failures} for message '{fingerprint}'")
+
+        if publish:
+            self._publish_dead_letter(stage, fingerprint, failures, topic, payload, command,
+                                      error)
+
+
+    def _count_failure(self, fingerprint):
+        """Increments the failure count of a fingerprint, quarantining it once the count reaches
+        the threshold, and returns the count
+        """
+        if fingerprint is None:
+            return 1
+
+        failures = self._failures.pop(fingerprint, 0) + 1
+        self._failures[fingerprint] = failures
+        if len(self._failures) > self.quarantine_size:
+            self._failures.popitem(last=False)
+
+        if self.quarantine_threshold and failures >= self.quarantine_threshold:
+            self._failures.pop(fingerprint, None)
+            expiry = self._clock() + self.quarantine_duration if self.quarantine_duration else 0
+            self._quarantine[fingerprint] = expiry
+            if len(self._quarantine) > self.quarantine_size:
+                self._quarantine.popitem(last=False)
+            logger.warning(''.join([f"Message '{fingerprint}' quarantined after {failures} ",
+                                    "failures"]))
+
+        return failures
+
+
+    def _publish_allowed(self):
+        """Returns whether a dead letter can be published without exceeding 'max_per_second'
+        """
+        if not (self.topic and self.mqtt_publish):
+            return False
+
+        if not self.max_per_second:
+            return True
+
+        now = self._clock()
+        if self._window_start is None or now - self._window_start >= 1:
+            self._window_start = now
+            self._window_published = 0
+
+        if self._window_published >= self.max_per_second:
+            self.counts['suppressed'] += 1
+            return False
+
+        self._window_published += 1
+        return True
+
+
+    def _publish_dead_letter(self, stage, fingerprint, failures, topic, payload, command, error):
+        dead_letter = {'stage': stage,
+                       'fingerprint': fingerprint,
+                       'failures': failures,
+                       'topic': topic,
+                       'command': command,
+                       'error': error if isinstance(error, str)
+                                else f'{type(error).__name__}: {error}',
+                       'size': len(payload),
+                       'payload': payload[:self.payload_excerpt].decode('utf-8',
+                                                                        errors='replace')}
+
+        self.mqtt_publish(self.topic, json.dumps(dead_letter), self.qos, False)
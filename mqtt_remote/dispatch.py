@@ -0,0 +1,795 @@
+"""Dispatch related functionality
+
+Examples:
+
+    To create a stream publisher:
+
+        .. code-block:: python
+
+            stream_publisher = StreamPublisher(publish_function)
+
+
+    To publish the items yielded by a streaming callback:
+
+        .. code-block:: python
+
+            stream_publisher.publish_stream(command_message, items)
+
+
+    To create a dispatch engine that calls callbacks on a worker thread:
+
+        .. code-block:: python
+
+            dispatch_engine = DispatchEngine(callback_caller, stream_publisher, workers=1)
+
+
+    To start and stop the dispatch engine:
+
+        .. code-block:: python
+
+            dispatch_engine.start()
+            dispatch_engine.stop()
+
+
+    To submit a CommandMessage to the dispatch engine:
+
+        .. code-block:: python
+
+            dispatch_engine.submit(command_message)
+
+
+    To create a dispatch engine that batches CommandMessages for callbacks that implement
+    'execute_batch', flushing each batch at 32 CommandMessages or after 5 ms:
+
+        .. code-block:: python
+
+            dispatch_engine = DispatchEngine(callback_caller, stream_publisher, workers=1,
+                                             batch_max_items=32, batch_max_delay=0.005)
+
+
+    To create a dispatch engine that records every CommandMessage dispatched in an audit
+    journal:
+
+        .. code-block:: python
+
+            dispatch_engine = DispatchEngine(callback_caller, stream_publisher,
+                                             audit_journal=AuditJournal('audit.bin'))
+
+
+    To create a dispatch engine that reports callbacks that execute for longer than 5
+    seconds, with their stack:
+
+        .. code-block:: python
+
+            dispatch_engine = DispatchEngine(callback_caller, stream_publisher,
+                                             slow_callback_detector=SlowCallbackDetector(5.0))
+"""
+import asyncio
+from collections import namedtuple
+import functools
+import inspect
+import json
+import logging
+import queue
+import threading
+import time
+
+from mqtt_remote import audit, message, metrics, tracing
+
+
+
+# pylint: disable=C0103
+logger = logging.getLogger(__name__)
+# pylint: enable=C0103
+
+
+
+_STOP = object()
+
+# The command label that rejected CommandMessages are counted under, so that commands sent by a
+# remote peer can't add labels to the metrics
+_UNKNOWN_COMMAND = '<unknown>'
+
+_Batch = namedtuple('_Batch', ['command_name', 'command_messages'])
+
+
+
+class StreamPublisher:
+    """Publishes the items yielded by a streaming callback to the reply address of the inbound
+    CommandMessage, see 'message.reply_address', with its correlation data
+
+    A callback streams its results by returning a generator, or an async generator, from its
+    'execute' method instead of publishing them itself. 'str' and 'bytes' items are published
+    as they are, any other item is published as JSON.
+
+    Attributes:
+        mqtt_publish (Callable): A callable object to publish MQTT messages
+        batch_size (int): The number of items published together, as a JSON list, in a single
+            MQTT message. 1 publishes each item in a message of its own.
+        max_pending (int): The number of publishes that can be waiting to be sent to the
+            broker before publishing the next item waits for them to drain. 0 disables flow
+            control.
+        pending_publishes (Callable): Returns the number of publishes waiting to be sent to
+            the broker, e.g. 'MQTTClient.pending_publish_count'
+        flow_control_timeout (float): The maximum time, in seconds, to wait for pending
+            publishes to drain before publishing an item regardless
+    """
+    def __init__(self, mqtt_publish, batch_size=1, max_pending=0, pending_publishes=None,
+                 flow_control_timeout=5.0):
+        """Constructor
+
+        Args:
+            mqtt_publish (Callable): A callable object to publish MQTT messages
+            batch_size (int, optional): The number of items published together.
+                Defaults to 1.
+            max_pending (int, optional): The number of pending publishes that triggers flow
+                control. Defaults to 0.
+            pending_publishes (Callable, optional): Returns the number of pending publishes.
+                Defaults to None, which disables flow control.
+            flow_control_timeout (float, optional): The maximum time, in seconds, to wait for
+                pending publishes to drain. Defaults to 5.0.
+        """
+        self.mqtt_publish = mqtt_publish
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.pending_publishes = pending_publishes
+        self.flow_control_timeout = flow_control_timeout
+
+
+    @staticmethod
+    def _reply_address(command_message):
+        """Returns the reply address of a CommandMessage, or None, logging why, if it doesn't
+        say where to reply
+        """
+        address = message.reply_address(command_message)
+
+        if address is None:
+            logger.warning(''.join([f"No stream sent to '{command_message.payload['command']}' ",
+                                    'CommandMessage: it has no response topic or ',
+                                    'return_message']))
+
+        return address
+
+
+    def _flow_control_required(self):
+        """Returns whether the number of pending publishes is at or above the limit
+        """
+        return self.pending_publishes() >= self.max_pending
+
+
+    def _flow_control_enabled(self, flow_control):
+        return flow_control and self.max_pending > 0 and self.pending_publishes is not None
+
+
+    def _wait_for_pending_publishes(self):
+        """Waits for pending publishes to drain below the limit, or for the timeout to expire
+        """
+        deadline = time.monotonic() + self.flow_control_timeout
+        while self._flow_control_required() and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+
+    async def _async_wait_for_pending_publishes(self):
+        """Waits, without blocking the event loop, for pending publishes to drain below the
+        limit, or for the timeout to expire
+        """
+        deadline = time.monotonic() + self.flow_control_timeout
+        while self._flow_control_required() and time.monotonic() < deadline:
+            await asyncio.sleep(0.001)
+
+
+    def _encode_item(self, item):
+        if isinstance(item, (str, bytes)):
+            return item
+        return json.dumps(item)
+
+
+    def _encode_batch(self, batch):
+        return json.dumps([item.decode('utf-8') if isinstance(item, bytes) else item
+                           for item in batch])
+
+
+    def _publish(self, address, batch):
+        if self.batch_size == 1:
+            payload = self._encode_item(batch[0])
+        else:
+            payload = self._encode_batch(batch)
+
+        message.publish_reply(self.mqtt_publish, address, payload)
+
+
+    def publish_stream(self, command_message, items, flow_control=True):
+        """Publishes each item yielded by a generator as it's produced
+
+        Args:
+            command_message (CommandMessage): The CommandMessage that the items are in reply to
+            items (generator): The items to publish
+            flow_control (bool, optional): Whether to wait for pending publishes to drain
+                before publishing. Must be False if the items are being published from the
+                MQTT client's network thread. Defaults to True.
+
+        Returns:
+            int: The number of items published
+        """
+        address = self._reply_address(command_message)
+        if address is None:
+            items.close()
+            return 0
+
+        flow_control = self._flow_control_enabled(flow_control)
+        published = 0
+        batch = []
+
+        for item in items:
+            batch.append(item)
+            if len(batch) < self.batch_size:
+                continue
+
+            if flow_control:
+                self._wait_for_pending_publishes()
+            self._publish(address, batch)
+            published += len(batch)
+            batch = []
+
+        if batch:
+            self._publish(address, batch)
+            published += len(batch)
+
+        return published
+
+
+    async def publish_async_stream(self, command_message, items, flow_control=True):
+        """Publishes each item yielded by an async generator as it's produced
+
+        Args:
+            command_message (CommandMessage): The CommandMessage that the items are in reply to
+            items (async generator): The items to publish
+            flow_control (bool, optional): Whether to wait for pending publishes to drain
+                before publishing. Defaults to True.
+
+        Returns:
+            int: The number of items published
+        """
+        address = self._reply_address(command_message)
+        if address is None:
+            await items.aclose()
+            return 0
+
+        flow_control = self._flow_control_enabled(flow_control)
+        published = 0
+        batch = []
+
+        async for item in items:
+            batch.append(item)
+            if len(batch) < self.batch_size:
+                continue
+
+            if flow_control:
+                await self._async_wait_for_pending_publishes()
+            self._publish(address, batch)
+            published += len(batch)
+            batch = []
+
+        if batch:
+            self._publish(address, batch)
+            published += len(batch)
+
+        return published
+
+
+
+class DispatchEngine:
+    """Calls the callbacks for CommandMessages and publishes the results of streaming callbacks
+
+    With 'workers' set to 0 callbacks are called inline, i.e. on the thread that submits the
+    CommandMessage, which is normally the MQTT client's network thread. Otherwise they're
+    called on a pool of worker threads fed from a bounded queue, keeping the network thread
+    free to send and receive while callbacks run.
+
+    Coroutines and async generators returned by callbacks are scheduled on 'event_loop', if it's
+    set and running, e.g. the AsyncioMQTTClient's, so that only they run on that loop and
+    callbacks that block stay on the worker threads.
+
+    Callbacks that implement 'execute_batch' have their CommandMessages validated one at a
+    time and accumulated per command, then passed to 'execute_batch' together once
+    'batch_max_items' have accumulated or 'batch_max_delay' has passed since the first of them
+    arrived, whichever is sooner.
+
+    Attributes:
+        callback_caller (CommandMessageCallbackCaller): Calls the registered callbacks
+        stream_publisher (StreamPublisher): Publishes the results of streaming callbacks
+        workers (int): The number of worker threads
+        max_queued (int): The maximum number of CommandMessages waiting for a worker. Further
+            CommandMessages are dropped until there's space. 0 means no limit.
+        batch_max_items (int): The number of CommandMessages that fills a batch. 1 disables
+            batching and 'execute' is called for every CommandMessage.
+        batch_max_delay (float): The maximum time, in seconds, that a CommandMessage waits in
+            a batch before the batch is flushed
+        dead_letter_handler (DeadLetterHandler): Records CommandMessages whose callback raised
+            an exception, or None to just log the exception
+        audit_journal (AuditJournal): Records every CommandMessage dispatched, with its
+            outcome and latency, or None. Opened and closed with the dispatch engine.
+        slow_callback_detector (SlowCallbackDetector): Reports callbacks that execute for
+            longer than its threshold, or None. Started and stopped with the dispatch engine.
+        event_loop (asyncio.AbstractEventLoop): The event loop that coroutines and async
+            generators returned by callbacks are scheduled on, or None to run them on the
+            thread that calls the callback
+        expired (int): The number of CommandMessages dropped because their MQTT 5 message
+            expiry interval passed before they were dispatched
+    """
+    def __init__(self, callback_caller, stream_publisher, workers=1, max_queued=1000,
+                 batch_max_items=1, batch_max_delay=0.005, dead_letter_handler=None,
+                 audit_journal=None, slow_callback_detector=None, event_loop=None):
+        """Constructor
+
+        Args:
+            callback_caller (CommandMessageCallbackCaller): Calls the registered callbacks
+            stream_publisher (StreamPublisher): Publishes the results of streaming callbacks
+            workers (int, optional): The number of worker threads. Defaults to 1.
+            max_queued (int, optional): The maximum number of CommandMessages waiting for a
+                worker. Defaults to 1000.
+            batch_max_items (int, optional): The number of CommandMessages that fills a batch.
+                Defaults to 1.
+            batch_max_delay (float, optional): The maximum time, in seconds, that a
+                CommandMessage waits in a batch. Defaults to 0.005.
+            dead_letter_handler (DeadLetterHandler, optional): Records CommandMessages whose
+                callback raised an exception. Defaults to None.
+            audit_journal (AuditJournal, optional): Records every CommandMessage dispatched.
+                Defaults to None.
+            slow_callback_detector (SlowCallbackDetector, optional): Reports callbacks that
+                execute for longer than its threshold. Defaults to None.
+            event_loop (asyncio.AbstractEventLoop, optional): The event loop that coroutines
+                and async generators returned by callbacks are scheduled on. Defaults to None.
+        """
+        self.callback_caller = callback_caller
+        self.stream_publisher = stream_publisher
+        self.workers = workers
+        self.max_queued = max_queued
+        self.batch_max_items = batch_max_items
+        self.batch_max_delay = batch_max_delay
+        self.dead_letter_handler = dead_letter_handler
+        self.audit_journal = audit_journal
+        self.slow_callback_detector = slow_callback_detector
+        self.event_loop = event_loop
+        self.expired = 0
+
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._threads = []
+        self._thread_state = threading.local()
+
+        self._batches = {}
+        self._batch_condition = threading.Condition()
+        self._batch_thread = None
+        self._stopping = False
+
+
+    def start(self):
+        """Starts the worker threads, and the batch flushing thread if batching is enabled
+        """
+        self._stopping = False
+
+        if self.audit_journal is not None:
+            self.audit_journal.open()
+
+        if self.slow_callback_detector is not None:
+            self.slow_callback_detector.start()
+
+        for number in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._work, daemon=True,
+                                      name=f'mqtt_remote_dispatch_{number}')
+            thread.start()
+            self._threads.append(thread)
+
+        if self.batch_max_items > 1 and self._batch_thread is None:
+            self._batch_thread = threading.Thread(target=self._flush_expired_batches,
+                                                  daemon=True, name='mqtt_remote_batch')
+            self._batch_thread.start()
+
+        logger.info(f"DispatchEngine has started with {self.workers} worker thread(s)")
+
+
+    def stop(self, timeout=None):
+        """Stops the worker threads once the CommandMessages already queued are dispatched
+
+        Batches still accumulating are flushed first
+
+        Args:
+            timeout (float, optional): The maximum time, in seconds, to wait for each worker
+                thread to stop. Defaults to None.
+        """
+        with self._batch_condition:
+            self._stopping = True
+            self._batch_condition.notify()
+
+        if self._batch_thread is not None:
+            self._batch_thread.join(timeout)
+            self._batch_thread = None
+
+        for _ in self._threads:
+            self._queue.put(_STOP)
+
+        for thread in self._threads:
+            thread.join(timeout)
+
+        self._threads = []
+
+        if self.slow_callback_detector is not None:
+            self.slow_callback_detector.stop()
+
+        if self.audit_journal is not None:
+            self.audit_journal.close()
+
+        logger.info("DispatchEngine has stopped")
+
+
+    def _event_loop(self):
+        """Returns the event loop used to run async callbacks on the current thread
+        """
+        event_loop = getattr(self._thread_state, 'event_loop', None)
+
+        if event_loop is None:
+            event_loop = asyncio.new_event_loop()
+            self._thread_state.event_loop = event_loop
+
+        return event_loop
+
+
+    def dispatch(self, command_message):
+        """Calls the callback for a CommandMessage on the current thread
+
+        If the callback returns a generator, or an async generator, each item it yields is
+        published to the reply address of 'command_message' as it's produced. If the callback
+        is a coroutine function it's scheduled on the event loop running on the current thread,
+        or else on 'event_loop' if it's running, or else run to completion on this thread. Async
+        generators are streamed the same way.
+
+        CommandMessages for callbacks that implement 'execute_batch' are added to a batch
+        instead, and the batch is executed here if this CommandMessage fills it. CommandMessages
+        that have expired, e.g. whilst waiting for a worker, are dropped, as are those that the
+        callback caller rejects, i.e. with no registered callback or an invalid payload.
+
+        The attachment of the CommandMessage, if it has one, is closed once the callback has
+        finished, i.e. after its batch is executed or its task is done if it's deferred.
+
+        Args:
+            command_message (CommandMessage): The CommandMessage to dispatch
+
+        Returns:
+            str: audit.OUTCOME_OK, audit.OUTCOME_EXPIRED, audit.OUTCOME_REJECTED, or None if
+                the CommandMessage was added to a batch or its coroutine was scheduled as a task,
+                its outcome being recorded when the batch is executed or the task is done
+        """
+        if command_message and command_message.expired():
+            self.expired += 1
+            metrics.MESSAGES_DROPPED.inc(labels=('expired',))
+            logger.debug("'%s' CommandMessage dropped: message expiry interval passed",
+                         command_message.payload['command'])
+            command_message.close_attachment()
+            return audit.OUTCOME_EXPIRED
+
+        if (self.batch_max_items > 1 and command_message
+                and self.callback_caller.has_batch_callback(command_message.payload['command'])):
+            return None if self._add_to_batch(command_message) else audit.OUTCOME_REJECTED
+
+        if not self.callback_caller.valid_command_message(command_message):
+            if command_message:
+                command_message.close_attachment()
+            return audit.OUTCOME_REJECTED
+
+        scheduled = False
+        try:
+            result = self.callback_caller.validated_callback_caller(command_message)
+            flow_control = self.workers > 0
+
+            if inspect.isgenerator(result):
+                self.stream_publisher.publish_stream(command_message, result, flow_control)
+            elif inspect.isasyncgen(result):
+                event_loop = self._scheduling_loop()
+                # Waiting for pending publishes doesn't block a running event loop
+                stream = self.stream_publisher.publish_async_stream(
+                    command_message, result, flow_control or event_loop is not None)
+                scheduled = self._run_coroutine(command_message, stream, event_loop)
+            elif inspect.iscoroutine(result):
+                scheduled = self._run_coroutine(command_message, result,
+                                                self._scheduling_loop())
+        finally:
+            if command_message and not scheduled:
+                command_message.close_attachment()
+
+        return None if scheduled else audit.OUTCOME_OK
+
+
+    @staticmethod
+    def _running_loop():
+        """Returns the event loop running on this thread, or None
+        """
+        try:
+            return asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+
+
+    def _scheduling_loop(self):
+        """Returns the running event loop that coroutines are scheduled on, i.e. the one running
+        on this thread, else 'event_loop' if it's running, else None
+        """
+        running_loop = self._running_loop()
+        if running_loop is not None:
+            return running_loop
+
+        if self.event_loop is not None and self.event_loop.is_running():
+            return self.event_loop
+        return None
+
+
+    def _run_coroutine(self, command_message, coroutine, event_loop):
+        """Schedules a coroutine as a task on 'event_loop', or runs it to completion on this
+        thread's own event loop if 'event_loop' is None, returning whether it was scheduled
+
+        A scheduled task is watched by the slow callback detector until it's done, when its
+        outcome is recorded
+        """
+        if event_loop is None:
+            self._event_loop().run_until_complete(coroutine)
+            return False
+
+        execution = self._watch(command_message)
+        started = time.perf_counter()
+        done = functools.partial(self._task_done, command_message, execution, started)
+
+        if event_loop is self._running_loop():
+            event_loop.create_task(coroutine).add_done_callback(done)
+        else:
+            asyncio.run_coroutine_threadsafe(coroutine, event_loop).add_done_callback(done)
+        return True
+
+
+    def _task_done(self, command_message, execution, started, task):
+        """Records the outcome of a scheduled task, or of the future of a task scheduled from
+        another thread, once it's done. A cancelled task is recorded as an error, without being
+        passed to the dead letter handler.
+        """
+        self._unwatch(execution)
+        if command_message:
+            command_message.close_attachment()
+
+        outcome = audit.OUTCOME_OK
+        if task.cancelled():
+            outcome = audit.OUTCOME_ERROR
+        elif task.exception() is not None:
+            outcome = audit.OUTCOME_ERROR
+            self._dispatch_failed([command_message], task.exception())
+
+        self._record_outcome([command_message], outcome, started)
+
+
+    def _add_to_batch(self, command_message):
+        """Validates a CommandMessage and adds it to the batch for its command, running the
+        batch on this thread if it's full, with its outcome recorded as for an expired batch.
+        Returns False if the CommandMessage was rejected.
+        """
+        if not self.callback_caller.valid_command_message(command_message):
+            command_message.close_attachment()
+            return False
+
+        command_name = command_message.payload['command']
+
+        with self._batch_condition:
+            if command_name not in self._batches:
+                self._batches[command_name] = (time.monotonic() + self.batch_max_delay, [])
+                self._batch_condition.notify()
+
+            command_messages = self._batches[command_name][1]
+            command_messages.append(command_message)
+
+            if len(command_messages) < self.batch_max_items:
+                return True
+
+            del self._batches[command_name]
+
+        self._run_batch(_Batch(command_name, command_messages))
+        return True
+
+
+    def _execute_batch(self, batch):
+        """Calls the batch callback for a batch of CommandMessages
+        """
+        self.callback_caller.batch_callback_caller(batch.command_name, batch.command_messages)
+
+
+    def _pop_expired_batches(self, flush_all):
+        """Removes and returns the batches whose delay has expired, and the time until the next
+        one expires
+        """
+        now = time.monotonic()
+        expired = []
+        next_expiry = None
+
+        for command_name, (deadline, command_messages) in list(self._batches.items()):
+            if flush_all or deadline <= now:
+                expired.append(_Batch(command_name, command_messages))
+                del self._batches[command_name]
+            elif next_expiry is None or deadline - now < next_expiry:
+                next_expiry = deadline - now
+
+        return expired, next_expiry
+
+
+    def _flush_expired_batches(self):
+        """Flushes batches as their delay expires, until the dispatch engine is stopped
+
+        Expired batches are queued for the worker threads, or executed on this thread if there
+        are no worker threads
+        """
+        while True:
+            with self._batch_condition:
+                stopping = self._stopping
+                expired, next_expiry = self._pop_expired_batches(stopping)
+                if not expired and not stopping:
+                    self._batch_condition.wait(next_expiry)
+                    continue
+
+            for batch in expired:
+                if self.workers == 0:
+                    self._run_batch(batch)
+                else:
+                    self._queue.put(batch)
+
+            if stopping:
+                break
+
+
+    def _watch(self, command_message, batch_size=1):
+        """Tells the slow callback detector, if there is one, that a callback is starting on
+        this thread, returning the execution to pass to '_unwatch'
+        """
+        if self.slow_callback_detector is None:
+            return None
+        return self.slow_callback_detector.started(command_message, batch_size)
+
+
+    def _unwatch(self, execution):
+        if execution is not None:
+            self.slow_callback_detector.finished(execution)
+
+
+    def _run_batch(self, batch):
+        execution = self._watch(batch.command_messages[0], len(batch.command_messages))
+        started = time.perf_counter()
+        outcome = audit.OUTCOME_OK
+        try:
+            self._execute_batch(batch)
+        except Exception as error: # pylint: disable=broad-except
+            outcome = audit.OUTCOME_ERROR
+            self._dispatch_failed(batch.command_messages, error)
+        finally:
+            self._unwatch(execution)
+            for command_message in batch.command_messages:
+                command_message.close_attachment()
+
+        self._record_outcome(batch.command_messages, outcome, started)
+
+
+    def _dispatch_safely(self, command_message):
+        trace = command_message.trace if command_message else None
+        token = tracing.activate(trace) if trace is not None else None
+        execution = self._watch(command_message)
+
+        started = time.perf_counter()
+        try:
+            outcome = self.dispatch(command_message)
+        except Exception as error: # pylint: disable=broad-except
+            outcome = audit.OUTCOME_ERROR
+            self._dispatch_failed([command_message], error)
+        finally:
+            self._unwatch(execution)
+            if token is not None:
+                tracing.deactivate(token)
+
+        if outcome is not None:
+            self._record_outcome([command_message], outcome, started)
+
+
+    def _record_outcome(self, command_messages, outcome, started):
+        """Records the outcome of dispatching CommandMessages in the metrics and the audit
+        journal, and logs it with the command, topic, latency and outcome as fields of the log
+        record, see 'log_pipeline.JsonFormatter'
+
+        Rejected CommandMessages are counted under a single command label, '<unknown>', and
+        their latency isn't observed
+        """
+        log_outcome = logger.isEnabledFor(logging.DEBUG)
+        latency = time.perf_counter() - started
+
+        for command_message in command_messages:
+            if not command_message:
+                continue
+
+            command = command_message.payload['command']
+            if outcome == audit.OUTCOME_REJECTED:
+                metrics.COMMANDS_DISPATCHED.inc(labels=(_UNKNOWN_COMMAND, outcome))
+            else:
+                metrics.COMMANDS_DISPATCHED.inc(labels=(command, outcome))
+            if outcome not in (audit.OUTCOME_EXPIRED, audit.OUTCOME_REJECTED):
+                metrics.COMMAND_DURATION.observe(latency, labels=(command,))
+
+            if self.audit_journal is not None:
+                self.audit_journal.append(command_message, outcome, latency)
+
+            if command_message.trace is not None:
+                command_message.trace.finish(outcome)
+
+            if log_outcome:
+                logger.debug("'%s' CommandMessage dispatched: %s (%.6f s)", command, outcome,
+                             latency, extra={'command': command,
+                                             'topic': command_message.topic,
+                                             'latency': latency,
+                                             'outcome': outcome})
+
+
+    def _dispatch_failed(self, command_messages, error):
+        """Passes CommandMessages whose callback raised an exception to the dead letter handler,
+        or logs the exception if there isn't one
+        """
+        if self.dead_letter_handler is None:
+            logger.error('Unhandled exception whilst dispatching a CommandMessage',
+                         exc_info=error)
+            return
+
+        for command_message in command_messages:
+            self.dead_letter_handler.execution_failed(command_message, error)
+
+
+    def queue_depth(self):
+        """Returns the number of CommandMessages waiting for a worker
+
+        Returns:
+            int: The number waiting
+        """
+        return self._queue.qsize()
+
+
+    def submit(self, command_message):
+        """Submits a CommandMessage to be dispatched on a worker thread, or on this thread if
+        there are no worker threads, with its outcome recorded and any exception raised by its
+        callback passed to the dead letter handler
+
+        A CommandMessage dropped because the queue is full has its attachment closed
+
+        Args:
+            command_message (CommandMessage): The CommandMessage to dispatch
+        """
+        if self.workers == 0:
+            self._dispatch_safely(command_message)
+            return
+
+        if command_message and command_message.trace is not None:
+            command_message.trace.mark('queued')
+
+        try:
+            self._queue.put_nowait((command_message, time.monotonic()))
+        except queue.Full:
+            if command_message:
+                command_message.close_attachment()
+            metrics.MESSAGES_DROPPED.inc(labels=('dispatch_queue_full',))
+            logger.warning(''.join(["DispatchEngine queue is full: CommandMessage dropped ",
+                                    f"(max_queued: {self.max_queued})"]))
+
+
+    def _work(self):
+        """Dispatches queued CommandMessages until told to stop
+        """
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+
+            if isinstance(item, _Batch):
+                self._run_batch(item)
+                continue
+
+            command_message, queued_at = item
+            metrics.DISPATCH_QUEUE_WAIT.observe(time.monotonic() - queued_at)
+            if command_message and command_message.trace is not None:
+                command_message.trace.mark('dequeued')
+            self._dispatch_safely(command_message)
@@ -0,0 +1,142 @@
+"""Latency histogram related functionality
+
+Examples:
+
+    To record latencies, in seconds:
+
+        .. code-block:: python
+
+            latency_histogram = LatencyHistogram()
+            latency_histogram.observe(0.012)
+
+
+    To get the 99th percentile latency:
+
+        .. code-block:: python
+
+            p99 = latency_histogram.percentile(99)
+
+
+    To get the cumulative bucket counts, e.g. to export them:
+
+        .. code-block:: python
+
+            snapshot = latency_histogram.snapshot()
+
+
+Attributes:
+    DEFAULT_LATENCY_BUCKETS (Tuple[float]): The default bucket upper bounds, in seconds
+"""
+import bisect
+import math
+import threading
+
+
+
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                           5.0, 10.0, 30.0, 60.0)
+
+
+
+class LatencyHistogram:
+    """Counts latencies into buckets with fixed upper bounds
+
+    Recording a latency takes constant memory however many are recorded, so a histogram can
+    be updated on every message. Percentiles are estimated as the upper bound of the bucket
+    the percentile falls in.
+
+    Attributes:
+        buckets (Tuple[float]): The bucket upper bounds, in seconds, in ascending order. A
+            final bucket catches everything above the last bound.
+    """
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        """Constructor
+
+        Args:
+            buckets (Iterable[float], optional): The bucket upper bounds, in seconds. Defaults
+                to DEFAULT_LATENCY_BUCKETS.
+
+        Raises:
+            ValueError: if there are no buckets
+        """
+        self.buckets = tuple(sorted(buckets))
+        if not self.buckets:
+            raise ValueError('LatencyHistogram needs at least one bucket')
+
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+
+
+    def observe(self, latency):
+        """Records a latency
+
+        Args:
+            latency (float): The latency, in seconds
+        """
+        index = bisect.bisect_left(self.buckets, latency)
+        with self._lock:
+            self._counts[index] += 1
+            self._count += 1
+            self._sum += latency
+            self._max = max(self._max, latency)
+
+
+    def percentile(self, percent):
+        """Returns an estimate of a percentile of the latencies recorded
+
+        Args:
+            percent (float): The percentile, 0 to 100
+
+        Returns:
+            float: The upper bound of the bucket the percentile falls in, or the largest
+                latency if that's lower or the percentile falls above the last bound. 0.0 if
+                nothing has been recorded.
+        """
+        with self._lock:
+            if not self._count:
+                return 0.0
+
+            rank = max(1, math.ceil(self._count * percent / 100))
+            seen = 0
+            for index, count in enumerate(self._counts):
+                seen += count
+                if seen >= rank:
+                    break
+
+            if index == len(self.buckets):
+                return self._max
+            return min(self.buckets[index], self._max)
+
+
+    def snapshot(self):
+        """Returns the counts recorded so far
+
+        Returns:
+            dict: 'buckets': [(<upper bound>, <cumulative count>), ...], ending with
+                (math.inf, <count>),
+                'count': the number of latencies recorded,
+                'sum': their total, in seconds,
+                'max': the largest, in seconds
+        """
+        with self._lock:
+            cumulative = []
+            seen = 0
+            for upper_bound, count in zip(self.buckets + (math.inf,), self._counts):
+                seen += count
+                cumulative.append((upper_bound, seen))
+
+            return {'buckets': cumulative, 'count': self._count, 'sum': self._sum,
+                    'max': self._max}
+
+
+    def reset(self):
+        """Forgets the latencies recorded so far
+        """
+        with self._lock:
+            self._counts = [0] * (len(self.buckets) + 1)
+            self._count = 0
+            self._sum = 0.0
+            self._max = 0.0
@@ -0,0 +1,213 @@
+"""Outbound publish journal related functionality
+
+Examples:
+
+    To create a journal that keeps up to 10000 pending publishes in an SQLite database:
+
+        .. code-block:: python
+
+            journal = PublishJournal('outbound.db', max_messages=10000, fsync='normal')
+            journal.open()
+
+
+    To record a publish and remove it once the broker has acknowledged it:
+
+        .. code-block:: python
+
+            entry_id = journal.append(topic, payload, qos, retain)
+            ...
+            journal.acknowledge(entry_id)
+
+
+    To replay the pending publishes, oldest first:
+
+        .. code-block:: python
+
+            for entry_id, topic, payload, qos, retain in journal.pending():
+                ...
+"""
+import logging
+import sqlite3
+import threading
+
+
+
+# pylint: disable=C0103
+logger = logging.getLogger(__name__)
+# pylint: enable=C0103
+
+
+
+FSYNC_POLICIES = {'always': 'FULL', 'normal': 'NORMAL', 'off': 'OFF'}
+
+
+
+class PublishJournal:
+    """An append only, disk backed journal of the QoS 1 and 2 publishes that are yet to be
+    acknowledged by the broker
+
+    The journal is an SQLite database in write ahead log mode. Entries are appended in publish
+    order and deleted when acknowledged. The space freed by acknowledged entries is reclaimed
+    every 'compact_interval' acknowledgements. When the journal holds 'max_messages' entries the
+    oldest is discarded to make room for a new one.
+
+    Attributes:
+        path (str): The path of the SQLite database, ':memory:' for a journal that doesn't
+            survive restarts
+        max_messages (int): The maximum number of entries held. 0 means no limit.
+        fsync (str): When the journal is flushed to disk:
+            'always': after every change, survives power loss
+            'normal': at write ahead log checkpoints, survives the process crashing
+            'off': when the operating system chooses
+        compact_interval (int): The number of acknowledgements between compactions
+        dropped (int): The number of entries discarded because the journal was full
+    """
+    def __init__(self, path, max_messages=10000, fsync='normal', compact_interval=1000):
+        """Constructor
+
+        Args:
+            path (str): The path of the SQLite database
+            max_messages (int, optional): The maximum number of entries held. Defaults to
+                10000.
+            fsync (str, optional): 'always', 'normal' or 'off'. Defaults to 'normal'.
+            compact_interval (int, optional): The number of acknowledgements between
+                compactions. Defaults to 1000.
+
+        Raises:
+            ValueError: if an unacceptable fsync policy is provided
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(''.join(['PublishJournal \'fsync\' argument can only be ',
+                                      '\'always\', \'normal\' or \'off\'']))
+
+        self.path = path
+        self.max_messages = max_messages
+        self.fsync = fsync
+        self.compact_interval = compact_interval
+        self.dropped = 0
+
+        self._lock = threading.Lock()
+        self._connection = None
+        self._count = 0
+        self._acknowledged = 0
+
+
+    def open(self):
+        """Opens, creating if required, the journal
+        """
+        with self._lock:
+            if self._connection is not None:
+                return
+
+            connection = sqlite3.connect(self.path, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute(f'PRAGMA synchronous = {FSYNC_POLICIES[self.fsync]}')
+            connection.execute(''.join(['CREATE TABLE IF NOT EXISTS publishes (',
+                                        'id INTEGER PRIMARY KEY AUTOINCREMENT, ',
+                                        'topic TEXT NOT NULL, payload, ',
+                                        'qos INTEGER NOT NULL, retain INTEGER NOT NULL)']))
+            self._count = connection.execute('SELECT COUNT(*) FROM publishes').fetchone()[0]
+            self._connection = connection
+
+        if self._count:
+            logger.info(f"Publish journal '{self.path}' opened with {self._count} pending")
+
+
+    def close(self):
+        """Compacts and closes the journal
+        """
+        with self._lock:
+            if self._connection is None:
+                return
+            self._compact()
+            self._connection.close()
+            self._connection = None
+
+
+    def __len__(self):
+        return self._count
+
+
+    def append(self, topic, payload, qos, retain):
+        """Adds a publish to the end of the journal
+
+        Args:
+            topic (str): The topic of the MQTT message
+            payload (str, bytes): The MQTT payload
+            qos (int): The Quality Of Service of the MQTT message
+            retain (bool): Whether the MQTT message is retained
+
+        Returns:
+            int: The id of the entry
+
+        Raises:
+            RuntimeError: if the journal hasn't been opened
+        """
+        with self._lock:
+            if self._connection is None:
+                raise RuntimeError('PublishJournal has not been opened')
+
+            if self.max_messages and self._count >= self.max_messages:
+                self._connection.execute(''.join(['DELETE FROM publishes WHERE id = ',
+                                                  '(SELECT MIN(id) FROM publishes)']))
+                self._count -= 1
+                self.dropped += 1
+                logger.warning(''.join(['Publish journal is full: oldest pending publish ',
+                                        f'discarded (max_messages: {self.max_messages})']))
+
+            cursor = self._connection.execute(
+                'INSERT INTO publishes (topic, payload, qos, retain) VALUES (?, ?, ?, ?)',
+                (topic, payload, qos, int(retain)))
+            self._count += 1
+            return cursor.lastrowid
+
+
+    def acknowledge(self, entry_id):
+        """Removes an entry once its publish has been acknowledged by the broker
+
+        Args:
+            entry_id (int): The id of the entry
+        """
+        with self._lock:
+            if self._connection is None:
+                return
+
+            removed = self._connection.execute('DELETE FROM publishes WHERE id = ?',
+                                               (entry_id,)).rowcount
+            self._count -= removed
+            self._acknowledged += removed
+            if self.compact_interval and self._acknowledged >= self.compact_interval:
+                self._compact()
+
+
+    def pending(self, limit=0):
+        """Returns the entries yet to be acknowledged, oldest first
+
+        Args:
+            limit (int, optional): The maximum number of entries returned, 0 for all of them.
+                Defaults to 0.
+
+        Returns:
+            list[Tuple]: [(<entry id>, <topic>, <payload>, <qos>, <retain>), (...)]
+        """
+        with self._lock:
+            if self._connection is None:
+                return []
+
+            rows = self._connection.execute(
+                'SELECT id, topic, payload, qos, retain FROM publishes ORDER BY id LIMIT ?',
+                (limit or -1,)).fetchall()
+
+        return [(entry_id, topic, payload, qos, bool(retain))
+                for entry_id, topic, payload, qos, retain in rows]
+
+
+    def _compact(self):
+        """Returns the space freed by acknowledged entries to the file system. The caller must
+        hold 'self._lock'
+        """
+        self._acknowledged = 0
+        self._connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self._connection.execute('PRAGMA incremental_vacuum')
@@ -0,0 +1,296 @@
+"""Background logging related functionality
+
+Log records are put on a bounded queue by the thread that logs them and written to the log
+file and console by a background thread, so the network and dispatch threads never wait on
+disk or console I/O. Only the log message itself is built on the logging thread; the
+Formatter runs in the background. Repetitive records can be thinned out before they're
+queued, by sampling the records below WARNING of chosen loggers or by limiting how often
+each message template can be logged per second.
+
+Examples:
+
+    To write log records to a file and the console from a background thread:
+
+        .. code-block:: python
+
+            background_logging = BackgroundLogging([file_handler, stream_handler],
+                                                   queue_size=10000)
+            background_logging.start()
+            logging.getLogger().addHandler(background_logging.handler)
+
+
+    To keep 1 in 100 of the records below WARNING logged by the MQTT client and at most 10
+    records per second of any one message template:
+
+        .. code-block:: python
+
+            log_sampler = LogSampler({'mqtt_remote.mqtt_client': 100}, max_per_second=10)
+            background_logging = BackgroundLogging(handlers, log_sampler=log_sampler)
+
+
+    To write each record as a line of JSON:
+
+        .. code-block:: python
+
+            file_handler.setFormatter(JsonFormatter())
+
+
+    To stop the background thread once the queued records have been written:
+
+        .. code-block:: python
+
+            background_logging.stop()
+
+
+Attributes:
+    MAX_RATE_LIMIT_KEYS (int): The maximum number of message templates that 'LogSampler'
+        tracks at once
+    JSON_EXTRA_FIELDS (Tuple[str]): The attributes that 'JsonFormatter' copies from a record
+        when they're present, as set by the 'extra' argument of a logging call
+"""
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+
+
+MAX_RATE_LIMIT_KEYS = 4096
+
+JSON_EXTRA_FIELDS = ('command', 'topic', 'latency', 'outcome')
+
+
+
+class LogSampler(logging.Filter):
+    """Drops repetitive log records
+
+    Records of WARNING and above are never sampled, but are rate limited along with the rest.
+    The decision is remembered on the record, so the same sampler can be added to several
+    handlers without them keeping different records.
+
+    Attributes:
+        sampling (dict): The 'N' of the loggers whose records below WARNING are sampled, 1 in
+            'N' being kept, keyed by logger name. A name covers the loggers below it too, e.g.
+            'mqtt_remote' covers 'mqtt_remote.mqtt_client'.
+        max_per_second (int): The maximum number of records kept per second for each message
+            template of each logger. 0 means no limit.
+        sampled_out (int): The number of records dropped by sampling
+        suppressed (int): The number of records dropped by rate limiting
+    """
+    def __init__(self, sampling=None, max_per_second=0):
+        """Constructor
+
+        Args:
+            sampling (dict, optional): The 'N' of the loggers whose records are sampled, keyed
+                by logger name. Defaults to None.
+            max_per_second (int, optional): The maximum number of records kept per second for
+                each message template of each logger. Defaults to 0.
+        """
+        super().__init__()
+        self.sampling = dict(sampling or {})
+        self.max_per_second = max_per_second
+        self.sampled_out = 0
+        self.suppressed = 0
+
+        self._lock = threading.Lock()
+        self._rates = {}
+        self._counters = {}
+        self._windows = {}
+        self._decision_key = f'_log_sampler_{id(self)}'
+
+
+    def _rate(self, name):
+        """Returns the sampling 'N' of a logger, from the closest configured logger above it
+        """
+        rate = self._rates.get(name)
+        if rate is None:
+            rate = 1
+            candidate = name
+            while candidate:
+                if candidate in self.sampling:
+                    rate = max(int(self.sampling[candidate]), 1)
+                    break
+                candidate = candidate.rpartition('.')[0]
+            self._rates[name] = rate
+        return rate
+
+
+    def filter(self, record):
+        """Decides whether a log record is kept
+
+        Args:
+            record (logging.LogRecord): The log record
+
+        Returns:
+            bool: True if the record is kept
+        """
+        kept = record.__dict__.get(self._decision_key)
+        if kept is None:
+            kept = self._decide(record)
+            record.__dict__[self._decision_key] = kept
+        return kept
+
+
+    def _decide(self, record):
+        """Decides whether a log record not seen before is kept
+        """
+        with self._lock:
+            if record.levelno < logging.WARNING and self.sampling:
+                rate = self._rate(record.name)
+                if rate > 1:
+                    count = self._counters.get(record.name, 0)
+                    self._counters[record.name] = count + 1
+                    if count % rate:
+                        self.sampled_out += 1
+                        return False
+
+            if not self.max_per_second:
+                return True
+
+            key = (record.name, record.msg)
+            second = int(time.monotonic())
+            window = self._windows.get(key)
+            if window is None or window[0] != second:
+                if window is None and len(self._windows) >= MAX_RATE_LIMIT_KEYS:
+                    self._windows.clear()
+                self._windows[key] = [second, 1]
+                return True
+
+            if window[1] >= self.max_per_second:
+                self.suppressed += 1
+                return False
+
+            window[1] += 1
+            return True
+
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each log record as a single line of JSON
+
+    Every line has 'time', 'level', 'logger' and 'message' fields, 'exception' if the record
+    has exception information, and any of JSON_EXTRA_FIELDS the record has, e.g. the
+    command, topic, latency and outcome of the CommandMessages logged by the dispatch engine
+    """
+    def format(self, record):
+        """Formats a log record
+
+        Args:
+            record (logging.LogRecord): The log record
+
+        Returns:
+            str: The record as JSON
+        """
+        fields = {'time': self.formatTime(record),
+                  'level': record.levelname,
+                  'logger': record.name,
+                  'message': record.getMessage()}
+
+        for field in JSON_EXTRA_FIELDS:
+            value = record.__dict__.get(field)
+            if value is not None:
+                fields[field] = value
+
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            fields['exception'] = record.exc_text
+
+        return json.dumps(fields, default=str)
+
+
+
+class _BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """Queues log records without blocking, counting those dropped because the queue is full
+    """
+    def __init__(self, record_queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+
+
+    def prepare(self, record):
+        """Builds the record's message, leaving the rest of the formatting to the background
+        thread's handlers
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+
+class BackgroundLogging:
+    """Writes log records to a set of handlers from a background thread
+
+    Attributes:
+        handlers (list[logging.Handler]): The handlers the records are written to
+        handler (logging.Handler): The handler to add to a logger, which queues its records
+        log_sampler (LogSampler): Drops repetitive records before they're queued, None keeps
+            every record
+    """
+    def __init__(self, handlers, queue_size=10000, log_sampler=None):
+        """Constructor
+
+        Args:
+            handlers (list[logging.Handler]): The handlers the records are written to
+            queue_size (int, optional): The maximum number of records waiting to be written.
+                Records logged whilst the queue is full are dropped. Defaults to 10000.
+            log_sampler (LogSampler, optional): Drops repetitive records. Defaults to None.
+        """
+        self.handlers = list(handlers)
+        self.log_sampler = log_sampler
+
+        self._queue = queue.Queue(queue_size)
+        self.handler = _BackgroundQueueHandler(self._queue)
+        if log_sampler is not None:
+            self.handler.addFilter(log_sampler)
+
+        self._listener = logging.handlers.QueueListener(self._queue, *self.handlers,
+                                                        respect_handler_level=True)
+        self._started = False
+
+
+    def start(self):
+        """Starts writing the queued records from the background thread
+        """
+        if not self._started:
+            self._listener.start()
+            self._started = True
+
+
+    def stop(self):
+        """Writes the records already queued and stops the background thread
+        """
+        if self._started:
+            self._listener.stop()
+            self._started = False
+
+        for handler in self.handlers:
+            handler.flush()
+
+
+    def metrics(self):
+        """Returns metrics describing the logging pipeline
+
+        Returns:
+            dict: 'queued': the number of records waiting to be written,
+                'dropped': the number of records dropped because the queue was full,
+                'sampled_out' and 'suppressed': the number of records dropped by the log
+                sampler's sampling and rate limiting
+        """
+        sampler = self.log_sampler
+        return {'queued': self._queue.qsize(),
+                'dropped': self.handler.dropped,
+                'sampled_out': sampler.sampled_out if sampler is not None else 0,
+                'suppressed': sampler.suppressed if sampler is not None else 0}
@@ -74,10 +74,101 @@ Examples:
         .. code-block:: python
 
             log_wrong_command_message_form(callback_name, required_message_form)
+
+
+    To declare the payload values required by a callback:
+
+        .. code-block:: python
+
+            payload_schema = PayloadSchema(
+                PayloadField('string_to_reverse', ['attributes', 'string_to_reverse'], str),
+                *return_message_fields())
+
+
+    To declare the payload values required by a callback that replies, accepting a response
+    topic in place of the 'return_message' block:
+
+        .. code-block:: python
+
+            payload_schema = ReplyPayloadSchema(
+                PayloadField('string_to_reverse', ['attributes', 'string_to_reverse'], str))
+
+
+    To validate a command message and extract its values in a single pass:
+
+        .. code-block:: python
+
+            compiled_schema = payload_schema.compile()
+            arguments = compiled_schema.extract(command_message)
+
+
+    To reply to a command message, with its MQTT 5 correlation data or response envelope:
+
+        .. code-block:: python
+
+            reply(publish_function, command_message, 'Spam')
+
+
+    To split data into chunked transfer payloads:
+
+        .. code-block:: python
+
+            payloads = chunk_payloads(data, chunk_size, message_payload)
+
+
+    To publish data as a chunked transfer:
+
+        .. code-block:: python
+
+            transfer_id = publish_chunked(publish_function, topic, data, qos, retain, chunk_size,
+                                          message_payload)
+
+
+    To copy a payload with its secret attributes, e.g. "token", redacted before logging it:
+
+        .. code-block:: python
+
+            payload = redacted_payload(command_message.payload)
+
+
+    To reassemble chunked transfers and call a callback with the completed CommandMessage:
+
+        .. code-block:: python
+
+            chunk_reassembler = ChunkReassembler(callback_caller.callback_caller)
+            callback_caller.add_callback(CHUNK_COMMAND_NAME, chunk_reassembler.receive,
+                                         CHUNK_PAYLOAD_SCHEMA)
+
+
+Attributes:
+    CHUNK_COMMAND_NAME (str): The command name of the CommandMessages that carry the parts of
+        a chunked transfer
+    CHUNK_PAYLOAD_SCHEMA (PayloadSchema): The payload values required in each part of a
+        chunked transfer
+    RESPONSE_TOPIC_KEY (str): The optional payload key holding the topic a reply is published
+        to, for clients that can't use MQTT 5 response topics
+    CORRELATION_DATA_KEY (str): The optional payload key holding the string that's returned
+        with the reply, for clients that can't use MQTT 5 correlation data
+    SECRET_ATTRIBUTES (tuple): The attributes whose values are redacted from payloads that are
+        logged, published or stored, see 'redacted_payload'
 """
 from abc import ABC, abstractmethod
+from collections import namedtuple
+import base64
+import binascii
+import hashlib
 import json
 import logging
+import math
+import tempfile
+import threading
+import time
+import uuid
+
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from mqtt_remote import metrics
 
 
 
@@ -94,6 +185,23 @@ class CommandMessage:
         topic (str): MQTT message topic
         qos (int): MQTT message Quality Of Service
         retain (bool): MQTT message retain flag
+        arguments (namedtuple): The payload values extracted by the callback's compiled
+            PayloadSchema, or None if the callback has no PayloadSchema
+        attachment (file object): The binary data of the chunked transfer that delivered the
+            message, or None if the message wasn't delivered by a chunked transfer. The
+            CommandMessage owns the file, which the DispatchEngine closes once the callback has
+            finished with it.
+        fingerprint (str): A digest of the raw MQTT message the CommandMessage was converted
+            from, used to quarantine messages that fail repeatedly, or None
+        expires_at (float): The 'time.monotonic()' time after which the message is stale and
+            is dropped rather than dispatched, from its MQTT 5 message expiry interval, or None
+            if it never expires
+        response_topic (str): The MQTT 5 response topic the message was published with, or
+            None
+        correlation_data (bytes): The MQTT 5 correlation data the message was published with,
+            or None
+        trace (tracing.Trace): Timestamps each stage of the message's life if it's sampled
+            for tracing, otherwise None
     """
     def __init__(self, topic, payload, qos, retain):
         """Constructor
@@ -109,6 +217,30 @@ class CommandMessage:
         self.payload = payload
         self.qos = qos
         self.retain = retain
+        self.arguments = None
+        self.attachment = None
+        self.fingerprint = None
+        self.expires_at = None
+        self.response_topic = None
+        self.correlation_data = None
+        self.trace = None
+
+
+    def expired(self):
+        """Returns whether the message's MQTT 5 message expiry interval has passed
+
+        Returns:
+            bool: True if the message has expired
+        """
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+
+    def close_attachment(self):
+        """Closes the attachment, if there is one, once the callback has finished with it
+        """
+        if self.attachment is not None:
+            self.attachment.close()
+            self.attachment = None
 
 
     @property
@@ -188,9 +320,39 @@ class PahoToCommandMessageConvertor(CommandMessageConvertor):
         return output
 
 
+    def _expires_at(self, message):
+        """Returns when a paho message received with an MQTT 5 message expiry interval expires
+        """
+        properties = getattr(message, 'properties', None)
+        interval = getattr(properties, 'MessageExpiryInterval', None)
+        if not isinstance(interval, int):
+            return None
+        return (message.timestamp or time.monotonic()) + interval
+
+
+    def _response(self, message):
+        """Returns the MQTT 5 response topic and correlation data a paho message was received
+        with, each None if absent
+        """
+        properties = getattr(message, 'properties', None)
+        response_topic = getattr(properties, 'ResponseTopic', None)
+        if not isinstance(response_topic, str):
+            return None, None
+
+        correlation_data = getattr(properties, 'CorrelationData', None)
+        if not isinstance(correlation_data, bytes):
+            correlation_data = None
+        return response_topic, correlation_data
+
+
     def convert(self, message):
         """Converts a paho message into a CommandMessage
 
+        The MQTT 5 message expiry interval the broker forwards with a message, i.e. the rest of
+        its lifetime, is stored in 'CommandMessage.expires_at' and its response topic and
+        correlation data in 'CommandMessage.response_topic' and
+        'CommandMessage.correlation_data'
+
         Args:
             message (paho.mqtt.client.MQTTMessage): Paho message
 
@@ -204,8 +366,11 @@ class PahoToCommandMessageConvertor(CommandMessageConvertor):
         try:
             command_message = CommandMessage(message.topic, payload,
                                              message.qos, message.retain)
+            command_message.expires_at = self._expires_at(message)
+            (command_message.response_topic,
+             command_message.correlation_data) = self._response(message)
             command = payload['command']
-            logger.debug(f'Paho \'{command}\' message successfully converted to CommandMessage')
+            logger.debug("Paho '%s' message successfully converted to CommandMessage", command)
 
         except (TypeError, ValueError):
             logger.warning(''.join(['Unable to convert Paho message to CommandMessage: ',
@@ -219,16 +384,28 @@ class PahoToCommandMessageConvertor(CommandMessageConvertor):
 
 class ConvertedCommandMessageForwarder:
     """Provides functionality to call a callback with a CommandMessage converted from a raw message
+
+    MQTT Remote itself only uses 'convert', as the 'convert' middleware stage, which hands the
+    CommandMessage on to the later stages. 'forward' and 'callback' are for converting and
+    dispatching raw messages without a middleware pipeline.
+
+    Attributes:
+        tracer (tracing.Tracer): Starts the traces of the sampled messages, or None to trace
+            nothing
     """
-    def __init__(self, message_convertor, callback):
+    def __init__(self, message_convertor, callback, dead_letter_handler=None):
         """Constructor
 
         Args:
             message_convertor (CommandMessageConvertor, optional): A message convertor.
             callback (function, class): a callable object (e.g. function, method or class).
+            dead_letter_handler (DeadLetterHandler, optional): Records conversion failures and
+                quarantines raw messages that fail repeatedly. Defaults to None.
         """
         self.message_convertor = message_convertor
         self.callback = callback
+        self.dead_letter_handler = dead_letter_handler
+        self.tracer = None
 
 
     def _command_message(self, raw_message):
@@ -238,14 +415,64 @@ class ConvertedCommandMessageForwarder:
     def forward(self, raw_message, command_message=None):
         """Calls 'self.callback' with a 'CommandMessage' converted from 'raw_message'
 
+        Raw messages that can't be converted are passed to 'self.dead_letter_handler', if
+        there is one, instead of 'self.callback'. Quarantined raw messages are skipped before
+        they're converted.
+
         Args:
             raw_message (Any): The raw message from an MQTT client. Must be compatible with
                 the specific convertor referenced by 'self.message_convertor'.
         """
         if command_message is None:
+            command_message = self.convert(raw_message)
+
+        if command_message is not None:
+            self.callback(command_message)
+
+
+    def convert(self, raw_message):
+        """Converts a raw message to a 'CommandMessage'
+
+        The 'convert' middleware stage. Raw messages that can't be converted are passed to
+        'self.dead_letter_handler', if there is one. Quarantined raw messages are skipped
+        before they're converted. The trace of a message sampled by 'self.tracer' starts here.
+
+        Args:
+            raw_message (Any): The raw message from an MQTT client. Must be compatible with
+                the specific convertor referenced by 'self.message_convertor'.
+
+        Returns:
+            CommandMessage: The converted message, None if it was skipped or couldn't be
+                converted
+        """
+        tracer = self.tracer
+        received = time.monotonic() if tracer is not None else None
+
+        fingerprint = None
+        if self.dead_letter_handler is not None:
+            fingerprint = self.dead_letter_handler.fingerprint(raw_message)
+            if self.dead_letter_handler.quarantined(fingerprint):
+                return
+
+        try:
             command_message = self._command_message(raw_message)
+        except Exception as error: # pylint: disable=broad-except
+            logger.warning(f'Unable to convert message to CommandMessage: {error!r}')
+            command_message = None
+            reason = error
+        else:
+            reason = 'Payload is not of the form {"command": <str>, "attributes": <dict>}'
 
-        self.callback(command_message)
+        if command_message is None:
+            metrics.CONVERT_FAILURES.inc()
+            if self.dead_letter_handler is not None:
+                self.dead_letter_handler.conversion_failed(raw_message, fingerprint, reason)
+            return None
+
+        command_message.fingerprint = fingerprint
+        if tracer is not None:
+            command_message.trace = tracer.begin(raw_message, command_message, received)
+        return command_message
 
 
 class CommandMessageCallback(ABC):
@@ -273,6 +500,25 @@ class CommandMessageCallback(ABC):
         """
 
 
+    def reply(self, inbound_message, payload):
+        """Publishes a reply to a CommandMessage with 'self.mqtt_publish', see 'reply'
+
+        The callback must set 'self.mqtt_publish = None' in its constructor so that it's given
+        the publish function when it's registered
+
+        Args:
+            inbound_message (CommandMessage): The CommandMessage being replied to
+            payload (str): The reply
+
+        Returns:
+            bool: True if the reply was published, False if the CommandMessage didn't say
+                where to send it
+        """
+        # pylint: disable=no-member
+        return reply(self.mqtt_publish, inbound_message, payload)
+        # pylint: enable=no-member
+
+
 class CommandMessageCallbackCaller:
     """Associates callbacks with CommandMessages and calls a callback if a matching CommandMessage
     is received
@@ -281,11 +527,13 @@ class CommandMessageCallbackCaller:
         """Constructor
         """
         self._callbacks = {}
+        self._payload_schemas = {}
+        self._batch_callbacks = {}
         self.mqtt_publish = None
         self.config = None
 
 
-    def add_callback(self, command_name, callback):
+    def add_callback(self, command_name, callback, payload_schema=None, batch_callback=None):
         """Adds a 'command_name': 'callback' key:value pair to the registered callbacks
 
         Args:
@@ -293,11 +541,29 @@ class CommandMessageCallbackCaller:
                 'CommandMessage.payload['command']' to result in the 'callback' associated with
                 this argument being called.
             callback (function, class): a callable object (e.g. function, method or class)
+            payload_schema (PayloadSchema, optional): The payload values required by the
+                callback. If supplied it's compiled here, once, and every matching
+                CommandMessage is validated against it before the callback is called.
+                Defaults to None.
+            batch_callback (function, class, optional): a callable object that accepts a list of
+                CommandMessages, used instead of 'callback' when matching CommandMessages are
+                dispatched in batches. Defaults to None.
 
         Returns:
             dict: All of the currently registered callbacks
         """
         self._callbacks[command_name] = callback
+
+        if payload_schema is None:
+            self._payload_schemas.pop(command_name, None)
+        else:
+            self._payload_schemas[command_name] = payload_schema.compile()
+
+        if batch_callback is None:
+            self._batch_callbacks.pop(command_name, None)
+        else:
+            self._batch_callbacks[command_name] = batch_callback
+
         logger.debug(f'\'{command_name}\' callback: Registered with CommandMessageCallbackCaller')
         return self._callbacks
 
@@ -312,6 +578,8 @@ class CommandMessageCallbackCaller:
             dict: All of the currently registered callbacks
         """
         del self._callbacks[command_name]
+        self._payload_schemas.pop(command_name, None)
+        self._batch_callbacks.pop(command_name, None)
         debug = f"'{command_name}' callback: Unregistered from CommandMessageCallbackCaller"
         logger.debug(debug)
         return self._callbacks
@@ -342,7 +610,9 @@ class CommandMessageCallbackCaller:
                                       'Not registered (disabled with \'self.disabled = True\')']))
                 continue
 
-            self.add_callback(instance.message_name, instance.execute)
+            self.add_callback(instance.message_name, instance.execute,
+                              getattr(instance, 'payload_schema', None),
+                              getattr(instance, 'execute_batch', None))
 
 
     def _setup_command_message_callback_instance(self, instance):
@@ -357,23 +627,103 @@ class CommandMessageCallbackCaller:
         return instance
 
 
+    def has_batch_callback(self, command_name):
+        """Returns whether a batch callback is registered for a command
+
+        Args:
+            command_name (str): Name of the command
+
+        Returns:
+            bool: True if a batch callback is registered
+        """
+        return command_name in self._batch_callbacks
+
+
+    def valid_command_message(self, command_message):
+        """Checks whether a CommandMessage can be passed to its registered callback
+
+        The CommandMessage must not be 'None', a callback must be registered for it and, if the
+        callback has a payload schema, the payload must match it. On a match the extracted
+        values are stored in 'CommandMessage.arguments'.
+
+        Args:
+            command_message (CommandMessage): CommandMessage
+
+        Returns:
+            bool: True if the CommandMessage is valid
+        """
+        if not command_message:
+            logger.warning('Unable to call any callback: Command Message is \'None\'')
+            return False
+
+        command_name = command_message.payload['command']
+        if command_name not in self._callbacks:
+            logger.warning(f'No callback registered for: \'{command_name}\'')
+            return False
+
+        payload_schema = self._payload_schemas.get(command_name)
+        if payload_schema is not None:
+            command_message.arguments = payload_schema.extract(command_message)
+            if command_message.arguments is None:
+                log_wrong_command_message_form(command_name,
+                                               payload_schema.message_form(command_name))
+                return False
+
+        if command_message.trace is not None:
+            command_message.trace.mark('validate')
+        return True
+
+
     def callback_caller(self, command_message):
         """Calls a registered callback if 'CommandMessage.payload['command']' matches with a
         key in the registered callbacks
 
         Args:
             command_message (CommandMessage): CommandMessage
+
+        Returns:
+            Any: The value returned by the callback, e.g. a generator for a streaming callback,
+                or None if no callback was called
         """
-        if command_message:
-            command_name = command_message.payload['command']
-            try:
-                self._callbacks[command_name](command_message)
-            except KeyError:
-                logger.warning(f'No callback registered for: \'{command_name}\'')
-            else:
-                logger.debug(f'Called callback for {command_name}')
-        else:
-            logger.warning('Unable to call any callback: Command Message is \'None\'')
+        if not self.valid_command_message(command_message):
+            return None
+
+        return self.validated_callback_caller(command_message)
+
+
+    def validated_callback_caller(self, command_message):
+        """Calls the registered callback for a CommandMessage
+
+        The CommandMessage must already have been checked with 'valid_command_message'
+
+        Args:
+            command_message (CommandMessage): CommandMessage
+
+        Returns:
+            Any: The value returned by the callback, e.g. a generator for a streaming callback
+        """
+        command_name = command_message.payload['command']
+        result = self._callbacks[command_name](command_message)
+        logger.debug('Called callback for %s', command_name)
+        return result
+
+
+    def batch_callback_caller(self, command_name, command_messages):
+        """Calls the registered batch callback for a command with a batch of CommandMessages
+
+        The CommandMessages must already have been checked with 'valid_command_message'
+
+        Args:
+            command_name (str): Name of the command
+            command_messages (list): The CommandMessages in the batch
+
+        Returns:
+            Any: The value returned by the batch callback
+        """
+        result = self._batch_callbacks[command_name](command_messages)
+        logger.debug('Called batch callback for %s with %d CommandMessage(s)', command_name,
+                     len(command_messages))
+        return result
 
 
 def valid_payload_value(message, keys, required_value_type):
@@ -424,3 +774,855 @@ def log_wrong_command_message_form(callback_name, required_message_form):
     error_message = ''.join([f'A CommandMessage for the callback: \'{callback_name}\'',
                              f'must be of the form:\n{required_message_form}'])
     logger.error(error_message)
+
+
+class PayloadField:
+    """A single value that a callback requires in a CommandMessage payload
+
+    Attributes:
+        name (str): The name given to the value in the extracted arguments. Must be a valid
+            python identifier.
+        keys (list): A list of keys ordered from root to leaf where the leaf is the key of the
+            value e.g. 'keys' for message.payload['attributes']['lounge']['temperature'] would
+            be: ['attributes', 'lounge', 'temperature']
+        value_type (type, Tuple[type]): The required type(s) of the value
+        minimum (int, float): The minimum allowable value (inclusive), or None for no minimum
+        maximum (int, float): The maximum allowable value (inclusive), or None for no maximum
+    """
+    def __init__(self, name, keys, value_type, minimum=None, maximum=None):
+        """Constructor
+
+        Args:
+            name (str): The name given to the value in the extracted arguments
+            keys (list): A list of keys ordered from root to leaf where the leaf is the key of
+                the value
+            value_type (type, Tuple[type]): The required type(s) of the value
+            minimum (int, float, optional): The minimum allowable value (inclusive).
+                Defaults to None.
+            maximum (int, float, optional): The maximum allowable value (inclusive).
+                Defaults to None.
+        """
+        self.name = name
+        self.keys = list(keys)
+        self.value_type = value_type
+        self.minimum = minimum
+        self.maximum = maximum
+
+
+    def valid(self, value):
+        """Checks a value against the type and range requirements of the field
+
+        Args:
+            value (Any): The value to check
+
+        Returns:
+            bool:
+                True: if the value is valid,
+                False: if the value is invalid
+        """
+        if not isinstance(value, self.value_type):
+            return False
+
+        if self.minimum is not None and value < self.minimum:
+            return False
+
+        if self.maximum is not None and value > self.maximum:
+            return False
+
+        return True
+
+
+    def form(self):
+        """Returns a placeholder describing the required value, e.g. '<int: 0 to 100>'
+
+        Returns:
+            str: The placeholder
+        """
+        if isinstance(self.value_type, tuple):
+            type_name = '|'.join([value_type.__name__ for value_type in self.value_type])
+        else:
+            type_name = self.value_type.__name__
+
+        if self.minimum is not None and self.maximum is not None:
+            return f'<{type_name}: {self.minimum} to {self.maximum}>'
+        if self.minimum is not None:
+            return f'<{type_name}: >= {self.minimum}>'
+        if self.maximum is not None:
+            return f'<{type_name}: <= {self.maximum}>'
+        return f'<{type_name}>'
+
+
+class PayloadSchema:
+    """Declarative description of the values that a callback requires in a CommandMessage
+    payload
+
+    A callback declares its schema by setting 'self.payload_schema'. The schema is compiled
+    once, when the callback is registered with CommandMessageCallbackCaller, and every
+    matching CommandMessage is then validated and its values extracted in a single pass.
+
+    Attributes:
+        fields (Tuple[PayloadField]): The required values
+    """
+    def __init__(self, *fields):
+        """Constructor
+
+        Args:
+            *fields (PayloadField): The required values
+
+        Raises:
+            ValueError: if two fields share a name, a field has no keys or the keys of one
+                field lead to the value of another
+        """
+        names = [field.name for field in fields]
+        if len(names) != len(set(names)):
+            raise ValueError(f'PayloadSchema field names must be unique: {names}')
+
+        self.fields = tuple(fields)
+        self._tree = self._key_tree()
+
+
+    def _key_tree(self):
+        """Returns the keys of all of the fields merged into a tree
+
+        Each branch of the tree is a dict and each leaf is the index of a field in
+        'self.fields'
+        """
+        tree = {}
+
+        for index, field in enumerate(self.fields):
+            if not field.keys:
+                raise ValueError(f"PayloadSchema field '{field.name}' has no keys")
+
+            node = tree
+            for key in field.keys[:-1]:
+                node = node.setdefault(key, {})
+                if not isinstance(node, dict):
+                    raise ValueError(f"PayloadSchema field '{field.name}' overlaps another field")
+
+            if field.keys[-1] in node:
+                raise ValueError(f"PayloadSchema field '{field.name}' overlaps another field")
+            node[field.keys[-1]] = index
+
+        return tree
+
+
+    def _render(self, node):
+        """Renders a branch of the key tree as a string
+        """
+        items = []
+        for key, child in node.items():
+            if isinstance(child, dict):
+                items.append(f'"{key}": {self._render(child)}')
+            else:
+                items.append(f'"{key}": {self.fields[child].form()}')
+
+        return ''.join(['{', ', '.join(items), '}'])
+
+
+    def message_form(self, command_name):
+        """Returns the form of CommandMessage payload required by the schema
+
+        Args:
+            command_name (str): Name of the command the schema belongs to
+
+        Returns:
+            str: The required message form
+        """
+        tree = {key: child for key, child in self._tree.items() if key != 'command'}
+        tree.setdefault('attributes', {})
+
+        return ''.join([f'{{"command": "{command_name}", ', self._render(tree)[1:]])
+
+
+    def compile(self):
+        """Compiles the schema into a single pass validator and extractor
+
+        Returns:
+            CompiledPayloadSchema: The compiled schema
+        """
+        return CompiledPayloadSchema(self)
+
+
+class CompiledPayloadSchema:
+    """A PayloadSchema compiled into a single pass validator and extractor
+
+    Attributes:
+        payload_schema (PayloadSchema): The schema that was compiled
+        arguments_type (type): The namedtuple type of the extracted arguments
+    """
+    def __init__(self, payload_schema):
+        """Constructor
+
+        Args:
+            payload_schema (PayloadSchema): The schema to compile
+        """
+        self.payload_schema = payload_schema
+        self.arguments_type = namedtuple('PayloadArguments',
+                                         [field.name for field in payload_schema.fields])
+        # pylint: disable=protected-access
+        self._walk = self._compile_branch(payload_schema._tree)
+        # pylint: enable=protected-access
+        self._size = len(payload_schema.fields)
+
+
+    def _compile_branch(self, branch):
+        """Compiles a branch of a key tree into a function that validates, and extracts, every
+        value below the branch
+        """
+        leaves = []
+        branches = []
+
+        for key, child in branch.items():
+            if isinstance(child, dict):
+                branches.append((key, self._compile_branch(child)))
+            else:
+                leaves.append((key, child, self.payload_schema.fields[child].valid))
+
+        def walk(mapping, values):
+            if not isinstance(mapping, dict):
+                return False
+
+            for key, index, valid in leaves:
+                if key not in mapping or not valid(mapping[key]):
+                    return False
+                values[index] = mapping[key]
+
+            for key, walk_branch in branches:
+                if key not in mapping or not walk_branch(mapping[key], values):
+                    return False
+
+            return True
+
+        return walk
+
+
+    def extract(self, message):
+        """Validates a CommandMessage and extracts the values declared by the schema
+
+        Args:
+            message (CommandMessage): CommandMessage to validate and extract values from
+
+        Returns:
+            namedtuple: The extracted values, in field order, or None if the payload of
+            'message' doesn't satisfy the schema
+        """
+        values = [None] * self._size
+
+        if self._walk(message.payload, values):
+            return self.arguments_type._make(values)
+
+        return None
+
+
+    def message_form(self, command_name):
+        """Returns the form of CommandMessage payload required by the schema
+
+        Args:
+            command_name (str): Name of the command the schema belongs to
+
+        Returns:
+            str: The required message form
+        """
+        return self.payload_schema.message_form(command_name)
+
+
+class ReplyPayloadSchema(PayloadSchema):
+    """A PayloadSchema for callbacks that publish a reply, see 'CommandMessageCallback.reply'
+
+    The 'return_message' block, see 'return_message_fields', is added to the required values
+    and to the message form. A CommandMessage that says where to reply in another way, i.e.
+    with an MQTT 5 response topic or a "response_topic" at the top level of its payload, see
+    'reply_address', can leave the block out, in which case its 'topic', 'qos' and 'retain'
+    arguments are None.
+
+    Attributes:
+        fields (Tuple[PayloadField]): The required values, the 'return_message' block last
+        reply_free_fields (Tuple[PayloadField]): The required values other than the
+            'return_message' block
+    """
+    def __init__(self, *fields):
+        """Constructor
+
+        Args:
+            *fields (PayloadField): The required values other than the 'return_message' block
+
+        Raises:
+            ValueError: if two fields share a name, a field has no keys or the keys of one
+                field lead to the value of another
+        """
+        super().__init__(*fields, *return_message_fields())
+        self.reply_free_fields = tuple(fields)
+
+
+    def compile(self):
+        """Compiles the schema into a single pass validator and extractor
+
+        Returns:
+            CompiledReplyPayloadSchema: The compiled schema
+        """
+        return CompiledReplyPayloadSchema(self)
+
+
+class CompiledReplyPayloadSchema(CompiledPayloadSchema):
+    """A ReplyPayloadSchema compiled into a single pass validator and extractor
+    """
+    def __init__(self, payload_schema):
+        """Constructor
+
+        Args:
+            payload_schema (ReplyPayloadSchema): The schema to compile
+        """
+        super().__init__(payload_schema)
+        self._reply_free = PayloadSchema(*payload_schema.reply_free_fields).compile()
+        self._return_message_size = self._size - len(payload_schema.reply_free_fields)
+
+
+    def extract(self, message):
+        """Validates a CommandMessage and extracts the values declared by the schema
+
+        Args:
+            message (CommandMessage): CommandMessage to validate and extract values from
+
+        Returns:
+            namedtuple: The extracted values, in field order, or None if the payload of
+            'message' doesn't satisfy the schema
+        """
+        arguments = super().extract(message)
+        if arguments is not None or reply_address(message) is None:
+            return arguments
+
+        values = self._reply_free.extract(message)
+        if values is None:
+            return None
+        return self.arguments_type._make(list(values) + [None] * self._return_message_size)
+
+
+def return_message_fields():
+    """Returns the PayloadFields of the 'return_message' block used by callbacks that publish a
+    reply:
+
+        {"return_message": {"topic": <str>, "qos": <int: 0 to 2>, "retain": <bool>}}
+
+    Returns:
+        Tuple[PayloadField]: The 'topic', 'qos' and 'retain' fields
+    """
+    return (PayloadField('topic', ['attributes', 'return_message', 'topic'], str),
+            PayloadField('qos', ['attributes', 'return_message', 'qos'], int, 0, 2),
+            PayloadField('retain', ['attributes', 'return_message', 'retain'], bool))
+
+
+
+RESPONSE_TOPIC_KEY = 'response_topic'
+CORRELATION_DATA_KEY = 'correlation_data'
+
+ReplyAddress = namedtuple('ReplyAddress', ['topic', 'qos', 'retain', 'correlation_data',
+                                           'envelope'])
+
+
+def reply_address(command_message):
+    """Returns where, and how, the reply to a CommandMessage is published
+
+    The address is taken from the first of these that the CommandMessage has:
+
+    1. The MQTT 5 response topic and correlation data it was published with. The reply is
+       published at the CommandMessage's QoS with the correlation data as a property.
+    2. A "response_topic" and, optionally, a "correlation_data" string at the top level of its
+       payload, the equivalent for MQTT 3.1.1:
+
+        {"command": ..., "attributes": {...}, "response_topic": <str>,
+         "correlation_data": <str>}
+
+       The reply is published at the CommandMessage's QoS in an envelope carrying the
+       correlation data, see 'publish_reply'.
+    3. A 'return_message' block in its attributes, see 'return_message_fields'. The reply is
+       published as it is.
+
+    Args:
+        command_message (CommandMessage): The CommandMessage being replied to
+
+    Returns:
+        ReplyAddress: The topic, qos, retain flag, correlation data and whether the reply is
+            enveloped, or None if the CommandMessage doesn't say where to reply
+    """
+    if command_message.response_topic:
+        return ReplyAddress(command_message.response_topic, command_message.qos, False,
+                            command_message.correlation_data, False)
+
+    payload = command_message.payload
+    response_topic = payload.get(RESPONSE_TOPIC_KEY)
+    if isinstance(response_topic, str) and response_topic:
+        correlation_data = payload.get(CORRELATION_DATA_KEY)
+        if not isinstance(correlation_data, str):
+            correlation_data = None
+        return ReplyAddress(response_topic, command_message.qos, False, correlation_data, True)
+
+    return_message = payload.get('attributes', {}).get('return_message')
+    if (isinstance(return_message, dict)
+            and all(field.valid(return_message.get(field.keys[-1]))
+                    for field in return_message_fields())):
+        return ReplyAddress(return_message['topic'], return_message['qos'],
+                            return_message['retain'], None, False)
+
+    return None
+
+
+def publish_reply(mqtt_publish, address, payload):
+    """Publishes a reply to a ReplyAddress
+
+    MQTT 5 correlation data is sent as the CorrelationData property of the reply. Enveloped
+    correlation data is sent by replacing the payload with:
+
+        {"correlation_data": <str>, "payload": <payload>}
+
+    Args:
+        mqtt_publish (Callable): A callable object to publish MQTT messages, which must accept
+            a 'properties' keyword argument for MQTT 5 replies
+        address (ReplyAddress): Where to publish the reply, see 'reply_address'
+        payload (str): The reply
+    """
+    if address.correlation_data is None:
+        mqtt_publish(address.topic, payload, address.qos, address.retain)
+    elif address.envelope:
+        envelope = {CORRELATION_DATA_KEY: address.correlation_data, 'payload': payload}
+        mqtt_publish(address.topic, json.dumps(envelope), address.qos, address.retain)
+    else:
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.CorrelationData = address.correlation_data
+        mqtt_publish(address.topic, payload, address.qos, address.retain,
+                     properties=properties)
+
+
+def reply(mqtt_publish, command_message, payload):
+    """Publishes a reply to a CommandMessage, with its correlation data attached
+
+    Clients can send many requests with the same response topic, and tell the replies apart by
+    their correlation data. See 'reply_address' for how the reply is addressed.
+
+    Args:
+        mqtt_publish (Callable): A callable object to publish MQTT messages
+        command_message (CommandMessage): The CommandMessage being replied to
+        payload (str): The reply
+
+    Returns:
+        bool: True if the reply was published, False if the CommandMessage didn't say where to
+            send it
+    """
+    address = reply_address(command_message)
+    if address is None:
+        logger.warning(''.join([f"No reply sent to '{command_message.payload['command']}' ",
+                                'CommandMessage: it has no response topic or return_message']))
+        return False
+
+    publish_reply(mqtt_publish, address, payload)
+    return True
+
+
+def group_by_reply_address(command_messages):
+    """Groups a batch of CommandMessages by their reply address so that a single reply can be
+    published to each distinct address
+
+    Requests carrying correlation data each have an address of their own. CommandMessages
+    that don't say where to reply are left out.
+
+    Args:
+        command_messages (list): The CommandMessages to group
+
+    Returns:
+        dict: Lists of CommandMessages, in their original order, keyed by ReplyAddress
+    """
+    groups = {}
+    for command_message in command_messages:
+        address = reply_address(command_message)
+        if address is None:
+            logger.warning(''.join(["No reply sent to batched ",
+                                    f"'{command_message.payload['command']}' CommandMessage: ",
+                                    'it has no response topic or return_message']))
+            continue
+        groups.setdefault(address, []).append(command_message)
+    return groups
+
+
+
+SECRET_ATTRIBUTES = ('token',)
+_REDACTED = '***'
+
+
+def redacted_payload(payload):
+    """Returns a CommandMessage payload with the values of its SECRET_ATTRIBUTES replaced, so
+    that it can be logged, published or stored without revealing them
+
+    Args:
+        payload (dict): The CommandMessage payload
+
+    Returns:
+        dict: The payload itself if it has no secret attributes, otherwise a copy of it with
+            their values replaced by '***'
+    """
+    attributes = payload.get('attributes')
+    if not (isinstance(attributes, dict)
+            and any(key in attributes for key in SECRET_ATTRIBUTES)):
+        return payload
+
+    return {**payload, 'attributes': {key: _REDACTED if key in SECRET_ATTRIBUTES else value
+                                      for key, value in attributes.items()}}
+
+
+
+CHUNK_COMMAND_NAME = 'mqtt_remote_chunk'
+
+CHUNK_PAYLOAD_SCHEMA = PayloadSchema(
+    PayloadField('transfer_id', ['attributes', 'transfer_id'], str),
+    PayloadField('sequence', ['attributes', 'sequence'], int, minimum=0),
+    PayloadField('total', ['attributes', 'total'], int, minimum=1),
+    PayloadField('chunk_size', ['attributes', 'chunk_size'], int, minimum=1),
+    PayloadField('size', ['attributes', 'size'], int, minimum=0),
+    PayloadField('checksum', ['attributes', 'checksum'], str),
+    PayloadField('data', ['attributes', 'data'], str))
+
+
+def chunk_payloads(data, chunk_size, message_payload=None, transfer_id=None):
+    """Splits data into the CommandMessage payloads of a chunked transfer
+
+    Each payload is of the form:
+
+        {"command": "mqtt_remote_chunk",
+         "attributes": {"transfer_id": <str>, "sequence": <int>, "total": <int>,
+                        "chunk_size": <int>, "size": <int>, "checksum": <str>,
+                        "data": <base64 str>}}
+
+    where 'checksum' is the SHA-256 hex digest of all of the data. The first payload also
+    contains a "message" attribute if 'message_payload' is supplied.
+
+    Args:
+        data (bytes, str): The data to split. Strings are encoded as UTF-8.
+        chunk_size (int): The maximum number of bytes of data carried by each payload
+        message_payload (dict, optional): A standard CommandMessage payload to deliver along
+            with the data, which is attached to the reassembled CommandMessage. If None the
+            data itself must be a standard CommandMessage payload in JSON form. Defaults to
+            None.
+        transfer_id (str, optional): A unique identifier for the transfer. Defaults to None,
+            in which case one is generated.
+
+    Yields:
+        dict: The CommandMessage payloads of the transfer, in sequence order
+
+    Raises:
+        ValueError: if 'chunk_size' is less than one
+    """
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be at least 1 byte')
+
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    if transfer_id is None:
+        transfer_id = uuid.uuid4().hex
+
+    total = max(1, math.ceil(len(data) / chunk_size))
+    checksum = hashlib.sha256(data).hexdigest()
+
+    for sequence in range(total):
+        part = data[sequence * chunk_size:(sequence + 1) * chunk_size]
+        attributes = {'transfer_id': transfer_id,
+                      'sequence': sequence,
+                      'total': total,
+                      'chunk_size': chunk_size,
+                      'size': len(data),
+                      'checksum': checksum,
+                      'data': base64.b64encode(part).decode('ascii')}
+
+        if sequence == 0 and message_payload is not None:
+            attributes['message'] = message_payload
+
+        yield {'command': CHUNK_COMMAND_NAME, 'attributes': attributes}
+
+
+def publish_chunked(publish_function, topic, data, qos, retain, chunk_size,
+                    message_payload=None):
+    """Publishes data as a chunked transfer
+
+    Args:
+        publish_function (Callable): A callable object to publish MQTT messages, e.g.
+            'MQTTClient.publish' or a callback's 'self.mqtt_publish'
+        topic (str): The topic to publish the parts of the transfer to
+        data (bytes, str): The data to transfer
+        qos (int): The required Quality Of Service for each part of the transfer
+        retain (bool): The retain flag for each part of the transfer
+        chunk_size (int): The maximum number of bytes of data carried by each part
+        message_payload (dict, optional): A standard CommandMessage payload to deliver along
+            with the data. Defaults to None.
+
+    Returns:
+        str: The transfer identifier
+    """
+    transfer_id = uuid.uuid4().hex
+
+    for payload in chunk_payloads(data, chunk_size, message_payload, transfer_id):
+        publish_function(topic, json.dumps(payload), qos, retain)
+
+    return transfer_id
+
+
+class _ChunkedTransfer:
+    """The state of a partially received chunked transfer
+    """
+    def __init__(self, arguments, spool_size, now):
+        self.total = arguments.total
+        self.chunk_size = arguments.chunk_size
+        self.size = arguments.size
+        self.checksum = arguments.checksum
+        self.received = set()
+        self.message_payload = None
+        self.last_activity = now
+        self.spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+
+
+    def matches(self, arguments):
+        """Checks that a part belongs to the same transfer description as earlier parts
+        """
+        return (arguments.total, arguments.chunk_size, arguments.size, arguments.checksum) == \
+            (self.total, self.chunk_size, self.size, self.checksum)
+
+
+    def write(self, sequence, part):
+        """Writes a part of the transfer into the spool at its final position
+        """
+        self.spool.seek(sequence * self.chunk_size)
+        self.spool.write(part)
+        self.received.add(sequence)
+
+
+    def complete(self):
+        """Returns whether every part of the transfer has been received
+        """
+        return len(self.received) == self.total
+
+
+    def checksum_valid(self, block_size=65536):
+        """Checks the spooled data against the transfer checksum
+        """
+        digest = hashlib.sha256()
+        self.spool.seek(0)
+        for block in iter(lambda: self.spool.read(block_size), b''):
+            digest.update(block)
+        self.spool.seek(0)
+
+        return digest.hexdigest() == self.checksum
+
+
+class ChunkReassembler:
+    """Reassembles chunked transfers and calls a callback with the completed CommandMessage
+
+    Each transfer is reassembled incrementally into a spooled temporary file, which is held in
+    memory until it exceeds 'spool_size' bytes and is then moved to disk. The file becomes the
+    'attachment' of the CommandMessage delivered by the transfer, which then owns it.
+
+    Whilst transfers are in progress a background thread discards those that have gone
+    'timeout' seconds without receiving a part, so that abandoned transfers don't hold their
+    spool indefinitely. The thread stops once there are no transfers left.
+
+    Attributes:
+        callback (function, class): a callable object (e.g. function, method or class) that's
+            called with the CommandMessage delivered by each completed transfer
+        spool_size (int): The number of bytes of a transfer held in memory before it's spooled
+            to disk
+        max_transfer_size (int): The maximum allowable size, in bytes, of a single transfer
+        max_transfers (int): The maximum number of incomplete transfers held at any one time
+        timeout (float): The time, in seconds, an incomplete transfer can go without receiving
+            a part before it's discarded
+    """
+    def __init__(self, callback, spool_size=1048576, max_transfer_size=104857600,
+                 max_transfers=8, timeout=60, clock=None):
+        """Constructor
+
+        Args:
+            callback (function, class): a callable object (e.g. function, method or class)
+            spool_size (int, optional): Bytes of a transfer held in memory before spooling to
+                disk. Defaults to 1048576.
+            max_transfer_size (int, optional): Maximum size of a single transfer in bytes.
+                Defaults to 104857600.
+            max_transfers (int, optional): Maximum number of incomplete transfers.
+                Defaults to 8.
+            timeout (float, optional): Time, in seconds, an incomplete transfer can go without
+                receiving a part. Defaults to 60.
+            clock (Callable, optional): Returns the current time in seconds.
+                Defaults to None, in which case time.monotonic is used.
+        """
+        self.callback = callback
+        self.spool_size = spool_size
+        self.max_transfer_size = max_transfer_size
+        self.max_transfers = max_transfers
+        self.timeout = timeout
+
+        self._clock = time.monotonic if clock is None else clock
+        self._transfers = {}
+        self._lock = threading.Lock()
+        self._sweeper = None
+
+
+    def _discard(self, transfer_id):
+        """Discards an incomplete transfer
+        """
+        self._transfers.pop(transfer_id).spool.close()
+
+
+    def _discard_expired_transfers(self, now):
+        """Discards incomplete transfers that haven't received a part within the timeout
+        """
+        for transfer_id, transfer in list(self._transfers.items()):
+            if now - transfer.last_activity > self.timeout:
+                logger.warning(''.join([f"Chunked transfer '{transfer_id}' timed out: ",
+                                        f"{len(transfer.received)} of {transfer.total} ",
+                                        "parts received"]))
+                self._discard(transfer_id)
+
+
+    def _start_sweeper(self):
+        """Starts the thread that discards expired transfers, if it isn't already running
+        """
+        if self._sweeper is not None:
+            return
+
+        self._sweeper = threading.Thread(target=self._sweep, daemon=True,
+                                         name='mqtt_remote_chunk_sweeper')
+        self._sweeper.start()
+
+
+    def _sweep(self):
+        """Discards expired transfers periodically until there are no transfers left
+        """
+        interval = min(max(self.timeout / 4, 0.01), 5.0)
+        while True:
+            time.sleep(interval)
+            with self._lock:
+                self._discard_expired_transfers(self._clock())
+                if not self._transfers:
+                    self._sweeper = None
+                    return
+
+
+    def _new_transfer(self, arguments, now):
+        """Starts a new transfer, returning None if the transfer isn't allowed
+        """
+        if arguments.size > self.max_transfer_size:
+            logger.warning(''.join([f"Chunked transfer '{arguments.transfer_id}' rejected: ",
+                                    f"{arguments.size} bytes exceeds the maximum of ",
+                                    f"{self.max_transfer_size} bytes"]))
+            return None
+
+        if arguments.total != max(1, math.ceil(arguments.size / arguments.chunk_size)):
+            logger.warning(''.join([f"Chunked transfer '{arguments.transfer_id}' rejected: ",
+                                    "part count doesn't match its size"]))
+            return None
+
+        if len(self._transfers) >= self.max_transfers:
+            logger.warning(''.join([f"Chunked transfer '{arguments.transfer_id}' rejected: ",
+                                    f"{self.max_transfers} transfers already in progress"]))
+            return None
+
+        transfer = _ChunkedTransfer(arguments, self.spool_size, now)
+        self._transfers[arguments.transfer_id] = transfer
+        self._start_sweeper()
+        return transfer
+
+
+    def _part(self, transfer, arguments):
+        """Decodes and checks a part of a transfer, returning None if it's invalid
+        """
+        if arguments.sequence >= transfer.total:
+            return None
+
+        try:
+            part = base64.b64decode(arguments.data, validate=True)
+        except binascii.Error:
+            return None
+
+        if arguments.sequence == transfer.total - 1:
+            expected_size = transfer.size - arguments.sequence * transfer.chunk_size
+        else:
+            expected_size = transfer.chunk_size
+
+        if len(part) != expected_size:
+            return None
+
+        return part
+
+
+    def _completed_command_message(self, transfer, chunk_message):
+        """Builds the CommandMessage delivered by a completed transfer
+        """
+        if transfer.message_payload is None:
+            payload = json.loads(transfer.spool.read().decode('utf-8'))
+            return CommandMessage(chunk_message.topic, payload,
+                                  chunk_message.qos, chunk_message.retain)
+
+        command_message = CommandMessage(chunk_message.topic, transfer.message_payload,
+                                         chunk_message.qos, chunk_message.retain)
+        command_message.attachment = transfer.spool
+        return command_message
+
+
+    def receive(self, command_message):
+        """Receives a part of a chunked transfer
+
+        Once every part of a transfer has been received, and its checksum verified, 'callback'
+        is called with the CommandMessage delivered by the transfer. If the transfer has an
+        attachment the CommandMessage owns it from then on, and it's only closed here if
+        'callback' raises an exception.
+
+        Args:
+            command_message (CommandMessage): A CommandMessage whose 'arguments' have been
+                extracted with CHUNK_PAYLOAD_SCHEMA
+        """
+        arguments = command_message.arguments
+
+        with self._lock:
+            now = self._clock()
+            self._discard_expired_transfers(now)
+
+            transfer = self._transfers.get(arguments.transfer_id)
+            if transfer is None:
+                transfer = self._new_transfer(arguments, now)
+                if transfer is None:
+                    return
+
+            part = self._part(transfer, arguments) if transfer.matches(arguments) else None
+            if part is None:
+                logger.warning(''.join([f"Chunked transfer '{arguments.transfer_id}': ",
+                                        f"part {arguments.sequence} is invalid and was ignored"]))
+                return
+
+            if arguments.sequence == 0:
+                transfer.message_payload = command_message.payload['attributes'].get('message')
+
+            transfer.write(arguments.sequence, part)
+            transfer.last_activity = now
+
+            if not transfer.complete():
+                return
+
+            del self._transfers[arguments.transfer_id]
+
+        if not transfer.checksum_valid():
+            logger.warning(f"Chunked transfer '{arguments.transfer_id}' failed its checksum")
+            transfer.spool.close()
+            return
+
+        try:
+            completed_message = self._completed_command_message(transfer, command_message)
+        except (TypeError, ValueError):
+            logger.warning(''.join([f"Chunked transfer '{arguments.transfer_id}' didn't ",
+                                    "contain a valid CommandMessage payload"]))
+            transfer.spool.close()
+            return
+
+        if completed_message.attachment is None:
+            transfer.spool.close()
+
+        logger.debug(''.join([f"Chunked transfer '{arguments.transfer_id}' complete: ",
+                              f"{transfer.size} bytes in {transfer.total} parts"]))
+        try:
+            self.callback(completed_message)
+        except Exception:
+            completed_message.close_attachment()
+            raise
@@ -0,0 +1,605 @@
+"""Metrics related functionality
+
+A metrics registry holds the counters, histograms and gauges recorded across MQTT Remote and
+writes them in the Prometheus text format, which a metrics server serves at '/metrics'.
+
+Counters are aggregated per thread: each thread adds to a cell of its own, without taking a
+lock, and the cells are only summed when the metrics are collected. Histograms are
+LatencyHistograms, one for each set of label values. Gauges call a function when the metrics
+are collected, so they cost nothing in between.
+
+MQTT Remote's own metrics are held by REGISTRY.
+
+Examples:
+
+    To count the messages received, and the CommandMessages dispatched for each command:
+
+        .. code-block:: python
+
+            messages_received = REGISTRY.counter('mqtt_remote_messages_received_total',
+                                                 'Messages received from the broker')
+            messages_received.inc()
+
+            commands_dispatched = REGISTRY.counter('mqtt_remote_commands_dispatched_total',
+                                                   'CommandMessages dispatched',
+                                                   ['command', 'outcome'])
+            commands_dispatched.inc(labels=('volume_up', 'ok'))
+
+
+    To record how long each command takes:
+
+        .. code-block:: python
+
+            command_duration = REGISTRY.histogram('mqtt_remote_command_duration_seconds',
+                                                  'Time spent calling callbacks', ['command'])
+            command_duration.observe(0.012, labels=('volume_up',))
+
+
+    To serve the metrics at 'http://127.0.0.1:9464/metrics':
+
+        .. code-block:: python
+
+            metrics_server = MetricsServer(REGISTRY, '127.0.0.1', 9464)
+            metrics_server.start()
+
+
+Attributes:
+    CONTENT_TYPE (str): The content type of the Prometheus text format
+    REGISTRY (MetricsRegistry): The registry holding MQTT Remote's own metrics
+    MESSAGES_RECEIVED (Counter): Messages received from the broker
+    MESSAGES_PUBLISHED (Counter): Messages published
+    MESSAGES_DROPPED (Counter): Messages dropped, by reason
+    PUBLISH_LATENCY (Histogram): The time between publishing messages and paho confirming
+        them as sent, i.e. the PUBACK, or PUBCOMP, latency of QoS 1 and 2 messages
+    CONVERT_FAILURES (Counter): Messages that couldn't be converted to CommandMessages
+    COMMANDS_DISPATCHED (Counter): CommandMessages dispatched, by command and outcome
+    COMMAND_DURATION (Histogram): The time spent calling callbacks, by command
+    DISPATCH_QUEUE_WAIT (Histogram): The time CommandMessages wait for a dispatch worker
+    RECONNECTS (Counter): Connections to the broker re-established after being lost
+    CONNECTION_FAILURES (Counter): Failed attempts to connect to the broker
+    SLOW_CALLBACKS (Counter): Callbacks that ran for longer than the slow callback threshold,
+        by command
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import math
+import threading
+
+from mqtt_remote.histogram import DEFAULT_LATENCY_BUCKETS, LatencyHistogram
+
+
+
+# pylint: disable=C0103
+logger = logging.getLogger(__name__)
+# pylint: enable=C0103
+
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+
+def _escape(value):
+    """Escapes a label value for the Prometheus text format
+    """
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    """Formats a sample value for the Prometheus text format
+    """
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _sample(name, labelnames, labels, value, extra_label=None):
+    """Formats a single sample line
+    """
+    pairs = [f'{labelname}="{_escape(label)}"' for labelname, label in zip(labelnames, labels)]
+    if extra_label is not None:
+        pairs.append(f'{extra_label[0]}="{extra_label[1]}"')
+    label_text = f"{{{','.join(pairs)}}}" if pairs else ''
+    return f'{name}{label_text} {_format_value(value)}'
+
+
+
+class _Metric:
+    """The name, documentation and label names shared by every kind of metric
+    """
+    metric_type = ''
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+
+    def _header(self):
+        return [f'# HELP {self.name} {self.documentation}',
+                f'# TYPE {self.name} {self.metric_type}']
+
+
+
+class Counter(_Metric):
+    """A count that only goes up, optionally split by label values
+
+    Each thread counts in a cell of its own, so counting never waits on a lock. The cells are
+    summed when the counter is collected.
+
+    Attributes:
+        name (str): The metric's name, ending in '_total' by convention
+        documentation (str): What the metric counts
+        labelnames (Tuple[str]): The names of the labels the count is split by
+    """
+    metric_type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        """Constructor
+
+        Args:
+            name (str): The metric's name
+            documentation (str): What the metric counts
+            labelnames (Iterable[str], optional): The names of the labels the count is split
+                by. Defaults to ().
+        """
+        super().__init__(name, documentation, labelnames)
+        self._local = threading.local()
+        self._cells = []
+        self._lock = threading.Lock()
+
+
+    def _cell(self):
+        """Returns the current thread's cell, creating it on first use
+        """
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = {}
+            with self._lock:
+                self._cells.append(cell)
+            self._local.cell = cell
+            return cell
+
+
+    def inc(self, amount=1, labels=()):
+        """Adds to the count
+
+        Args:
+            amount (float, optional): The amount added. Defaults to 1.
+            labels (Tuple[str], optional): The label values, one for each label name.
+                Defaults to ().
+        """
+        cell = self._cell()
+        cell[labels] = cell.get(labels, 0) + amount
+
+
+    def values(self):
+        """Returns the counts
+
+        Returns:
+            dict: The count for each tuple of label values counted so far
+        """
+        with self._lock:
+            cells = list(self._cells)
+
+        totals = {}
+        for cell in cells:
+            for labels, value in cell.copy().items():
+                totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+
+    def value(self, labels=()):
+        """Returns the count for one tuple of label values
+
+        Args:
+            labels (Tuple[str], optional): The label values. Defaults to ().
+
+        Returns:
+            float: The count
+        """
+        return self.values().get(labels, 0)
+
+
+    def collect(self):
+        """Returns the counter in the Prometheus text format
+
+        Returns:
+            list[str]: The lines
+        """
+        lines = self._header()
+        for labels, value in sorted(self.values().items()):
+            lines.append(_sample(self.name, self.labelnames, labels, value))
+        return lines
+
+
+
+class Histogram(_Metric):
+    """The distribution of a set of values, e.g. latencies, optionally split by label values
+
+    Attributes:
+        name (str): The metric's name, ending in the unit, e.g. '_seconds', by convention
+        documentation (str): What the metric measures
+        labelnames (Tuple[str]): The names of the labels the distribution is split by
+        buckets (Tuple[float]): The bucket upper bounds
+    """
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        """Constructor
+
+        Args:
+            name (str): The metric's name
+            documentation (str): What the metric measures
+            labelnames (Iterable[str], optional): The names of the labels the distribution is
+                split by. Defaults to ().
+            buckets (Iterable[float], optional): The bucket upper bounds. Defaults to
+                DEFAULT_LATENCY_BUCKETS.
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+
+    def histogram(self, labels=()):
+        """Returns the LatencyHistogram for one tuple of label values, creating it if required
+
+        Args:
+            labels (Tuple[str], optional): The label values. Defaults to ().
+
+        Returns:
+            LatencyHistogram: The histogram
+        """
+        histogram = self._histograms.get(labels)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(labels, LatencyHistogram(self.buckets))
+        return histogram
+
+
+    def observe(self, value, labels=()):
+        """Records a value
+
+        Args:
+            value (float): The value, e.g. a latency in seconds
+            labels (Tuple[str], optional): The label values, one for each label name.
+                Defaults to ().
+        """
+        self.histogram(labels).observe(value)
+
+
+    def histograms(self):
+        """Returns the LatencyHistograms recorded so far
+
+        Returns:
+            dict: The LatencyHistogram for each tuple of label values
+        """
+        with self._lock:
+            return dict(self._histograms)
+
+
+    def collect(self):
+        """Returns the histogram in the Prometheus text format
+
+        Returns:
+            list[str]: The lines
+        """
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+
+        lines = self._header()
+        for labels, histogram in histograms:
+            snapshot = histogram.snapshot()
+            for upper_bound, count in snapshot['buckets']:
+                lines.append(_sample(f'{self.name}_bucket', self.labelnames, labels, count,
+                                     ('le', _format_value(float(upper_bound)))))
+            lines.append(_sample(f'{self.name}_sum', self.labelnames, labels, snapshot['sum']))
+            lines.append(_sample(f'{self.name}_count', self.labelnames, labels,
+                                 snapshot['count']))
+        return lines
+
+
+
+class Gauge(_Metric):
+    """A value that can go up and down, read from a function when the metrics are collected
+
+    Attributes:
+        name (str): The metric's name
+        documentation (str): What the metric measures
+        labelnames (Tuple[str]): The names of the labels the value is split by
+        function (Callable): Returns the value, or, if there are label names, a dict of the
+            value for each tuple of label values
+    """
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, function, labelnames=()):
+        """Constructor
+
+        Args:
+            name (str): The metric's name
+            documentation (str): What the metric measures
+            function (Callable): Returns the value, or a dict keyed by label values
+            labelnames (Iterable[str], optional): The names of the labels the value is split
+                by. Defaults to ().
+        """
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+
+    def collect(self):
+        """Returns the gauge in the Prometheus text format
+
+        Returns:
+            list[str]: The lines, just the header if the function raised an exception
+        """
+        lines = self._header()
+        try:
+            values = self.function()
+        except Exception as error: # pylint: disable=broad-except
+            logger.warning(f"Metric '{self.name}' could not be read: {error}")
+            return lines
+
+        if not self.labelnames:
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            lines.append(_sample(self.name, self.labelnames, labels, value))
+        return lines
+
+
+
+class MetricsRegistry:
+    """Holds a set of metrics, each with a unique name
+    """
+    def __init__(self):
+        """Constructor
+        """
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+
+    def _register(self, metric):
+        """Adds a metric, or returns the metric of the same name and kind already registered
+
+        Raises:
+            ValueError: if a different kind of metric, or one with different label names, is
+                already registered with the same name
+        """
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is None:
+                self._metrics[metric.name] = metric
+                return metric
+
+        if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+            raise ValueError(f"A different metric called '{metric.name}' is already registered")
+        return existing
+
+
+    def counter(self, name, documentation, labelnames=()):
+        """Returns the counter called 'name', registering it if required
+
+        Args:
+            name (str): The metric's name
+            documentation (str): What the metric counts
+            labelnames (Iterable[str], optional): The names of its labels. Defaults to ().
+
+        Returns:
+            Counter: The counter
+
+        Raises:
+            ValueError: if a different metric called 'name' is already registered
+        """
+        return self._register(Counter(name, documentation, labelnames))
+
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        """Returns the histogram called 'name', registering it if required
+
+        Args:
+            name (str): The metric's name
+            documentation (str): What the metric measures
+            labelnames (Iterable[str], optional): The names of its labels. Defaults to ().
+            buckets (Iterable[float], optional): The bucket upper bounds. Defaults to
+                DEFAULT_LATENCY_BUCKETS.
+
+        Returns:
+            Histogram: The histogram
+
+        Raises:
+            ValueError: if a different metric called 'name' is already registered
+        """
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+
+    def gauge(self, name, documentation, function, labelnames=()):
+        """Registers a gauge, replacing any gauge of the same name
+
+        Args:
+            name (str): The metric's name
+            documentation (str): What the metric measures
+            function (Callable): Returns the value, or a dict keyed by label values
+            labelnames (Iterable[str], optional): The names of its labels. Defaults to ().
+
+        Returns:
+            Gauge: The gauge
+
+        Raises:
+            ValueError: if a metric that isn't a gauge is already registered as 'name'
+        """
+        gauge = Gauge(name, documentation, function, labelnames)
+        with self._lock:
+            existing = self._metrics.get(name)
+            if existing is not None and not isinstance(existing, Gauge):
+                raise ValueError(f"A different metric called '{name}' is already registered")
+            self._metrics[name] = gauge
+        return gauge
+
+
+    def unregister(self, name):
+        """Removes a metric
+
+        Args:
+            name (str): The metric's name
+        """
+        with self._lock:
+            self._metrics.pop(name, None)
+
+
+    def get(self, name):
+        """Returns a metric
+
+        Args:
+            name (str): The metric's name
+
+        Returns:
+            Counter, Histogram or Gauge: The metric, None if there isn't one called 'name'
+        """
+        return self._metrics.get(name)
+
+
+    def metrics(self):
+        """Returns the metrics registered
+
+        Returns:
+            list: The Counters, Histograms and Gauges, sorted by name
+        """
+        with self._lock:
+            return [metric for _, metric in sorted(self._metrics.items())]
+
+
+    def exposition(self):
+        """Returns every metric in the Prometheus text format
+
+        Returns:
+            str: The metrics
+        """
+        lines = []
+        for metric in self.metrics():
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Serves a registry's metrics at '/metrics'
+    """
+    registry = None
+
+    def do_GET(self): # pylint: disable=invalid-name
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.registry.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        logger.debug('Metrics request: %s', format % args)
+
+
+
+class MetricsServer:
+    """Serves a metrics registry over HTTP at '/metrics', on a background thread
+
+    Attributes:
+        registry (MetricsRegistry): The registry served
+        host (str): The address the server listens on
+        port (int): The port the server listens on, the one chosen by the operating system
+            once started if 0 was given
+    """
+    def __init__(self, registry, host='127.0.0.1', port=9464):
+        """Constructor
+
+        Args:
+            registry (MetricsRegistry): The registry served
+            host (str, optional): The address the server listens on. Defaults to '127.0.0.1'.
+            port (int, optional): The port the server listens on, 0 for any free port.
+                Defaults to 9464.
+        """
+        self.registry = registry
+        self.host = host
+        self.port = port
+
+        self._server = None
+        self._thread = None
+
+
+    def start(self):
+        """Starts serving the metrics
+
+        Raises:
+            OSError: if the server can't listen on 'host' and 'port'
+        """
+        if self._server is not None:
+            return
+
+        handler = type('MetricsRequestHandler', (_MetricsRequestHandler,),
+                       {'registry': self.registry})
+        self._server = ThreadingHTTPServer((self.host, self.port), handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True,
+                                        name='mqtt_remote_metrics')
+        self._thread.start()
+
+        logger.info(f'Metrics are being served at http://{self.host}:{self.port}/metrics')
+
+
+    def stop(self):
+        """Stops serving the metrics
+        """
+        if self._server is None:
+            return
+
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        self._thread = None
+
+
+
+REGISTRY = MetricsRegistry()
+
+MESSAGES_RECEIVED = REGISTRY.counter('mqtt_remote_messages_received_total',
+                                     'Messages received from the broker')
+
+MESSAGES_PUBLISHED = REGISTRY.counter('mqtt_remote_messages_published_total',
+                                      'Messages published')
+
+MESSAGES_DROPPED = REGISTRY.counter('mqtt_remote_messages_dropped_total',
+                                    'Messages dropped', ['reason'])
+
+PUBLISH_LATENCY = REGISTRY.histogram('mqtt_remote_publish_latency_seconds',
+                                     'Time between publishing a message and it being sent')
+
+CONVERT_FAILURES = REGISTRY.counter('mqtt_remote_convert_failures_total',
+                                    'Messages that could not be converted to CommandMessages')
+
+COMMANDS_DISPATCHED = REGISTRY.counter('mqtt_remote_commands_dispatched_total',
+                                       'CommandMessages dispatched', ['command', 'outcome'])
+
+COMMAND_DURATION = REGISTRY.histogram('mqtt_remote_command_duration_seconds',
+                                      'Time spent calling callbacks', ['command'])
+
+DISPATCH_QUEUE_WAIT = REGISTRY.histogram('mqtt_remote_dispatch_queue_wait_seconds',
+                                         'Time CommandMessages wait for a dispatch worker')
+
+RECONNECTS = REGISTRY.counter('mqtt_remote_reconnects_total',
+                              'Connections to the broker re-established after being lost')
+
+CONNECTION_FAILURES = REGISTRY.counter('mqtt_remote_connection_failures_total',
+                                       'Failed attempts to connect to the broker')
+
+SLOW_CALLBACKS = REGISTRY.counter('mqtt_remote_slow_callbacks_total',
+                                  'Callbacks that ran longer than the slow callback threshold',
+                                  ['command'])
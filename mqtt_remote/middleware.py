@@ -0,0 +1,282 @@
+"""Inbound middleware related functionality
+
+A middleware pipeline passes each message received through an ordered list of named stages.
+A stage is a callable that takes a message and returns the message for the next stage, which
+can be a different object, e.g. the CommandMessage converted from a raw message, or None to
+stop the message going any further. MQTT Remote's own stages are 'convert', 'route' and
+'dispatch'; filtering, authorisation, rate limiting and the like are added as stages of
+their own.
+
+The stages are compiled into a single flat loop whenever they change, so a message costs one
+call per stage. Changes replace the compiled loop, rather than modifying it, so stages can
+be added or removed at any time: a message already part way through finishes on the stages
+it started with.
+
+Examples:
+
+    To create a pipeline that converts paho messages to CommandMessages and dispatches them:
+
+        .. code-block:: python
+
+            middleware = MiddlewarePipeline()
+            middleware.add(CONVERT_STAGE, message_forwarder.convert)
+            middleware.add(DISPATCH_STAGE, dispatch_engine.submit)
+
+
+    To pass a message through the pipeline:
+
+        .. code-block:: python
+
+            middleware.process(paho_message)
+
+
+    To drop the messages received on unexpected topics before they're converted:
+
+        .. code-block:: python
+
+            def topic_filter(paho_message):
+                return paho_message if paho_message.topic == 'MyPC' else None
+
+            middleware.add('filter', topic_filter, before=CONVERT_STAGE)
+
+
+    To time each stage and get the timings:
+
+        .. code-block:: python
+
+            middleware.timed = True
+            metrics = middleware.stage_metrics()
+
+
+Attributes:
+    CONVERT_STAGE (str): The name of the stage that converts raw messages to CommandMessages
+    ROUTE_STAGE (str): The name of the stage that drops duplicate CommandMessages and forwards
+        pinned ones to another worker
+    DISPATCH_STAGE (str): The name of the stage that hands CommandMessages to the dispatch
+        engine
+"""
+import logging
+import threading
+import time
+
+from mqtt_remote.histogram import LatencyHistogram
+
+
+
+# pylint: disable=C0103
+logger = logging.getLogger(__name__)
+# pylint: enable=C0103
+
+
+
+CONVERT_STAGE = 'convert'
+ROUTE_STAGE = 'route'
+DISPATCH_STAGE = 'dispatch'
+
+
+
+class _StageMetrics:
+    """The timings of a single stage
+    """
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+
+    def observe(self, duration, dropped):
+        self.latency.observe(duration)
+        if dropped:
+            with self._lock:
+                self.dropped += 1
+
+
+    def as_dict(self):
+        snapshot = self.latency.snapshot()
+        return {'calls': snapshot['count'],
+                'dropped': self.dropped,
+                'time_total': snapshot['sum'],
+                'time_max': snapshot['max'],
+                'time_p99': self.latency.percentile(99)}
+
+
+
+class MiddlewarePipeline:
+    """An ordered list of named stages that each message received is passed through
+
+    Attributes:
+        timed (bool): Whether each stage is timed, see 'stage_metrics'. Timing costs two clock
+            reads per stage per message.
+    """
+    def __init__(self, stages=None, timed=False):
+        """Constructor
+
+        Args:
+            stages (Iterable[Tuple[str, Callable]], optional): [(<name>, <stage>), (...)], the
+                initial stages in order. Defaults to None.
+            timed (bool, optional): Whether each stage is timed. Defaults to False.
+        """
+        self._lock = threading.Lock()
+        self._stages = ()
+        self._metrics = {}
+        self._timed = timed
+        self._run = self._compile(self._stages, timed)
+
+        for name, stage in stages or ():
+            self.add(name, stage)
+
+
+    def __bool__(self):
+        return bool(self._stages)
+
+
+    def names(self):
+        """Returns the names of the stages
+
+        Returns:
+            list[str]: The names, in the order messages pass through the stages
+        """
+        return [name for name, _ in self._stages]
+
+
+    @property
+    def timed(self):
+        """bool: Whether each stage is timed
+        """
+        return self._timed
+
+
+    @timed.setter
+    def timed(self, timed):
+        with self._lock:
+            self._timed = bool(timed)
+            self._run = self._compile(self._stages, self._timed)
+
+
+    def add(self, name, stage, before=None, after=None):
+        """Adds a stage
+
+        Args:
+            name (str): The stage's name, unique within the pipeline
+            stage (Callable): Called with each message, returns the message for the next
+                stage or None to stop the message going any further
+            before (str, optional): The name of the stage to add the stage before. Defaults to
+                None.
+            after (str, optional): The name of the stage to add the stage after. Defaults to
+                None, which, if 'before' is also None, adds the stage last.
+
+        Raises:
+            ValueError: if a stage called 'name' already exists, 'before' or 'after' isn't the
+                name of a stage, or both are provided
+        """
+        if before is not None and after is not None:
+            raise ValueError('MiddlewarePipeline.add() takes \'before\' or \'after\', not both')
+
+        with self._lock:
+            names = [existing for existing, _ in self._stages]
+            if name in names:
+                raise ValueError(f"Middleware stage '{name}' already exists")
+
+            index = len(names)
+            for neighbour, offset in ((before, 0), (after, 1)):
+                if neighbour is not None:
+                    if neighbour not in names:
+                        raise ValueError(f"Middleware stage '{neighbour}' does not exist")
+                    index = names.index(neighbour) + offset
+
+            stages = list(self._stages)
+            stages.insert(index, (name, stage))
+            self._metrics.setdefault(name, _StageMetrics())
+            self._replace(tuple(stages))
+
+        logger.debug(f"'{name}' middleware stage added")
+
+
+    def remove(self, name):
+        """Removes a stage
+
+        Args:
+            name (str): The stage's name
+
+        Raises:
+            ValueError: if there's no stage called 'name'
+        """
+        with self._lock:
+            stages = tuple(stage for stage in self._stages if stage[0] != name)
+            if len(stages) == len(self._stages):
+                raise ValueError(f"Middleware stage '{name}' does not exist")
+
+            self._metrics.pop(name, None)
+            self._replace(stages)
+
+        logger.debug(f"'{name}' middleware stage removed")
+
+
+    def _replace(self, stages):
+        """Replaces the stages and their compiled loop. The caller must hold 'self._lock'
+        """
+        self._stages = stages
+        self._run = self._compile(stages, self._timed)
+
+
+    def _compile(self, stages, timed):
+        """Compiles the stages into a function that passes a message through each of them in
+        turn
+        """
+        if not timed:
+            calls = tuple(stage for _, stage in stages)
+
+            def run(message):
+                for call in calls:
+                    message = call(message)
+                    if message is None:
+                        return None
+                return message
+
+            return run
+
+        # The last stage, e.g. 'dispatch', ends the pipeline, so it returning None isn't a drop
+        last = len(stages) - 1
+        timed_calls = tuple((stage, self._metrics[name], index < last)
+                            for index, (name, stage) in enumerate(stages))
+        perf_counter = time.perf_counter
+
+        def run_timed(message):
+            for call, metrics, can_drop in timed_calls:
+                started = perf_counter()
+                message = call(message)
+                metrics.observe(perf_counter() - started, can_drop and message is None)
+                if message is None:
+                    return None
+            return message
+
+        return run_timed
+
+
+    def process(self, message):
+        """Passes a message through each stage in turn
+
+        Args:
+            message (Any): The message, e.g. a paho.mqtt.client.MQTTMessage
+
+        Returns:
+            Any: What the last stage returned, None if a stage stopped the message
+        """
+        return self._run(message)
+
+
+    def stage_metrics(self):
+        """Returns the timings of each stage, recorded whilst 'timed' is True
+
+        Returns:
+            dict: Keyed by stage name, in stage order:
+                'calls': the number of messages passed to the stage,
+                'dropped': the number of messages the stage stopped, never counted for the
+                    last stage, which ends the pipeline,
+                'time_total' and 'time_max': the time, in seconds, spent in the stage,
+                'time_p99': an estimate of the 99th percentile of that time
+        """
+        with self._lock:
+            metrics = [(name, self._metrics[name]) for name, _ in self._stages]
+
+        return {name: stage_metrics.as_dict() for name, stage_metrics in metrics}
@@ -69,10 +69,100 @@ Examples:
 
             mqtt_software_client.publish("my topic", "hello world", 0, False)
 
+
+    To use the MQTT client to publish several MQTT messages in one call:
+
+        .. code-block:: python
+
+            mqtt_software_client.publish_many([("my topic", "hello", 0, False),
+                                               ("my topic", "world", 0, False)])
+
+
+    To create an MQTT client that coalesces the publishes made within 2 ms:
+
+        .. code-block:: python
+
+            mqtt_software_client = mqtt_client.MQTTClient(..., coalesce_window=0.002)
+
+
+    To create an MQTT client whose outbound queue holds at most 1000 messages, blocking the
+    publisher for up to 5 seconds when it's full:
+
+        .. code-block:: python
+
+            mqtt_software_client = mqtt_client.MQTTClient(..., max_queued=1000,
+                                                          queue_full_policy='block',
+                                                          queue_full_timeout=5)
+
+
+    To get the outbound queue metrics:
+
+        .. code-block:: python
+
+            metrics = mqtt_software_client.outbound_metrics()
+
+
+    To wait for the broker to acknowledge a QoS 1 message and get its delivery latency:
+
+        .. code-block:: python
+
+            handle = mqtt_software_client.publish("my topic", "hello world", 1, False)
+            latency = handle.wait(timeout=5)
+
+
+    To get the 99th percentile delivery latency of the messages published so far:
+
+        .. code-block:: python
+
+            p99 = mqtt_software_client.delivery_latency.percentile(99)
+
+
+    To create an MQTT client that journals QoS 1 and 2 publishes to disk, replaying those not
+    acknowledged by the broker when it next connects, even after a restart:
+
+        .. code-block:: python
+
+            journal = PublishJournal('outbound.db')
+            mqtt_software_client = mqtt_client.MQTTClient(..., journal=journal)
+
+
+    To create an MQTT client that reconnects after waiting between 1 and 30 seconds, with
+    jitter, and to get its connection metrics:
+
+        .. code-block:: python
+
+            reconnect_supervisor = ReconnectSupervisor(min_delay=1, max_delay=30, jitter=0.5)
+            mqtt_software_client = mqtt_client.MQTTClient(...,
+                                                          reconnect_supervisor=reconnect_supervisor)
+            metrics = mqtt_software_client.connection_metrics()
+
+
+    To create an MQTT 5 client that advertises a receive maximum of 100 and gives up to 16
+    frequently used topics a topic alias:
+
+        .. code-block:: python
+
+            mqtt_software_client = mqtt_client.MQTTClient(..., mqtt.MQTTv5, ...,
+                                                          receive_maximum=100,
+                                                          topic_alias_maximum=16)
+
 """
+from collections import OrderedDict, deque
+from concurrent.futures import Future, InvalidStateError
+import copy
 import logging
+import socket
+import threading
+import time
 
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from mqtt_remote import metrics
+from mqtt_remote.histogram import LatencyHistogram
+from mqtt_remote.middleware import MiddlewarePipeline
+from mqtt_remote.reconnect import ReconnectSupervisor
 
 
 
@@ -86,10 +176,13 @@ class CallbackSet:
     """Data structure to hold callbacks
 
     Extends the required methods of a set by adding additional logging and error checking
-    capabilities
+    capabilities. Iterating goes over a snapshot taken when the callbacks last changed, so
+    callbacks can be added or removed whilst the set is being iterated over, e.g. by another
+    thread.
     """
     def __init__(self):
         self.__callbacks = set()
+        self.__snapshot = ()
 
     def add(self, callback):
         """Adds a callback
@@ -102,6 +195,7 @@ class CallbackSet:
         """
         if callable(callback):
             self.__callbacks.add(callback)
+            self.__snapshot = tuple(self.__callbacks)
             logger.debug(f"'{callback.__name__}' callback: Registered with CallbackSet")
             return self.__callbacks
 
@@ -118,16 +212,120 @@ class CallbackSet:
             set: callbacks
         """
         self.__callbacks.remove(callback)
+        self.__snapshot = tuple(self.__callbacks)
         logger.debug(f"'{callback.__name__}' callback removed from CallbackSet", )
         return self.__callbacks
 
     def __iter__(self):
-        return iter(self.__callbacks)
+        return iter(self.__snapshot)
 
     def __bool__(self):
-        if len(self.__callbacks) == 0:
-            return False
-        return True
+        return bool(self.__snapshot)
+
+
+
+class OutboundQueueFullError(RuntimeError):
+    """Raised when publishing a message whilst the outbound queue is full and the queue full
+    policy is 'raise'
+    """
+
+
+
+class PublishError(RuntimeError):
+    """Set on a publish handle's future when its message won't be confirmed as sent, e.g.
+    because it was dropped or paho refused it
+    """
+
+
+
+class PublishHandle:
+    """Tracks a published message until paho confirms it's been sent
+
+    paho confirms a QoS 0 message once it's written to the socket, a QoS 1 message when the
+    broker's PUBACK arrives and a QoS 2 message when its PUBCOMP arrives. The handle's future
+    is resolved on the thread that confirms the message, usually paho's network thread, so
+    callbacks added to it should return quickly.
+
+    Attributes:
+        topic (str): The topic of the message
+        qos (int): The Quality Of Service of the message
+        mid (int): The paho message id, None until the message is passed to paho
+        published (float): When the message was published, from time.monotonic()
+        delivered (float): When paho confirmed the message as sent, from time.monotonic(),
+            None until then
+        future (concurrent.futures.Future): Resolves to the delivery latency, in seconds, or
+            fails with PublishError
+    """
+    def __init__(self, topic, qos):
+        """Constructor
+
+        Args:
+            topic (str): The topic of the message
+            qos (int): The Quality Of Service of the message
+        """
+        self.topic = topic
+        self.qos = qos
+        self.mid = None
+        self.published = time.monotonic()
+        self.delivered = None
+        self.future = Future()
+
+
+    @property
+    def latency(self):
+        """float: The time, in seconds, between publishing and confirmation of sending, None
+        until the message is confirmed
+        """
+        if self.delivered is None:
+            return None
+        return self.delivered - self.published
+
+
+    def done(self):
+        """Returns whether the message has been confirmed as sent or has failed
+
+        Returns:
+            bool: True if the handle's future is resolved
+        """
+        return self.future.done()
+
+
+    def wait(self, timeout=None):
+        """Waits for paho to confirm the message as sent
+
+        Args:
+            timeout (float, optional): The maximum time, in seconds, to wait. Defaults to None,
+                i.e. no limit.
+
+        Returns:
+            float: The delivery latency, in seconds
+
+        Raises:
+            PublishError: if the message won't be confirmed as sent
+            TimeoutError: if the message isn't confirmed within 'timeout' seconds
+        """
+        return self.future.result(timeout)
+
+
+    def _deliver(self, delivered):
+        """Resolves the handle's future with the delivery latency. The caller mustn't hold the
+        client's locks as the future's callbacks run here
+        """
+        self.delivered = delivered
+        try:
+            self.future.set_result(self.latency)
+        except InvalidStateError:
+            pass
+
+
+    def _fail(self, reason):
+        """Fails the handle's future with a PublishError. The caller mustn't hold the client's
+        locks as the future's callbacks run here
+        """
+        try:
+            self.future.set_exception(PublishError(reason))
+        except InvalidStateError:
+            pass
 
 
 
@@ -159,16 +357,49 @@ class MQTTClient:
         log_client (bool): True: allow the log messages from the underlying paho client to
             pass through and be logged by this client, False: do not allow the log messages
             from the underlying paho client to pass through and be logged by this client
+        middleware (MiddlewarePipeline): The stages each MQTT message received is passed
+            through, in order, before the on message callbacks are called
         on_message_callbacks (CallbackSet): The callbacks to be called when an MQTT message
             is received
         initialised (bool): Whether the client has been initialised, i.e. whether
             self.initialise has been run
+        coalesce_window (float): The time, in seconds, that publishes are gathered for before
+            they're sent to the broker together. 0 sends each publish immediately.
+        max_inflight (int): The maximum number of QoS 1 and 2 messages that can be part way
+            through their handshake with the broker at once
+        max_queued (int): The maximum number of published messages not yet confirmed as sent
+            to the broker. 0 means no limit.
+        queue_full_policy (str): What happens when a message is published whilst the outbound
+            queue is full:
+            'block': the publisher waits, for up to 'queue_full_timeout' seconds, for space
+            before the message is dropped. Publishes made on the network thread are dropped
+            straight away as waiting there would stop the queue from draining.
+            'drop': the message is dropped.
+            'raise': OutboundQueueFullError is raised.
+        queue_full_timeout (float): The maximum time, in seconds, that the 'block' policy waits
+        journal (PublishJournal): Records QoS 1 and 2 publishes until they're acknowledged by the
+            broker, None disables journaling
+        reconnect_supervisor (ReconnectSupervisor): Decides the delays between, and tracks,
+            attempts to connect to the broker
+        receive_maximum (int): MQTT 5 only. The maximum number of QoS 1 and 2 messages the
+            broker may send before they're acknowledged. 0 leaves it to the broker.
+        topic_alias_maximum (int): MQTT 5 only. The maximum number of topics given a topic
+            alias, which replaces the topic in the QoS 0 messages published to it after the
+            first. 0 disables topic aliases.
+        delivery_timeout (float): The time, in seconds, after which a published message that
+            paho hasn't confirmed as sent stops being tracked and its handle fails. paho may
+            still send it. 0 means no limit.
+        delivery_latency (LatencyHistogram): The delivery latencies of the messages confirmed
+            as sent
     """
     def __init__(self, broker_user_name, broker_password,
                  broker_ip, broker_port, broker_keepalive,
                  subscription_topics, mqtt_client_id,
                  mqtt_clean_session, mqtt_protocol,
-                 mqtt_transport, log_client):
+                 mqtt_transport, log_client, coalesce_window=0,
+                 max_inflight=20, max_queued=0, queue_full_policy='block',
+                 queue_full_timeout=5.0, journal=None, reconnect_supervisor=None,
+                 receive_maximum=0, topic_alias_maximum=0, delivery_timeout=0):
         """Constructor
 
         Args:
@@ -194,7 +425,34 @@ class MQTTClient:
             log_client (bool): True: allow the log messages from the underlying paho client to
                 pass through and be logged by this client, False: do not allow the log messages
                 from the underlying paho client to pass through and be logged by this client
+            coalesce_window (float, optional): The time, in seconds, that publishes are
+                gathered for before they're sent to the broker together. Defaults to 0.
+            max_inflight (int, optional): The maximum number of QoS 1 and 2 messages part way
+                through their handshake with the broker. Defaults to 20.
+            max_queued (int, optional): The maximum number of published messages not yet
+                confirmed as sent to the broker. Defaults to 0.
+            queue_full_policy (str, optional): 'block', 'drop' or 'raise'. Defaults to 'block'.
+            queue_full_timeout (float, optional): The maximum time, in seconds, that the
+                'block' policy waits. Defaults to 5.0.
+            journal (PublishJournal, optional): Records QoS 1 and 2 publishes until they're
+                acknowledged by the broker. Defaults to None.
+            reconnect_supervisor (ReconnectSupervisor, optional): Decides the delays between,
+                and tracks, attempts to connect to the broker. Defaults to a
+                ReconnectSupervisor with its default settings.
+            receive_maximum (int, optional): MQTT 5 only. The maximum number of unacknowledged
+                QoS 1 and 2 messages the broker may send. Defaults to 0.
+            topic_alias_maximum (int, optional): MQTT 5 only. The maximum number of topics
+                given a topic alias. Defaults to 0.
+            delivery_timeout (float, optional): The time, in seconds, after which a published
+                message not confirmed as sent stops being tracked. Defaults to 0.
+
+        Raises:
+            ValueError: if an unacceptable queue_full_policy is provided
         """
+        if queue_full_policy not in ('block', 'drop', 'raise'):
+            raise ValueError(''.join(['MQTTClient \'queue_full_policy\' argument can only be ',
+                                      '\'block\', \'drop\' or \'raise\'']))
+
         self.broker_user_name = broker_user_name
         self.broker_password = broker_password
         self.broker_ip = broker_ip
@@ -206,34 +464,78 @@ class MQTTClient:
         self.mqtt_protocol = mqtt_protocol
         self.mqtt_transport = mqtt_transport
         self.log_client = log_client
-
+        self.coalesce_window = coalesce_window
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.queue_full_policy = queue_full_policy
+        self.queue_full_timeout = queue_full_timeout
+        self.journal = journal
+        self.reconnect_supervisor = reconnect_supervisor or ReconnectSupervisor()
+        self.receive_maximum = receive_maximum
+        self.topic_alias_maximum = topic_alias_maximum
+        self.delivery_timeout = delivery_timeout
+        self.delivery_latency = LatencyHistogram()
+
+        self.middleware = MiddlewarePipeline()
         self.on_message_callbacks = CallbackSet()
         self.initialised = False
 
         self._mqtt_client = None
+        self._topic_alias_lock = threading.Lock()
+        self._topic_aliases = OrderedDict()
+        self._topic_alias_limit = 0
 
         self._subscription_mid = set()
-        self._publish_mid = set()
+        self._publish_mid = OrderedDict()
+        self._early_publish_mid = OrderedDict()
+        self._outbound_condition = threading.Condition()
+        self._outbound_stats = {'sent': 0, 'dropped': 0, 'blocked': 0, 'expired': 0,
+                                'time_in_queue_total': 0.0, 'time_in_queue_max': 0.0}
+        self._network_thread = None
+        self._broker_address = None
+        self._journal_lock = threading.Lock()
+        self._journal_entries = {}
+        self._journal_handed = set()
+        self._journal_backlog = False
         self._connected = False
         self._subscribed = False
 
+        self._coalesce_buffer = deque()
+        self._coalesce_condition = threading.Condition()
+        self._coalesce_thread = None
+        self._coalesce_stopping = threading.Event()
+
 
     def initialise(self):
         """Gets the underlying MQTT client ready to start
         """
+        # MQTT 5 replaces the clean session flag with clean start, set when connecting
+        clean_session = None if self._mqtt_v5 else self.mqtt_clean_session
         self._mqtt_client = mqtt.Client(client_id=self.mqtt_client_id,
-                                        clean_session=self.mqtt_clean_session,
+                                        clean_session=clean_session,
                                         protocol=self.mqtt_protocol,
                                         transport=self.mqtt_transport)
 
         self._mqtt_client.on_connect = self._on_connect
+        self._mqtt_client.on_connect_fail = self._on_connect_fail
         self._mqtt_client.on_disconnect = self._on_disconnect
-        self._mqtt_client.on_log = self._on_log
+        if self.log_client:
+            self._mqtt_client.on_log = self._on_log
         self._mqtt_client.on_message = self._on_message
         self._mqtt_client.on_publish = self._on_publish
         self._mqtt_client.on_subscribe = self._on_subscribe
 
         self._mqtt_client.username_pw_set(self.broker_user_name, password=self.broker_password)
+        self._mqtt_client.max_inflight_messages_set(self.max_inflight)
+        self._mqtt_client.max_queued_messages_set(self.max_queued)
+        # paho 1.x has no public setter for the network connection timeout
+        self._mqtt_client._connect_timeout = self.reconnect_supervisor.connect_timeout
+        self._mqtt_client.reconnect_delay_set(self.reconnect_supervisor.min_delay,
+                                              self.reconnect_supervisor.max_delay)
+
+        if self.journal is not None:
+            self.journal.open()
+            self._journal_backlog = len(self.journal) > 0
 
         self.initialised = True
 
@@ -241,6 +543,10 @@ class MQTTClient:
     def start(self, loop_type):
         """Starts the client
 
+        The client keeps trying to connect to the broker, waiting between attempts as decided
+        by 'self.reconnect_supervisor', until it succeeds and reconnects whenever the
+        connection is lost
+
         Args:
             loop_type (str): determines in which mode the client is run:
                 'blocking' or
@@ -253,32 +559,404 @@ class MQTTClient:
         if not self.initialised:
             raise RuntimeError('MQTTClient has not been initialised')
 
-        try:
-            self._mqtt_client.connect(host=self.broker_ip, port=self.broker_port,
-                                      keepalive=self.broker_keepalive)
-        except ConnectionRefusedError as error:
-            logger.warning(error)
+        if self.coalesce_window and self._coalesce_thread is None:
+            self._coalesce_stopping.clear()
+            self._coalesce_thread = threading.Thread(target=self._coalesce_publishes,
+                                                     daemon=True,
+                                                     name='mqtt_remote_coalesce')
+            self._coalesce_thread.start()
 
-        if loop_type == 'blocking':
-            self._mqtt_client.loop_forever()
-        elif loop_type == 'non_blocking':
-            self._mqtt_client.loop_start()
-        else:
+        if loop_type not in ('blocking', 'non_blocking'):
             error = ''.join(['MQTTClient.start() \'loop_type\' argument ',
                              'can only be \'blocking\' or \'non_blocking\''])
             raise ValueError(error)
 
+        self._broker_address = self.reconnect_supervisor.address(self.broker_ip,
+                                                                 self.broker_port)
+        self._connect_async(self._mqtt_client, self._broker_address)
+
+        if loop_type == 'blocking':
+            self._mqtt_client.loop_forever(retry_first_connection=True)
+        else:
+            self._mqtt_client.loop_start()
+
         logger.info("MQTTClient has started")
 
 
+    @property
+    def _mqtt_v5(self):
+        return self.mqtt_protocol == mqtt.MQTTv5
+
+
+    def _connect_properties(self):
+        """Returns the MQTT 5 properties of the CONNECT packet
+        """
+        properties = Properties(PacketTypes.CONNECT)
+        if self.receive_maximum:
+            properties.ReceiveMaximum = min(self.receive_maximum, 65535)
+        if not self.mqtt_clean_session:
+            # without an expiry interval an MQTT 5 session ends with the connection
+            properties.SessionExpiryInterval = 0xFFFFFFFF
+        return properties
+
+
+    def _connect_async(self, client, address):
+        """Asks paho to connect to the broker at 'address' once its network loop starts
+        """
+        if not self._mqtt_v5:
+            client.connect_async(host=address, port=self.broker_port,
+                                 keepalive=self.broker_keepalive)
+            return
+
+        client.connect_async(host=address, port=self.broker_port,
+                             keepalive=self.broker_keepalive,
+                             clean_start=self.mqtt_clean_session,
+                             properties=self._connect_properties())
+
+
     def stop(self):
         """Stops the client
+
+        Publishes still being coalesced are sent first
         """
+        if self._coalesce_thread is not None:
+            with self._coalesce_condition:
+                self._coalesce_stopping.set()
+                self._coalesce_condition.notify()
+            self._coalesce_thread.join()
+            self._coalesce_thread = None
+
         self._mqtt_client.loop_stop()
         self._mqtt_client.disconnect()
+
+        if self.journal is not None:
+            self.journal.close()
+
         logger.info("MQTTClient has stopped")
 
 
+    def pending_publish_count(self):
+        """Returns the number of published messages not yet confirmed as sent to the broker,
+        including those still being coalesced
+
+        Returns:
+            int: The number of pending publishes
+        """
+        return len(self._publish_mid) + len(self._coalesce_buffer)
+
+
+    @property
+    def subscribed(self):
+        """bool: Whether the broker has confirmed the client's subscriptions on the current
+        connection
+        """
+        return self._subscribed
+
+
+    def connection_metrics(self):
+        """Returns metrics describing the connection to the broker
+
+        Returns:
+            dict: See 'ReconnectSupervisor.metrics'
+        """
+        return self.reconnect_supervisor.metrics()
+
+
+    def outbound_metrics(self):
+        """Returns metrics describing the outbound queue
+
+        Returns:
+            dict: 'queue_depth': the number of published messages not yet confirmed as sent,
+                'inflight': the number of QoS 1 and 2 messages part way through their handshake
+                with the broker, as reported by paho,
+                'oldest_age': the time, in seconds, the oldest queued message has been waiting,
+                'sent': the number of messages confirmed as sent,
+                'dropped': the number of messages dropped because the queue was full,
+                'blocked': the number of publishes that waited because the queue was full,
+                'expired': the number of messages that stopped being tracked after
+                'delivery_timeout' seconds,
+                'time_in_queue_avg' and 'time_in_queue_max': the time, in seconds, between
+                publishing and confirmation of sending,
+                'delivery_latency_p50' and 'delivery_latency_p99': estimates of the median and
+                99th percentile of that time, from 'delivery_latency'
+        """
+        expired = self._expire_publishes()
+        with self._outbound_condition:
+            stats = dict(self._outbound_stats)
+            oldest = next(iter(self._publish_mid.values()), None)
+
+        for handle in expired:
+            handle._fail(f'Not confirmed as sent within {self.delivery_timeout} s')
+
+        time_in_queue_total = stats.pop('time_in_queue_total')
+        stats['time_in_queue_avg'] = time_in_queue_total / stats['sent'] if stats['sent'] else 0.0
+        stats['queue_depth'] = self.pending_publish_count()
+        stats['inflight'] = getattr(self._mqtt_client, '_inflight_messages', 0)
+        stats['oldest_age'] = time.monotonic() - oldest.published if oldest is not None else 0.0
+        stats['delivery_latency_p50'] = self.delivery_latency.percentile(50)
+        stats['delivery_latency_p99'] = self.delivery_latency.percentile(99)
+        return stats
+
+
+    def _expire_publishes(self):
+        """Stops tracking the published messages, and early confirmations, older than
+        'self.delivery_timeout'
+
+        Returns:
+            list[PublishHandle]: The handles of the messages no longer tracked, which the
+                caller must fail once it no longer holds 'self._outbound_condition'
+        """
+        if not self.delivery_timeout:
+            return []
+
+        expired = []
+        cutoff = time.monotonic() - self.delivery_timeout
+        with self._outbound_condition:
+            while self._publish_mid:
+                mid = next(iter(self._publish_mid))
+                if self._publish_mid[mid].published >= cutoff:
+                    break
+                expired.append(self._publish_mid.pop(mid))
+
+            while self._early_publish_mid:
+                mid = next(iter(self._early_publish_mid))
+                if self._early_publish_mid[mid] >= cutoff:
+                    break
+                del self._early_publish_mid[mid]
+
+            if expired:
+                self._outbound_stats['expired'] += len(expired)
+                self._outbound_condition.notify_all()
+
+        return expired
+
+
+    def _admit_publish(self):
+        """Applies the queue full policy if the outbound queue is full
+
+        Returns:
+            bool: True if the message can be published, False if it must be dropped
+
+        Raises:
+            OutboundQueueFullError: if the queue is full and the policy is 'raise'
+        """
+        if not self.max_queued:
+            return True
+
+        def space_available():
+            return self.pending_publish_count() < self.max_queued
+
+        with self._outbound_condition:
+            if space_available():
+                return True
+
+            if self.queue_full_policy == 'raise':
+                raise OutboundQueueFullError(f'Outbound queue is full (max_queued: '
+                                             f'{self.max_queued})')
+
+            if (self.queue_full_policy == 'block'
+                    and threading.current_thread() is not self._network_thread):
+                self._outbound_stats['blocked'] += 1
+                if self._outbound_condition.wait_for(space_available, self.queue_full_timeout):
+                    return True
+
+            self._outbound_stats['dropped'] += 1
+
+        metrics.MESSAGES_DROPPED.inc(labels=('outbound_queue_full',))
+        logger.warning(f"Outbound queue is full: message dropped (max_queued: {self.max_queued})")
+        return False
+
+
+    def _send(self, topic, message, qos, retain, properties=None, handle=None):
+        """Passes a message to paho and tracks it until paho confirms it's been sent
+
+        Messages paho has accepted, or queued whilst disconnected, are tracked by their
+        publish handle, keyed by message id. paho can confirm a message before 'publish'
+        returns, in which case the confirmation is held in 'self._early_publish_mid' until the
+        message id is known. QoS 1 and 2 messages are journaled first, if there's a journal,
+        without their MQTT 5 properties.
+
+        Returns:
+            Tuple[int, int]: The paho result code and message id
+        """
+        metrics.MESSAGES_PUBLISHED.inc()
+
+        entry_id = None
+        if self.journal is not None and qos > 0:
+            with self._journal_lock:
+                entry_id = self.journal.append(topic, message, qos, retain)
+                with self._outbound_condition:
+                    self._journal_handed.add(entry_id)
+
+        result = self._send_entry(topic, message, qos, retain, entry_id, properties, handle)
+
+        if self._journal_backlog and self._connected:
+            self._replay_journal()
+
+        return result
+
+
+    def _send_entry(self, topic, message, qos, retain, entry_id=None, properties=None,
+                    handle=None):
+        """Passes a message, and its journal entry id if it has one, to paho
+
+        A confirmation held in 'self._early_publish_mid' only counts if it arrived after the
+        message was published, any earlier one being for an expired message with the same
+        message id. A message id can only be tracked once, so the table of tracked messages
+        never holds more than paho's 65535 message ids.
+
+        Returns:
+            Tuple[int, int]: The paho result code and message id
+        """
+        handle = handle or PublishHandle(topic, qos)
+        (result, mid) = self._paho_publish(topic, message, qos, retain, properties)
+        handle.mid = mid
+
+        acknowledged = False
+        delivered = None
+        replaced = None
+        with self._outbound_condition:
+            if result == mqtt.MQTT_ERR_SUCCESS or (result == mqtt.MQTT_ERR_NO_CONN and qos > 0):
+                delivered = self._early_publish_mid.pop(mid, None)
+                if delivered is not None and delivered >= handle.published:
+                    self._record_sent(delivered - handle.published)
+                    acknowledged = entry_id is not None
+                else:
+                    delivered = None
+                    replaced = self._publish_mid.pop(mid, None)
+                    self._publish_mid[mid] = handle
+                    if entry_id is not None:
+                        self._journal_entries[mid] = entry_id
+            elif entry_id is not None:
+                self._journal_handed.discard(entry_id)
+                self._journal_backlog = True
+
+        if delivered is not None:
+            handle._deliver(delivered)
+        elif result != mqtt.MQTT_ERR_SUCCESS and (result != mqtt.MQTT_ERR_NO_CONN or qos == 0):
+            handle._fail(mqtt.error_string(result))
+
+        if replaced is not None:
+            replaced._fail(f'Message id {mid} was reused before the message was confirmed')
+
+        for expired in self._expire_publishes():
+            expired._fail(f'Not confirmed as sent within {self.delivery_timeout} s')
+
+        if acknowledged:
+            self._acknowledge_journal_entry(entry_id)
+
+        return (result, mid)
+
+
+    def _paho_publish(self, topic, message, qos, retain, properties=None):
+        """Passes a message to paho, replacing its topic with a topic alias where possible
+
+        Only QoS 0 messages are aliased: paho resends unacknowledged QoS 1 and 2 messages on a
+        new connection, where an alias set up on the old one would be unknown. The alias lock
+        is held whilst paho queues an aliased message so that the message that sets up an
+        alias is always sent before those that use it.
+
+        Returns:
+            Tuple[int, int]: The paho result code and message id
+        """
+        if qos > 0 or not self._topic_alias_limit:
+            if properties is None:
+                return self._mqtt_client.publish(topic, payload=message, qos=qos, retain=retain)
+            return self._mqtt_client.publish(topic, payload=message, qos=qos, retain=retain,
+                                             properties=properties)
+
+        with self._topic_alias_lock:
+            aliased_topic, properties = self._topic_alias(topic, properties)
+            return self._mqtt_client.publish(aliased_topic, payload=message, qos=qos,
+                                             retain=retain, properties=properties)
+
+
+    def _topic_alias(self, topic, properties=None):
+        """Returns the topic to publish with and the PUBLISH properties carrying its alias,
+        a copy of 'properties' with the alias added if supplied
+
+        A topic seen for the first time on this connection is given an alias, the least
+        recently used topic's alias once all of them are in use, and sent in full along with
+        it. After that the topic is sent empty. The caller must hold 'self._topic_alias_lock'
+        """
+        limit = self._topic_alias_limit
+        if not limit:
+            return topic, properties
+
+        properties = copy.copy(properties) if properties else Properties(PacketTypes.PUBLISH)
+        alias = self._topic_aliases.get(topic)
+        if alias is not None:
+            self._topic_aliases.move_to_end(topic)
+            properties.TopicAlias = alias
+            return '', properties
+
+        if len(self._topic_aliases) >= limit:
+            _, alias = self._topic_aliases.popitem(last=False)
+        else:
+            alias = len(self._topic_aliases) + 1
+
+        self._topic_aliases[topic] = alias
+        properties.TopicAlias = alias
+        return topic, properties
+
+
+    def _reset_topic_aliases(self, broker_maximum=0):
+        """Forgets the topic aliases of the previous connection and sets the number available
+        on this one
+        """
+        with self._topic_alias_lock:
+            self._topic_aliases.clear()
+            self._topic_alias_limit = min(self.topic_alias_maximum, broker_maximum)
+
+
+    def _acknowledge_journal_entry(self, entry_id):
+        """Removes a journal entry once the broker has acknowledged its message
+        """
+        with self._outbound_condition:
+            self._journal_handed.discard(entry_id)
+        self.journal.acknowledge(entry_id)
+
+
+    def _replay_journal(self):
+        """Passes the journaled messages that paho doesn't hold to paho, oldest first
+
+        This covers messages journaled before a restart and those that paho refused, e.g.
+        because its queue was full. Replaying stops at the first message refused.
+        """
+        with self._journal_lock:
+            entries = self.journal.pending()
+            with self._outbound_condition:
+                entries = [entry for entry in entries if entry[0] not in self._journal_handed]
+                self._journal_handed.update(entry[0] for entry in entries)
+                self._journal_backlog = False
+
+        if entries:
+            logger.info(f"Replaying {len(entries)} journaled messages")
+
+        for index, (entry_id, topic, message, qos, retain) in enumerate(entries):
+            (result, _) = self._send_entry(topic, message, qos, retain, entry_id)
+            if result not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                with self._outbound_condition:
+                    self._journal_handed.difference_update(entry[0]
+                                                           for entry in entries[index + 1:])
+                logger.warning("".join(["Replaying journaled messages paused: ",
+                                        f"{mqtt.error_string(result)}"]))
+                break
+
+
+    def _record_sent(self, time_in_queue):
+        """Updates the outbound metrics for a message confirmed as sent. The caller must hold
+        'self._outbound_condition'
+        """
+        self.delivery_latency.observe(time_in_queue)
+        metrics.PUBLISH_LATENCY.observe(time_in_queue)
+        self._outbound_stats['sent'] += 1
+        self._outbound_stats['time_in_queue_total'] += time_in_queue
+        self._outbound_stats['time_in_queue_max'] = max(self._outbound_stats['time_in_queue_max'],
+                                                        time_in_queue)
+        self._outbound_condition.notify_all()
+
+
     def _process_publish_results(self, result, mid):
         """Processes the results that come from publishing a message
 
@@ -286,11 +964,9 @@ class MQTTClient:
             result (int): Paho result code
             mid (int): Paho message id
         """
-        self._publish_mid.add(mid)
-
         if result == 0:
             logger.debug("".join(["Preperations for sending message and ",
-                                  f"connecting to MQTT Broker succeeded (mid: {mid})"]))
+                                  "connecting to MQTT Broker succeeded (mid: %s)"]), mid)
 
         else:
             logger.warning("".join(["Message publishing: preperation error or ",
@@ -298,7 +974,7 @@ class MQTTClient:
                                     f"{mqtt.error_string(result)} (mid: {mid})"]))
 
 
-    def publish(self, topic, message, qos, retain):
+    def publish(self, topic, message, qos, retain, properties=None):
         """Requests that the client sends an MQTT message to the broker for publishing
 
         Args:
@@ -308,17 +984,153 @@ class MQTTClient:
             retain (bool): True: the message will be set as the "last known good" / retained
                 message for the topic. False: the message will not be set as the
                 "last known good" / retained message for the topic.
+            properties (paho.mqtt.properties.Properties, optional): The MQTT 5 PUBLISH
+                properties of the message, e.g. its CorrelationData. Defaults to None.
+
+        Returns:
+            PublishHandle: Resolves once paho confirms the message as sent, or fails if the
+                message was dropped, refused by paho or not confirmed within
+                'delivery_timeout' seconds
 
         Raises:
             RuntimeError: if the client has not been initialised prior to using this method
+            OutboundQueueFullError: if the outbound queue is full and the queue full policy is
+                'raise'
         """
         if not self.initialised:
             raise RuntimeError('MQTTClient has not been initialised')
 
-        (result, mid) = self._mqtt_client.publish(topic, payload=message, qos=qos,
-                                                   retain=retain)
+        handle = PublishHandle(topic, qos)
+        if not self._admit_publish():
+            handle._fail('Outbound queue is full: message dropped')
+            return handle
+
+        if self.coalesce_window:
+            with self._coalesce_condition:
+                self._coalesce_buffer.append((topic, message, qos, retain, properties, handle))
+                self._coalesce_condition.notify()
+            return handle
+
+        (result, mid) = self._send(topic, message, qos, retain, properties, handle)
 
         self._process_publish_results(result, mid)
+        return handle
+
+
+    def publish_many(self, messages):
+        """Requests that the client sends several MQTT messages to the broker for publishing
+
+        Unlike calling 'publish' for each message, the results are processed, and logged, once
+        for all of the messages. If 'coalesce_window' is set the messages are gathered with the
+        other publishes made in the window, as for 'publish'.
+
+        Args:
+            messages (Iterable[Tuple]): [(<topic>, <message>, <qos>, <retain>), (...)], see
+                'publish' for a description of each item
+
+        Returns:
+            list[PublishHandle]: A handle for each message, in the same order as 'messages',
+                failed for any message dropped because the outbound queue was full
+
+        Raises:
+            RuntimeError: if the client has not been initialised prior to using this method
+            OutboundQueueFullError: if the outbound queue is full and the queue full policy is
+                'raise'
+        """
+        if not self.initialised:
+            raise RuntimeError('MQTTClient has not been initialised')
+
+        handles = []
+        results = []
+        for topic, message, qos, retain in messages:
+            handle = PublishHandle(topic, qos)
+            handles.append(handle)
+            if not self._admit_publish():
+                handle._fail('Outbound queue is full: message dropped')
+            elif self.coalesce_window:
+                with self._coalesce_condition:
+                    self._coalesce_buffer.append((topic, message, qos, retain, None, handle))
+                    self._coalesce_condition.notify()
+            else:
+                results.append(self._send(topic, message, qos, retain, None, handle))
+
+        if not self.coalesce_window:
+            self._process_publish_many_results(results)
+        return handles
+
+
+    def _process_publish_many_results(self, results):
+        """Processes the results that come from the paho client upon publishing several
+        messages, once for all of them
+
+        Args:
+            results (list[Tuple[int, int]]): The paho result code and message id of each message
+        """
+        failures = [(result, mid) for result, mid in results if result != 0]
+        for result, mid in failures:
+            logger.warning("".join(["Message publishing: preperation error or ",
+                                    "problem connecting to MQTT Broker: "
+                                    f"{mqtt.error_string(result)} (mid: {mid})"]))
+
+        logger.debug("Preparations for sending %d of %d messages succeeded",
+                     len(results) - len(failures), len(results))
+
+
+    def _set_cork(self, corked):
+        """Sets the TCP_CORK option of the client's socket, where the platform supports it, so
+        that the packets written whilst it's set leave in as few TCP segments as possible
+
+        Returns:
+            bool: True if the option was set
+        """
+        paho_socket = self._mqtt_client.socket()
+        if paho_socket is None or not hasattr(socket, 'TCP_CORK'):
+            return False
+
+        try:
+            paho_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(corked))
+        except (AttributeError, OSError):
+            return False
+        return True
+
+
+    def flush_coalesced(self):
+        """Sends the publishes gathered whilst coalescing to the broker together
+
+        Returns:
+            int: The number of publishes sent
+        """
+        with self._coalesce_condition:
+            messages = list(self._coalesce_buffer)
+            self._coalesce_buffer.clear()
+
+        if not messages:
+            return 0
+
+        corked = self._set_cork(True)
+        try:
+            self._process_publish_many_results([self._send(*message) for message in messages])
+        finally:
+            if corked:
+                self._set_cork(False)
+
+        return len(messages)
+
+
+    def _coalesce_publishes(self):
+        """Waits for a publish, gathers the publishes made in the following coalesce window
+        and sends them together, until the client is stopped
+        """
+        while True:
+            with self._coalesce_condition:
+                while not self._coalesce_buffer and not self._coalesce_stopping.is_set():
+                    self._coalesce_condition.wait()
+
+            stopping = self._coalesce_stopping.wait(self.coalesce_window)
+            self.flush_coalesced()
+
+            if stopping:
+                break
 
 
     def _process_paho_subscribe_results(self, result, mid):
@@ -344,11 +1156,20 @@ class MQTTClient:
         """Processes the connection result (rc) that comes from the paho client upon connecting
 
         Args:
-            connection_result (int): Paho connection result (rc)
+            connection_result (int, ReasonCodes): Paho connection result (rc), or MQTT 5 reason
+                code
         """
         if connection_result == 0:
             logger.info("Connection accepted by MQTT Broker")
             self._connected = True
+            downtime = self.reconnect_supervisor.connected()
+            if downtime is not None:
+                logger.info(f"Reconnected to MQTT Broker after {downtime:.1f} s")
+            return
+
+        self.reconnect_supervisor.connection_failed()
+        if not isinstance(connection_result, int):
+            logger.warning(f"Connection refused by MQTT Broker: {connection_result}")
         elif 1 <= connection_result <= 5:
             logger.warning(f"{mqtt.connack_string(connection_result)}")
         else:
@@ -356,13 +1177,21 @@ class MQTTClient:
 
 
     #pylint: disable=unused-argument, invalid-name
-    def _on_connect(self, client, userdata, flags, rc):
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
         """Manages activities that occur as a result of the client connecting to the broker
 
-        This connection callback is required by the underlying paho client
+        This connection callback is required by the underlying paho client. 'properties' are
+        only passed by paho when using MQTT 5.
         """
+        self._network_thread = threading.current_thread()
         self._process_paho_connection_result(rc)
 
+        if properties is not None and self._connected:
+            self._apply_connack_properties(client, properties)
+
+        if self._journal_backlog and self._connected:
+            self._replay_journal()
+
         # placed here to ensure resubscription occurs on reconnection if connection is lost
         (result, mid) = client.subscribe(self.subscription_topics)
 
@@ -370,17 +1199,55 @@ class MQTTClient:
     #pylint: enable=unused-argument, invalid-name
 
 
+    def _apply_connack_properties(self, client, properties):
+        """Applies the limits the broker sets in its MQTT 5 CONNACK properties
+        """
+        self._reset_topic_aliases(getattr(properties, 'TopicAliasMaximum', 0))
+
+        broker_receive_maximum = getattr(properties, 'ReceiveMaximum', 0)
+        if broker_receive_maximum:
+            client.max_inflight_messages_set(min(self.max_inflight, broker_receive_maximum))
+
+        logger.debug(''.join(['MQTT 5 limits: ',
+                              f'{self._topic_alias_limit} topic alias(es), ',
+                              f'broker receive maximum {broker_receive_maximum or 65535}']))
+
+
+    #pylint: disable=unused-argument
+    def _on_connect_fail(self, client, userdata):
+        """Manages activities that occur as a result of the client failing to connect to the
+        broker, e.g. because it's unreachable
+
+        This callback is required by the underlying paho client
+        """
+        delay = self.reconnect_supervisor.connection_failed()
+        client.reconnect_delay_set(delay, delay)
+
+        address = self.reconnect_supervisor.address(self.broker_ip, self.broker_port)
+        if address != self._broker_address:
+            self._broker_address = address
+            self._connect_async(client, address)
+
+        logger.warning(f"Unable to connect to MQTT Broker, retrying in {delay:.1f} s")
+    #pylint: enable=unused-argument
+
+
     #pylint: disable=unused-argument, invalid-name
-    def _on_disconnect(self, client, userdata, rc):
+    def _on_disconnect(self, client, userdata, rc, properties=None):
         """Manages activities that occur as a result of the client disconnecting from the broker
 
-        This disconnection callback is required by the underlying paho client
+        This disconnection callback is required by the underlying paho client. 'properties'
+        are only passed by paho when using MQTT 5.
         """
         self._connected = False
         self._subscribed = False
+        self._topic_alias_limit = 0
 
         if rc != 0:
-            logger.warning("Unexpected loss of connection to MQTT Broker")
+            delay = self.reconnect_supervisor.disconnected()
+            client.reconnect_delay_set(delay, delay)
+            logger.warning(''.join(["Unexpected loss of connection to MQTT Broker, ",
+                                    f"reconnecting in {delay:.1f} s"]))
     #pylint: enable=unused-argument, invalid-name
 
 
@@ -388,10 +1255,11 @@ class MQTTClient:
     def _on_log(self, mqttc, obj, level, string):
         """Manages activities that occur as a result of the underlying client creating a log
 
-        This callback is required by the underlying paho client
+        This callback is only set on the paho client when 'self.log_client' is True, as paho
+        builds every log message it passes here, one or more per packet
         """
         if self.log_client:
-            logger.debug(f'PAHO: {string}')
+            logger.debug('PAHO: %s', string)
     #pylint: enable=unused-argument
 
 
@@ -401,12 +1269,18 @@ class MQTTClient:
 
         This callback is required by the underlying paho client
         """
-        if self.on_message_callbacks:
-            for callback in self.on_message_callbacks:
-                callback(msg)
-        else:
+        metrics.MESSAGES_RECEIVED.inc()
+        middleware = self.middleware
+        if not middleware and not self.on_message_callbacks:
             warning = "MQTT message received but no 'on_message_callbacks' are set for MQTTClient"
             logger.warning(warning)
+            return
+
+        if middleware:
+            middleware.process(msg)
+
+        for callback in self.on_message_callbacks:
+            callback(msg)
     #pylint: enable=unused-argument
 
 
@@ -414,18 +1288,34 @@ class MQTTClient:
     def _on_publish(self, client, userdata, mid):
         """Manages activities that occur as a result of the underlying client publishing a message
 
-        This callback is required by the underlying paho client
+        This callback is required by the underlying paho client. It can be called before the
+        paho 'publish' call for the message has returned, see '_send'.
         """
-        if mid in self._publish_mid:
-            logger.debug(f"Message successfully sent to the MQTT Broker (mid: {mid})")
-            self._publish_mid.remove(mid)
-        else:
-            logger.warning(f"Problem sending the message to the MQTT Broker (mid: {mid})")
+        delivered = time.monotonic()
+        with self._outbound_condition:
+            handle = self._publish_mid.pop(mid, None)
+            entry_id = self._journal_entries.pop(mid, None)
+            if handle is None:
+                if len(self._early_publish_mid) >= 1024:
+                    del self._early_publish_mid[next(iter(self._early_publish_mid))]
+                self._early_publish_mid[mid] = delivered
+            else:
+                self._record_sent(delivered - handle.published)
+
+        if handle is not None:
+            handle._deliver(delivered)
+
+        logger.debug("Message successfully sent to the MQTT Broker (mid: %s)", mid)
+
+        if entry_id is not None:
+            self._acknowledge_journal_entry(entry_id)
+            if self._journal_backlog and self._connected:
+                self._replay_journal()
     #pylint: enable=unused-argument
 
 
    #pylint: disable=unused-argument
-    def _on_subscribe(self, client, userdata, mid, granted_qos):
+    def _on_subscribe(self, client, userdata, mid, granted_qos, properties=None):
         """Manages activities that occur as a result of the underlying client requesting
         subscriptions from the broker
 
@@ -0,0 +1,578 @@
+"""Remote profiling related functionality
+
+Built-in callbacks that diagnose a running instance on demand, without a restart or shell
+access to the computer it runs on:
+
+- 'mqtt_remote_profile_cpu' samples the stacks of every thread for a number of seconds and
+  reports where the time went
+- 'mqtt_remote_profile_memory' starts and stops tracemalloc and reports the largest
+  allocations, and how they've changed since the previous snapshot
+- 'mqtt_remote_dump_threads' reports the stack of every thread and the garbage collector's
+  statistics
+
+They're only registered if 'profiling > enabled' and 'profiling > token' are set in the
+configuration, and only run for CommandMessages whose attributes contain the same "token".
+Each report is published as a chunked transfer, see 'message.publish_chunked', to the
+CommandMessage's reply address, see 'message.reply_address', or, if it has none, written to a
+file in 'profiling > output_dir'.
+
+The CPU profile is statistical rather than a cProfile trace: cProfile only sees the thread it
+was enabled on, whereas sampling 'sys._current_frames()' sees every thread, costs nothing
+between samples and doesn't slow the callbacks being profiled.
+
+Examples:
+
+    To register the profiling callbacks, if they're enabled:
+
+        .. code-block:: python
+
+            profiling_callbacks = add_profiling_callbacks(callback_caller,
+                                                          completed_config['profiling'])
+
+
+    To profile the CPU use of an instance subscribed to 'spam' for 10 seconds, from another
+    computer, with the report published to 'spam_reports':
+
+        .. code-block:: python
+
+            publish_function('spam', json.dumps({
+                'command': 'mqtt_remote_profile_cpu',
+                'attributes': {'duration': 10, 'token': 'secret',
+                               'return_message': {'topic': 'spam_reports', 'qos': 1,
+                                                  'retain': False}}}))
+
+
+    To sample the stacks of every other thread for a second:
+
+        .. code-block:: python
+
+            samples, stacks = sample_stacks(1.0)
+
+
+Attributes:
+    PROFILE_CPU_COMMAND_NAME (str): The command name of the CPU profiling callback
+    PROFILE_MEMORY_COMMAND_NAME (str): The command name of the memory profiling callback
+    DUMP_THREADS_COMMAND_NAME (str): The command name of the thread dump callback
+    REPORT_SUFFIX (str): Appended to a command name to make the command name of its reports
+"""
+from abc import ABC, abstractmethod
+from collections import Counter
+import gc
+import hmac
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+from mqtt_remote import message, stats
+
+
+
+# pylint: disable=C0103
+logger = logging.getLogger(__name__)
+# pylint: enable=C0103
+
+
+
+PROFILE_CPU_COMMAND_NAME = 'mqtt_remote_profile_cpu'
+PROFILE_MEMORY_COMMAND_NAME = 'mqtt_remote_profile_memory'
+DUMP_THREADS_COMMAND_NAME = 'mqtt_remote_dump_threads'
+
+REPORT_SUFFIX = '_report'
+
+_SAMPLE_INTERVAL = 0.005
+
+_REPORT_NUMBERS = itertools.count(1)
+
+_TRACEMALLOC_FILTERS = [tracemalloc.Filter(False, tracemalloc.__file__),
+                        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+                        tracemalloc.Filter(False, '<unknown>')]
+
+
+
+def _attribute(inbound_message, key, value_type, default):
+    """Returns an optional attribute of a CommandMessage, or 'default' if it's missing or of
+    the wrong type
+    """
+    value = inbound_message.payload['attributes'].get(key, default)
+    if isinstance(value, bool) and value_type is not bool:
+        return default
+    return value if isinstance(value, value_type) else default
+
+
+def _function_label(function):
+    filename, first_line, name = function
+    return f'{name} ({os.path.basename(filename)}:{first_line})'
+
+
+def sample_stacks(duration, interval=_SAMPLE_INTERVAL, clock=time.monotonic):
+    """Samples the stacks of every thread, except the calling one, for a time
+
+    Args:
+        duration (float): The time, in seconds, to sample for
+        interval (float, optional): The time, in seconds, between samples. Defaults to 0.005.
+        clock (Callable, optional): Returns the current time in seconds. Defaults to
+            time.monotonic.
+
+    Returns:
+        Tuple[int, Counter]: The number of samples taken, and the number of times each stack
+            was seen, keyed by the name of its thread followed by its functions, outermost
+            first, each function being a (filename, first line, name) tuple
+    """
+    own_ident = threading.get_ident()
+    stacks = Counter()
+    samples = 0
+    deadline = clock() + duration
+
+    while True:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        frames = sys._current_frames() # pylint: disable=protected-access
+
+        for ident, frame in frames.items():
+            if ident == own_ident:
+                continue
+
+            functions = []
+            while frame is not None:
+                code = frame.f_code
+                functions.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            functions.reverse()
+
+            stacks[(thread_names.get(ident, str(ident)), *functions)] += 1
+
+        del frames
+        samples += 1
+
+        if clock() >= deadline:
+            return samples, stacks
+        time.sleep(interval)
+
+
+def cpu_profile_report(samples, stacks, duration, limit=30, folded=False):
+    """Formats sampled stacks as a CPU profile report
+
+    Args:
+        samples (int): The number of samples taken
+        stacks (Counter): The sampled stacks, see 'sample_stacks'
+        duration (float): The time, in seconds, the stacks were sampled for
+        limit (int, optional): The number of functions listed. Defaults to 30.
+        folded (bool, optional): True for one line per stack, in the folded format read by
+            flame graph tools, e.g. 'thread;outer;inner 12'. Defaults to False.
+
+    Returns:
+        str: The report
+    """
+    if folded:
+        return '\n'.join(';'.join([stack[0], *[_function_label(function)
+                                                for function in stack[1:]]]) + f' {count}'
+                         for stack, count in stacks.most_common())
+
+    own = Counter()
+    total = Counter()
+    threads = Counter()
+    for stack, count in stacks.items():
+        threads[stack[0]] += count
+        if len(stack) > 1:
+            own[stack[-1]] += count
+        for function in set(stack[1:]):
+            total[function] += count
+
+    lines = [f'CPU profile: {samples} samples over {duration:.1f} s, {len(threads)} thread(s)',
+             '',
+             f"{'Own':>8} {'Own %':>7} {'Total':>8} {'Total %':>7}  Function"]
+    for function, count in own.most_common(limit):
+        lines.append(''.join([f'{count:>8} {100 * count / samples:>7.1f} ',
+                              f'{total[function]:>8} {100 * total[function] / samples:>7.1f}  ',
+                              _function_label(function)]))
+
+    lines.extend(['', f"{'Samples':>8}  Thread"])
+    lines.extend(f'{count:>8}  {thread}' for thread, count in threads.most_common())
+    return '\n'.join(lines)
+
+
+def memory_report(snapshot, previous=None, limit=25):
+    """Formats a tracemalloc snapshot as a memory report
+
+    Args:
+        snapshot (tracemalloc.Snapshot): The snapshot
+        previous (tracemalloc.Snapshot, optional): An earlier snapshot to report the
+            differences from. Defaults to None.
+        limit (int, optional): The number of source lines listed. Defaults to 25.
+
+    Returns:
+        str: The report
+    """
+    snapshot = snapshot.filter_traces(_TRACEMALLOC_FILTERS)
+    current, peak = tracemalloc.get_traced_memory()
+
+    lines = [f'Traced memory: {current} bytes, peak {peak} bytes', '',
+             f'Top {limit} allocations:']
+    lines.extend(str(statistic) for statistic in snapshot.statistics('lineno')[:limit])
+
+    if previous is not None:
+        previous = previous.filter_traces(_TRACEMALLOC_FILTERS)
+        lines.extend(['', f'Top {limit} differences since the previous snapshot:'])
+        lines.extend(str(difference)
+                     for difference in snapshot.compare_to(previous, 'lineno')[:limit])
+
+    return '\n'.join(lines)
+
+
+def thread_dump_report(objects=0):
+    """Returns a report of the stack of every thread and the garbage collector's statistics
+
+    Args:
+        objects (int, optional): The number of object types listed, most numerous first. 0
+            lists none, avoiding a walk of every object tracked by the garbage collector.
+            Defaults to 0.
+
+    Returns:
+        str: The report
+    """
+    threads = {thread.ident: thread for thread in threading.enumerate()}
+    frames = sys._current_frames() # pylint: disable=protected-access
+    lines = [f'Threads: {len(frames)}']
+
+    for ident, frame in frames.items():
+        thread = threads.get(ident)
+        name = thread.name if thread is not None else str(ident)
+        daemon = ' (daemon)' if thread is not None and thread.daemon else ''
+        lines.extend(['', f"Thread '{name}'{daemon}:",
+                      ''.join(traceback.format_stack(frame)).rstrip('\n')])
+    del frames
+
+    lines.extend(['', f"Garbage collector: {'enabled' if gc.isenabled() else 'disabled'}",
+                  f'Counts: {gc.get_count()}, thresholds: {gc.get_threshold()}',
+                  f'Uncollectable objects: {len(gc.garbage)}'])
+    for generation, generation_stats in enumerate(gc.get_stats()):
+        lines.append(''.join([f"Generation {generation}: ",
+                              f"{generation_stats['collections']} collections, ",
+                              f"{generation_stats['collected']} collected, ",
+                              f"{generation_stats['uncollectable']} uncollectable"]))
+    lines.append(f'Resident memory: {stats.resident_memory()} bytes')
+
+    if objects:
+        counts = Counter(type(tracked).__name__ for tracked in gc.get_objects())
+        lines.extend(['', f'Top {objects} object types:'])
+        lines.extend(f'{count:>10}  {type_name}'
+                     for type_name, count in counts.most_common(objects))
+
+    return '\n'.join(lines)
+
+
+
+class _ProfilingCallback(ABC):
+    """Common behaviour of the profiling callbacks: checking the token and delivering reports
+
+    The profiling callbacks have the same shape as a CommandMessageCallback but don't inherit
+    from it, so that they're only registered when enabled, by 'add_profiling_callbacks'.
+
+    Attributes:
+        config (dict): The 'profiling' section of the MQTT Remote configuration
+        mqtt_publish (Callable): A callable object to publish MQTT messages
+        payload_schema (PayloadSchema): The payload values required by the callback, or None
+    """
+    def __init__(self, config, mqtt_publish):
+        """Constructor
+
+        Args:
+            config (dict): The 'profiling' section of the MQTT Remote configuration
+            mqtt_publish (Callable): A callable object to publish MQTT messages
+        """
+        self.config = config
+        self.mqtt_publish = mqtt_publish
+        self.payload_schema = None
+
+
+    @property
+    @abstractmethod
+    def message_name(self):
+        """Abstract method for a 'message_name' property getter
+        """
+
+
+    @abstractmethod
+    def execute(self, inbound_message):
+        """Abstract method for the callback, registered by 'add_profiling_callbacks'
+        """
+
+
+    def authorised(self, inbound_message):
+        """Checks the token in a CommandMessage's attributes against 'profiling > token'
+
+        Args:
+            inbound_message (CommandMessage): The CommandMessage
+
+        Returns:
+            bool: True if a token is configured and the tokens match
+        """
+        token = self.config['token']
+        supplied = _attribute(inbound_message, 'token', str, '')
+        if token and hmac.compare_digest(supplied.encode('utf-8'), token.encode('utf-8')):
+            return True
+
+        logger.warning(f"'{self.message_name}' CommandMessage ignored: wrong or missing token")
+        return False
+
+
+    def deliver(self, inbound_message, report, extension='txt'):
+        """Publishes a report as a chunked transfer to the CommandMessage's reply address, or
+        writes it to a file in 'profiling > output_dir' if it has none
+
+        Args:
+            inbound_message (CommandMessage): The CommandMessage the report is for
+            report (str): The report
+            extension (str, optional): The extension of the report's file name. Defaults to
+                'txt'.
+
+        Returns:
+            str: The transfer identifier, or the path of the file, or None if the report had
+                nowhere to go
+        """
+        file_name = ''.join([f"{self.message_name}-{time.strftime('%Y%m%d-%H%M%S')}-",
+                             f'{os.getpid()}-{next(_REPORT_NUMBERS)}.{extension}'])
+
+        address = message.reply_address(inbound_message)
+        if address is not None:
+            attributes = {'file_name': file_name}
+            if address.correlation_data is not None:
+                attributes['correlation_data'] = (
+                    address.correlation_data.decode('utf-8', errors='replace')
+                    if isinstance(address.correlation_data, bytes)
+                    else address.correlation_data)
+            return message.publish_chunked(self.mqtt_publish, address.topic, report,
+                                           address.qos, address.retain,
+                                           self.config['chunk_size'],
+                                           {'command': f'{self.message_name}{REPORT_SUFFIX}',
+                                            'attributes': attributes})
+
+        if self.config['output_dir']:
+            path = os.path.join(self.config['output_dir'], file_name)
+            with open(path, 'w', encoding='utf-8') as report_file:
+                report_file.write(report)
+            logger.info(f"'{self.message_name}' report written to '{path}'")
+            return path
+
+        logger.warning(''.join([f"'{self.message_name}' report discarded: the CommandMessage ",
+                                "has no reply address and 'profiling > output_dir' isn't set"]))
+        return None
+
+
+
+class CpuProfileCallback(_ProfilingCallback):
+    """Samples the stacks of every thread for a number of seconds and reports the functions
+    the time was spent in
+
+    Requires an inbound message MQTT payload of the form:
+
+        {"command": "mqtt_remote_profile_cpu",
+         "attributes": {"duration": <int|float: 0.1 to max_duration>,
+                        "limit": <int, optional>, "folded": <bool, optional>,
+                        "token": <str>}}
+
+    The profile runs on a thread of its own, so the CommandMessage's dispatch worker is free
+    straight away. Only one profile runs at a time.
+    """
+    def __init__(self, config, mqtt_publish):
+        """Constructor
+
+        Args:
+            config (dict): The 'profiling' section of the MQTT Remote configuration
+            mqtt_publish (Callable): A callable object to publish MQTT messages
+        """
+        super().__init__(config, mqtt_publish)
+        self.payload_schema = message.PayloadSchema(
+            message.PayloadField('duration', ['attributes', 'duration'], (int, float),
+                                 minimum=0.1, maximum=config['max_duration']))
+        self._running = threading.Lock()
+
+
+    @property
+    def message_name(self):
+        """Getter
+
+        Returns:
+            str: The message name
+        """
+        return PROFILE_CPU_COMMAND_NAME
+
+
+    def execute(self, inbound_message):
+        """Starts profiling for 'duration' seconds
+
+        Args:
+            inbound_message (CommandMessage): The CommandMessage
+        """
+        if not self.authorised(inbound_message):
+            return
+
+        if not self._running.acquire(blocking=False): # pylint: disable=consider-using-with
+            logger.warning(f"'{self.message_name}' CommandMessage ignored: already profiling")
+            return
+
+        threading.Thread(target=self._profile, args=(inbound_message,), daemon=True,
+                         name='mqtt_remote_profiler').start()
+
+
+    def _profile(self, inbound_message):
+        try:
+            duration = inbound_message.arguments.duration
+            logger.info(f'CPU profile started for {duration} s')
+            samples, stacks = sample_stacks(duration)
+            folded = _attribute(inbound_message, 'folded', bool, False)
+            report = cpu_profile_report(samples, stacks, duration,
+                                        _attribute(inbound_message, 'limit', int, 30), folded)
+            self.deliver(inbound_message, report, 'folded' if folded else 'txt')
+        except Exception: # pylint: disable=broad-except
+            logger.exception('CPU profile failed')
+        finally:
+            self._running.release()
+
+
+
+class MemoryProfileCallback(_ProfilingCallback):
+    """Starts and stops tracemalloc and reports the largest allocations, and the differences
+    since the previous snapshot
+
+    Requires an inbound message MQTT payload of the form:
+
+        {"command": "mqtt_remote_profile_memory",
+         "attributes": {"action": <str: "start"|"snapshot"|"stop">,
+                        "frames": <int, optional>, "limit": <int, optional>,
+                        "token": <str>}}
+
+    "start" starts tracing allocations, keeping "frames" frames of each allocation's
+    traceback, and takes the first snapshot. "snapshot" reports the allocations traced, and
+    the differences from the previous snapshot, starting tracing first if required. "stop"
+    stops tracing, which frees the memory tracemalloc uses.
+    """
+    def __init__(self, config, mqtt_publish):
+        """Constructor
+
+        Args:
+            config (dict): The 'profiling' section of the MQTT Remote configuration
+            mqtt_publish (Callable): A callable object to publish MQTT messages
+        """
+        super().__init__(config, mqtt_publish)
+        self.payload_schema = message.PayloadSchema(
+            message.PayloadField('action', ['attributes', 'action'], str))
+        self._lock = threading.Lock()
+        self._previous = None
+
+
+    @property
+    def message_name(self):
+        """Getter
+
+        Returns:
+            str: The message name
+        """
+        return PROFILE_MEMORY_COMMAND_NAME
+
+
+    def execute(self, inbound_message):
+        """Carries out the requested 'action'
+
+        Args:
+            inbound_message (CommandMessage): The CommandMessage
+        """
+        if not self.authorised(inbound_message):
+            return
+
+        action = inbound_message.arguments.action
+        if action not in ('start', 'snapshot', 'stop'):
+            logger.warning(''.join([f"'{self.message_name}' CommandMessage ignored: unknown ",
+                                    f"action '{action}'"]))
+            return
+
+        with self._lock:
+            if action == 'stop':
+                tracemalloc.stop()
+                self._previous = None
+                report = 'tracemalloc stopped'
+            elif not tracemalloc.is_tracing() or action == 'start':
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(_attribute(inbound_message, 'frames', int, 1))
+                self._previous = tracemalloc.take_snapshot()
+                frames = tracemalloc.get_traceback_limit()
+                report = f'tracemalloc started, keeping {frames} frame(s) per allocation'
+            else:
+                snapshot = tracemalloc.take_snapshot()
+                report = memory_report(snapshot, self._previous,
+                                       _attribute(inbound_message, 'limit', int, 25))
+                self._previous = snapshot
+
+        logger.info(f"'{self.message_name}' {action}: {report.splitlines()[0]}")
+        self.deliver(inbound_message, report)
+
+
+
+class ThreadDumpCallback(_ProfilingCallback):
+    """Reports the stack of every thread and the garbage collector's statistics
+
+    Requires an inbound message MQTT payload of the form:
+
+        {"command": "mqtt_remote_dump_threads",
+         "attributes": {"objects": <int, optional>, "token": <str>}}
+
+    "objects" lists the most numerous object types too, which walks every object tracked by
+    the garbage collector.
+    """
+    @property
+    def message_name(self):
+        """Getter
+
+        Returns:
+            str: The message name
+        """
+        return DUMP_THREADS_COMMAND_NAME
+
+
+    def execute(self, inbound_message):
+        """Reports the threads and garbage collector
+
+        Args:
+            inbound_message (CommandMessage): The CommandMessage
+        """
+        if not self.authorised(inbound_message):
+            return
+
+        self.deliver(inbound_message,
+                     thread_dump_report(_attribute(inbound_message, 'objects', int, 0)))
+
+
+
+def add_profiling_callbacks(callback_caller, config):
+    """Registers the profiling callbacks with a callback caller, if they're enabled and
+    protected by a token
+
+    Args:
+        callback_caller (CommandMessageCallbackCaller): Callback caller, whose 'mqtt_publish'
+            the reports are published with
+        config (dict): The 'profiling' section of the MQTT Remote configuration
+
+    Returns:
+        list: The registered callbacks, empty if profiling is disabled or has no token
+    """
+    if not config['enabled']:
+        return []
+
+    if not config['token']:
+        logger.warning(''.join(["Profiling commands not registered: 'profiling > token' ",
+                                "must be set to enable them"]))
+        return []
+
+    callbacks = [CpuProfileCallback(config, callback_caller.mqtt_publish),
+                 MemoryProfileCallback(config, callback_caller.mqtt_publish),
+                 ThreadDumpCallback(config, callback_caller.mqtt_publish)]
+
+    for callback in callbacks:
+        callback_caller.add_callback(callback.message_name, callback.execute,
+                                     callback.payload_schema)
+
+    return callbacks
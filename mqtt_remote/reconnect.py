@@ -0,0 +1,219 @@
+"""Reconnection related functionality
+
+Examples:
+
+    To create a reconnect supervisor that waits between 1 and 30 seconds, with up to half of
+    each wait removed at random, between attempts:
+
+        .. code-block:: python
+
+            reconnect_supervisor = ReconnectSupervisor(min_delay=1, max_delay=30, jitter=0.5)
+
+
+    To get the delay before the next attempt after a failed attempt:
+
+        .. code-block:: python
+
+            delay = reconnect_supervisor.connection_failed()
+
+
+    To get the reconnection metrics:
+
+        .. code-block:: python
+
+            snapshot = reconnect_supervisor.metrics()
+"""
+import logging
+import random
+import socket
+import threading
+import time
+
+from mqtt_remote import metrics
+
+
+
+# pylint: disable=C0103
+logger = logging.getLogger(__name__)
+# pylint: enable=C0103
+
+
+
+class ReconnectSupervisor:
+    """Decides how long to wait between attempts to connect to the broker, which address to
+    connect to and tracks the attempts and the time spent disconnected
+
+    The delay doubles with each consecutive failure, from 'min_delay' up to 'max_delay', and a
+    random fraction, up to 'jitter', of it is removed so that many clients losing the same
+    broker don't all reconnect at once.
+
+    Attributes:
+        min_delay (float): The delay, in seconds, before the first attempt after losing the
+            connection
+        max_delay (float): The maximum delay, in seconds, between attempts
+        jitter (float): The maximum fraction, between 0 and 1, of each delay removed at random
+        connect_timeout (float): The time, in seconds, allowed for establishing the network
+            connection to the broker
+        dns_policy (str): When the broker's host name is resolved:
+            'always': on every attempt
+            'cached': once, then again after 'dns_refresh_failures' consecutive failures
+        dns_refresh_failures (int): The number of consecutive failures after which a cached
+            address is resolved again
+    """
+    def __init__(self, min_delay=1.0, max_delay=30.0, jitter=0.5, connect_timeout=5.0,
+                 dns_policy='always', dns_refresh_failures=3, rand=random.random,
+                 clock=time.monotonic):
+        """Constructor
+
+        Args:
+            min_delay (float, optional): The delay, in seconds, before the first attempt after
+                losing the connection. Defaults to 1.0.
+            max_delay (float, optional): The maximum delay, in seconds, between attempts.
+                Defaults to 30.0.
+            jitter (float, optional): The maximum fraction of each delay removed at random.
+                Defaults to 0.5.
+            connect_timeout (float, optional): The time, in seconds, allowed for establishing
+                the network connection. Defaults to 5.0.
+            dns_policy (str, optional): 'always' or 'cached'. Defaults to 'always'.
+            dns_refresh_failures (int, optional): The number of consecutive failures after
+                which a cached address is resolved again. Defaults to 3.
+            rand (Callable, optional): Returns a random float in [0, 1). Defaults to
+                random.random.
+            clock (Callable, optional): Returns the current time in seconds. Defaults to
+                time.monotonic.
+
+        Raises:
+            ValueError: if an unacceptable dns_policy is provided
+        """
+        if dns_policy not in ('always', 'cached'):
+            raise ValueError(''.join(['ReconnectSupervisor \'dns_policy\' argument can only ',
+                                      'be \'always\' or \'cached\'']))
+
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.connect_timeout = connect_timeout
+        self.dns_policy = dns_policy
+        self.dns_refresh_failures = dns_refresh_failures
+
+        self._rand = rand
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._address = None
+        self._consecutive_failures = 0
+        self._disconnected_at = None
+        self._metrics = {'attempts': 0, 'failures': 0, 'reconnects': 0, 'connected': False,
+                         'downtime_total': 0.0, 'last_delay': 0.0}
+
+
+    def address(self, host, port):
+        """Returns the address to connect to the broker with
+
+        Args:
+            host (str): The host name or IP address of the broker
+            port (int): The port of the broker
+
+        Returns:
+            str: The host name, or the resolved IP address if the dns policy is 'cached'
+        """
+        if self.dns_policy == 'always':
+            return host
+
+        with self._lock:
+            refresh = (self._address is None
+                       or (self.dns_refresh_failures
+                           and self._consecutive_failures
+                           and self._consecutive_failures % self.dns_refresh_failures == 0))
+            if not refresh:
+                return self._address
+
+        try:
+            address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0][4][0]
+        except OSError as error:
+            logger.warning(f"Unable to resolve MQTT Broker address '{host}': {error}")
+            return self._address or host
+
+        with self._lock:
+            if address != self._address:
+                logger.info(f"MQTT Broker address '{host}' resolved to {address}")
+            self._address = address
+        return address
+
+
+    def _next_delay(self):
+        """Returns the delay before the next attempt. The caller must hold 'self._lock'
+        """
+        exponent = max(self._consecutive_failures - 1, 0)
+        delay = min(self.max_delay, self.min_delay * 2 ** min(exponent, 32))
+        delay -= delay * self.jitter * self._rand()
+        self._metrics['last_delay'] = delay
+        return delay
+
+
+    def connected(self):
+        """Records a successful connection to the broker
+
+        Returns:
+            float: The time, in seconds, spent disconnected, None for the first connection
+        """
+        with self._lock:
+            self._metrics['attempts'] += 1
+            downtime = None
+            if self._disconnected_at is not None:
+                downtime = self._clock() - self._disconnected_at
+                self._metrics['downtime_total'] += downtime
+                self._metrics['reconnects'] += 1
+                metrics.RECONNECTS.inc()
+            self._disconnected_at = None
+            self._consecutive_failures = 0
+            self._metrics['connected'] = True
+            return downtime
+
+
+    def connection_failed(self):
+        """Records a failed attempt to connect to the broker
+
+        Returns:
+            float: The delay, in seconds, before the next attempt
+        """
+        with self._lock:
+            self._metrics['attempts'] += 1
+            self._metrics['failures'] += 1
+            metrics.CONNECTION_FAILURES.inc()
+            self._consecutive_failures += 1
+            return self._next_delay()
+
+
+    def disconnected(self):
+        """Records the loss of the connection to the broker, or the broker refusing a connection
+
+        Returns:
+            float: The delay, in seconds, before the next attempt to connect
+        """
+        with self._lock:
+            if self._metrics['connected']:
+                self._disconnected_at = self._clock()
+                self._consecutive_failures = 0
+            self._metrics['connected'] = False
+            return self._next_delay()
+
+
+    def metrics(self):
+        """Returns metrics describing the connection to the broker
+
+        Returns:
+            dict: 'attempts': the number of attempts to connect,
+                'failures': the number of failed attempts,
+                'reconnects': the number of times the connection was re-established,
+                'connected': whether the client is connected,
+                'downtime_total': the time, in seconds, spent disconnected after losing
+                connections,
+                'downtime_current': the time, in seconds, since the current connection was
+                lost, 0 if connected,
+                'last_delay': the last delay, in seconds, between attempts
+        """
+        with self._lock:
+            snapshot = dict(self._metrics)
+            snapshot['downtime_current'] = (self._clock() - self._disconnected_at
+                                            if self._disconnected_at is not None else 0.0)
+            return snapshot
@@ -13,7 +13,7 @@ Examples:
 
         .. code-block:: python
 
-            configure_logging(completed_config)
+            background_logging = configure_logging(completed_config)
 
 
     To load all local callbacks and plugin callbacks:
@@ -32,13 +32,88 @@ Examples:
                                                     completed_config)
 
 
+    To create the dead letter handler:
+
+        .. code-block:: python
+
+            dead_letter_handler = create_dead_letter_handler(mqtt_software_client,
+                                                             completed_config)
+
+
+    To create the tracer that traces a sample of the messages received:
+
+        .. code-block:: python
+
+            tracer = create_tracer(mqtt_software_client, completed_config)
+
+
+    To create and start the dispatch engine:
+
+        .. code-block:: python
+
+            dispatch_engine = create_dispatch_engine(callback_caller,
+                                                     mqtt_software_client,
+                                                     completed_config,
+                                                     dead_letter_handler)
+
+
+    To setup reassembly of chunked transfers:
+
+        .. code-block:: python
+
+            chunk_reassembler = setup_chunk_reassembler(callback_caller,
+                                                        dispatch_engine,
+                                                        completed_config)
+
+
+    To register the built-in profiling callbacks, if enabled:
+
+        .. code-block:: python
+
+            profiling_callbacks = setup_profiling(callback_caller, completed_config)
+
+
+    To create the command router:
+
+        .. code-block:: python
+
+            command_router = create_command_router(mqtt_software_client, completed_config)
+
+
     To setup the message forwarder:
 
         .. code-block:: python
 
             message_forwarder = setup_message_forwarder(message_forwarder,
-                                                        callback_caller,
-                                                        message_convertor)
+                                                        message_convertor,
+                                                        dead_letter_handler,
+                                                        tracer)
+
+
+    To setup the middleware stages that convert, route and dispatch each message received:
+
+        .. code-block:: python
+
+            middleware = setup_middleware(mqtt_software_client.middleware,
+                                          message_forwarder,
+                                          dispatch_engine,
+                                          completed_config,
+                                          command_router)
+
+
+    To get the subscription topic, client id and worker id of this instance:
+
+        .. code-block:: python
+
+            subscription_topic, mqtt_client_id, worker_id = subscription_identity(
+                completed_config)
+
+
+    To get the MQTT 5 receive maximum advertised to the broker:
+
+        .. code-block:: python
+
+            maximum = receive_maximum(completed_config)
 
 
     To create an unconfigured MQTT client:
@@ -52,15 +127,24 @@ Examples:
 
         .. code-block:: python
 
-            mqtt_software_client = setup_mqtt_software_client(mqtt_software_client,
-                                                              completed_config)
+            mqtt_software_client, dispatch_engine, tracer = setup_mqtt_software_client(
+                mqtt_software_client, completed_config)
 
 
     To create a configured MQTT client:
 
         .. code-block:: python
 
-            mqtt_software_client = create_configured_mqtt_software_client(completed_config)
+            mqtt_software_client, dispatch_engine, tracer = (
+                create_configured_mqtt_software_client(completed_config))
+
+
+    To create a configured MQTT client that hands CommandMessages to 4 worker processes:
+
+        .. code-block:: python
+
+            mqtt_software_client, worker_pool = create_configured_multiprocess_mqtt_software_client(
+                completed_config, 4)
 
 
     To stop the MQTT client in a controlled manner:
@@ -70,6 +154,15 @@ Examples:
             controlled_shutdown(mqtt_software_client)
 
 
+    To serve the metrics over HTTP and publish snapshots of them to '<client id>/$stats', if
+    enabled:
+
+        .. code-block:: python
+
+            metrics_server = start_metrics_server(mqtt_software_client, completed_config)
+            stats_publisher = start_stats_publisher(mqtt_software_client, completed_config)
+
+
     To start the application manually:
 
         .. code-block:: python
@@ -77,6 +170,13 @@ Examples:
             start(mqtt_software_client)
 
 
+    To parse the command line arguments:
+
+        .. code-block:: python
+
+            arguments = parse_arguments(['--workers', '4'])
+
+
     To start the application automatically:
 
         .. code-block:: python
@@ -88,14 +188,32 @@ Attributes:
     MQTT_CLIENT_LOOP_TYPE (str): The desired mode for running the MQTT client, i.e. 'blocking'
         or 'non_blocking'
 """
+import argparse
 import logging
 from pathlib import Path
 
-from mqtt_remote import (callbacks_local,
+import paho.mqtt.client as mqtt
+
+from mqtt_remote import (asyncio_client,
+                         audit,
+                         callbacks_local,
                          callbacks_plugins,
                          config,
+                         dead_letter,
+                         dispatch,
+                         journal,
+                         log_pipeline,
                          message,
-                         mqtt_client)
+                         metrics,
+                         middleware,
+                         mqtt_client,
+                         profiling,
+                         reconnect,
+                         routing,
+                         stats,
+                         tracing,
+                         watchdog,
+                         workers)
 
 
 
@@ -121,15 +239,24 @@ def installation_path():
 def configure_logging(completed_config):
     """Configures logging for the app
 
+    Unless 'logging > queue_size' is 0, log records are written to the log file and console
+    by a background thread, see 'log_pipeline.BackgroundLogging', which must be stopped
+    before the app exits so that the records still queued are written
+
     Args:
         completed_config (dict): A dictionary containing a completed MQTT Remote
         configuration
+
+    Returns:
+        log_pipeline.BackgroundLogging: The background logging pipeline, already started, or
+            None if records are written by the thread that logs them
     """
     output_file_name = completed_config['logging']['output_file']['name']
     output_file_maxsize = completed_config['logging']['output_file']['max_size']
     output_file_backups = completed_config['logging']['output_file']['max_backups']
     logging_level = completed_config['logging']['pylevel']
     logging_format = completed_config['logging']['log_format']
+    queue_size = completed_config['logging']['queue_size']
 
     rotating_file_handler = logging.handlers.RotatingFileHandler(
         output_file_name, maxBytes=output_file_maxsize,
@@ -138,9 +265,26 @@ def configure_logging(completed_config):
     stream_handler = logging.StreamHandler()
 
     logging_handlers = [rotating_file_handler, stream_handler]
+    for handler in logging_handlers:
+        if completed_config['logging']['json_format']:
+            handler.setFormatter(log_pipeline.JsonFormatter())
+        else:
+            handler.setFormatter(logging.Formatter(logging_format))
+
+    log_sampler = log_pipeline.LogSampler(completed_config['logging']['sampling'],
+                                          completed_config['logging']['max_per_second'])
+
+    if queue_size <= 0:
+        for handler in logging_handlers:
+            handler.addFilter(log_sampler)
+        logging.basicConfig(level=logging_level, handlers=logging_handlers)
+        return None
 
-    logging.basicConfig(level=logging_level, format=logging_format,
-                        handlers=logging_handlers)
+    background_logging = log_pipeline.BackgroundLogging(logging_handlers, queue_size,
+                                                        log_sampler)
+    background_logging.start()
+    logging.basicConfig(level=logging_level, handlers=[background_logging.handler])
+    return background_logging
 
 
 def load_all_callbacks():
@@ -167,47 +311,400 @@ def setup_callback_caller(callback_caller, publish_function, completed_config):
     return callback_caller
 
 
-def setup_message_forwarder(message_forwarder, callback_caller, message_convertor):
-    """Sets up the message forwarder
+def create_dead_letter_handler(mqtt_software_client, completed_config):
+    """Creates the dead letter handler
+
+    Args:
+        mqtt_software_client (mqtt_client.MQTTClient): The MQTT software client that dead
+            letters are published with
+        completed_config (dict): Completed MQTT Remote configuration
+
+    Returns:
+        DeadLetterHandler: The dead letter handler
+    """
+    dead_letter_config = completed_config['dead_letter']
+
+    return dead_letter.DeadLetterHandler(mqtt_software_client.publish,
+                                         dead_letter_config['topic'],
+                                         dead_letter_config['qos'],
+                                         dead_letter_config['quarantine_threshold'],
+                                         dead_letter_config['quarantine_size'],
+                                         dead_letter_config['quarantine_duration'],
+                                         dead_letter_config['payload_excerpt'],
+                                         dead_letter_config['max_per_second'])
+
+
+def create_audit_journal(completed_config):
+    """Creates the command audit journal
+
+    Args:
+        completed_config (dict): Completed MQTT Remote configuration
+
+    Returns:
+        AuditJournal: The audit journal, None if auditing is disabled
+    """
+    audit_config = completed_config['audit']
+
+    if not audit_config['path']:
+        return None
+
+    return audit.AuditJournal(audit_config['path'],
+                              audit_config['max_size'],
+                              audit_config['max_backups'],
+                              audit_config['flush_interval'])
+
+
+def create_slow_callback_detector(mqtt_software_client, completed_config):
+    """Creates the slow callback detector
+
+    Args:
+        mqtt_software_client (mqtt_client.MQTTClient): The MQTT software client that slow
+            callback reports are published with
+        completed_config (dict): Completed MQTT Remote configuration
+
+    Returns:
+        SlowCallbackDetector: The slow callback detector, None if it's disabled
+    """
+    slow_callbacks_config = completed_config['slow_callbacks']
+
+    if not slow_callbacks_config['threshold']:
+        return None
+
+    return watchdog.SlowCallbackDetector(slow_callbacks_config['threshold'],
+                                         mqtt_software_client.publish,
+                                         slow_callbacks_config['topic'],
+                                         slow_callbacks_config['qos'],
+                                         slow_callbacks_config['max_per_minute'],
+                                         slow_callbacks_config['attributes_excerpt'])
+
+
+def create_tracer(mqtt_software_client, completed_config):
+    """Creates the tracer, which exports its spans to 'tracing > topic' if set, otherwise to
+    the file at 'tracing > path'
+
+    Args:
+        mqtt_software_client (mqtt_client.MQTTClient): The MQTT software client that the
+            spans are published with, and whose protocol decides how the trace context is sent
+        completed_config (dict): Completed MQTT Remote configuration
+
+    Returns:
+        Tracer: The tracer, None if tracing is disabled
+    """
+    tracing_config = completed_config['tracing']
+
+    if tracing_config['topic']:
+        exporter = tracing.MQTTTraceExporter(mqtt_software_client.publish,
+                                             tracing_config['topic'])
+    elif tracing_config['path']:
+        exporter = tracing.FileTraceExporter(tracing_config['path'])
+    else:
+        return None
+
+    return tracing.Tracer(exporter,
+                          tracing_config['sample_rate'],
+                          getattr(mqtt_software_client, 'mqtt_protocol', None) == mqtt.MQTTv5)
+
+
+def create_dispatch_engine(callback_caller, mqtt_software_client, completed_config,
+                           dead_letter_handler=None):
+    """Creates and starts the dispatch engine
+
+    Args:
+        callback_caller (CommandMessageCallbackCaller): Callback caller
+        mqtt_software_client (mqtt_client.MQTTClient): The MQTT software client that streamed
+            results are published with
+        completed_config (dict): Completed MQTT Remote configuration
+        dead_letter_handler (DeadLetterHandler, optional): Records callbacks that raise an
+            exception. Defaults to None.
+
+    Returns:
+        DispatchEngine: The started dispatch engine
+    """
+    dispatch_config = completed_config['dispatch']
+
+    stream_publisher = dispatch.StreamPublisher(mqtt_software_client.publish,
+                                                dispatch_config['stream_batch_size'],
+                                                dispatch_config['stream_max_pending'],
+                                                mqtt_software_client.pending_publish_count,
+                                                dispatch_config['stream_flow_control_timeout'])
+
+    dispatch_engine = dispatch.DispatchEngine(callback_caller,
+                                              stream_publisher,
+                                              dispatch_config['workers'],
+                                              dispatch_config['max_queued'],
+                                              dispatch_config['batch_max_items'],
+                                              dispatch_config['batch_max_delay'],
+                                              dead_letter_handler,
+                                              create_audit_journal(completed_config),
+                                              create_slow_callback_detector(mqtt_software_client,
+                                                                            completed_config))
+    dispatch_engine.start()
+
+    metrics.REGISTRY.gauge('mqtt_remote_dispatch_queue_depth',
+                           'CommandMessages waiting for a dispatch worker',
+                           dispatch_engine.queue_depth)
+
+    return dispatch_engine
+
+
+def setup_chunk_reassembler(callback_caller, dispatch_engine, completed_config):
+    """Sets up reassembly of chunked transfers
+
+    Registers a chunk reassembler with the callback caller so that CommandMessages delivered
+    by chunked transfers are submitted to the dispatch engine once reassembled, and so are
+    dispatched, recorded and dead lettered like any other CommandMessage
 
     Args:
-        message_forwarder (ConvertedCommandMessageForwarder): Message forwarder to set up
         callback_caller (CommandMessageCallbackCaller): Callback caller
+        dispatch_engine (DispatchEngine): Dispatch engine
+        completed_config (dict): Completed MQTT Remote configuration
+
+    Returns:
+        ChunkReassembler: The registered chunk reassembler
+    """
+    chunking_config = completed_config['chunking']
+
+    chunk_reassembler = message.ChunkReassembler(dispatch_engine.submit,
+                                                 chunking_config['spool_size'],
+                                                 chunking_config['max_transfer_size'],
+                                                 chunking_config['max_transfers'],
+                                                 chunking_config['timeout'])
+
+    callback_caller.add_callback(message.CHUNK_COMMAND_NAME, chunk_reassembler.receive,
+                                 message.CHUNK_PAYLOAD_SCHEMA)
+
+    return chunk_reassembler
+
+
+def setup_profiling(callback_caller, completed_config):
+    """Registers the built-in profiling callbacks with the callback caller, if they're
+    enabled
+
+    Args:
+        callback_caller (CommandMessageCallbackCaller): Callback caller
+        completed_config (dict): Completed MQTT Remote configuration
+
+    Returns:
+        list: The registered profiling callbacks, empty if profiling is disabled
+    """
+    return profiling.add_profiling_callbacks(callback_caller, completed_config['profiling'])
+
+
+def subscription_identity(completed_config):
+    """Returns the topic this instance subscribes to, its MQTT client id and its worker id
+
+    A subscription name of the form '$share/<group>/<topic>', or a 'shared_group', makes this
+    instance one worker of a shared subscription group. Each worker is then given a client id
+    of its own, derived from the topic and its worker id.
+
+    Args:
+        completed_config (dict): Completed MQTT Remote configuration
+
+    Returns:
+        Tuple[str, str, str]: The subscription topic, the MQTT client id and the worker id, None
+            if the subscription isn't shared
+    """
+    this_mqtt_client = completed_config['subscriptions']['this_mqtt_client']
+    group, topic = routing.split_shared_topic(this_mqtt_client['name'])
+    group = this_mqtt_client['shared_group'] or group
+
+    if not group:
+        return topic, topic, None
+
+    worker_id = this_mqtt_client['worker_id'] or routing.default_worker_id()
+    return (routing.shared_topic(topic, group), routing.worker_client_id(topic, worker_id),
+            worker_id)
+
+
+def create_command_router(mqtt_software_client, completed_config):
+    """Creates the command router
+
+    Args:
+        mqtt_software_client (mqtt_client.MQTTClient): The MQTT software client that commands
+            pinned to another worker are forwarded with
+        completed_config (dict): Completed MQTT Remote configuration
+
+    Returns:
+        CommandRouter: The command router
+    """
+    routing_config = completed_config['routing']
+    _, topic = routing.split_shared_topic(
+        completed_config['subscriptions']['this_mqtt_client']['name'])
+    _, _, worker_id = subscription_identity(completed_config)
+
+    return routing.CommandRouter(mqtt_software_client.publish,
+                                 topic,
+                                 worker_id,
+                                 routing_config['pinned_commands'],
+                                 routing_config['dedup_size'])
+
+
+def setup_message_forwarder(message_forwarder, message_convertor, dead_letter_handler=None,
+                            tracer=None):
+    """Sets up the message forwarder for its 'convert' middleware stage, see
+    'setup_middleware', which passes the converted CommandMessages on to the later stages
+
+    Args:
+        message_forwarder (ConvertedCommandMessageForwarder): Message forwarder to set up
         message_convertor (CommandMessageConvertor): Message convertor
+        dead_letter_handler (DeadLetterHandler, optional): Records messages that can't be
+            converted. Defaults to None.
+        tracer (Tracer, optional): Starts the traces of the sampled messages. Defaults to
+            None.
 
     Returns:
         ConvertedCommandMessageForwarder: Set up message forwarder
     """
     message_forwarder.message_convertor = message_convertor
-    message_forwarder.callback = callback_caller.callback_caller
+    message_forwarder.dead_letter_handler = dead_letter_handler
+    message_forwarder.tracer = tracer
 
     return message_forwarder
 
 
+def setup_middleware(middleware_pipeline, message_forwarder, dispatch_engine, completed_config,
+                     command_router=None):
+    """Adds the stages that convert, route and dispatch each message received to a middleware
+    pipeline
+
+    Args:
+        middleware_pipeline (MiddlewarePipeline): The MQTT client's middleware pipeline
+        message_forwarder (ConvertedCommandMessageForwarder): Set up message forwarder, see
+            'setup_message_forwarder'
+        dispatch_engine (DispatchEngine, WorkerPool): Dispatch engine, or the pool of worker
+            processes that CommandMessages are handed to
+        completed_config (dict): Completed MQTT Remote configuration
+        command_router (CommandRouter, optional): Drops duplicate CommandMessages and forwards
+            pinned ones. Defaults to None.
+
+    Returns:
+        MiddlewarePipeline: Set up middleware pipeline
+    """
+    middleware_pipeline.timed = completed_config['middleware']['timing']
+    middleware_pipeline.add(middleware.CONVERT_STAGE, message_forwarder.convert)
+    if command_router is not None:
+        middleware_pipeline.add(middleware.ROUTE_STAGE, command_router.admit)
+    middleware_pipeline.add(middleware.DISPATCH_STAGE, dispatch_engine.submit)
+
+    return middleware_pipeline
+
+
+def create_publish_journal(completed_config):
+    """Creates the outbound publish journal
+
+    Args:
+        completed_config (dict): Completed MQTT Remote configuration
+
+    Returns:
+        PublishJournal: The publish journal, None if journaling is disabled
+    """
+    journal_config = completed_config['journal']
+
+    if not journal_config['path']:
+        return None
+
+    return journal.PublishJournal(journal_config['path'],
+                                  journal_config['max_messages'],
+                                  journal_config['fsync'],
+                                  journal_config['compact_interval'])
+
+
+def create_reconnect_supervisor(completed_config):
+    """Creates the reconnect supervisor
+
+    Args:
+        completed_config (dict): Completed MQTT Remote configuration
+
+    Returns:
+        ReconnectSupervisor: The reconnect supervisor
+    """
+    reconnect_config = completed_config['reconnect']
+
+    return reconnect.ReconnectSupervisor(reconnect_config['min_delay'],
+                                         reconnect_config['max_delay'],
+                                         reconnect_config['jitter'],
+                                         reconnect_config['connect_timeout'],
+                                         reconnect_config['dns_policy'],
+                                         reconnect_config['dns_refresh_failures'])
+
+
+def receive_maximum(completed_config):
+    """Returns the MQTT 5 receive maximum advertised to the broker
+
+    A configured receive maximum of 0 matches the dispatch engine's capacity, i.e. its worker
+    threads plus its queue, so that the broker doesn't send more unacknowledged QoS 1 and 2
+    messages than can be dispatched
+
+    Args:
+        completed_config (dict): Completed MQTT Remote configuration
+
+    Returns:
+        int: The receive maximum, 0 to leave it to the broker
+    """
+    configured = completed_config['mqtt_v5']['receive_maximum']
+    if configured:
+        return min(configured, 65535)
+
+    dispatch_config = completed_config['dispatch']
+    if not dispatch_config['max_queued']:
+        return 0
+    return min(max(dispatch_config['workers'] + dispatch_config['max_queued'], 1), 65535)
+
+
 def create_mqtt_software_client(completed_config):
     """Creates an MQTT software client
 
+    The 'mqtt_session' > 'backend' setting selects the paho based mqtt_client.MQTTClient,
+    'paho', or the asyncio based asyncio_client.AsyncioMQTTClient, 'asyncio'. A worker of a
+    shared subscription group also subscribes to its own worker topic.
+
     Args:
         completed_config (dict): A dictionary containing a completed MQTT Remote configuration
 
     Returns:
-        MQTT Client (mqtt_client.MQTTClient): MQTT software client
+        MQTT Client (mqtt_client.MQTTClient, asyncio_client.AsyncioMQTTClient): MQTT software
+            client
+
+    Raises:
+        ValueError: if an unacceptable backend is configured
     """
-    subscription_config = completed_config['subscriptions']
-    subscription_topic = subscription_config['this_mqtt_client']['name']
-    subscription_qos = subscription_config['this_mqtt_client']['qos']
-
-    mqtt_software_client = mqtt_client.MQTTClient(completed_config['mqtt_broker']['user_name'],
-                                                completed_config['mqtt_broker']['password'],
-                                                completed_config['mqtt_broker']['ip'],
-                                                completed_config['mqtt_broker']['port'],
-                                                completed_config['mqtt_broker']['keepalive'],
-                                                [(subscription_topic, subscription_qos)],
-                                                subscription_topic,
-                                                completed_config['mqtt_session']['clean'],
-                                                completed_config['mqtt_session']['pyprotocol'],
-                                                completed_config['mqtt_session']['transport'],
-                                                completed_config['logging']['log_base_client']) \
+    subscription_topic, mqtt_client_id, worker_id = subscription_identity(completed_config)
+    subscription_qos = completed_config['subscriptions']['this_mqtt_client']['qos']
+    subscription_topics = [(subscription_topic, subscription_qos)]
+
+    if worker_id is not None:
+        subscription_topics.append((routing.worker_topic(mqtt_client_id), subscription_qos))
+        logger.info(''.join([f"Joining shared subscription '{subscription_topic}' as worker ",
+                             f"'{worker_id}' (client id: '{mqtt_client_id}')"]))
+
+    backends = {'paho': mqtt_client.MQTTClient,
+                'asyncio': asyncio_client.AsyncioMQTTClient}
+    backend = completed_config['mqtt_session']['backend']
+    if backend not in backends:
+        raise ValueError(''.join(["The yaml 'mqtt_session > backend' parameter can only have ",
+                                  f"the following values: {list(backends)}"]))
+
+    mqtt_software_client = backends[backend](completed_config['mqtt_broker']['user_name'],
+                                             completed_config['mqtt_broker']['password'],
+                                             completed_config['mqtt_broker']['ip'],
+                                             completed_config['mqtt_broker']['port'],
+                                             completed_config['mqtt_broker']['keepalive'],
+                                             subscription_topics,
+                                             mqtt_client_id,
+                                             completed_config['mqtt_session']['clean'],
+                                             completed_config['mqtt_session']['pyprotocol'],
+                                             completed_config['mqtt_session']['transport'],
+                                             completed_config['logging']['log_base_client'],
+                                             completed_config['outbound']['coalesce_window'],
+                                             completed_config['outbound']['max_inflight'],
+                                             completed_config['outbound']['max_queued'],
+                                             completed_config['outbound']['queue_full_policy'],
+                                             completed_config['outbound']['queue_full_timeout'],
+                                             create_publish_journal(completed_config),
+                                             create_reconnect_supervisor(completed_config),
+                                             receive_maximum(completed_config),
+                                             completed_config['mqtt_v5']['topic_alias_maximum'],
+                                             completed_config['outbound']['delivery_timeout'])
 
     return mqtt_software_client
 
@@ -220,37 +717,132 @@ def setup_mqtt_software_client(mqtt_software_client, completed_config):
         completed_config (dict): A dictionary containing a completed MQTT Remote configuration
 
     Returns:
-        MQTT Client (mqtt_client.MQTTClient): The MQTT software client
+        Tuple[mqtt_client.MQTTClient, DispatchEngine, Tracer]: The MQTT software client, the
+            started dispatch engine and the tracer, None if tracing is disabled. The dispatch
+            engine is to be stopped, then the tracer closed, once the MQTT software client has
+            stopped.
     """
     callback_caller = message.CommandMessageCallbackCaller()
     message_convertor = message.PahoToCommandMessageConvertor()
-    message_forwarder = message.ConvertedCommandMessageForwarder(message_convertor, callback_caller)
+    message_forwarder = message.ConvertedCommandMessageForwarder(message_convertor, None)
+
+    tracer = create_tracer(mqtt_software_client, completed_config)
+    publish_function = mqtt_software_client.publish
+    if tracer is not None:
+        publish_function = tracer.wrap_publish(publish_function)
 
     callback_caller = setup_callback_caller(callback_caller,
-                                            mqtt_software_client.publish,
+                                            publish_function,
                                             completed_config)
-    message_forwarder = setup_message_forwarder(message_forwarder, callback_caller,
-                                                message_convertor)
+    dead_letter_handler = create_dead_letter_handler(mqtt_software_client, completed_config)
+    dispatch_engine = create_dispatch_engine(callback_caller, mqtt_software_client,
+                                             completed_config, dead_letter_handler)
+    setup_chunk_reassembler(callback_caller, dispatch_engine, completed_config)
+    setup_profiling(callback_caller, completed_config)
+    command_router = create_command_router(mqtt_software_client, completed_config)
+    message_forwarder = setup_message_forwarder(message_forwarder, message_convertor,
+                                                dead_letter_handler, tracer)
+    setup_middleware(mqtt_software_client.middleware, message_forwarder, dispatch_engine,
+                     completed_config, command_router)
 
-    mqtt_software_client.on_message_callbacks.add(message_forwarder.forward)
     mqtt_software_client.initialise()
+    # With the asyncio backend coroutine callbacks run on the client's event loop, whilst the
+    # callbacks that block stay on the worker threads
+    dispatch_engine.event_loop = getattr(mqtt_software_client, 'event_loop', None)
 
-    return mqtt_software_client
+    return mqtt_software_client, dispatch_engine, tracer
 
 
 def create_configured_mqtt_software_client(completed_config):
-    """Returns a configured MQTT software client
+    """Returns a configured MQTT software client, its dispatch engine and its tracer
 
     Args:
         completed_config (dict): A dictionary containing a completed MQTT Remote configuration
 
     Returns:
-        MQTT Client (mqtt_client.MQTTClient): A configured MQTT software client
+        Tuple[mqtt_client.MQTTClient, DispatchEngine, Tracer]: A configured MQTT software
+            client, the started dispatch engine and the tracer, None if tracing is disabled
     """
     mqtt_software_client = create_mqtt_software_client(completed_config)
-    mqtt_software_client = setup_mqtt_software_client(mqtt_software_client,
-                                                      completed_config)
-    return mqtt_software_client
+    return setup_mqtt_software_client(mqtt_software_client, completed_config)
+
+
+def create_worker_pool(mqtt_software_client, completed_config, processes,
+                       dead_letter_handler=None):
+    """Creates and starts a pool of worker processes
+
+    Args:
+        mqtt_software_client (mqtt_client.MQTTClient): The MQTT software client that the
+            workers' messages are published with
+        completed_config (dict): Completed MQTT Remote configuration
+        processes (int): The number of worker processes
+        dead_letter_handler (DeadLetterHandler, optional): Records CommandMessages whose
+            callback failed in a worker. Defaults to None.
+
+    Returns:
+        WorkerPool: The started worker pool
+    """
+    worker_pool = workers.WorkerPool(completed_config,
+                                     processes,
+                                     mqtt_software_client.publish,
+                                     dead_letter_handler,
+                                     max_queued=completed_config['dispatch']['max_queued'])
+    worker_pool.start()
+
+    metrics.REGISTRY.gauge('mqtt_remote_worker_queue_depth',
+                           'CommandMessages handed to worker processes and not yet finished',
+                           lambda: sum(worker_pool.outstanding()))
+
+    return worker_pool
+
+
+def setup_multiprocess_mqtt_software_client(mqtt_software_client, completed_config, processes):
+    """Sets up the MQTT software client to hand CommandMessages to a pool of worker processes
+
+    The callbacks are loaded and called by the worker processes rather than by this process,
+    which only converts, routes and publishes messages
+
+    Args:
+        mqtt_software_client (mqtt_client.MQTTClient): The MQTT software client to set up
+        completed_config (dict): A dictionary containing a completed MQTT Remote configuration
+        processes (int): The number of worker processes
+
+    Returns:
+        Tuple[mqtt_client.MQTTClient, WorkerPool]: The MQTT software client and the started
+            worker pool
+    """
+    message_convertor = message.PahoToCommandMessageConvertor()
+    message_forwarder = message.ConvertedCommandMessageForwarder(message_convertor, None)
+
+    dead_letter_handler = create_dead_letter_handler(mqtt_software_client, completed_config)
+    worker_pool = create_worker_pool(mqtt_software_client, completed_config, processes,
+                                     dead_letter_handler)
+    command_router = create_command_router(mqtt_software_client, completed_config)
+    message_forwarder = setup_message_forwarder(message_forwarder, message_convertor,
+                                                dead_letter_handler)
+    setup_middleware(mqtt_software_client.middleware, message_forwarder, worker_pool,
+                     completed_config, command_router)
+
+    mqtt_software_client.initialise()
+
+    return mqtt_software_client, worker_pool
+
+
+def create_configured_multiprocess_mqtt_software_client(completed_config, processes):
+    """Returns a configured MQTT software client that hands CommandMessages to a pool of
+    worker processes, and the pool
+
+    Args:
+        completed_config (dict): A dictionary containing a completed MQTT Remote configuration
+        processes (int): The number of worker processes
+
+    Returns:
+        Tuple[mqtt_client.MQTTClient, WorkerPool]: The configured MQTT software client and the
+            started worker pool
+    """
+    mqtt_software_client = create_mqtt_software_client(completed_config)
+    return setup_multiprocess_mqtt_software_client(mqtt_software_client, completed_config,
+                                                   processes)
 
 
 def controlled_shutdown(mqtt_software_client):
@@ -263,6 +855,71 @@ def controlled_shutdown(mqtt_software_client):
     mqtt_software_client.stop()
 
 
+def register_outbound_gauge(mqtt_software_client):
+    """Adds a gauge of the MQTT software client's outbound queue depth to the metrics
+
+    Args:
+        mqtt_software_client (mqtt_client.MQTTClient): The MQTT software client
+    """
+    metrics.REGISTRY.gauge('mqtt_remote_outbound_queue_depth',
+                           'Published messages not yet confirmed as sent',
+                           mqtt_software_client.pending_publish_count)
+
+
+def start_metrics_server(mqtt_software_client, completed_config):
+    """Starts serving the metrics over HTTP, if enabled
+
+    Args:
+        mqtt_software_client (mqtt_client.MQTTClient): The MQTT software client
+        completed_config (dict): Completed MQTT Remote configuration
+
+    Returns:
+        MetricsServer: The started metrics server, None if the metrics server is disabled
+    """
+    metrics_config = completed_config['metrics']
+
+    if not metrics_config['enabled']:
+        return None
+
+    register_outbound_gauge(mqtt_software_client)
+
+    metrics_server = metrics.MetricsServer(metrics.REGISTRY,
+                                           metrics_config['host'],
+                                           metrics_config['port'])
+    metrics_server.start()
+
+    return metrics_server
+
+
+def start_stats_publisher(mqtt_software_client, completed_config):
+    """Starts publishing snapshots of the metrics to '<client id>/$stats', if enabled
+
+    Args:
+        mqtt_software_client (mqtt_client.MQTTClient): The MQTT software client the snapshots
+            are published with
+        completed_config (dict): Completed MQTT Remote configuration
+
+    Returns:
+        StatsPublisher: The started stats publisher, None if 'stats > interval' is 0
+    """
+    stats_config = completed_config['stats']
+
+    if not stats_config['interval']:
+        return None
+
+    register_outbound_gauge(mqtt_software_client)
+
+    _, mqtt_client_id, _ = subscription_identity(completed_config)
+    stats_publisher = stats.StatsPublisher(mqtt_software_client.publish,
+                                           stats.stats_topic(mqtt_client_id),
+                                           stats_config['interval'],
+                                           stats_config['qos'],
+                                           stats_config['retain'])
+    stats_publisher.start()
+
+    return stats_publisher
+
+
 def start(mqtt_software_client):
     """Starts the app
 
@@ -275,18 +932,72 @@ def start(mqtt_software_client):
         controlled_shutdown(mqtt_software_client)
 
 
-def auto_start():
+def parse_arguments(argv=None):
+    """Parses the command line arguments of 'mr_start'
+
+    Args:
+        argv (list[str], optional): The arguments. Defaults to None, i.e. sys.argv[1:].
+
+    Returns:
+        argparse.Namespace: The parsed arguments
+    """
+    parser = argparse.ArgumentParser(prog='mr_start',
+                                     description='Starts MQTT Remote')
+    parser.add_argument('--workers', type=int, default=0, metavar='N',
+                        help=''.join(['call the callbacks in N worker processes that share this ',
+                                      "process's connection to the broker. 0, the default, ",
+                                      'calls them in this process']))
+    return parser.parse_args(argv)
+
+
+def auto_start(argv=None):
     """Automatically starts the app
 
     This is the entry point for the app
+
+    Args:
+        argv (list[str], optional): The command line arguments. Defaults to None, i.e.
+            sys.argv[1:].
     """
+    arguments = parse_arguments(argv)
     completed_config = config.completed_config_from_file(config.YAML_CONFIG_FILE)
 
-    configure_logging(completed_config)
-    load_all_callbacks()
+    background_logging = configure_logging(completed_config)
+    metrics_server = None
+    stats_publisher = None
 
-    mqtt_software_client = create_configured_mqtt_software_client(completed_config)
-    start(mqtt_software_client)
+    try:
+        if arguments.workers > 0:
+            mqtt_software_client, worker_pool = (
+                create_configured_multiprocess_mqtt_software_client(completed_config,
+                                                                    arguments.workers))
+            metrics_server = start_metrics_server(mqtt_software_client, completed_config)
+            stats_publisher = start_stats_publisher(mqtt_software_client, completed_config)
+            try:
+                start(mqtt_software_client)
+            finally:
+                worker_pool.stop()
+            return
+
+        load_all_callbacks()
+
+        mqtt_software_client, dispatch_engine, tracer = create_configured_mqtt_software_client(
+            completed_config)
+        metrics_server = start_metrics_server(mqtt_software_client, completed_config)
+        stats_publisher = start_stats_publisher(mqtt_software_client, completed_config)
+        try:
+            start(mqtt_software_client)
+        finally:
+            dispatch_engine.stop()
+            if tracer is not None:
+                tracer.close()
+    finally:
+        if stats_publisher is not None:
+            stats_publisher.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
+        if background_logging is not None:
+            background_logging.stop()
 
 
 
@@ -0,0 +1,327 @@
+"""Shared subscription and command routing related functionality
+
+Several MQTT Remote instances can split a single stream of commands between them by
+subscribing to the same topic as members of a shared subscription group,
+'$share/<group>/<topic>'. The broker delivers each message to just one member of the group.
+Each instance is identified by a worker id and also subscribes to a topic of its own so that
+commands can be addressed to, or pinned to, a single instance.
+
+Examples:
+
+    To get the shared subscription topic for a group:
+
+        .. code-block:: python
+
+            topic = shared_topic('spam', 'workers')  # '$share/workers/spam'
+
+
+    To split a shared subscription topic into its group and topic:
+
+        .. code-block:: python
+
+            group, topic = split_shared_topic('$share/workers/spam')  # ('workers', 'spam')
+
+
+    To get the client id and the topic of a worker:
+
+        .. code-block:: python
+
+            client_id = worker_client_id('spam', 'worker_1')  # 'spam-worker_1'
+            topic = worker_topic(client_id)  # 'mqtt_remote/workers/spam-worker_1'
+
+
+    To create a command router that runs 'reset_counter' commands on 'worker_1' only and
+    ignores repeated message ids, as the 'route' middleware stage:
+
+        .. code-block:: python
+
+            command_router = CommandRouter(publish_function, 'spam', 'worker_1',
+                                           pinned_commands={'reset_counter': 'worker_1'})
+            middleware_pipeline.add(middleware.ROUTE_STAGE, command_router.admit)
+
+
+    To do the same without a middleware pipeline, calling a callback with the CommandMessages
+    run by this instance:
+
+        .. code-block:: python
+
+            command_router = CommandRouter(publish_function, 'spam', 'worker_1',
+                                           pinned_commands={'reset_counter': 'worker_1'},
+                                           callback=dispatch_engine.submit)
+            command_router.route(command_message)
+
+
+Attributes:
+    SHARED_TOPIC_PREFIX (str): The prefix of a shared subscription topic
+    WORKER_TOPIC_PREFIX (str): The prefix of the topic each worker subscribes to
+    MESSAGE_ID_KEY (str): The optional payload key holding a CommandMessage's unique id
+"""
+from collections import OrderedDict
+import json
+import logging
+import math
+import os
+import socket
+import threading
+import time
+
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from mqtt_remote import metrics, tracing
+
+
+# pylint: disable=C0103
+logger = logging.getLogger(__name__)
+# pylint: enable=C0103
+
+
+
+SHARED_TOPIC_PREFIX = '$share/'
+WORKER_TOPIC_PREFIX = 'mqtt_remote/workers/'
+MESSAGE_ID_KEY = 'message_id'
+
+
+
+def shared_topic(topic, group):
+    """Returns the shared subscription topic of a group
+
+    Args:
+        topic (str): The topic
+        group (str): The shared subscription group, '' for a normal subscription
+
+    Returns:
+        str: '$share/<group>/<topic>', or 'topic' if 'group' is ''
+    """
+    if not group:
+        return topic
+    return f'{SHARED_TOPIC_PREFIX}{group}/{topic}'
+
+
+def split_shared_topic(topic):
+    """Splits a topic that may be a shared subscription topic into its group and topic
+
+    Args:
+        topic (str): The topic, e.g. '$share/<group>/<topic>' or '<topic>'
+
+    Returns:
+        Tuple[str, str]: The group, '' if 'topic' isn't a shared subscription topic, and the
+            topic
+
+    Raises:
+        ValueError: if a shared subscription topic has no group or no topic
+    """
+    if not topic.startswith(SHARED_TOPIC_PREFIX):
+        return '', topic
+
+    group, _, shared = topic[len(SHARED_TOPIC_PREFIX):].partition('/')
+    if not group or not shared:
+        raise ValueError(''.join([f"Shared subscription topic '{topic}' must be of the form ",
+                                  "'$share/<group>/<topic>'"]))
+    return group, shared
+
+
+def default_worker_id():
+    """Returns a worker id that's unique to this process on this machine
+
+    Returns:
+        str: '<host name>-<process id>'
+    """
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def worker_client_id(mqtt_client_id, worker_id):
+    """Returns the MQTT client id of a worker
+
+    Every member of a shared subscription group needs a client id of its own, otherwise the
+    broker disconnects one whenever another connects
+
+    Args:
+        mqtt_client_id (str): The client id shared by the group's workers
+        worker_id (str): The worker id
+
+    Returns:
+        str: '<mqtt_client_id>-<worker_id>'
+    """
+    return f'{mqtt_client_id}-{worker_id}'
+
+
+def worker_topic(client_id):
+    """Returns the topic that a worker subscribes to in addition to its shared subscription
+
+    Args:
+        client_id (str): The worker's MQTT client id, see 'worker_client_id'
+
+    Returns:
+        str: 'mqtt_remote/workers/<client_id>'
+    """
+    return f'{WORKER_TOPIC_PREFIX}{client_id}'
+
+
+
+class CommandRouter:
+    """Decides whether a CommandMessage is run by this instance, by another instance or not at
+    all, before it's passed to the dispatch engine
+
+    CommandMessages whose payload has a 'message_id' are run at most once per instance: a
+    repeated id, e.g. a QoS 1 redelivery after a reconnect, is dropped along with the reply it
+    would have published. CommandMessages for a pinned command are republished to the worker
+    topic of the worker they're pinned to, unless this is that worker. CommandMessages
+    received on this worker's own topic are always run here, so a forwarded CommandMessage
+    can't be forwarded again. A forwarded CommandMessage keeps its MQTT 5 response topic,
+    correlation data and the rest of its message expiry interval, and its trace context, so the
+    worker it's pinned to replies, expires and is traced as if it had received it first.
+
+    Attributes:
+        mqtt_publish (Callable): A callable object to publish MQTT messages
+        mqtt_client_id (str): The client id shared by the group's workers
+        worker_id (str): This instance's worker id, None if it isn't part of a shared
+            subscription group, which disables pinning
+        pinned_commands (dict): The worker id that each pinned command runs on, keyed by
+            command name
+        dedup_size (int): The number of message ids remembered. 0 disables deduplication.
+        callback (Callable): Called by 'route' with each CommandMessage that's run by this
+            instance, e.g. 'DispatchEngine.submit', when the router is used without a
+            middleware pipeline
+        duplicates (int): The number of CommandMessages dropped as duplicates
+        forwarded (int): The number of CommandMessages forwarded to another worker
+    """
+    def __init__(self, mqtt_publish, mqtt_client_id, worker_id=None, pinned_commands=None,
+                 dedup_size=1024, callback=None):
+        """Constructor
+
+        Args:
+            mqtt_publish (Callable): A callable object to publish MQTT messages
+            mqtt_client_id (str): The client id shared by the group's workers
+            worker_id (str, optional): This instance's worker id. Defaults to None.
+            pinned_commands (dict, optional): The worker id that each pinned command runs on,
+                keyed by command name. Defaults to None.
+            dedup_size (int, optional): The number of message ids remembered. Defaults to
+                1024.
+            callback (Callable, optional): Called with each CommandMessage that's run by this
+                instance. Defaults to None.
+        """
+        self.mqtt_publish = mqtt_publish
+        self.mqtt_client_id = mqtt_client_id
+        self.worker_id = worker_id
+        self.pinned_commands = dict(pinned_commands or {})
+        self.dedup_size = dedup_size
+        self.callback = callback
+        self.duplicates = 0
+        self.forwarded = 0
+
+        self._lock = threading.Lock()
+        self._message_ids = OrderedDict()
+
+        if self.pinned_commands and worker_id is None:
+            logger.warning(''.join(['Pinned commands are ignored unless the subscription is ',
+                                    'shared: set \'subscriptions > this_mqtt_client > ',
+                                    'shared_group\'']))
+
+
+    @property
+    def topic(self):
+        """str: This worker's own topic, None if it isn't part of a shared subscription group
+        """
+        if self.worker_id is None:
+            return None
+        return worker_topic(worker_client_id(self.mqtt_client_id, self.worker_id))
+
+
+    def _duplicate(self, command_message):
+        """Returns whether the CommandMessage's id has already been seen, remembering it if not
+        """
+        message_id = command_message.payload.get(MESSAGE_ID_KEY)
+        if self.dedup_size <= 0 or not isinstance(message_id, (str, int)):
+            return False
+
+        with self._lock:
+            if message_id in self._message_ids:
+                self._message_ids.move_to_end(message_id)
+                self.duplicates += 1
+                metrics.MESSAGES_DROPPED.inc(labels=('duplicate',))
+                return True
+
+            self._message_ids[message_id] = None
+            if len(self._message_ids) > self.dedup_size:
+                self._message_ids.popitem(last=False)
+            return False
+
+
+    def _owner(self, command_message):
+        """Returns the worker id that a CommandMessage must run on, None if it can run here
+        """
+        if self.worker_id is None or command_message.topic == self.topic:
+            return None
+
+        owner = self.pinned_commands.get(command_message.payload['command'])
+        if owner is None or owner == self.worker_id:
+            return None
+        return owner
+
+
+    def _forward(self, command_message, topic):
+        """Republishes a CommandMessage to a worker's topic, with its MQTT 5 reply properties,
+        the rest of its message expiry interval and its trace context
+        """
+        payload = command_message.payload
+        if command_message.trace is not None:
+            payload = dict(payload)
+            payload[tracing.TRACEPARENT_KEY] = command_message.trace.traceparent()
+
+        properties = None
+        if command_message.response_topic or command_message.expires_at is not None:
+            properties = Properties(PacketTypes.PUBLISH)
+            if command_message.response_topic:
+                properties.ResponseTopic = command_message.response_topic
+            if command_message.correlation_data is not None:
+                properties.CorrelationData = command_message.correlation_data
+            if command_message.expires_at is not None:
+                remaining = command_message.expires_at - time.monotonic()
+                properties.MessageExpiryInterval = max(math.ceil(remaining), 1)
+
+        if properties is None:
+            self.mqtt_publish(topic, json.dumps(payload), command_message.qos, False)
+        else:
+            self.mqtt_publish(topic, json.dumps(payload), command_message.qos, False,
+                              properties=properties)
+
+
+    def route(self, command_message):
+        """Runs, with 'callback', forwards or drops a CommandMessage, for use without a
+        middleware pipeline
+
+        Args:
+            command_message (CommandMessage): The CommandMessage to route
+        """
+        if self.admit(command_message) is not None:
+            self.callback(command_message)
+
+
+    def admit(self, command_message):
+        """Forwards or drops a CommandMessage unless it's to be run by this instance
+
+        The 'route' middleware stage
+
+        Args:
+            command_message (CommandMessage): The CommandMessage to route
+
+        Returns:
+            CommandMessage: 'command_message' if it's to be run by this instance, otherwise
+                None
+        """
+        owner = self._owner(command_message)
+        if owner is not None:
+            self._forward(command_message,
+                          worker_topic(worker_client_id(self.mqtt_client_id, owner)))
+            self.forwarded += 1
+            logger.debug("'%s' CommandMessage forwarded to pinned worker '%s'",
+                         command_message.payload['command'], owner)
+            return None
+
+        if self._duplicate(command_message):
+            logger.debug('Duplicate CommandMessage dropped (message_id: %r)',
+                         command_message.payload[MESSAGE_ID_KEY])
+            return None
+
+        return command_message
@@ -0,0 +1,478 @@
+"""Request/response (RPC) client related functionality
+
+Sends standard CommandMessage payloads to an MQTT Remote instance and returns futures that
+are resolved by the instance's correlated replies, see 'mqtt_remote.message.reply'. Any number
+of requests can be in flight at once over one connection: each carries a unique correlation
+id, which the reply returns, so replies can arrive in any order on a single response topic.
+
+Examples:
+
+    To create an RPC client that sends requests over an MQTT client. The RPC client must be
+    created before the MQTT client is started, so that the response topic is subscribed to:
+
+        .. code-block:: python
+
+            mqtt_software_client = MQTTClient(..., [], 'orchestrator', ...)
+            rpc_client = RPCClient(mqtt_software_client, 'MyPC', timeout=5, retries=1)
+            mqtt_software_client.initialise()
+            mqtt_software_client.start('non_blocking')
+
+
+    To send a request and wait for the reply:
+
+        .. code-block:: python
+
+            reversed_string = rpc_client.call('reverse_string', {'string_to_reverse': 'spam'})
+
+
+    To send several requests at once and wait for all of the replies:
+
+        .. code-block:: python
+
+            futures = [rpc_client.request('reverse_string', {'string_to_reverse': string})
+                       for string in strings]
+            reversed_strings = [future.result() for future in futures]
+
+
+    To await a reply from a coroutine:
+
+        .. code-block:: python
+
+            reversed_string = await rpc_client.call_async('reverse_string',
+                                                          {'string_to_reverse': 'spam'})
+
+
+    To spread requests over several connections:
+
+        .. code-block:: python
+
+            rpc_client_pool = RPCClientPool([RPCClient(client, 'MyPC') for client in clients])
+            reversed_string = rpc_client_pool.call('reverse_string', {'string_to_reverse': 'spam'})
+
+
+    To cancel the requests still waiting for a reply and stop an RPC client:
+
+        .. code-block:: python
+
+            rpc_client.close()
+
+
+Attributes:
+    REPLY_TOPIC_PREFIX (str): The prefix of an RPC client's default response topic
+"""
+import asyncio
+from concurrent.futures import Future, InvalidStateError
+import heapq
+import json
+import logging
+import threading
+import time
+import uuid
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from mqtt_remote.message import CORRELATION_DATA_KEY, RESPONSE_TOPIC_KEY
+from mqtt_remote.routing import MESSAGE_ID_KEY
+from mqtt_remote.tracing import TRACEPARENT_KEY, current_traceparent
+
+
+
+# pylint: disable=C0103
+logger = logging.getLogger(__name__)
+# pylint: enable=C0103
+
+
+
+REPLY_TOPIC_PREFIX = 'mqtt_remote/replies/'
+
+
+
+class RPCError(RuntimeError):
+    """Raised by the future of a request that can't be completed
+    """
+
+
+
+class RPCTimeoutError(RPCError, TimeoutError):
+    """Raised by the future of a request that wasn't replied to in time, after any retries
+    """
+
+
+
+class _PendingRequest:
+    """A request waiting for its reply
+    """
+    __slots__ = ('future', 'command', 'topic', 'payload', 'qos', 'properties', 'timeout',
+                 'retries', 'deadline')
+
+    def __init__(self, command, topic, payload, qos, properties, timeout, retries):
+        self.future = Future()
+        self.command = command
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.properties = properties
+        self.timeout = timeout
+        self.retries = retries
+        self.deadline = time.monotonic() + timeout
+
+
+
+class RPCClient:
+    """Sends requests to an MQTT Remote instance and resolves their futures with its replies
+
+    Each request is a standard CommandMessage payload with a unique correlation id, which is
+    also its 'message_id' so that instances which deduplicate commands run a retried request
+    at most once. The response topic and correlation id are always sent in the payload, see
+    'mqtt_remote.message.reply_address', and also as MQTT 5 properties when the MQTT client
+    uses MQTT 5. A request that isn't replied to within its timeout is sent again, with the
+    same correlation id, until its retries are used up, after which its future raises
+    RPCTimeoutError.
+
+    Attributes:
+        mqtt_client (MQTTClient): The MQTT client, or AsyncioMQTTClient, the requests are sent
+            and replies received over
+        request_topic (str): The topic the remote instance subscribes to
+        response_topic (str): The topic replies are sent to
+        qos (int): The Quality Of Service of the requests, which the replies also use
+        timeout (float): The default time, in seconds, to wait for each attempt's reply
+        retries (int): The default number of times a request is sent again if it isn't
+            replied to in time
+        retried (int): The number of times a request has been sent again
+        timed_out (int): The number of requests that weren't replied to in time
+    """
+    def __init__(self, mqtt_client, request_topic, response_topic=None, qos=1, timeout=10.0,
+                 retries=0):
+        """Constructor
+
+        Adds the response topic to the MQTT client's subscriptions, so the RPC client must be
+        created before the MQTT client is started
+
+        Args:
+            mqtt_client (MQTTClient): The MQTT client the requests are sent over
+            request_topic (str): The topic the remote instance subscribes to
+            response_topic (str, optional): The topic replies are sent to. Defaults to None,
+                in which case 'mqtt_remote/replies/<mqtt_client_id>' is used.
+            qos (int, optional): The Quality Of Service of the requests. Defaults to 1.
+            timeout (float, optional): The default time, in seconds, to wait for each
+                attempt's reply. Defaults to 10.0.
+            retries (int, optional): The default number of times a request is sent again if
+                it isn't replied to in time. Defaults to 0.
+        """
+        self.mqtt_client = mqtt_client
+        self.request_topic = request_topic
+        self.response_topic = (response_topic
+                               or f'{REPLY_TOPIC_PREFIX}{mqtt_client.mqtt_client_id}')
+        self.qos = qos
+        self.timeout = timeout
+        self.retries = retries
+        self.retried = 0
+        self.timed_out = 0
+
+        self._mqtt_v5 = getattr(mqtt_client, 'mqtt_protocol', None) == mqtt.MQTTv5
+        self._pending = {}
+        self._deadlines = []
+        self._condition = threading.Condition()
+        self._closed = False
+
+        if self.response_topic not in [topic for topic, _ in mqtt_client.subscription_topics]:
+            mqtt_client.subscription_topics.append((self.response_topic, qos))
+        mqtt_client.on_message_callbacks.add(self.receive)
+
+        self._expiry_thread = threading.Thread(target=self._expire, daemon=True,
+                                               name='mqtt_remote_rpc_expiry')
+        self._expiry_thread.start()
+
+
+    def pending(self):
+        """Returns the number of requests waiting for their reply
+
+        Returns:
+            int: The number of requests in flight
+        """
+        with self._condition:
+            return len(self._pending)
+
+
+    def request(self, command, attributes=None, topic=None, timeout=None, retries=None,
+                traceparent=None):
+        """Sends a request without waiting for its reply
+
+        A request sent whilst a traced CommandMessage is dispatched, e.g. by a callback,
+        carries that CommandMessage's trace context, so the node that handles it continues the
+        trace, see 'tracing'
+
+        Args:
+            command (str): The command name
+            attributes (dict, optional): The command's attributes. Defaults to None.
+            topic (str, optional): The topic to send the request to. Defaults to None, in
+                which case 'self.request_topic' is used.
+            timeout (float, optional): The time, in seconds, to wait for each attempt's reply.
+                Defaults to None, in which case 'self.timeout' is used.
+            retries (int, optional): The number of times the request is sent again if it
+                isn't replied to in time. Defaults to None, in which case 'self.retries' is
+                used.
+            traceparent (str, optional): The W3C trace context sent with the request. Defaults
+                to None, in which case the current trace context, if any, is sent.
+
+        Returns:
+            concurrent.futures.Future: Resolved with the reply's payload, a str, or bytes if
+                it isn't UTF-8. Raises RPCTimeoutError if there's no reply in time.
+
+        Raises:
+            RPCError: if the client has been closed
+        """
+        correlation_id = uuid.uuid4().hex
+        payload = {'command': command,
+                   'attributes': attributes or {},
+                   MESSAGE_ID_KEY: correlation_id,
+                   RESPONSE_TOPIC_KEY: self.response_topic,
+                   CORRELATION_DATA_KEY: correlation_id}
+
+        traceparent = traceparent or current_traceparent()
+        if traceparent is not None:
+            payload[TRACEPARENT_KEY] = traceparent
+
+        properties = None
+        if self._mqtt_v5:
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.ResponseTopic = self.response_topic
+            properties.CorrelationData = correlation_id.encode('ascii')
+            if traceparent is not None:
+                properties.UserProperty = (TRACEPARENT_KEY, traceparent)
+
+        pending = _PendingRequest(command, topic or self.request_topic, json.dumps(payload),
+                                  self.qos, properties,
+                                  self.timeout if timeout is None else timeout,
+                                  self.retries if retries is None else retries)
+
+        with self._condition:
+            if self._closed:
+                raise RPCError('RPCClient is closed')
+            self._pending[correlation_id] = pending
+            heapq.heappush(self._deadlines, (pending.deadline, correlation_id))
+            self._condition.notify()
+
+        self._send(pending)
+        return pending.future
+
+
+    def call(self, command, attributes=None, topic=None, timeout=None, retries=None):
+        """Sends a request and waits for its reply, see 'request'
+
+        Returns:
+            str: The reply's payload, or bytes if it isn't UTF-8
+
+        Raises:
+            RPCTimeoutError: if there's no reply in time
+        """
+        return self.request(command, attributes, topic, timeout, retries).result()
+
+
+    async def call_async(self, command, attributes=None, topic=None, timeout=None,
+                         retries=None):
+        """Sends a request and awaits its reply without blocking the event loop, see 'request'
+
+        Returns:
+            str: The reply's payload, or bytes if it isn't UTF-8
+
+        Raises:
+            RPCTimeoutError: if there's no reply in time
+        """
+        return await asyncio.wrap_future(self.request(command, attributes, topic, timeout,
+                                                      retries))
+
+
+    def _send(self, pending):
+        if pending.properties is None:
+            self.mqtt_client.publish(pending.topic, pending.payload, pending.qos, False)
+        else:
+            self.mqtt_client.publish(pending.topic, pending.payload, pending.qos, False,
+                                     pending.properties)
+
+
+    def _correlated_payload(self, message):
+        """Returns the correlation id and payload of a reply, (None, None) if it isn't one
+        """
+        properties = getattr(message, 'properties', None)
+        correlation_data = getattr(properties, 'CorrelationData', None)
+        if isinstance(correlation_data, bytes):
+            return correlation_data.decode('ascii', 'replace'), message.payload
+
+        try:
+            envelope = json.loads(message.payload)
+        except ValueError:
+            return None, None
+
+        if not isinstance(envelope, dict) or CORRELATION_DATA_KEY not in envelope:
+            return None, None
+        return envelope[CORRELATION_DATA_KEY], envelope.get('payload')
+
+
+    def receive(self, message):
+        """Resolves the future of the request a reply belongs to
+
+        Added to the MQTT client's on message callbacks. Messages on other topics, and replies
+        to requests that have already timed out, are ignored.
+
+        Args:
+            message (paho.mqtt.client.MQTTMessage): The message received
+        """
+        if message.topic != self.response_topic:
+            return
+
+        correlation_id, payload = self._correlated_payload(message)
+        with self._condition:
+            pending = self._pending.pop(correlation_id, None)
+
+        if pending is None:
+            logger.debug(f'Uncorrelated or late reply ignored (correlation id: {correlation_id})')
+            return
+
+        if isinstance(payload, bytes):
+            try:
+                payload = payload.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+
+        self._resolve(pending.future, payload)
+
+
+    def _resolve(self, future, result=None, error=None):
+        """Sets the result, or exception, of a future unless it has been cancelled
+        """
+        try:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        except InvalidStateError:
+            pass
+
+
+    def _expire(self):
+        """Sends again, or times out, the requests whose deadline has passed until the client
+        is closed
+        """
+        while True:
+            with self._condition:
+                if self._closed:
+                    return
+
+                if not self._deadlines:
+                    self._condition.wait()
+                    continue
+
+                deadline, correlation_id = self._deadlines[0]
+                now = time.monotonic()
+                if deadline > now:
+                    self._condition.wait(deadline - now)
+                    continue
+
+                heapq.heappop(self._deadlines)
+                pending = self._pending.get(correlation_id)
+                if pending is None or pending.deadline != deadline:
+                    continue
+
+                if pending.future.cancelled():
+                    del self._pending[correlation_id]
+                    continue
+
+                retry = pending.retries > 0
+                if retry:
+                    pending.retries -= 1
+                    pending.deadline = now + pending.timeout
+                    heapq.heappush(self._deadlines, (pending.deadline, correlation_id))
+                    self.retried += 1
+                else:
+                    del self._pending[correlation_id]
+                    self.timed_out += 1
+
+            if retry:
+                logger.debug(f'Request sent again (correlation id: {correlation_id})')
+                self._send(pending)
+            else:
+                self._resolve(pending.future, error=RPCTimeoutError(''.join([
+                    f"No reply to '{pending.command}' request within {pending.timeout} s ",
+                    f"(correlation id: {correlation_id})"])))
+
+
+    def close(self):
+        """Stops the client and fails the requests still waiting for their reply with RPCError
+        """
+        with self._condition:
+            self._closed = True
+            pending = list(self._pending.values())
+            self._pending.clear()
+            self._deadlines.clear()
+            self._condition.notify()
+
+        self._expiry_thread.join()
+        self.mqtt_client.on_message_callbacks.remove(self.receive)
+
+        for request in pending:
+            self._resolve(request.future, error=RPCError('RPCClient was closed'))
+
+
+
+class RPCClientPool:
+    """Spreads requests over several RPCClients, each with a connection of its own
+
+    Each request goes to the client with the fewest requests in flight
+
+    Attributes:
+        rpc_clients (list[RPCClient]): The clients in the pool
+    """
+    def __init__(self, rpc_clients):
+        """Constructor
+
+        Args:
+            rpc_clients (Iterable[RPCClient]): The clients in the pool
+
+        Raises:
+            ValueError: if the pool has no clients
+        """
+        self.rpc_clients = list(rpc_clients)
+        if not self.rpc_clients:
+            raise ValueError('RPCClientPool needs at least one RPCClient')
+
+
+    def _select(self):
+        return min(self.rpc_clients, key=lambda rpc_client: rpc_client.pending())
+
+
+    def request(self, command, attributes=None, topic=None, timeout=None, retries=None):
+        """Sends a request without waiting for its reply, see 'RPCClient.request'
+
+        Returns:
+            concurrent.futures.Future: Resolved with the reply's payload
+        """
+        return self._select().request(command, attributes, topic, timeout, retries)
+
+
+    def call(self, command, attributes=None, topic=None, timeout=None, retries=None):
+        """Sends a request and waits for its reply, see 'RPCClient.call'
+
+        Returns:
+            str: The reply's payload, or bytes if it isn't UTF-8
+        """
+        return self.request(command, attributes, topic, timeout, retries).result()
+
+
+    async def call_async(self, command, attributes=None, topic=None, timeout=None,
+                         retries=None):
+        """Sends a request and awaits its reply, see 'RPCClient.call_async'
+
+        Returns:
+            str: The reply's payload, or bytes if it isn't UTF-8
+        """
+        return await self._select().call_async(command, attributes, topic, timeout, retries)
+
+
+    def close(self):
+        """Closes every client in the pool
+        """
+        for rpc_client in self.rpc_clients:
+            rpc_client.close()
@@ -0,0 +1,359 @@
+"""Scatter-gather related functionality
+
+Sends one command to many MQTT Remote instances at once and gathers their replies. Each
+instance is told where to reply by the 'return_message' block of its command, so callbacks
+that read 'return_message' themselves work unchanged. Every instance gets a reply topic of
+its own, '<gather topic>/<gather id>/<index>', which identifies the instance that sent each
+reply.
+
+Examples:
+
+    To create a scatter-gather client that sends commands over an MQTT client. It must be
+    created before the MQTT client is started, so that the reply topics are subscribed to:
+
+        .. code-block:: python
+
+            scatter_gather = ScatterGather(mqtt_software_client)
+            mqtt_software_client.initialise()
+            mqtt_software_client.start('non_blocking')
+
+
+    To get the speaker volume of every room PC, waiting up to 5 seconds for the replies:
+
+        .. code-block:: python
+
+            result = scatter_gather.broadcast('get_speaker_volume',
+                                              ['lounge_pc', 'kitchen_pc', 'study_pc'],
+                                              timeout=5)
+            for node_reply in result.replies:
+                print(node_reply.node, node_reply.payload, node_reply.latency)
+
+
+    To stop waiting once any two of the room PCs have replied:
+
+        .. code-block:: python
+
+            result = scatter_gather.broadcast('get_speaker_volume',
+                                              ['lounge_pc', 'kitchen_pc', 'study_pc'],
+                                              quorum=2)
+
+
+    To do the same from the command line:
+
+        .. code-block:: none
+
+            mr_broadcast get_speaker_volume --nodes lounge_pc kitchen_pc study_pc --quorum 2
+
+
+Attributes:
+    GATHER_TOPIC_PREFIX (str): The prefix of a scatter-gather client's default gather topic
+"""
+from collections import namedtuple
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+
+from mqtt_remote import config, mqtt_client
+from mqtt_remote.routing import MESSAGE_ID_KEY
+
+
+
+# pylint: disable=C0103
+logger = logging.getLogger(__name__)
+# pylint: enable=C0103
+
+
+
+GATHER_TOPIC_PREFIX = 'mqtt_remote/gather/'
+
+NodeReply = namedtuple('NodeReply', ['node', 'payload', 'latency'])
+
+GatherResult = namedtuple('GatherResult', ['replies', 'missing', 'complete', 'quorum_reached',
+                                           'elapsed'])
+
+
+
+class _Gather:
+    """The state of a broadcast waiting for its replies
+    """
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.sent = [None] * len(nodes)
+        self.replies = {}
+
+
+
+class ScatterGather:
+    """Sends a command to many MQTT Remote instances and gathers their replies
+
+    Attributes:
+        mqtt_client (MQTTClient): The MQTT client, or AsyncioMQTTClient, the commands are sent
+            and replies received over
+        gather_topic (str): The topic below which the replies are received
+        qos (int): The Quality Of Service of the commands and their replies
+    """
+    def __init__(self, mqtt_client, gather_topic=None, qos=1):
+        """Constructor
+
+        Adds '<gather_topic>/#' to the MQTT client's subscriptions, so the scatter-gather
+        client must be created before the MQTT client is started
+
+        Args:
+            mqtt_client (MQTTClient): The MQTT client the commands are sent over
+            gather_topic (str, optional): The topic below which the replies are received.
+                Defaults to None, in which case 'mqtt_remote/gather/<mqtt_client_id>' is used.
+            qos (int, optional): The Quality Of Service of the commands and their replies.
+                Defaults to 1.
+        """
+        self.mqtt_client = mqtt_client
+        self.gather_topic = (gather_topic
+                             or f'{GATHER_TOPIC_PREFIX}{mqtt_client.mqtt_client_id}')
+        self.qos = qos
+
+        self._gathers = {}
+        self._condition = threading.Condition()
+
+        mqtt_client.subscription_topics.append((f'{self.gather_topic}/#', qos))
+        mqtt_client.on_message_callbacks.add(self.receive)
+
+
+    def broadcast(self, command, nodes, attributes=None, quorum=None, timeout=10.0):
+        """Sends a command to each node and waits for their replies
+
+        Waiting stops when every node has replied, when 'quorum' nodes have replied or after
+        'timeout' seconds, whichever is first. Replies that arrive after that are ignored.
+
+        Args:
+            command (str): The command name
+            nodes (Iterable[str]): The topics that the MQTT Remote instances subscribe to
+            attributes (dict, optional): The command's attributes, to which each node's
+                'return_message' is added. Defaults to None.
+            quorum (int, optional): The number of replies to wait for. Defaults to None, i.e.
+                every node.
+            timeout (float, optional): The maximum time, in seconds, to wait. Defaults to 10.0.
+
+        Returns:
+            GatherResult: 'replies': a NodeReply for each node that replied, in the order they
+                arrived, with the reply's payload, a str, or bytes if it isn't UTF-8, and the
+                node's latency in seconds,
+                'missing': the nodes that didn't reply,
+                'complete': whether every node replied,
+                'quorum_reached': whether at least 'quorum' nodes replied,
+                'elapsed': the time, in seconds, spent waiting
+
+        Raises:
+            ValueError: if there are no nodes or 'quorum' isn't between 1 and the number of
+                nodes
+        """
+        nodes = list(nodes)
+        if not nodes:
+            raise ValueError('ScatterGather.broadcast() needs at least one node')
+
+        target = len(nodes) if quorum is None else quorum
+        if not 1 <= target <= len(nodes):
+            raise ValueError(''.join(["ScatterGather.broadcast() 'quorum' argument must be ",
+                                      f'between 1 and the number of nodes ({len(nodes)})']))
+
+        gather_id = uuid.uuid4().hex
+        gather = _Gather(nodes)
+        with self._condition:
+            self._gathers[gather_id] = gather
+
+        started = time.monotonic()
+        try:
+            for index in range(len(nodes)):
+                self._send(gather, gather_id, index, command, attributes)
+
+            with self._condition:
+                self._condition.wait_for(lambda: len(gather.replies) >= target,
+                                         started + timeout - time.monotonic())
+                replies = sorted(gather.replies.values(), key=lambda reply: reply[0])
+        finally:
+            with self._condition:
+                del self._gathers[gather_id]
+
+        node_replies = [node_reply for _, node_reply in replies]
+        replied = {node_reply.node for node_reply in node_replies}
+        missing = [node for node in nodes if node not in replied]
+        elapsed = time.monotonic() - started
+
+        logger.info(''.join([f"'{command}' broadcast to {len(nodes)} node(s): ",
+                             f'{len(node_replies)} replied in {elapsed:.3f} s']))
+
+        return GatherResult(node_replies, missing, not missing, len(node_replies) >= target,
+                            elapsed)
+
+
+    def _send(self, gather, gather_id, index, command, attributes):
+        """Sends the command to a single node, telling it to reply to its own reply topic
+        """
+        node_attributes = dict(attributes or {})
+        node_attributes['return_message'] = {'topic': f'{self.gather_topic}/{gather_id}/{index}',
+                                             'qos': self.qos,
+                                             'retain': False}
+        payload = {'command': command,
+                   'attributes': node_attributes,
+                   MESSAGE_ID_KEY: f'{gather_id}-{index}'}
+
+        gather.sent[index] = time.monotonic()
+        self.mqtt_client.publish(gather.nodes[index], json.dumps(payload), self.qos, False)
+
+
+    def receive(self, message):
+        """Records a node's reply to a broadcast
+
+        Added to the MQTT client's on message callbacks. Messages on other topics, replies to
+        broadcasts that have finished and any reply after a node's first are ignored.
+
+        Args:
+            message (paho.mqtt.client.MQTTMessage): The message received
+        """
+        prefix = f'{self.gather_topic}/'
+        if not message.topic.startswith(prefix):
+            return
+
+        received = time.monotonic()
+        gather_id, _, index = message.topic[len(prefix):].partition('/')
+
+        payload = message.payload
+        if isinstance(payload, bytes):
+            try:
+                payload = payload.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+
+        with self._condition:
+            gather = self._gathers.get(gather_id)
+            if gather is None or not index.isdigit() or int(index) >= len(gather.nodes):
+                logger.debug(f"Late or unknown broadcast reply ignored: '{message.topic}'")
+                return
+
+            index = int(index)
+            if index in gather.replies or gather.sent[index] is None:
+                return
+
+            gather.replies[index] = (received, NodeReply(gather.nodes[index], payload,
+                                                         received - gather.sent[index]))
+            self._condition.notify_all()
+
+
+    def close(self):
+        """Stops the scatter-gather client receiving replies
+        """
+        self.mqtt_client.on_message_callbacks.remove(self.receive)
+
+
+
+def parse_arguments(argv=None):
+    """Parses the command line arguments of 'mr_broadcast'
+
+    Args:
+        argv (list[str], optional): The arguments. Defaults to None, i.e. sys.argv[1:].
+
+    Returns:
+        argparse.Namespace: The parsed arguments
+    """
+    parser = argparse.ArgumentParser(prog='mr_broadcast',
+                                     description=''.join(['Sends a command to many MQTT Remote ',
+                                                          'instances and prints their replies']))
+    parser.add_argument('command', help='the command name')
+    parser.add_argument('--nodes', nargs='+', required=True, metavar='TOPIC',
+                        help='the topics that the MQTT Remote instances subscribe to')
+    parser.add_argument('--attributes', type=json.loads, default={}, metavar='JSON',
+                        help='the command\'s attributes as a JSON object')
+    parser.add_argument('--quorum', type=int, default=None, metavar='N',
+                        help='stop waiting once N nodes have replied. Defaults to every node')
+    parser.add_argument('--timeout', type=float, default=10.0, metavar='SECONDS',
+                        help='the maximum time to wait for the replies. Defaults to 10')
+    parser.add_argument('--qos', type=int, default=1, choices=[0, 1, 2],
+                        help='the Quality Of Service of the commands. Defaults to 1')
+    return parser.parse_args(argv)
+
+
+def create_broadcast_mqtt_client(completed_config):
+    """Creates an MQTT client that connects to the configured broker to broadcast commands
+
+    Args:
+        completed_config (dict): Completed MQTT Remote configuration
+
+    Returns:
+        mqtt_client.MQTTClient: The MQTT client, not yet initialised
+    """
+    broker_config = completed_config['mqtt_broker']
+    session_config = completed_config['mqtt_session']
+
+    return mqtt_client.MQTTClient(broker_config['user_name'],
+                                  broker_config['password'],
+                                  broker_config['ip'],
+                                  broker_config['port'],
+                                  broker_config['keepalive'],
+                                  [],
+                                  f'mr_broadcast-{os.getpid()}',
+                                  True,
+                                  session_config['pyprotocol'],
+                                  session_config['transport'],
+                                  False)
+
+
+def result_as_dict(result):
+    """Returns a GatherResult in a form that can be converted to JSON
+
+    Args:
+        result (GatherResult): The result of a broadcast
+
+    Returns:
+        dict: The result with its replies keyed by node
+    """
+    replies = {}
+    for node_reply in result.replies:
+        payload = node_reply.payload
+        if isinstance(payload, bytes):
+            payload = payload.hex()
+        replies[node_reply.node] = {'payload': payload, 'latency': node_reply.latency}
+
+    return {'replies': replies,
+            'missing': result.missing,
+            'complete': result.complete,
+            'quorum_reached': result.quorum_reached,
+            'elapsed': result.elapsed}
+
+
+def auto_broadcast(argv=None):
+    """Broadcasts a command from the command line and prints the result as JSON
+
+    This is the entry point for 'mr_broadcast'. The broker is taken from the config file.
+
+    Args:
+        argv (list[str], optional): The command line arguments. Defaults to None, i.e.
+            sys.argv[1:].
+
+    Returns:
+        int: 0 if the quorum was reached, otherwise 1
+    """
+    arguments = parse_arguments(argv)
+    completed_config = config.completed_config_from_file(config.YAML_CONFIG_FILE)
+
+    mqtt_software_client = create_broadcast_mqtt_client(completed_config)
+    scatter_gather = ScatterGather(mqtt_software_client, qos=arguments.qos)
+    mqtt_software_client.initialise()
+    mqtt_software_client.start('non_blocking')
+
+    try:
+        deadline = time.monotonic() + arguments.timeout
+        while not mqtt_software_client.subscribed and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        result = scatter_gather.broadcast(arguments.command, arguments.nodes,
+                                          arguments.attributes, arguments.quorum,
+                                          max(deadline - time.monotonic(), 0))
+    finally:
+        mqtt_software_client.stop()
+
+    json.dump(result_as_dict(result), sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0 if result.quorum_reached else 1
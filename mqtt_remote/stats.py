@@ -0,0 +1,307 @@
+"""Self-telemetry related functionality
+
+A stats publisher periodically publishes a compact JSON snapshot of MQTT Remote's metrics to
+'<client id>/$stats', so that the load on every instance can be seen from the broker alone,
+e.g. for instances behind NAT that can't be scraped.
+
+Each snapshot only covers the time since the previous one: rates and latency percentiles are
+worked out from the difference between the metrics' running totals now and at the previous
+snapshot, so publishing costs the same however long MQTT Remote has been running.
+
+Examples:
+
+    To publish a snapshot every 60 seconds, retained so that new subscribers get the latest:
+
+        .. code-block:: python
+
+            stats_publisher = StatsPublisher(mqtt_software_client.publish,
+                                             stats_topic('spam'), interval=60, retain=True)
+            stats_publisher.start()
+
+
+    To get a snapshot without publishing it:
+
+        .. code-block:: python
+
+            snapshot = stats_publisher.snapshot()
+
+
+Attributes:
+    STATS_TOPIC_SUFFIX (str): Appended to the MQTT client id to make the stats topic
+"""
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+
+from mqtt_remote import metrics
+
+
+
+# pylint: disable=C0103
+logger = logging.getLogger(__name__)
+# pylint: enable=C0103
+
+
+
+STATS_TOPIC_SUFFIX = '/$stats'
+
+_METRIC_PREFIX = 'mqtt_remote_'
+
+
+
+def stats_topic(mqtt_client_id):
+    """Returns the topic an instance's stats are published to
+
+    Args:
+        mqtt_client_id (str): The instance's MQTT client id
+
+    Returns:
+        str: '<mqtt_client_id>/$stats'
+    """
+    return f'{mqtt_client_id}{STATS_TOPIC_SUFFIX}'
+
+
+def resident_memory():
+    """Returns the resident set size of this process
+
+    Returns:
+        int: The resident set size, in bytes, or on platforms without '/proc' the peak resident
+            set size. None if neither is available, e.g. on Windows.
+    """
+    try:
+        with open('/proc/self/statm', 'rb') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+
+    try:
+        import resource # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _merged_counts(histogram):
+    """Returns the bucket counts of a metrics.Histogram, summed across its label values
+
+    Returns:
+        Tuple[list[int], float]: The count in each bucket, not cumulative, the last being the
+            count above the last bound, and the largest value recorded
+    """
+    counts = [0] * (len(histogram.buckets) + 1)
+    largest = 0.0
+
+    for latency_histogram in histogram.histograms().values():
+        snapshot = latency_histogram.snapshot()
+        previous = 0
+        for index, (_, cumulative) in enumerate(snapshot['buckets']):
+            counts[index] += cumulative - previous
+            previous = cumulative
+        largest = max(largest, snapshot['max'])
+
+    return counts, largest
+
+
+def _percentile(buckets, counts, largest, percent):
+    """Estimates a percentile from bucket counts, as LatencyHistogram.percentile does
+
+    Returns:
+        float: The upper bound of the bucket the percentile falls in, capped at 'largest'. 0.0
+            if the counts are all 0.
+    """
+    total = sum(counts)
+    if not total:
+        return 0.0
+
+    rank = max(1, math.ceil(total * percent / 100))
+    seen = 0
+    for index, count in enumerate(counts):
+        seen += count
+        if seen >= rank:
+            break
+
+    if index == len(buckets):
+        return largest
+    return min(buckets[index], largest)
+
+
+
+class StatsPublisher:
+    """Periodically publishes a snapshot of the metrics, on a background thread
+
+    A snapshot is a JSON object:
+
+    - 'time': the 'time.time()' time it was taken
+    - 'interval': the time, in seconds, since the previous snapshot
+    - 'rates': the messages received, the messages published, the CommandMessages dispatched,
+      the messages dropped and the callback errors, per second, over the interval
+    - 'latency': the median and 99th percentile, over the interval, of the time callbacks took
+      ('command_p50', 'command_p99'), of the time between publishing and sending
+      ('publish_p50', 'publish_p99') and of the time CommandMessages waited for a dispatch
+      worker ('dispatch_wait_p99')
+    - 'queues': the value of each gauge, e.g. 'outbound_queue_depth'
+    - 'errors': the callback errors ('callback'), messages that weren't CommandMessages
+      ('convert') and failed connection attempts ('connection') since starting
+    - 'rss': the resident set size of the process, in bytes
+
+    Attributes:
+        publish (Callable): Publishes a message, called as publish(topic, payload, qos, retain)
+        topic (str): The topic the snapshots are published to
+        interval (float): The time, in seconds, between snapshots
+        qos (int): The QoS the snapshots are published with
+        retain (bool): Whether the snapshots are retained by the broker
+        registry (MetricsRegistry): The registry the snapshots are taken from
+    """
+    def __init__(self, publish, topic, interval=60.0, qos=0, retain=False,
+                 registry=metrics.REGISTRY):
+        """Constructor
+
+        Args:
+            publish (Callable): Publishes a message
+            topic (str): The topic the snapshots are published to
+            interval (float, optional): The time, in seconds, between snapshots. Defaults to
+                60.0.
+            qos (int, optional): The QoS the snapshots are published with. Defaults to 0.
+            retain (bool, optional): Whether the snapshots are retained by the broker. Defaults
+                to False.
+            registry (MetricsRegistry, optional): The registry the snapshots are taken from.
+                Defaults to metrics.REGISTRY.
+        """
+        self.publish = publish
+        self.topic = topic
+        self.interval = interval
+        self.qos = qos
+        self.retain = retain
+        self.registry = registry
+
+        self._previous_time = time.monotonic()
+        self._previous_totals = {}
+        self._previous_counts = {}
+        self._stop_event = threading.Event()
+        self._thread = None
+
+
+    def start(self):
+        """Starts publishing a snapshot every 'interval' seconds
+        """
+        if self._thread is not None:
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='mqtt_remote_stats')
+        self._thread.start()
+
+        logger.info(f"Stats are being published to '{self.topic}' every {self.interval} s")
+
+
+    def stop(self):
+        """Stops publishing snapshots
+        """
+        if self._thread is None:
+            return
+
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.publish_snapshot()
+
+
+    def publish_snapshot(self):
+        """Takes a snapshot and publishes it. Errors are logged, not raised.
+        """
+        try:
+            payload = json.dumps(self.snapshot(), separators=(',', ':'))
+            self.publish(self.topic, payload, self.qos, self.retain)
+        except Exception as error: # pylint: disable=broad-except
+            logger.warning(f"Stats could not be published to '{self.topic}': {error}")
+
+
+    def _total(self, name, labels_filter=None):
+        """Returns the running total of a counter, summed across the label values accepted by
+        'labels_filter'. 0 if there's no such counter.
+        """
+        counter = self.registry.get(name)
+        if counter is None:
+            return 0
+        return sum(value for labels, value in counter.values().items()
+                   if labels_filter is None or labels_filter(labels))
+
+
+    def _interval_counts(self, name):
+        """Returns the bucket counts of a histogram recorded since the previous snapshot, the
+        largest value recorded and the bucket bounds. None if there's no such histogram.
+        """
+        histogram = self.registry.get(name)
+        if histogram is None:
+            return None
+
+        counts, largest = _merged_counts(histogram)
+        previous = self._previous_counts.get(name, [0] * len(counts))
+        self._previous_counts[name] = counts
+        interval_counts = [count - before for count, before in zip(counts, previous)]
+        return interval_counts, largest, histogram.buckets
+
+
+    def snapshot(self):
+        """Returns a snapshot of the metrics since the previous snapshot
+
+        Returns:
+            dict: The snapshot, see 'StatsPublisher'
+        """
+        now = time.monotonic()
+        elapsed = max(now - self._previous_time, 1e-9)
+        self._previous_time = now
+
+        callback_errors = self._total('mqtt_remote_commands_dispatched_total',
+                                      lambda labels: labels[-1] == 'error')
+        totals = {'received': self._total('mqtt_remote_messages_received_total'),
+                  'published': self._total('mqtt_remote_messages_published_total'),
+                  'dispatched': self._total('mqtt_remote_commands_dispatched_total'),
+                  'dropped': self._total('mqtt_remote_messages_dropped_total'),
+                  'errors': callback_errors}
+        rates = {name: (total - self._previous_totals.get(name, 0)) / elapsed
+                 for name, total in totals.items()}
+        self._previous_totals = totals
+
+        latency = {}
+        for key, name, percents in [
+                ('command', 'mqtt_remote_command_duration_seconds', (50, 99)),
+                ('publish', 'mqtt_remote_publish_latency_seconds', (50, 99)),
+                ('dispatch_wait', 'mqtt_remote_dispatch_queue_wait_seconds', (99,))]:
+            interval_counts = self._interval_counts(name)
+            if interval_counts is None:
+                continue
+            counts, largest, buckets = interval_counts
+            for percent in percents:
+                latency[f'{key}_p{percent}'] = _percentile(buckets, counts, largest, percent)
+
+        queues = {}
+        for metric in self.registry.metrics():
+            if isinstance(metric, metrics.Gauge) and not metric.labelnames:
+                try:
+                    queues[metric.name[len(_METRIC_PREFIX):]
+                           if metric.name.startswith(_METRIC_PREFIX)
+                           else metric.name] = metric.function()
+                except Exception as error: # pylint: disable=broad-except
+                    logger.debug("Gauge '%s' could not be read: %s", metric.name, error)
+
+        return {'time': time.time(),
+                'interval': elapsed,
+                'rates': rates,
+                'latency': latency,
+                'queues': queues,
+                'errors': {'callback': callback_errors,
+                           'convert': self._total('mqtt_remote_convert_failures_total'),
+                           'connection': self._total('mqtt_remote_connection_failures_total')},
+                'rss': resident_memory()}
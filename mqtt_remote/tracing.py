@@ -0,0 +1,569 @@
+"""Message tracing related functionality
+
+A trace follows a sampled message through MQTT Remote, timestamping each stage of its life:
+
+- 'receipt': paho reads the message from the socket
+- 'on_message': the message enters the middleware pipeline
+- 'convert': the message has been converted to a CommandMessage
+- 'queued' and 'dequeued': the CommandMessage waits for a dispatch worker
+- 'validate': the CommandMessage has been validated against its callback's PayloadSchema
+- 'publish': the callback publishes a message, once per message
+- 'executed': the callback has returned
+
+Each message the callback publishes gets a span of its own, a child of the message's span,
+that ends when paho confirms the message as sent, i.e. the PUBACK of a QoS 1 message.
+
+The trace context is carried between nodes in W3C 'traceparent' format, as the 'traceparent'
+MQTT 5 user property of a message or, for MQTT 3.1.1, a "traceparent" string at the top level
+of its payload. A message that arrives with a trace context continues that trace, and takes
+its sampling decision, so a request and its reply can be stitched together across nodes.
+Other messages are sampled at 'sample_rate' when they're received, and the messages that
+aren't sampled cost a clock read and a property lookup.
+
+Spans are exported as JSON lines, either to a file or published to a topic that a collector
+subscribes to.
+
+Examples:
+
+    To trace 1 message in 100 and write the spans to a file:
+
+        .. code-block:: python
+
+            tracer = Tracer(FileTraceExporter('traces.jsonl'), sample_rate=0.01)
+            message_forwarder.tracer = tracer
+            callback_caller.mqtt_publish = tracer.wrap_publish(mqtt_software_client.publish)
+
+
+    To publish the spans to a collector instead:
+
+        .. code-block:: python
+
+            tracer = Tracer(MQTTTraceExporter(mqtt_software_client.publish, 'traces'), 0.01)
+
+
+    To get the trace context of the message being dispatched on this thread, e.g. to send it
+    on with a request:
+
+        .. code-block:: python
+
+            traceparent = current_traceparent()
+
+
+Attributes:
+    TRACEPARENT_KEY (str): The name of the user property, and the payload key, that carries
+        the trace context
+"""
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+
+
+# pylint: disable=C0103
+logger = logging.getLogger(__name__)
+# pylint: enable=C0103
+
+
+
+TRACEPARENT_KEY = 'traceparent'
+
+_CURRENT_TRACE = contextvars.ContextVar('mqtt_remote_trace', default=None)
+
+
+
+def new_trace_id():
+    """Returns a new, random, trace id
+
+    Returns:
+        str: 32 lowercase hex digits
+    """
+    return os.urandom(16).hex()
+
+
+def new_span_id():
+    """Returns a new, random, span id
+
+    Returns:
+        str: 16 lowercase hex digits
+    """
+    return os.urandom(8).hex()
+
+
+def format_traceparent(trace_id, span_id, sampled=True):
+    """Returns a trace context in W3C 'traceparent' format
+
+    Args:
+        trace_id (str): The trace id
+        span_id (str): The id of the parent span
+        sampled (bool, optional): Whether the trace is sampled. Defaults to True.
+
+    Returns:
+        str: '00-<trace id>-<span id>-<01 if sampled, else 00>'
+    """
+    return f"00-{trace_id}-{span_id}-{'01' if sampled else '00'}"
+
+
+def parse_traceparent(traceparent):
+    """Parses a trace context in W3C 'traceparent' format
+
+    Args:
+        traceparent (str): The trace context
+
+    Returns:
+        Tuple[str, str, bool]: The trace id, the parent span id and whether the trace is
+            sampled, or None if 'traceparent' isn't a valid trace context
+    """
+    if not isinstance(traceparent, str):
+        return None
+
+    parts = traceparent.strip().lower().split('-')
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or len(parts[3]) != 2:
+        return None
+
+    try:
+        flags = int(parts[3], 16)
+        if not int(parts[1], 16) or not int(parts[2], 16):
+            return None
+    except ValueError:
+        return None
+
+    return parts[1], parts[2], bool(flags & 1)
+
+
+def received_traceparent(raw_message, command_message):
+    """Returns the trace context a message was received with
+
+    Args:
+        raw_message (paho.mqtt.client.MQTTMessage): The raw message
+        command_message (CommandMessage): The CommandMessage converted from it
+
+    Returns:
+        str: The 'traceparent' user property of the raw message, or the "traceparent" string
+            in the payload of the CommandMessage, None if it has neither
+    """
+    properties = getattr(raw_message, 'properties', None)
+    for name, value in getattr(properties, 'UserProperty', None) or ():
+        if name == TRACEPARENT_KEY:
+            return value
+    return command_message.payload.get(TRACEPARENT_KEY)
+
+
+def current_trace():
+    """Returns the trace of the CommandMessage being dispatched in the current context
+
+    Returns:
+        Trace: The trace, None if the CommandMessage isn't traced
+    """
+    return _CURRENT_TRACE.get()
+
+
+def current_traceparent():
+    """Returns the trace context of the CommandMessage being dispatched in the current context,
+    to send on with the messages it causes
+
+    Returns:
+        str: The trace context in W3C 'traceparent' format, None if the CommandMessage isn't
+            traced
+    """
+    trace = _CURRENT_TRACE.get()
+    return None if trace is None else trace.traceparent()
+
+
+def activate(trace):
+    """Makes a trace the current trace of this context, see 'current_trace'
+
+    Args:
+        trace (Trace): The trace
+
+    Returns:
+        contextvars.Token: Passed to 'deactivate' to restore the previous trace
+    """
+    return _CURRENT_TRACE.set(trace)
+
+
+def deactivate(token):
+    """Restores the trace that was current before 'activate' was called
+
+    Args:
+        token (contextvars.Token): Returned by 'activate'
+    """
+    _CURRENT_TRACE.reset(token)
+
+
+
+class FileTraceExporter:
+    """Appends spans to a file, one JSON object per line
+
+    Spans are buffered in memory and written at most 'flush_interval' seconds after they're
+    exported, by a background thread started when the file is opened, so the last spans before
+    an idle period don't wait for the next one. Errors writing the file are logged, never raised.
+
+    Attributes:
+        path (str): The path of the file
+        flush_interval (float): The maximum time, in seconds, that a span waits in memory
+    """
+    def __init__(self, path, flush_interval=1.0):
+        """Constructor
+
+        Args:
+            path (str): The path of the file
+            flush_interval (float, optional): The maximum time, in seconds, that a span waits
+                in memory. Defaults to 1.0.
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._file = None
+        self._flushed = 0.0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+
+    def _start_flushing(self):
+        """Starts writing the spans in memory every 'flush_interval' seconds. The caller must
+        hold 'self._lock'
+        """
+        if self.flush_interval > 0 and self._thread is None:
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name='mqtt_remote_tracing')
+            self._thread.start()
+
+
+    def _run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+
+    def flush(self):
+        """Writes the spans still in memory to the file
+        """
+        with self._lock:
+            if self._file is not None:
+                self._flush(time.monotonic())
+
+
+    def _flush(self, now):
+        """Writes the spans in memory to the file. The caller must hold 'self._lock'
+        """
+        self._flushed = now
+        try:
+            self._file.flush()
+        except OSError as error:
+            logger.warning(f"Trace file '{self.path}' could not be written: {error}")
+
+
+    def export(self, span):
+        """Appends a span to the file, opening the file if required
+
+        Args:
+            span (dict): The span
+        """
+        line = json.dumps(span, separators=(',', ':'), default=str) + '\n'
+
+        with self._lock:
+            try:
+                if self._file is None:
+                    self._file = open(self.path, 'a', encoding='utf-8')
+                    self._flushed = time.monotonic()
+                    self._start_flushing()
+                self._file.write(line)
+            except OSError as error:
+                logger.warning(f"Trace file '{self.path}' could not be written: {error}")
+                return
+
+            now = time.monotonic()
+            if now - self._flushed >= self.flush_interval:
+                self._flush(now)
+
+
+    def close(self):
+        """Stops the background writes, writes the spans still in memory and closes the file
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop_event.set()
+            thread.join()
+
+        with self._lock:
+            if self._file is None:
+                return
+            try:
+                self._file.close()
+            except OSError as error:
+                logger.warning(f"Trace file '{self.path}' could not be closed: {error}")
+            self._file = None
+
+
+
+class MQTTTraceExporter:
+    """Publishes spans, as JSON, to a topic that a collector subscribes to
+
+    Attributes:
+        publish (Callable): Publishes a message, called as publish(topic, payload, qos, retain)
+        topic (str): The topic the spans are published to
+        qos (int): The QoS the spans are published with
+    """
+    def __init__(self, publish, topic, qos=0):
+        """Constructor
+
+        Args:
+            publish (Callable): Publishes a message
+            topic (str): The topic the spans are published to
+            qos (int, optional): The QoS the spans are published with. Defaults to 0.
+        """
+        self.publish = publish
+        self.topic = topic
+        self.qos = qos
+
+
+    def export(self, span):
+        """Publishes a span
+
+        Args:
+            span (dict): The span
+        """
+        self.publish(self.topic, json.dumps(span, separators=(',', ':'), default=str), self.qos,
+                     False)
+
+
+    def close(self):
+        """Does nothing, the spans are already published
+        """
+
+
+
+class Trace:
+    """The span of a single message, timestamping each stage of its life
+
+    Attributes:
+        trace_id (str): The id of the trace the span is part of
+        span_id (str): The span's id
+        parent_id (str): The id of the span that caused the message, on this or another node,
+            or None if the message started the trace
+        topic (str): The topic the message was received on
+        command (str): The message's command
+        stages (list[Tuple[str, float]]): [(<stage>, <time.monotonic() time>), ...], in the
+            order they were reached
+    """
+    def __init__(self, tracer, trace_id, parent_id, topic, command):
+        """Constructor
+
+        Args:
+            tracer (Tracer): Exports the span when it's finished
+            trace_id (str): The id of the trace
+            parent_id (str): The id of the parent span, or None
+            topic (str): The topic the message was received on
+            command (str): The message's command
+        """
+        self.trace_id = trace_id
+        self.span_id = new_span_id()
+        self.parent_id = parent_id
+        self.topic = topic
+        self.command = command
+        self.stages = []
+
+        self._tracer = tracer
+        self._wall_offset = time.time() - time.monotonic()
+        self._finished = False
+
+
+    def __getstate__(self):
+        # Sent to worker processes without the tracer, which can't be pickled, so spans are
+        # only exported by the process that received the message
+        state = self.__dict__.copy()
+        state['_tracer'] = None
+        return state
+
+
+    def mark(self, stage, at=None):
+        """Timestamps a stage
+
+        Args:
+            stage (str): The stage's name
+            at (float, optional): The 'time.monotonic()' time the stage was reached. Defaults
+                to None, i.e. now.
+        """
+        self.stages.append((stage, time.monotonic() if at is None else at))
+
+
+    def traceparent(self, span_id=None):
+        """Returns the trace context to send with a message caused by this one
+
+        Args:
+            span_id (str, optional): The id of the span of the message sent. Defaults to None,
+                i.e. this span's id.
+
+        Returns:
+            str: The trace context in W3C 'traceparent' format
+        """
+        return format_traceparent(self.trace_id, span_id or self.span_id)
+
+
+    def finish(self, outcome):
+        """Timestamps the 'executed' stage and exports the span. Only the first call has any
+        effect.
+
+        Args:
+            outcome (str): The outcome of dispatching the message, see 'audit'
+        """
+        if self._finished:
+            return
+        self._finished = True
+        self.mark('executed')
+
+        if self._tracer is None:
+            return
+
+        start = self.stages[0][1]
+        self._tracer.export({'trace_id': self.trace_id,
+                             'span_id': self.span_id,
+                             'parent_id': self.parent_id,
+                             'name': 'message',
+                             'topic': self.topic,
+                             'command': self.command,
+                             'start': start + self._wall_offset,
+                             'duration': self.stages[-1][1] - start,
+                             'outcome': outcome,
+                             'stages': [[stage, at - start] for stage, at in self.stages]})
+
+
+
+class Tracer:
+    """Decides which messages are traced, propagates their trace context and exports their
+    spans
+
+    Attributes:
+        exporter (FileTraceExporter, MQTTTraceExporter): Exports the spans
+        sample_rate (float): The fraction of the messages received without a trace context
+            that are traced, 0 to 1
+        mqtt_v5 (bool): Whether the trace context is sent as an MQTT 5 user property of the
+            messages published
+    """
+    def __init__(self, exporter, sample_rate=0.0, mqtt_v5=False):
+        """Constructor
+
+        Args:
+            exporter (FileTraceExporter, MQTTTraceExporter): Exports the spans
+            sample_rate (float, optional): The fraction of the messages received without a
+                trace context that are traced. Defaults to 0.0.
+            mqtt_v5 (bool, optional): Whether the trace context is sent as an MQTT 5 user
+                property. Defaults to False.
+        """
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.mqtt_v5 = mqtt_v5
+
+
+    def begin(self, raw_message, command_message, received):
+        """Starts the trace of a message, if it's sampled
+
+        Args:
+            raw_message (paho.mqtt.client.MQTTMessage): The raw message
+            command_message (CommandMessage): The CommandMessage converted from it
+            received (float): The 'time.monotonic()' time the message entered the middleware
+                pipeline
+
+        Returns:
+            Trace: The trace, None if the message isn't sampled
+        """
+        context = parse_traceparent(received_traceparent(raw_message, command_message))
+        if context is None:
+            if not self.sample_rate or random.random() >= self.sample_rate:
+                return None
+            trace_id, parent_id = new_trace_id(), None
+        else:
+            trace_id, parent_id, sampled = context
+            if not sampled:
+                return None
+
+        trace = Trace(self, trace_id, parent_id, command_message.topic,
+                      command_message.payload['command'])
+        timestamp = getattr(raw_message, 'timestamp', None)
+        trace.mark('receipt', timestamp if isinstance(timestamp, float) else received)
+        trace.mark('on_message', received)
+        trace.mark('convert')
+        return trace
+
+
+    def export(self, span):
+        """Exports a span. Errors are logged, not raised.
+
+        Args:
+            span (dict): The span
+        """
+        try:
+            self.exporter.export(span)
+        except Exception as error: # pylint: disable=broad-except
+            logger.warning(f'Span could not be exported: {error}')
+
+
+    def close(self):
+        """Closes the exporter
+        """
+        self.exporter.close()
+
+
+    def wrap_publish(self, publish):
+        """Wraps a publish function so that the messages published whilst a traced
+        CommandMessage is dispatched are timestamped, carry the trace context and get a span
+        that ends when they're confirmed as sent
+
+        Args:
+            publish (Callable): The publish function, e.g. 'MQTTClient.publish'
+
+        Returns:
+            Callable: The wrapped publish function
+        """
+        def traced_publish(topic, message, qos, retain, properties=None):
+            trace = _CURRENT_TRACE.get()
+            if trace is None:
+                if properties is None:
+                    return publish(topic, message, qos, retain)
+                return publish(topic, message, qos, retain, properties=properties)
+
+            span_id = new_span_id()
+            trace.mark('publish')
+            if self.mqtt_v5:
+                if properties is None:
+                    properties = Properties(PacketTypes.PUBLISH)
+                properties.UserProperty = (TRACEPARENT_KEY, trace.traceparent(span_id))
+
+            started = time.time()
+            if properties is None:
+                handle = publish(topic, message, qos, retain)
+            else:
+                handle = publish(topic, message, qos, retain, properties=properties)
+
+            future = getattr(handle, 'future', None)
+            if future is not None:
+                future.add_done_callback(lambda future: self._published(trace, span_id, topic,
+                                                                        qos, started, future))
+            return handle
+
+        return traced_publish
+
+
+    def _published(self, trace, span_id, topic, qos, started, future):
+        """Exports the span of a message published whilst a traced CommandMessage was
+        dispatched, once it's confirmed as sent or has failed
+        """
+        error = future.exception()
+        self.export({'trace_id': trace.trace_id,
+                     'span_id': span_id,
+                     'parent_id': trace.span_id,
+                     'name': 'publish',
+                     'topic': topic,
+                     'qos': qos,
+                     'start': started,
+                     'duration': time.time() - started if error else future.result(),
+                     'outcome': 'error' if error else 'ok'})
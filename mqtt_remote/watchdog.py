@@ -0,0 +1,299 @@
+"""Slow callback related functionality
+
+A slow callback detector watches the callbacks being executed by the dispatch engine from a
+background thread. When a callback has been executing for longer than the threshold the stack
+of the thread executing it is captured, so that it shows where the callback is stuck, and is
+logged, along with the command and a summary of its attributes, and optionally published.
+
+Capturing a stack means briefly taking a snapshot of every thread's current frame, so the
+number captured is limited to 'max_per_minute'. Slow callbacks beyond the limit are still
+counted and logged, without their stack.
+
+Examples:
+
+    To log the stack of any callback that takes longer than 5 seconds:
+
+        .. code-block:: python
+
+            slow_callback_detector = SlowCallbackDetector(5.0)
+            slow_callback_detector.start()
+
+
+    To also publish the stacks to a topic:
+
+        .. code-block:: python
+
+            slow_callback_detector = SlowCallbackDetector(5.0, publish_function,
+                                                          'mqtt_remote/slow_callbacks')
+
+
+    To watch the callback for a CommandMessage:
+
+        .. code-block:: python
+
+            execution = slow_callback_detector.started(command_message)
+            try:
+                callback_caller.callback_caller(command_message)
+            finally:
+                slow_callback_detector.finished(execution)
+"""
+import json
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from mqtt_remote import message, metrics
+
+
+
+# pylint: disable=C0103
+logger = logging.getLogger(__name__)
+# pylint: enable=C0103
+
+
+
+class _Execution:
+    """A callback being executed, as recorded by SlowCallbackDetector.started
+    """
+    __slots__ = ('thread_ident', 'thread_name', 'command_message', 'batch_size', 'started',
+                 'reported')
+
+    def __init__(self, command_message, batch_size, started):
+        thread = threading.current_thread()
+        self.thread_ident = thread.ident
+        self.thread_name = thread.name
+        self.command_message = command_message
+        self.batch_size = batch_size
+        self.started = started
+        self.reported = False
+
+
+
+class SlowCallbackDetector:
+    """Reports callbacks that execute for longer than a threshold, with the stack of the
+    thread executing them
+
+    Each slow callback is reported once, whilst it's still executing, as a warning and, if
+    'topic' is set, as a JSON message published to 'topic' with the command, the topic of the
+    CommandMessage, the time it's been executing, the thread, a summary of the attributes and
+    the stack. It's also counted in 'metrics.SLOW_CALLBACKS'.
+
+    Attributes:
+        threshold (float): The time, in seconds, after which an executing callback is reported
+        mqtt_publish (Callable): A callable object to publish MQTT messages
+        topic (str): The topic reports are published to. An empty string disables publishing.
+        qos (int): The Quality Of Service of published reports
+        max_per_minute (int): The maximum number of stacks captured per minute. 0 means no
+            limit.
+        attributes_excerpt (int): The maximum number of characters of the JSON encoded
+            attributes included in a report
+        counts (dict): The number of 'slow' callbacks and of stacks not captured, i.e.
+            'suppressed', because of 'max_per_minute'
+    """
+    def __init__(self, threshold=5.0, mqtt_publish=None, topic='', qos=0, max_per_minute=6,
+                 attributes_excerpt=256, clock=time.monotonic):
+        """Constructor
+
+        Args:
+            threshold (float, optional): The time, in seconds, after which an executing
+                callback is reported. Defaults to 5.0.
+            mqtt_publish (Callable, optional): A callable object to publish MQTT messages.
+                Defaults to None.
+            topic (str, optional): The topic reports are published to. Defaults to ''.
+            qos (int, optional): The Quality Of Service of published reports. Defaults to 0.
+            max_per_minute (int, optional): The maximum number of stacks captured per minute.
+                Defaults to 6.
+            attributes_excerpt (int, optional): The maximum number of characters of the
+                attributes included in a report. Defaults to 256.
+            clock (Callable, optional): Returns the current time in seconds. Defaults to
+                time.monotonic.
+        """
+        self.threshold = threshold
+        self.mqtt_publish = mqtt_publish
+        self.topic = topic
+        self.qos = qos
+        self.max_per_minute = max_per_minute
+        self.attributes_excerpt = attributes_excerpt
+        self.counts = {'slow': 0, 'suppressed': 0}
+
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._executions = set()
+        self._window_start = None
+        self._window_captured = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+
+    def start(self):
+        """Starts checking the executing callbacks, several times per 'threshold'
+        """
+        if self._thread is not None:
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='mqtt_remote_watchdog')
+        self._thread.start()
+
+        logger.info(f"Callbacks executing for longer than {self.threshold} s will be reported")
+
+
+    def stop(self):
+        """Stops checking the executing callbacks
+        """
+        if self._thread is None:
+            return
+
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+
+    def _run(self):
+        interval = min(max(self.threshold / 4, 0.01), 1.0)
+        while not self._stop_event.wait(interval):
+            self.check()
+
+
+    def started(self, command_message, batch_size=1):
+        """Records that a callback has started executing on the current thread
+
+        Args:
+            command_message (CommandMessage): The CommandMessage the callback was called for,
+                the first of them for a batch
+            batch_size (int, optional): The number of CommandMessages the callback was called
+                for. Defaults to 1.
+
+        Returns:
+            object: The execution, to be passed to 'finished'
+        """
+        execution = _Execution(command_message, batch_size, self._clock())
+        with self._lock:
+            self._executions.add(execution)
+        return execution
+
+
+    def finished(self, execution):
+        """Records that a callback has finished executing
+
+        Args:
+            execution (object): The execution returned by 'started'
+        """
+        with self._lock:
+            self._executions.discard(execution)
+
+        if execution.reported:
+            logger.info(''.join([f"Slow '{self._command(execution)}' callback finished after ",
+                                 f"{self._clock() - execution.started:.3f} s"]))
+
+
+    def check(self):
+        """Reports the callbacks that have been executing for longer than 'threshold' and
+        haven't been reported yet. Called periodically once started.
+        """
+        now = self._clock()
+        slow = []
+
+        with self._lock:
+            for execution in self._executions:
+                if not execution.reported and now - execution.started >= self.threshold:
+                    execution.reported = True
+                    slow.append((execution, self._capture_allowed(now)))
+            self.counts['slow'] += len(slow)
+
+        for execution, capture in slow:
+            self._report(execution, now - execution.started, capture)
+
+
+    def _capture_allowed(self, now):
+        """Returns whether a stack can be captured without exceeding 'max_per_minute'
+        """
+        if not self.max_per_minute:
+            return True
+
+        if self._window_start is None or now - self._window_start >= 60:
+            self._window_start = now
+            self._window_captured = 0
+
+        if self._window_captured >= self.max_per_minute:
+            self.counts['suppressed'] += 1
+            return False
+
+        self._window_captured += 1
+        return True
+
+
+    @staticmethod
+    def _command(execution):
+        if not execution.command_message:
+            return None
+        return execution.command_message.payload['command']
+
+
+    def _attributes_summary(self, execution):
+        """Returns the JSON encoded attributes, with secrets redacted, cut to
+        'attributes_excerpt' characters
+        """
+        if not execution.command_message:
+            return ''
+
+        payload = message.redacted_payload(execution.command_message.payload)
+        attributes = json.dumps(payload.get('attributes'), default=str)
+        if len(attributes) <= self.attributes_excerpt:
+            return attributes
+        return f'{attributes[:self.attributes_excerpt]}...'
+
+
+    @staticmethod
+    def _stack(thread_ident):
+        """Returns the formatted stack of a thread, '' if it's no longer running
+        """
+        frame = sys._current_frames().get(thread_ident) # pylint: disable=protected-access
+        if frame is None:
+            return ''
+
+        try:
+            return ''.join(traceback.format_stack(frame))
+        finally:
+            del frame
+
+
+    def _report(self, execution, elapsed, capture):
+        """Logs, counts and publishes a slow callback
+        """
+        command = self._command(execution)
+        topic = execution.command_message.topic if execution.command_message else None
+        attributes = self._attributes_summary(execution)
+        stack = self._stack(execution.thread_ident) if capture else ''
+
+        metrics.SLOW_CALLBACKS.inc(labels=(command,))
+
+        batch = f' (batch of {execution.batch_size})' if execution.batch_size > 1 else ''
+        warning = ''.join([f"'{command}' callback{batch} has been executing for ",
+                           f"{elapsed:.3f} s on thread '{execution.thread_name}', ",
+                           f"attributes: {attributes}"])
+        if capture:
+            logger.warning(f'{warning}\n{stack}'.rstrip('\n'))
+        else:
+            logger.warning(f'{warning} (stack not captured: max_per_minute reached)')
+
+        if not (self.topic and self.mqtt_publish):
+            return
+
+        report = {'command': command,
+                  'topic': topic,
+                  'elapsed': elapsed,
+                  'threshold': self.threshold,
+                  'thread': execution.thread_name,
+                  'batch_size': execution.batch_size,
+                  'attributes': attributes,
+                  'stack': stack}
+
+        try:
+            self.mqtt_publish(self.topic, json.dumps(report), self.qos, False)
+        except Exception as error: # pylint: disable=broad-except
+            logger.warning(''.join(["Slow callback report could not be published to ",
+                                    f"'{self.topic}': {error}"]))
@@ -0,0 +1,428 @@
+"""Multi-process worker related functionality
+
+A supervisor process owns the single connection to the broker and hands the CommandMessages
+it receives to a pool of worker processes, each of which calls the callbacks on its own CPU
+core. The workers send the messages their callbacks publish, and their log records, back to
+the supervisor, which publishes them on the shared connection.
+
+Examples:
+
+    To start a pool of 4 worker processes that publish through an MQTT client:
+
+        .. code-block:: python
+
+            worker_pool = WorkerPool(completed_config, 4, mqtt_software_client.publish,
+                                     dead_letter_handler)
+            worker_pool.start()
+
+
+    To pass a CommandMessage to the least busy worker:
+
+        .. code-block:: python
+
+            worker_pool.submit(command_message)
+
+
+    To stop the worker processes once they've finished the CommandMessages they were given:
+
+        .. code-block:: python
+
+            worker_pool.stop()
+"""
+from collections import OrderedDict
+import itertools
+import logging
+import logging.handlers
+import multiprocessing
+from multiprocessing import connection
+import pickle
+import signal
+import threading
+import time
+import zlib
+
+from mqtt_remote import (audit,
+                         callbacks_local,
+                         callbacks_plugins,
+                         dispatch,
+                         message,
+                         profiling,
+                         watchdog)
+
+
+
+# pylint: disable=C0103
+logger = logging.getLogger(__name__)
+# pylint: enable=C0103
+
+
+
+_PUBLISH = 'publish'
+_DONE = 'done'
+_FAILED = 'failed'
+
+
+
+class WorkerProcessError(RuntimeError):
+    """Raised in place of an exception from a worker process that can't be sent to the
+    supervisor, or recorded when a worker process dies whilst calling a callback
+    """
+
+
+
+def load_callbacks(callback_caller):
+    """Registers the local and plugin callbacks with a worker process's callback caller
+
+    Args:
+        callback_caller (CommandMessageCallbackCaller): The worker's callback caller
+    """
+    callbacks_plugins.auto_import_plugins()
+    callbacks_local.auto_import_local_callback_modules()
+    callback_caller.auto_add_command_message_callbacks()
+
+
+
+class _Publisher:
+    """Sends the publishes of a worker process's callbacks to the supervisor
+    """
+    def __init__(self, outbound):
+        self._outbound = outbound
+
+
+    def __call__(self, topic, payload=None, qos=0, retain=False, properties=None):
+        if properties is None:
+            self._outbound.put((_PUBLISH, topic, payload, qos, retain))
+        else:
+            self._outbound.put((_PUBLISH, topic, payload, qos, retain, properties))
+
+
+
+class _DeadLetterProxy:
+    """Sends the CommandMessages whose callback raised an exception in a worker process to the
+    supervisor's dead letter handler
+    """
+    def __init__(self, outbound):
+        self._outbound = outbound
+
+
+    def execution_failed(self, command_message, error):
+        try:
+            pickle.loads(pickle.dumps(error))
+        except Exception: # pylint: disable=broad-except
+            error = WorkerProcessError(f'{type(error).__name__}: {error}')
+        self._outbound.put((_FAILED, command_message, error))
+
+
+def _worker_main(number, completed_config, inbound, outbound, callback_loader):
+    """Runs a worker process: calls the callbacks for the CommandMessages received from the
+    supervisor until it's told to stop
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    root_logger = logging.getLogger()
+    root_logger.handlers = [logging.handlers.QueueHandler(outbound)]
+    root_logger.setLevel(completed_config['logging']['pylevel'])
+
+    publisher = _Publisher(outbound)
+    callback_caller = message.CommandMessageCallbackCaller()
+    callback_caller.mqtt_publish = publisher
+    callback_caller.config = completed_config
+    callback_loader(callback_caller)
+
+    dispatch_config = completed_config['dispatch']
+    chunking_config = completed_config['chunking']
+    audit_config = completed_config['audit']
+    slow_callbacks_config = completed_config['slow_callbacks']
+
+    audit_journal = None
+    if audit_config['path']:
+        audit_journal = audit.AuditJournal(f"{audit_config['path']}.worker{number}",
+                                           audit_config['max_size'],
+                                           audit_config['max_backups'],
+                                           audit_config['flush_interval'])
+
+    slow_callback_detector = None
+    if slow_callbacks_config['threshold']:
+        slow_callback_detector = watchdog.SlowCallbackDetector(
+            slow_callbacks_config['threshold'],
+            publisher,
+            slow_callbacks_config['topic'],
+            slow_callbacks_config['qos'],
+            slow_callbacks_config['max_per_minute'],
+            slow_callbacks_config['attributes_excerpt'])
+
+    dispatch_engine = dispatch.DispatchEngine(callback_caller,
+                                              dispatch.StreamPublisher(
+                                                  publisher, dispatch_config['stream_batch_size']),
+                                              0,
+                                              0,
+                                              dispatch_config['batch_max_items'],
+                                              dispatch_config['batch_max_delay'],
+                                              _DeadLetterProxy(outbound),
+                                              audit_journal,
+                                              slow_callback_detector)
+    dispatch_engine.start()
+
+    chunk_reassembler = message.ChunkReassembler(dispatch_engine.submit,
+                                                 chunking_config['spool_size'],
+                                                 chunking_config['max_transfer_size'],
+                                                 chunking_config['max_transfers'],
+                                                 chunking_config['timeout'])
+    callback_caller.add_callback(message.CHUNK_COMMAND_NAME, chunk_reassembler.receive,
+                                 message.CHUNK_PAYLOAD_SCHEMA)
+    profiling.add_profiling_callbacks(callback_caller, completed_config['profiling'])
+
+    logger.info(f'Worker process {number} has started')
+
+    while True:
+        item = inbound.get()
+        if item is None:
+            break
+
+        sequence, command_message = item
+        dispatch_engine.submit(command_message)
+        outbound.put((_DONE, number, sequence))
+
+    dispatch_engine.stop()
+    logger.info(f'Worker process {number} has stopped')
+
+
+
+class WorkerPool:
+    """Distributes CommandMessages between a pool of worker processes and publishes the
+    messages their callbacks publish
+
+    Each worker has a queue of its own. A CommandMessage goes to the worker with the fewest
+    CommandMessages outstanding, except for the parts of a chunked transfer, which all go to
+    the same worker so that it can reassemble them. A worker that dies is restarted after
+    'restart_delay' seconds and picks up where it left off; the CommandMessage it was working
+    on is passed to the dead letter handler rather than retried.
+
+    Attributes:
+        completed_config (dict): Completed MQTT Remote configuration, passed to every worker
+        processes (int): The number of worker processes
+        mqtt_publish (Callable): A callable object to publish MQTT messages
+        dead_letter_handler (DeadLetterHandler): Records CommandMessages whose callback raised
+            an exception or killed its worker, or None to just log them
+        callback_loader (Callable): Registers the callbacks with each worker's callback
+            caller. Must be a module level function so it can be sent to the workers.
+        max_queued (int): The maximum number of CommandMessages outstanding across all of the
+            workers. Further CommandMessages are dropped until there's space. 0 means no limit.
+        restart_delay (float): The time, in seconds, before a dead worker is restarted
+        restarts (int): The number of times a worker has been restarted
+    """
+    def __init__(self, completed_config, processes, mqtt_publish, dead_letter_handler=None,
+                 callback_loader=load_callbacks, max_queued=1000, restart_delay=1.0):
+        """Constructor
+
+        Args:
+            completed_config (dict): Completed MQTT Remote configuration
+            processes (int): The number of worker processes
+            mqtt_publish (Callable): A callable object to publish MQTT messages
+            dead_letter_handler (DeadLetterHandler, optional): Records failed CommandMessages.
+                Defaults to None.
+            callback_loader (Callable, optional): Registers the callbacks with each worker's
+                callback caller. Defaults to load_callbacks.
+            max_queued (int, optional): The maximum number of CommandMessages outstanding.
+                Defaults to 1000.
+            restart_delay (float, optional): The time, in seconds, before a dead worker is
+                restarted. Defaults to 1.0.
+
+        Raises:
+            ValueError: if fewer than one worker process is requested
+        """
+        if processes < 1:
+            raise ValueError('WorkerPool \'processes\' argument must be at least 1')
+
+        self.completed_config = completed_config
+        self.processes = processes
+        self.mqtt_publish = mqtt_publish
+        self.dead_letter_handler = dead_letter_handler
+        self.callback_loader = callback_loader
+        self.max_queued = max_queued
+        self.restart_delay = restart_delay
+        self.restarts = 0
+
+        self._context = multiprocessing.get_context('spawn')
+        self._outbound = self._context.Queue()
+        self._inbound = [self._context.Queue() for _ in range(processes)]
+        self._workers = [None] * processes
+        self._outstanding = [OrderedDict() for _ in range(processes)]
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads = []
+
+
+    def _start_worker(self, number):
+        process = self._context.Process(target=_worker_main,
+                                        args=(number, self.completed_config,
+                                              self._inbound[number], self._outbound,
+                                              self.callback_loader),
+                                        name=f'mqtt_remote_worker_{number}',
+                                        daemon=True)
+        process.start()
+        self._workers[number] = process
+
+
+    def start(self):
+        """Starts the worker processes and the threads that supervise them
+        """
+        self._stopping.clear()
+
+        for number in range(self.processes):
+            self._start_worker(number)
+
+        self._threads = [threading.Thread(target=self._receive, daemon=True,
+                                          name='mqtt_remote_worker_receive'),
+                         threading.Thread(target=self._supervise, daemon=True,
+                                          name='mqtt_remote_worker_supervise')]
+        for thread in self._threads:
+            thread.start()
+
+        logger.info(f'WorkerPool has started with {self.processes} worker process(es)')
+
+
+    def stop(self, timeout=10.0):
+        """Stops the worker processes once they've finished the CommandMessages they were given
+
+        Args:
+            timeout (float, optional): The maximum time, in seconds, to wait for each worker
+                process to stop before it's terminated. Defaults to 10.0.
+        """
+        self._stopping.set()
+
+        for inbound in self._inbound:
+            inbound.put(None)
+
+        for process in self._workers:
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f'Worker process {process.name} did not stop: terminating it')
+                process.terminate()
+                process.join()
+
+        self._outbound.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+
+        self._threads = []
+        logger.info('WorkerPool has stopped')
+
+
+    def outstanding(self):
+        """Returns the number of CommandMessages each worker has yet to finish
+
+        Returns:
+            list[int]: The number outstanding, per worker
+        """
+        with self._lock:
+            return [len(outstanding) for outstanding in self._outstanding]
+
+
+    def _select_worker(self, command_message):
+        """Returns the number of the worker that a CommandMessage is given to. The caller must
+        hold 'self._lock'
+        """
+        if command_message.payload['command'] == message.CHUNK_COMMAND_NAME:
+            transfer_id = str(command_message.payload['attributes'].get('transfer_id'))
+            return zlib.crc32(transfer_id.encode('utf-8')) % self.processes
+
+        return min(range(self.processes), key=lambda number: len(self._outstanding[number]))
+
+
+    def submit(self, command_message):
+        """Gives a CommandMessage to a worker process
+
+        Args:
+            command_message (CommandMessage): The CommandMessage to dispatch
+        """
+        with self._lock:
+            if self.max_queued and sum(map(len, self._outstanding)) >= self.max_queued:
+                logger.warning(''.join(['WorkerPool is full: CommandMessage dropped ',
+                                        f'(max_queued: {self.max_queued})']))
+                return
+
+            number = self._select_worker(command_message)
+            sequence = next(self._sequence)
+            self._outstanding[number][sequence] = command_message
+
+        self._inbound[number].put((sequence, command_message))
+
+
+    def _receive(self):
+        """Handles the publishes, results and log records sent by the worker processes until
+        the pool is stopped
+        """
+        while True:
+            item = self._outbound.get()
+            if item is None:
+                break
+
+            try:
+                self._handle(item)
+            except Exception: # pylint: disable=broad-except
+                logger.exception('Unable to handle a message from a worker process')
+
+
+    def _handle(self, item):
+        if isinstance(item, logging.LogRecord):
+            logging.getLogger(item.name).handle(item)
+        elif item[0] == _PUBLISH:
+            self.mqtt_publish(*item[1:])
+        elif item[0] == _DONE:
+            with self._lock:
+                self._outstanding[item[1]].pop(item[2], None)
+        elif item[0] == _FAILED:
+            self._failed(item[1], item[2])
+
+
+    def _failed(self, command_message, error):
+        if self.dead_letter_handler is None:
+            logger.error('Unhandled exception whilst dispatching a CommandMessage',
+                         exc_info=error)
+            return
+
+        self.dead_letter_handler.execution_failed(command_message, error)
+
+
+    def _supervise(self):
+        """Restarts worker processes that die until the pool is stopped
+        """
+        restart_at = {}
+
+        while not self._stopping.is_set():
+            sentinels = [process.sentinel for number, process in enumerate(self._workers)
+                         if number not in restart_at]
+            connection.wait(sentinels, timeout=0.1)
+            if self._stopping.is_set():
+                break
+
+            for number, process in enumerate(self._workers):
+                if number not in restart_at and not process.is_alive():
+                    self._worker_died(number, process)
+                    restart_at[number] = time.monotonic() + self.restart_delay
+
+            for number, deadline in list(restart_at.items()):
+                if deadline <= time.monotonic():
+                    del restart_at[number]
+                    self._start_worker(number)
+                    self.restarts += 1
+
+
+    def _worker_died(self, number, process):
+        """Passes the CommandMessage a dead worker was working on to the dead letter handler
+        """
+        process.join()
+        with self._lock:
+            outstanding = self._outstanding[number]
+            command_message = outstanding.popitem(last=False)[1] if outstanding else None
+
+        logger.warning(''.join([f'Worker process {number} died (exit code: {process.exitcode})',
+                                f': restarting it in {self.restart_delay} s']))
+
+        if command_message is not None:
+            self._failed(command_message, WorkerProcessError(
+                f'Worker process {number} died with exit code {process.exitcode}'))
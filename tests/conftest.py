@@ -1,10 +1,12 @@
 from unittest.mock import patch, Mock
 from collections import namedtuple
+import time
 
 import paho.mqtt.client as mqtt
 from pytest import fixture
 
-from mqtt_remote.mqtt_client import MQTTClient
+from mqtt_remote.message import CommandMessage
+from mqtt_remote.mqtt_client import CallbackSet, MQTTClient
 
 
 
@@ -52,13 +54,18 @@ def mqtt_client(mqtt_config):
 def initial_config():
     ini_config = {'logging': {'level': 'DEBUG',
                               'log_format': '%(asctime)s  %(name)s  %(levelname)s: %(message)s',
+                              'json_format': False,
                               'output_file': {'name': 'mqtt_remote.log',
                                               'max_size': 5242880,
                                               'max_backups': 2},
-                              'log_base_client': True},
+                              'log_base_client': True,
+                              'queue_size': 10000,
+                              'sampling': {},
+                              'max_per_second': 0},
                   'mqtt_session': {'protocol': '3.1.1',
                                   'transport': 'tcp',
-                                  'clean': True},
+                                  'clean': True,
+                                  'backend': 'paho'},
                   'mqtt_broker': {'ip': '192.168.1.100',
                                   'port': 1883,
                                   'user_name': 'username',
@@ -66,7 +73,71 @@ def initial_config():
                                   'password': 'password',
                                   'keepalive': 60},
                   'subscriptions':{'this_mqtt_client': {'name': 'this_client',
-                                                      'qos': 0}}}
+                                                      'qos': 0,
+                                                      'shared_group': '',
+                                                      'worker_id': ''}},
+                  'chunking': {'spool_size': 1048576,
+                               'max_transfer_size': 104857600,
+                               'max_transfers': 8,
+                               'timeout': 60},
+                  'dispatch': {'workers': 1,
+                               'max_queued': 1000,
+                               'batch_max_items': 1,
+                               'batch_max_delay': 0.005,
+                               'stream_batch_size': 1,
+                               'stream_max_pending': 100,
+                               'stream_flow_control_timeout': 5},
+                  'dead_letter': {'topic': 'mqtt_remote/dead_letter',
+                                  'qos': 0,
+                                  'quarantine_threshold': 3,
+                                  'quarantine_size': 1024,
+                                  'quarantine_duration': 300,
+                                  'payload_excerpt': 256,
+                                  'max_per_second': 10},
+                  'slow_callbacks': {'threshold': 5,
+                                     'topic': '',
+                                     'qos': 0,
+                                     'max_per_minute': 6,
+                                     'attributes_excerpt': 256},
+                  'outbound': {'coalesce_window': 0,
+                               'max_inflight': 20,
+                               'max_queued': 1000,
+                               'queue_full_policy': 'block',
+                               'queue_full_timeout': 5,
+                               'delivery_timeout': 300},
+                  'journal': {'path': '',
+                              'max_messages': 10000,
+                              'fsync': 'normal',
+                              'compact_interval': 1000},
+                  'reconnect': {'min_delay': 1,
+                                'max_delay': 30,
+                                'jitter': 0.5,
+                                'connect_timeout': 5,
+                                'dns_policy': 'always',
+                                'dns_refresh_failures': 3},
+                  'routing': {'pinned_commands': {},
+                              'dedup_size': 1024},
+                  'mqtt_v5': {'receive_maximum': 0,
+                              'topic_alias_maximum': 16},
+                  'middleware': {'timing': False},
+                  'audit': {'path': '',
+                            'max_size': 10485760,
+                            'max_backups': 5,
+                            'flush_interval': 1},
+                  'metrics': {'enabled': False,
+                              'host': '127.0.0.1',
+                              'port': 9464},
+                  'stats': {'interval': 0,
+                            'qos': 0,
+                            'retain': False},
+                  'tracing': {'sample_rate': 0.01,
+                              'path': '',
+                              'topic': ''},
+                  'profiling': {'enabled': False,
+                                'token': '',
+                                'output_dir': '',
+                                'max_duration': 60,
+                                'chunk_size': 65536}}
     return ini_config
 
 
@@ -83,3 +154,49 @@ def pub_msg():
     publish_message = namedtuple('pub', ['topic', 'message', 'qos', 'retain'])
     message = publish_message('topic', 'message', 0, False)
     return message
+
+
+@fixture(scope='function')
+def command_message():
+    def create_command_message(command='volume_up', attributes=None, topic='spam', qos=0,
+                               **payload):
+        payload = {'command': command,
+                   'attributes': {} if attributes is None else attributes,
+                   **payload}
+        return CommandMessage(topic, payload, qos, False)
+    return create_command_message
+
+
+@fixture(scope='function')
+def paho_message():
+    def create_paho_message(topic, payload, properties=None):
+        paho_msg = mqtt.MQTTMessage(topic=topic.encode('utf-8'))
+        paho_msg.payload = payload.encode('utf-8') if isinstance(payload, str) else payload
+        if properties is not None:
+            paho_msg.properties = properties
+        return paho_msg
+    return create_paho_message
+
+
+@fixture(scope='function')
+def fake_mqtt_client():
+    def create_fake_mqtt_client(protocol=mqtt.MQTTv311):
+        client = Mock()
+        client.mqtt_client_id = 'orchestrator'
+        client.mqtt_protocol = protocol
+        client.subscription_topics = []
+        client.on_message_callbacks = CallbackSet()
+        return client
+    return create_fake_mqtt_client
+
+
+@fixture(scope='session')
+def wait_until():
+    def wait(condition, timeout=20):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.005)
+        return True
+    return wait
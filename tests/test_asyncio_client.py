@@ -0,0 +1,287 @@
+from unittest.mock import Mock, patch
+import asyncio
+import struct
+import threading
+
+import paho.mqtt.client as mqtt
+import pytest
+
+import mqtt_remote.asyncio_client as asyncio_client
+from mqtt_remote.journal import PublishJournal
+from mqtt_remote.mqtt_client import OutboundQueueFullError, PublishError
+from mqtt_remote.reconnect import ReconnectSupervisor
+
+
+
+class FakeBroker:
+    """Just enough of an MQTT broker to exercise the client: one session at a time, exact topic
+    subscriptions and QoS 0, 1 and 2 in both directions
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+        self.port = None
+        self.received = []
+        self.connects = 0
+        self._subscriptions = {}
+        self._writer = None
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self.server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._session, '127.0.0.1', 0), self.loop).result()
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        async def close():
+            self.server.close()
+            if self._writer is not None:
+                self._writer.close()
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    def drop_connection(self):
+        self.loop.call_soon_threadsafe(self._writer.close)
+
+    async def _session(self, reader, writer):
+        self._writer = writer
+        try:
+            while True:
+                packet_type, body = await asyncio_client.read_packet(reader)
+                self._process(packet_type, body, writer)
+        except (EOFError, OSError):
+            writer.close()
+
+    def _process(self, packet_type, body, writer):
+        kind = packet_type & 0xF0
+        if kind == asyncio_client.CONNECT:
+            self.connects += 1
+            writer.write(asyncio_client.encode_packet(asyncio_client.CONNACK, b'\x00\x00'))
+        elif kind == asyncio_client.SUBSCRIBE & 0xF0:
+            position = 2
+            while position < len(body):
+                length = struct.unpack('!H', body[position:position + 2])[0]
+                topic = body[position + 2:position + 2 + length].decode()
+                self._subscriptions[topic] = body[position + 2 + length]
+                position += 3 + length
+            writer.write(asyncio_client.encode_packet(asyncio_client.SUBACK,
+                                                      body[:2] + b'\x00'))
+        elif kind == asyncio_client.PUBLISH:
+            qos = (packet_type >> 1) & 0x03
+            length = struct.unpack('!H', body[:2])[0]
+            topic = body[2:2 + length].decode()
+            mid = body[2 + length:4 + length] if qos else b''
+            payload = body[2 + length + len(mid):]
+            self.received.append((topic, payload, qos))
+            if qos == 1:
+                writer.write(asyncio_client.encode_packet(asyncio_client.PUBACK, mid))
+            elif qos == 2:
+                writer.write(asyncio_client.encode_packet(asyncio_client.PUBREC, mid))
+            if topic in self._subscriptions:
+                out_qos = min(qos, self._subscriptions[topic])
+                out = asyncio_client.encode_string(topic)
+                if out_qos:
+                    out += b'\x00\x01'
+                writer.write(asyncio_client.encode_packet(
+                    asyncio_client.PUBLISH | out_qos << 1, out + payload))
+        elif kind == asyncio_client.PUBREL & 0xF0:
+            writer.write(asyncio_client.encode_packet(asyncio_client.PUBCOMP, body[:2]))
+        elif kind == asyncio_client.PINGREQ:
+            writer.write(asyncio_client.encode_packet(asyncio_client.PINGRESP))
+
+
+def client(port, **kwargs):
+    kwargs.setdefault('reconnect_supervisor', ReconnectSupervisor(min_delay=0.01, max_delay=0.05,
+                                                                  connect_timeout=1))
+    return asyncio_client.AsyncioMQTTClient('user', 'password', '127.0.0.1', port, 60,
+                                            [('spam', 2)], 'client_id', True, mqtt.MQTTv311,
+                                            'tcp', False, **kwargs)
+
+
+@pytest.fixture
+def broker():
+    fake_broker = FakeBroker()
+    fake_broker.start()
+    yield fake_broker
+    fake_broker.stop()
+
+
+
+class TestCodec:
+
+    @pytest.mark.parametrize('length, encoded', [(0, b'\x00'),
+                                                 (127, b'\x7f'),
+                                                 (128, b'\x80\x01'),
+                                                 (16383, b'\xff\x7f'),
+                                                 (2097152, b'\x80\x80\x80\x01')])
+    def test_encode_remaining_length(self, length, encoded):
+        assert asyncio_client.encode_remaining_length(length) == encoded
+
+
+    def test_encode_remaining_length_too_large(self):
+        with pytest.raises(ValueError):
+            asyncio_client.encode_remaining_length(asyncio_client.MAX_REMAINING_LENGTH + 1)
+
+
+    def test_read_packet(self):
+        packet = asyncio_client.encode_packet(asyncio_client.PUBLISH, b'x' * 200)
+
+        async def read():
+            reader = asyncio.StreamReader()
+            reader.feed_data(packet)
+            return await asyncio_client.read_packet(reader)
+
+        assert asyncio.run(read()) == (asyncio_client.PUBLISH, b'x' * 200)
+
+
+    @pytest.mark.parametrize('payload, encoded', [(None, b''),
+                                                  ('é', 'é'.encode('utf-8')),
+                                                  (bytearray(b'ab'), b'ab'),
+                                                  (1.5, b'1.5')])
+    def test_payload_bytes(self, payload, encoded):
+        assert asyncio_client.payload_bytes(payload) == encoded
+
+
+    def test_payload_bytes_unsupported(self):
+        with pytest.raises(TypeError):
+            asyncio_client.payload_bytes({})
+
+
+
+class TestAsyncioMQTTClient:
+
+    def test_invalid_queue_full_policy(self):
+        with pytest.raises(ValueError):
+            client(1883, queue_full_policy='spam')
+
+
+    @pytest.mark.parametrize('protocol, transport', [(mqtt.MQTTv5, 'tcp'),
+                                                     (mqtt.MQTTv311, 'websockets')])
+    def test_initialise_unsupported(self, protocol, transport):
+        asyncio_mqtt_client = client(1883)
+        asyncio_mqtt_client.mqtt_protocol = protocol
+        asyncio_mqtt_client.mqtt_transport = transport
+
+        with pytest.raises(ValueError):
+            asyncio_mqtt_client.initialise()
+
+
+    def test_publish_no_initialisation(self):
+        with pytest.raises(RuntimeError):
+            client(1883).publish('spam', 'eggs', 0, False)
+
+
+    def test_start_invalid_loop_type(self):
+        asyncio_mqtt_client = client(1883)
+        asyncio_mqtt_client.initialise()
+
+        with pytest.raises(ValueError):
+            asyncio_mqtt_client.start('invalid method')
+
+
+    @pytest.mark.parametrize('qos', [0, 1, 2])
+    def test_round_trip(self, broker, qos, wait_until):
+        received = []
+        asyncio_mqtt_client = client(broker.port)
+        asyncio_mqtt_client.on_message_callbacks.add(received.append)
+        asyncio_mqtt_client.initialise()
+        asyncio_mqtt_client.start('non_blocking')
+        assert wait_until(lambda: asyncio_mqtt_client._subscribed)
+
+        handle = asyncio_mqtt_client.publish('spam', 'eggs', qos, False)
+
+        assert wait_until(lambda: received)
+        assert (received[0].topic, received[0].payload, received[0].qos) == ('spam', b'eggs', qos)
+        assert wait_until(lambda: asyncio_mqtt_client.pending_publish_count() == 0)
+        assert asyncio_mqtt_client.outbound_metrics()['sent'] == 1
+        assert handle.wait(1) == handle.latency
+        assert asyncio_mqtt_client.delivery_latency.snapshot()['count'] == 1
+        asyncio_mqtt_client.stop()
+
+
+    def test_publish_from_callback(self, broker, wait_until):
+        asyncio_mqtt_client = client(broker.port)
+        asyncio_mqtt_client.on_message_callbacks.add(
+            lambda msg: asyncio_mqtt_client.publish('reply', msg.payload, 1, False))
+        asyncio_mqtt_client.initialise()
+        asyncio_mqtt_client.start('non_blocking')
+        assert wait_until(lambda: asyncio_mqtt_client._subscribed)
+
+        handles = asyncio_mqtt_client.publish_many([('spam', 'one', 0, False),
+                                                    ('spam', 'two', 0, False)])
+
+        assert wait_until(lambda: len(broker.received) == 4)
+        assert [payload for topic, payload, _ in broker.received if topic == 'reply'] == [
+            b'one', b'two']
+        assert all(handle.wait(1) == handle.latency for handle in handles)
+        asyncio_mqtt_client.stop()
+
+
+    def test_reconnect(self, broker, wait_until):
+        asyncio_mqtt_client = client(broker.port)
+        asyncio_mqtt_client.initialise()
+        asyncio_mqtt_client.start('non_blocking')
+        assert wait_until(lambda: asyncio_mqtt_client._subscribed)
+
+        broker.drop_connection()
+
+        assert wait_until(lambda: broker.connects == 2)
+        assert wait_until(lambda: asyncio_mqtt_client.connection_metrics()['reconnects'] == 1)
+        asyncio_mqtt_client.stop()
+
+
+    def test_retries_first_connection(self, wait_until):
+        asyncio_mqtt_client = client(1)
+        asyncio_mqtt_client.initialise()
+        asyncio_mqtt_client.start('non_blocking')
+
+        assert wait_until(lambda: asyncio_mqtt_client.connection_metrics()['failures'] >= 2)
+        asyncio_mqtt_client.stop()
+
+
+    def test_queued_whilst_disconnected(self):
+        asyncio_mqtt_client = client(1, max_queued=1, queue_full_policy='drop')
+        asyncio_mqtt_client.initialise()
+        asyncio_mqtt_client.start('non_blocking')
+
+        queued = asyncio_mqtt_client.publish('spam', 'one', 1, False)
+        dropped = asyncio_mqtt_client.publish('spam', 'two', 1, False)
+
+        assert asyncio_mqtt_client.pending_publish_count() == 1
+        assert not queued.done()
+        assert isinstance(dropped.future.exception(), PublishError)
+        assert asyncio_mqtt_client.outbound_metrics()['dropped'] == 1
+        asyncio_mqtt_client.queue_full_policy = 'raise'
+        with pytest.raises(OutboundQueueFullError):
+            asyncio_mqtt_client.publish('spam', 'three', 1, False)
+        asyncio_mqtt_client.stop()
+
+
+    def test_journal_replayed(self, broker, tmp_path, wait_until):
+        path = str(tmp_path / 'outbound.db')
+        journal = PublishJournal(path)
+        journal.open()
+        journal.append('spam', 'journaled', 1, False)
+        journal.close()
+        asyncio_mqtt_client = client(broker.port, journal=PublishJournal(path))
+        asyncio_mqtt_client.initialise()
+        asyncio_mqtt_client.start('non_blocking')
+
+        assert wait_until(lambda: ('spam', b'journaled', 1) in broker.received)
+        assert wait_until(lambda: len(asyncio_mqtt_client.journal) == 0)
+        asyncio_mqtt_client.stop()
+
+
+    @patch('mqtt_remote.asyncio_client.logger')
+    def test_on_message_callback_exception(self, mock_logger):
+        asyncio_mqtt_client = client(1883)
+        def failing_callback(msg):
+            raise RuntimeError('fail')
+
+        asyncio_mqtt_client.on_message_callbacks.add(failing_callback)
+
+        asyncio_mqtt_client._on_message(Mock())
+
+        mock_logger.exception.assert_called_with('Unhandled exception in an on message callback')
@@ -0,0 +1,192 @@
+from unittest.mock import Mock, patch
+import json
+import os
+import time
+
+import pytest
+
+import mqtt_remote.audit as audit
+import mqtt_remote.message as message
+
+
+
+class TestAuditJournal:
+
+    def test_append_and_read(self, tmp_path, command_message):
+        path = str(tmp_path / 'audit.bin')
+        audit_journal = audit.AuditJournal(path)
+        audit_journal.open()
+
+        audit_journal.append(command_message(), audit.OUTCOME_OK, 0.25, timestamp=100.0)
+        audit_journal.append(command_message('mute'), audit.OUTCOME_ERROR, 0.5)
+        audit_journal.close()
+
+        records = list(audit.read_audit_journal(path))
+
+        assert len(records) == 2
+        assert records[0].timestamp == 100.0
+        assert records[0].latency == pytest.approx(0.25)
+        assert records[0].outcome == 'ok'
+        assert records[0].topic == 'spam'
+        assert records[0].command == 'volume_up'
+        assert json.loads(records[0].payload) == {'command': 'volume_up',
+                                                  'attributes': {}}
+        assert records[1].command == 'mute'
+        assert records[1].outcome == 'error'
+        assert audit_journal.written == 2
+
+
+    def test_token_redacted(self, tmp_path):
+        path = str(tmp_path / 'audit.bin')
+        audit_journal = audit.AuditJournal(path)
+        audit_journal.open()
+        cmd_msg = message.CommandMessage('spam', {'command': 'name',
+                                                  'attributes': {'token': 'secret'}}, 0, False)
+
+        audit_journal.append(cmd_msg, audit.OUTCOME_OK, 0.1)
+        audit_journal.close()
+
+        record = list(audit.read_audit_journal(path))[0]
+        assert json.loads(record.payload)['attributes'] == {'token': '***'}
+
+
+    def test_reopen_appends(self, tmp_path, command_message):
+        path = str(tmp_path / 'audit.bin')
+        for _ in range(2):
+            audit_journal = audit.AuditJournal(path)
+            audit_journal.open()
+            audit_journal.append(command_message(), audit.OUTCOME_OK, 0.1)
+            audit_journal.close()
+
+        assert len(list(audit.read_audit_journal(path))) == 2
+
+
+    def test_append_not_opened(self, tmp_path, command_message):
+        audit_journal = audit.AuditJournal(str(tmp_path / 'audit.bin'))
+
+        audit_journal.append(command_message(), audit.OUTCOME_OK, 0.1)
+
+        assert audit_journal.written == 0
+        assert not os.path.exists(tmp_path / 'audit.bin')
+
+
+    def test_read_filtered(self, tmp_path, command_message):
+        path = str(tmp_path / 'audit.bin')
+        audit_journal = audit.AuditJournal(path)
+        audit_journal.open()
+        audit_journal.append(command_message('mute'), audit.OUTCOME_OK, 0.1)
+        audit_journal.append(command_message('mute'), audit.OUTCOME_ERROR, 0.1)
+        audit_journal.append(command_message(), audit.OUTCOME_ERROR, 0.1)
+        audit_journal.close()
+
+        records = list(audit.read_audit_journal(path, command='mute', outcome='error'))
+
+        assert [(record.command, record.outcome) for record in records] == [('mute', 'error')]
+
+
+    def test_read_truncated_record(self, tmp_path, command_message):
+        path = str(tmp_path / 'audit.bin')
+        audit_journal = audit.AuditJournal(path)
+        audit_journal.open()
+        audit_journal.append(command_message(), audit.OUTCOME_OK, 0.1)
+        audit_journal.append(command_message(), audit.OUTCOME_OK, 0.1)
+        audit_journal.close()
+
+        with open(path, 'r+b') as journal_file:
+            journal_file.truncate(os.path.getsize(path) - 3)
+
+        assert len(list(audit.read_audit_journal(path))) == 1
+
+
+    def test_read_not_audit_journal(self, tmp_path):
+        path = tmp_path / 'other.bin'
+        path.write_bytes(b'not a journal')
+
+        with pytest.raises(ValueError):
+            list(audit.read_audit_journal(str(path)))
+
+
+    def test_rotation(self, tmp_path, command_message):
+        path = str(tmp_path / 'audit.bin')
+        record_size = len(audit.encode_record(command_message(), audit.OUTCOME_OK, 0.1))
+        audit_journal = audit.AuditJournal(path, max_size=len(audit.MAGIC) + 2 * record_size,
+                                           max_backups=2)
+        audit_journal.open()
+
+        for _ in range(7):
+            audit_journal.append(command_message(), audit.OUTCOME_OK, 0.1)
+        audit_journal.close()
+
+        assert len(list(audit.read_audit_journal(path))) == 1
+        assert len(list(audit.read_audit_journal(f'{path}.1'))) == 2
+        assert len(list(audit.read_audit_journal(f'{path}.2'))) == 2
+        assert not os.path.exists(f'{path}.3')
+
+
+    @patch('mqtt_remote.audit.time')
+    def test_flush_interval(self, mock_time, tmp_path, command_message):
+        path = str(tmp_path / 'audit.bin')
+        mock_time.monotonic.return_value = 0.0
+        mock_time.time.return_value = 0.0
+        audit_journal = audit.AuditJournal(path, flush_interval=1.0)
+        audit_journal.open()
+
+        audit_journal.append(command_message(), audit.OUTCOME_OK, 0.1)
+        assert os.path.getsize(path) == 0
+
+        mock_time.monotonic.return_value = 1.0
+        audit_journal.append(command_message(), audit.OUTCOME_OK, 0.1)
+        assert len(list(audit.read_audit_journal(path))) == 2
+        audit_journal.close()
+
+
+    def test_background_flush(self, tmp_path, command_message):
+        path = str(tmp_path / 'audit.bin')
+        audit_journal = audit.AuditJournal(path, flush_interval=0.01)
+        audit_journal.open()
+
+        audit_journal.append(command_message(), audit.OUTCOME_OK, 0.1)
+        for _ in range(500):
+            if os.path.getsize(path) > len(audit.MAGIC):
+                break
+            time.sleep(0.01)
+
+        assert len(list(audit.read_audit_journal(path))) == 1
+        audit_journal.close()
+        assert audit_journal._thread is None
+
+
+    @patch('mqtt_remote.audit.logger')
+    def test_write_error(self, mock_logger, tmp_path, command_message):
+        audit_journal = audit.AuditJournal(str(tmp_path / 'audit.bin'))
+        audit_journal.open()
+        audit_journal._file.close()
+        audit_journal._file = Mock()
+        audit_journal._file.write.side_effect = OSError('disk full')
+
+        audit_journal.append(command_message(), audit.OUTCOME_OK, 0.1)
+
+        assert audit_journal.failed == 1
+        mock_logger.warning.assert_called_once()
+
+
+
+class TestAutoAudit:
+
+    def test_auto_audit(self, tmp_path, capsys, command_message):
+        path = str(tmp_path / 'audit.bin')
+        audit_journal = audit.AuditJournal(path)
+        audit_journal.open()
+        audit_journal.append(command_message(), audit.OUTCOME_OK, 0.1, timestamp=5.0)
+        audit_journal.append(command_message('mute'), audit.OUTCOME_OK, 0.1)
+        audit_journal.close()
+
+        output = audit.auto_audit([path, '--command', 'volume_up'])
+
+        lines = capsys.readouterr().out.splitlines()
+        assert output == 0
+        assert len(lines) == 1
+        record = json.loads(lines[0])
+        assert record['command'] == 'volume_up'
+        assert record['timestamp'] == 5.0
+        assert record['payload'] == {'command': 'volume_up', 'attributes': {}}
@@ -0,0 +1,166 @@
+from unittest.mock import Mock, patch
+import json
+
+import mqtt_remote.dead_letter as dead_letter
+import mqtt_remote.message as message
+
+
+
+def raw_message(payload=b'not json', topic='spam'):
+    raw = Mock()
+    raw.topic = topic
+    raw.payload = payload
+    return raw
+
+
+def handler(**kwargs):
+    kwargs.setdefault('mqtt_publish', Mock())
+    kwargs.setdefault('topic', 'dead')
+    kwargs.setdefault('clock', Mock(return_value=0))
+    return dead_letter.DeadLetterHandler(**kwargs)
+
+
+
+class TestDeadLetterHandler:
+
+    def test_fingerprint(self):
+        dead_letter_handler = handler()
+
+        fingerprint = dead_letter_handler.fingerprint(raw_message())
+
+        assert fingerprint == dead_letter_handler.fingerprint(raw_message())
+        assert fingerprint != dead_letter_handler.fingerprint(raw_message(b'other'))
+        assert fingerprint != dead_letter_handler.fingerprint(raw_message(topic='eggs'))
+        assert len(fingerprint) == 32
+
+
+    def test_conversion_failed_publishes_dead_letter(self):
+        dead_letter_handler = handler(payload_excerpt=4)
+        raw = raw_message()
+        fingerprint = dead_letter_handler.fingerprint(raw)
+
+        dead_letter_handler.conversion_failed(raw, fingerprint, ValueError('bad'))
+
+        topic, payload, qos, retain = dead_letter_handler.mqtt_publish.call_args[0]
+        assert (topic, qos, retain) == ('dead', 0, False)
+        assert json.loads(payload) == {'stage': 'conversion',
+                                       'fingerprint': fingerprint,
+                                       'failures': 1,
+                                       'topic': 'spam',
+                                       'command': None,
+                                       'error': 'ValueError: bad',
+                                       'size': 8,
+                                       'payload': 'not '}
+        assert dead_letter_handler.counts['conversion'] == 1
+
+
+    @patch('mqtt_remote.dead_letter.logger')
+    def test_execution_failed_publishes_dead_letter(self, mock_logger):
+        dead_letter_handler = handler()
+        command_message = message.CommandMessage('spam', {'command': 'name', 'attributes': {}},
+                                                 0, False)
+        command_message.fingerprint = 'abc'
+        error = RuntimeError('fail')
+
+        dead_letter_handler.execution_failed(command_message, error)
+
+        dead_letter = json.loads(dead_letter_handler.mqtt_publish.call_args[0][1])
+        assert dead_letter['stage'] == 'execution'
+        assert dead_letter['command'] == 'name'
+        assert dead_letter['error'] == 'RuntimeError: fail'
+        assert dead_letter_handler.counts['execution'] == 1
+        mock_logger.error.assert_called_with("Callback for 'name' failed", exc_info=error)
+
+
+    @patch('mqtt_remote.dead_letter.logger')
+    def test_execution_failed_token_redacted(self, mock_logger):
+        dead_letter_handler = handler()
+        command_message = message.CommandMessage(
+            'spam', {'command': 'name', 'attributes': {'token': 'secret'}}, 0, False)
+
+        dead_letter_handler.execution_failed(command_message, RuntimeError('fail'))
+
+        dead_letter = json.loads(dead_letter_handler.mqtt_publish.call_args[0][1])
+        assert 'secret' not in dead_letter['payload']
+        assert '***' in dead_letter['payload']
+
+
+    def test_no_topic(self):
+        dead_letter_handler = handler(topic='')
+
+        dead_letter_handler.conversion_failed(raw_message(), 'abc', 'bad')
+
+        dead_letter_handler.mqtt_publish.assert_not_called()
+        assert dead_letter_handler.counts['conversion'] == 1
+
+
+    def test_dead_letter_topic_not_republished(self):
+        dead_letter_handler = handler()
+
+        dead_letter_handler.conversion_failed(raw_message(topic='dead'), 'abc', 'bad')
+
+        dead_letter_handler.mqtt_publish.assert_not_called()
+
+
+    @patch('mqtt_remote.dead_letter.logger')
+    def test_quarantine(self, mock_logger):
+        dead_letter_handler = handler(quarantine_threshold=2)
+        raw = raw_message()
+        fingerprint = dead_letter_handler.fingerprint(raw)
+
+        dead_letter_handler.conversion_failed(raw, fingerprint, 'bad')
+        assert not dead_letter_handler.quarantined(fingerprint)
+        dead_letter_handler.conversion_failed(raw, fingerprint, 'bad')
+
+        assert dead_letter_handler.quarantined(fingerprint)
+        assert dead_letter_handler.counts['quarantined'] == 1
+        mock_logger.warning.assert_called_with(
+            f"Message '{fingerprint}' quarantined after 2 failures")
+
+
+    def test_quarantine_disabled(self):
+        dead_letter_handler = handler(quarantine_threshold=0)
+
+        for _ in range(5):
+            dead_letter_handler.conversion_failed(raw_message(), 'abc', 'bad')
+
+        assert not dead_letter_handler.quarantined('abc')
+
+
+    def test_quarantine_expires(self):
+        clock = Mock(return_value=0)
+        dead_letter_handler = handler(quarantine_threshold=1, quarantine_duration=10,
+                                      clock=clock)
+
+        dead_letter_handler.conversion_failed(raw_message(), 'abc', 'bad')
+        assert dead_letter_handler.quarantined('abc')
+
+        clock.return_value = 10
+        assert not dead_letter_handler.quarantined('abc')
+
+
+    def test_quarantine_bounded(self):
+        dead_letter_handler = handler(quarantine_threshold=1, quarantine_size=2)
+
+        for fingerprint in ['a', 'b', 'c']:
+            dead_letter_handler.conversion_failed(raw_message(), fingerprint, 'bad')
+
+        assert not dead_letter_handler.quarantined('a')
+        assert dead_letter_handler.quarantined('b')
+        assert dead_letter_handler.quarantined('c')
+
+
+    def test_max_per_second(self):
+        clock = Mock(return_value=0)
+        dead_letter_handler = handler(quarantine_threshold=0, max_per_second=2, clock=clock)
+
+        for _ in range(3):
+            dead_letter_handler.conversion_failed(raw_message(), 'abc', 'bad')
+
+        assert dead_letter_handler.mqtt_publish.call_count == 2
+        assert dead_letter_handler.counts['suppressed'] == 1
+
+        clock.return_value = 1
+        dead_letter_handler.conversion_failed(raw_message(), 'abc', 'bad')
+
+        assert dead_letter_handler.mqtt_publish.call_count == 3
@@ -0,0 +1,780 @@
+from unittest.mock import Mock, patch
+import asyncio
+import io
+import json
+import threading
+
+import pytest
+
+import mqtt_remote.dispatch as dispatch
+import mqtt_remote.message as message
+import mqtt_remote.metrics as metrics
+
+
+
+@pytest.fixture
+def command_message(command_message):
+    def create_command_message(return_message=True):
+        attributes = {}
+        if return_message:
+            attributes['return_message'] = {'topic': 'reply', 'qos': 1, 'retain': False}
+        return command_message('name', attributes, 'topic')
+    return create_command_message
+
+
+def items(*values):
+    yield from values
+
+
+async def async_items(*values):
+    for value in values:
+        yield value
+
+
+
+class TestStreamPublisher:
+
+    def test_publish_stream(self, command_message):
+        mqtt_publish = Mock()
+        stream_publisher = dispatch.StreamPublisher(mqtt_publish)
+
+        output = stream_publisher.publish_stream(command_message(), items('a', b'b', {'c': 1}))
+
+        assert output == 3
+        assert [call.args for call in mqtt_publish.call_args_list] == [
+            ('reply', 'a', 1, False),
+            ('reply', b'b', 1, False),
+            ('reply', json.dumps({'c': 1}), 1, False)]
+
+
+    def test_publish_stream_batched(self, command_message):
+        mqtt_publish = Mock()
+        stream_publisher = dispatch.StreamPublisher(mqtt_publish, batch_size=2)
+
+        output = stream_publisher.publish_stream(command_message(), items('a', b'b', 3))
+
+        assert output == 3
+        assert [call.args[1] for call in mqtt_publish.call_args_list] == [
+            json.dumps(['a', 'b']), json.dumps([3])]
+
+
+    def test_publish_stream_response_topic(self, command_message):
+        mqtt_publish = Mock()
+        stream_publisher = dispatch.StreamPublisher(mqtt_publish)
+        cmd_msg = command_message(return_message=False)
+        cmd_msg.response_topic = 'replies'
+        cmd_msg.correlation_data = b'request-1'
+
+        output = stream_publisher.publish_stream(cmd_msg, items('a', 'b'))
+
+        assert output == 2
+        assert [call.args for call in mqtt_publish.call_args_list] == [('replies', 'a', 0, False),
+                                                                       ('replies', 'b', 0, False)]
+        assert all(call.kwargs['properties'].CorrelationData == b'request-1'
+                   for call in mqtt_publish.call_args_list)
+
+
+    def test_publish_stream_enveloped(self, command_message):
+        mqtt_publish = Mock()
+        stream_publisher = dispatch.StreamPublisher(mqtt_publish)
+        cmd_msg = command_message(return_message=False)
+        cmd_msg.payload.update({'response_topic': 'replies', 'correlation_data': '42'})
+
+        stream_publisher.publish_stream(cmd_msg, items('a'))
+
+        topic, payload, _, _ = mqtt_publish.call_args.args
+        assert topic == 'replies'
+        assert json.loads(payload) == {'correlation_data': '42', 'payload': 'a'}
+
+
+    @patch('mqtt_remote.dispatch.logger')
+    def test_publish_stream_no_return_message(self, mock_logger, command_message):
+        mqtt_publish = Mock()
+        stream_publisher = dispatch.StreamPublisher(mqtt_publish)
+        stream = items('a')
+
+        output = stream_publisher.publish_stream(command_message(return_message=False), stream)
+
+        assert output == 0
+        mqtt_publish.assert_not_called()
+        assert mock_logger.warning.called
+        assert list(stream) == []
+
+
+    @patch('mqtt_remote.dispatch.time')
+    def test_publish_stream_flow_control(self, mock_time, command_message):
+        mqtt_publish = Mock()
+        mock_time.monotonic.return_value = 0
+        pending_publishes = Mock(side_effect=[5, 5, 1, 1])
+        stream_publisher = dispatch.StreamPublisher(mqtt_publish, max_pending=5,
+                                                    pending_publishes=pending_publishes)
+
+        stream_publisher.publish_stream(command_message(), items('a', 'b'))
+
+        assert pending_publishes.call_count == 4
+        mock_time.sleep.assert_called_with(0.001)
+        assert mqtt_publish.call_count == 2
+
+
+    def test_publish_stream_flow_control_disabled(self, command_message):
+        mqtt_publish = Mock()
+        pending_publishes = Mock(return_value=10)
+        stream_publisher = dispatch.StreamPublisher(mqtt_publish, max_pending=5,
+                                                    pending_publishes=pending_publishes)
+
+        stream_publisher.publish_stream(command_message(), items('a'), flow_control=False)
+
+        pending_publishes.assert_not_called()
+        assert mqtt_publish.call_count == 1
+
+
+    def test_publish_stream_flow_control_timeout(self, command_message):
+        mqtt_publish = Mock()
+        pending_publishes = Mock(return_value=10)
+        stream_publisher = dispatch.StreamPublisher(mqtt_publish, max_pending=5,
+                                                    pending_publishes=pending_publishes,
+                                                    flow_control_timeout=0.01)
+
+        stream_publisher.publish_stream(command_message(), items('a'))
+
+        assert mqtt_publish.call_count == 1
+
+
+
+class TestDispatchEngine:
+
+    def test_dispatch(self, command_message):
+        callback_caller = Mock()
+        callback_caller.validated_callback_caller.return_value = None
+        stream_publisher = Mock()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, stream_publisher)
+        cmd_msg = command_message()
+
+        dispatch_engine.dispatch(cmd_msg)
+
+        callback_caller.validated_callback_caller.assert_called_with(cmd_msg)
+        stream_publisher.publish_stream.assert_not_called()
+
+
+    def test_dispatch_expired(self, command_message):
+        callback_caller = Mock()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock())
+        cmd_msg = command_message()
+        cmd_msg.expires_at = 0.0
+
+        dispatch_engine.dispatch(cmd_msg)
+
+        callback_caller.validated_callback_caller.assert_not_called()
+        assert dispatch_engine.expired == 1
+
+
+    def test_dispatch_generator(self, command_message):
+        callback_caller = Mock()
+        stream = items('a')
+        callback_caller.validated_callback_caller.return_value = stream
+        stream_publisher = Mock()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, stream_publisher)
+        cmd_msg = command_message()
+
+        dispatch_engine.dispatch(cmd_msg)
+
+        stream_publisher.publish_stream.assert_called_with(cmd_msg, stream, True)
+
+
+    def test_dispatch_generator_inline(self, command_message):
+        callback_caller = Mock()
+        stream = items('a')
+        callback_caller.validated_callback_caller.return_value = stream
+        stream_publisher = Mock()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, stream_publisher, workers=0)
+        cmd_msg = command_message()
+
+        dispatch_engine.dispatch(cmd_msg)
+
+        stream_publisher.publish_stream.assert_called_with(cmd_msg, stream, False)
+
+
+    def test_dispatch_async_generator(self, command_message):
+        mqtt_publish = Mock()
+        callback_caller = Mock()
+        callback_caller.validated_callback_caller.return_value = async_items('a', 'b')
+        dispatch_engine = dispatch.DispatchEngine(callback_caller,
+                                                  dispatch.StreamPublisher(mqtt_publish))
+
+        dispatch_engine.dispatch(command_message())
+
+        assert [call.args[1] for call in mqtt_publish.call_args_list] == ['a', 'b']
+
+
+    def test_dispatch_coroutine(self, command_message):
+        called = []
+
+        async def coroutine():
+            called.append(True)
+
+        callback_caller = Mock()
+        callback_caller.validated_callback_caller.return_value = coroutine()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock())
+
+        dispatch_engine.dispatch(command_message())
+
+        assert called == [True]
+
+
+    def test_dispatch_coroutine_running_loop(self, command_message):
+        called = []
+
+        async def coroutine():
+            called.append(True)
+
+        async def dispatch_on_loop(dispatch_engine):
+            dispatch_engine.dispatch(command_message())
+            assert called == []
+            await asyncio.sleep(0)
+
+        callback_caller = Mock()
+        callback_caller.validated_callback_caller.return_value = coroutine()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock())
+
+        asyncio.run(dispatch_on_loop(dispatch_engine))
+
+        assert called == [True]
+
+
+    def test_dispatch_coroutine_running_loop_exception(self, command_message):
+        error = RuntimeError('fail')
+
+        async def coroutine():
+            raise error
+
+        async def dispatch_on_loop(dispatch_engine):
+            dispatch_engine.dispatch(command_message())
+            await asyncio.sleep(0)
+
+        callback_caller = Mock()
+        callback_caller.validated_callback_caller.return_value = coroutine()
+        dead_letter_handler = Mock()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(),
+                                                  dead_letter_handler=dead_letter_handler)
+
+        asyncio.run(dispatch_on_loop(dispatch_engine))
+
+        assert dead_letter_handler.execution_failed.call_args[0][1] is error
+
+
+    def test_submit_inline_coroutine_outcome_recorded_when_done(self, command_message):
+        async def coroutine(event):
+            await event.wait()
+            raise RuntimeError('fail')
+
+        async def submit_on_loop(dispatch_engine):
+            event = asyncio.Event()
+            callback_caller.validated_callback_caller.return_value = coroutine(event)
+            dispatch_engine.submit(cmd_msg)
+            audit_journal.append.assert_not_called()
+            slow_callback_detector.finished.assert_called_once()
+            event.set()
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+
+        callback_caller = Mock()
+        audit_journal = Mock()
+        slow_callback_detector = Mock()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(), workers=0,
+                                                  dead_letter_handler=Mock(),
+                                                  audit_journal=audit_journal,
+                                                  slow_callback_detector=slow_callback_detector)
+        cmd_msg = command_message()
+
+        asyncio.run(submit_on_loop(dispatch_engine))
+
+        audit_journal.append.assert_called_once()
+        assert audit_journal.append.call_args.args[:2] == (cmd_msg, 'error')
+        assert slow_callback_detector.started.call_count == 2
+        assert slow_callback_detector.finished.call_count == 2
+
+
+    def test_submit_workers_coroutine_scheduled_on_event_loop(self, command_message):
+        event_loop = asyncio.new_event_loop()
+        loop_thread = threading.Thread(target=event_loop.run_forever, daemon=True)
+        loop_thread.start()
+        threads = []
+        done = threading.Event()
+
+        async def coroutine():
+            threads.append(threading.current_thread())
+
+        def callback(command_message):
+            threads.append(threading.current_thread())
+            return coroutine()
+
+        audit_journal = Mock()
+        audit_journal.append.side_effect = lambda *args: done.set()
+        callback_caller = Mock()
+        callback_caller.validated_callback_caller.side_effect = callback
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(), workers=1,
+                                                  audit_journal=audit_journal,
+                                                  event_loop=event_loop)
+        dispatch_engine.start()
+        cmd_msg = command_message()
+
+        dispatch_engine.submit(cmd_msg)
+
+        assert done.wait(5)
+        dispatch_engine.stop()
+        event_loop.call_soon_threadsafe(event_loop.stop)
+        loop_thread.join()
+        event_loop.close()
+        assert threads[0] not in (loop_thread, threading.current_thread())
+        assert threads[1] is loop_thread
+        assert audit_journal.append.call_args.args[:2] == (cmd_msg, 'ok')
+
+
+    def test_dispatch_async_generator_event_loop_flow_control(self, command_message):
+        event_loop = Mock()
+        event_loop.is_running.return_value = True
+        stream_publisher = Mock()
+        callback_caller = Mock()
+        stream = async_items('a')
+        callback_caller.validated_callback_caller.return_value = stream
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, stream_publisher, workers=0,
+                                                  event_loop=event_loop)
+
+        with patch('mqtt_remote.dispatch.asyncio.run_coroutine_threadsafe') as mock_run:
+            assert dispatch_engine.dispatch(command_message()) is None
+
+        stream_publisher.publish_async_stream.assert_called_once()
+        assert stream_publisher.publish_async_stream.call_args.args[2] is True
+        assert mock_run.call_args.args == (stream_publisher.publish_async_stream.return_value,
+                                           event_loop)
+
+
+    def test_submit_inline(self, command_message):
+        callback_caller = Mock()
+        callback_caller.validated_callback_caller.return_value = None
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(), workers=0)
+        cmd_msg = command_message()
+
+        dispatch_engine.submit(cmd_msg)
+
+        callback_caller.validated_callback_caller.assert_called_with(cmd_msg)
+
+
+    def test_submit_workers(self, command_message):
+        called = threading.Event()
+        callback_caller = Mock()
+        callback_caller.validated_callback_caller.side_effect = lambda cmd_msg: called.set()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(), workers=2)
+        cmd_msg = command_message()
+
+        dispatch_engine.start()
+        dispatch_engine.submit(cmd_msg)
+
+        assert called.wait(5)
+        dispatch_engine.stop(5)
+        callback_caller.validated_callback_caller.assert_called_with(cmd_msg)
+
+
+    @patch('mqtt_remote.dispatch.logger')
+    def test_submit_queue_full(self, mock_logger, command_message):
+        dispatch_engine = dispatch.DispatchEngine(Mock(), Mock(), workers=1, max_queued=1)
+
+        dispatch_engine.submit(command_message())
+        dispatch_engine.submit(command_message())
+
+        mock_logger.warning.assert_called_with(''.join(["DispatchEngine queue is full: ",
+                                                        "CommandMessage dropped ",
+                                                        "(max_queued: 1)"]))
+        assert dispatch_engine.queue_depth() == 1
+
+
+    @patch('mqtt_remote.dispatch.logger')
+    def test_submit_queue_full_closes_attachment(self, mock_logger, command_message):
+        dispatch_engine = dispatch.DispatchEngine(Mock(), Mock(), workers=1, max_queued=1)
+        attachment = io.BytesIO(b'data')
+        dropped = command_message()
+        dropped.attachment = attachment
+
+        dispatch_engine.submit(command_message())
+        dispatch_engine.submit(dropped)
+
+        assert attachment.closed
+
+
+    def test_reassembled_exception_dead_letter(self):
+        callback_caller = message.CommandMessageCallbackCaller()
+        error = RuntimeError('fail')
+        callback_caller.add_callback('name', Mock(side_effect=error))
+        dead_letter_handler = Mock()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(), workers=0,
+                                                  dead_letter_handler=dead_letter_handler)
+        reassembler = message.ChunkReassembler(dispatch_engine.submit)
+        compiled_schema = message.CHUNK_PAYLOAD_SCHEMA.compile()
+
+        for payload in message.chunk_payloads(b'data', 2, {'command': 'name', 'attributes': {}}):
+            chunk_message = message.CommandMessage('topic', payload, 1, False)
+            chunk_message.arguments = compiled_schema.extract(chunk_message)
+            reassembler.receive(chunk_message)
+
+        command_message_failed, raised = dead_letter_handler.execution_failed.call_args.args
+        assert command_message_failed.payload['command'] == 'name'
+        assert raised is error
+        assert command_message_failed.attachment is None
+
+
+    @patch('mqtt_remote.dispatch.logger')
+    def test_worker_survives_exception(self, mock_logger, command_message):
+        called = threading.Event()
+        callback_caller = Mock()
+        callback_caller.validated_callback_caller.side_effect = [RuntimeError('fail'), None]
+        stream_publisher = Mock()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, stream_publisher, workers=1)
+        dispatch_engine.dispatch = Mock(wraps=dispatch_engine.dispatch)
+
+        def dispatched(cmd_msg):
+            try:
+                callback_caller.validated_callback_caller(cmd_msg)
+            finally:
+                if callback_caller.validated_callback_caller.call_count == 2:
+                    called.set()
+
+        dispatch_engine.dispatch.side_effect = dispatched
+
+        dispatch_engine.start()
+        dispatch_engine.submit(command_message())
+        dispatch_engine.submit(command_message())
+
+        assert called.wait(5)
+        dispatch_engine.stop(5)
+        assert callback_caller.validated_callback_caller.call_count == 2
+        assert mock_logger.error.call_args[0][0] == (
+            'Unhandled exception whilst dispatching a CommandMessage')
+
+
+    def test_dispatch_batch_full(self, command_message):
+        callback_caller = Mock()
+        callback_caller.has_batch_callback.return_value = True
+        callback_caller.valid_command_message.return_value = True
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(), batch_max_items=2)
+        cmd_msgs = [command_message(), command_message()]
+
+        dispatch_engine.dispatch(cmd_msgs[0])
+        callback_caller.batch_callback_caller.assert_not_called()
+        dispatch_engine.dispatch(cmd_msgs[1])
+
+        callback_caller.batch_callback_caller.assert_called_once_with('name', cmd_msgs)
+        callback_caller.validated_callback_caller.assert_not_called()
+
+
+    def test_attachment_closed_after_execute(self, command_message):
+        attachment = io.BytesIO(b'data')
+        cmd_msg = command_message()
+        cmd_msg.attachment = attachment
+        callback_caller = Mock()
+        callback_caller.validated_callback_caller.side_effect = lambda msg: msg.attachment.read()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock())
+
+        dispatch_engine.dispatch(cmd_msg)
+
+        assert attachment.closed
+        assert cmd_msg.attachment is None
+
+
+    def test_attachment_closed_after_batch(self, command_message):
+        callback_caller = Mock()
+        callback_caller.has_batch_callback.return_value = True
+        callback_caller.valid_command_message.return_value = True
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(), batch_max_items=2)
+        attachments = [io.BytesIO(b'a'), io.BytesIO(b'b')]
+        cmd_msgs = [command_message(), command_message()]
+        for cmd_msg, attachment in zip(cmd_msgs, attachments):
+            cmd_msg.attachment = attachment
+
+        dispatch_engine.dispatch(cmd_msgs[0])
+        assert not attachments[0].closed
+        dispatch_engine.dispatch(cmd_msgs[1])
+
+        assert all(attachment.closed for attachment in attachments)
+
+
+    def test_attachment_closed_after_task(self, command_message):
+        attachment = io.BytesIO(b'data')
+        cmd_msg = command_message()
+        cmd_msg.attachment = attachment
+        read = []
+
+        async def coroutine():
+            read.append(attachment.read())
+
+        async def dispatch_on_loop(dispatch_engine):
+            dispatch_engine.dispatch(cmd_msg)
+            assert not attachment.closed
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+
+        callback_caller = Mock()
+        callback_caller.validated_callback_caller.return_value = coroutine()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock())
+
+        asyncio.run(dispatch_on_loop(dispatch_engine))
+
+        assert read == [b'data']
+        assert attachment.closed
+
+
+    def test_dispatch_batch_full_exception_dead_letter(self, command_message):
+        callback_caller = Mock()
+        callback_caller.has_batch_callback.return_value = True
+        error = RuntimeError('fail')
+        callback_caller.batch_callback_caller.side_effect = error
+        dead_letter_handler = Mock()
+        audit_journal = Mock()
+        slow_callback_detector = Mock()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(), workers=0,
+                                                  batch_max_items=2,
+                                                  dead_letter_handler=dead_letter_handler,
+                                                  audit_journal=audit_journal,
+                                                  slow_callback_detector=slow_callback_detector)
+        cmd_msgs = [command_message(), command_message()]
+
+        for cmd_msg in cmd_msgs:
+            dispatch_engine.submit(cmd_msg)
+
+        assert [call.args for call in dead_letter_handler.execution_failed.call_args_list] == [
+            (cmd_msgs[0], error), (cmd_msgs[1], error)]
+        assert [call.args[:2] for call in audit_journal.append.call_args_list] == [
+            (cmd_msgs[0], 'error'), (cmd_msgs[1], 'error')]
+        slow_callback_detector.started.assert_any_call(cmd_msgs[0], 2)
+
+
+    def test_dispatch_batch_invalid_command_message(self, command_message):
+        callback_caller = Mock()
+        callback_caller.has_batch_callback.return_value = True
+        callback_caller.valid_command_message.return_value = False
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(), batch_max_items=2)
+
+        dispatch_engine.dispatch(command_message())
+        dispatch_engine.dispatch(command_message())
+
+        callback_caller.batch_callback_caller.assert_not_called()
+
+
+    def test_dispatch_batch_disabled(self, command_message):
+        callback_caller = Mock()
+        callback_caller.has_batch_callback.return_value = True
+        callback_caller.validated_callback_caller.return_value = None
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock())
+        cmd_msg = command_message()
+
+        dispatch_engine.dispatch(cmd_msg)
+
+        callback_caller.validated_callback_caller.assert_called_with(cmd_msg)
+        callback_caller.batch_callback_caller.assert_not_called()
+
+
+    @pytest.mark.parametrize('workers', [0, 1])
+    def test_batch_flushed_after_delay(self, workers, command_message):
+        flushed = threading.Event()
+        callback_caller = Mock()
+        callback_caller.has_batch_callback.return_value = True
+        callback_caller.valid_command_message.return_value = True
+        callback_caller.batch_callback_caller.side_effect = lambda *args: flushed.set()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(), workers=workers,
+                                                  batch_max_items=10, batch_max_delay=0.01)
+        cmd_msg = command_message()
+
+        dispatch_engine.start()
+        dispatch_engine.submit(cmd_msg)
+
+        assert flushed.wait(5)
+        dispatch_engine.stop(5)
+        callback_caller.batch_callback_caller.assert_called_once_with('name', [cmd_msg])
+
+
+    def test_stop_flushes_batches(self, command_message):
+        callback_caller = Mock()
+        callback_caller.has_batch_callback.return_value = True
+        callback_caller.valid_command_message.return_value = True
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(), workers=1,
+                                                  batch_max_items=10, batch_max_delay=60)
+        cmd_msg = command_message()
+
+        dispatch_engine.start()
+        dispatch_engine.dispatch(cmd_msg)
+        dispatch_engine.stop(5)
+
+        callback_caller.batch_callback_caller.assert_called_once_with('name', [cmd_msg])
+
+
+    def test_submit_inline_exception_dead_letter(self, command_message):
+        error = RuntimeError('fail')
+        callback_caller = Mock()
+        callback_caller.validated_callback_caller.side_effect = error
+        dead_letter_handler = Mock()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(), workers=0,
+                                                  dead_letter_handler=dead_letter_handler)
+        cmd_msg = command_message()
+
+        dispatch_engine.submit(cmd_msg)
+
+        dead_letter_handler.execution_failed.assert_called_with(cmd_msg, error)
+
+
+    def test_batch_exception_dead_letter(self, command_message):
+        error = RuntimeError('fail')
+        callback_caller = Mock()
+        callback_caller.batch_callback_caller.side_effect = error
+        dead_letter_handler = Mock()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(),
+                                                  dead_letter_handler=dead_letter_handler)
+        cmd_msgs = [command_message(), command_message()]
+
+        dispatch_engine._run_batch(dispatch._Batch('name', cmd_msgs))
+
+        assert [call.args for call in dead_letter_handler.execution_failed.call_args_list] == [
+            (cmd_msgs[0], error), (cmd_msgs[1], error)]
+
+
+    def test_submit_inline_audit_journal(self, command_message):
+        callback_caller = Mock()
+        callback_caller.validated_callback_caller.side_effect = [None, RuntimeError('fail')]
+        audit_journal = Mock()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(), workers=0,
+                                                  dead_letter_handler=Mock(),
+                                                  audit_journal=audit_journal)
+        cmd_msgs = [command_message(), command_message(), command_message()]
+        cmd_msgs[2].expires_at = 0.0
+
+        for cmd_msg in cmd_msgs:
+            dispatch_engine.submit(cmd_msg)
+
+        assert [call.args[:2] for call in audit_journal.append.call_args_list] == [
+            (cmd_msgs[0], 'ok'), (cmd_msgs[1], 'error'), (cmd_msgs[2], 'expired')]
+        assert all(call.args[2] >= 0 for call in audit_journal.append.call_args_list)
+
+
+    def test_batch_audit_journal(self, command_message):
+        callback_caller = Mock()
+        audit_journal = Mock()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(),
+                                                  audit_journal=audit_journal)
+        cmd_msgs = [command_message(), command_message()]
+
+        dispatch_engine._run_batch(dispatch._Batch('name', cmd_msgs))
+
+        assert [call.args[:2] for call in audit_journal.append.call_args_list] == [
+            (cmd_msgs[0], 'ok'), (cmd_msgs[1], 'ok')]
+
+
+    def test_start_stop_audit_journal(self):
+        audit_journal = Mock()
+        dispatch_engine = dispatch.DispatchEngine(Mock(), Mock(), workers=0,
+                                                  audit_journal=audit_journal)
+
+        dispatch_engine.start()
+        audit_journal.open.assert_called_once_with()
+
+        dispatch_engine.stop()
+        audit_journal.close.assert_called_once_with()
+
+
+    def test_submit_inline_slow_callback_detector(self, command_message):
+        callback_caller = Mock()
+        callback_caller.validated_callback_caller.side_effect = RuntimeError('fail')
+        slow_callback_detector = Mock()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(), workers=0,
+                                                  dead_letter_handler=Mock(),
+                                                  slow_callback_detector=slow_callback_detector)
+        cmd_msg = command_message()
+
+        dispatch_engine.submit(cmd_msg)
+
+        slow_callback_detector.started.assert_called_once_with(cmd_msg, 1)
+        slow_callback_detector.finished.assert_called_once_with(
+            slow_callback_detector.started.return_value)
+
+
+    def test_batch_slow_callback_detector(self, command_message):
+        slow_callback_detector = Mock()
+        dispatch_engine = dispatch.DispatchEngine(Mock(), Mock(),
+                                                  slow_callback_detector=slow_callback_detector)
+        cmd_msgs = [command_message(), command_message()]
+
+        dispatch_engine._run_batch(dispatch._Batch('name', cmd_msgs))
+
+        slow_callback_detector.started.assert_called_once_with(cmd_msgs[0], 2)
+        slow_callback_detector.finished.assert_called_once_with(
+            slow_callback_detector.started.return_value)
+
+
+    def test_start_stop_slow_callback_detector(self):
+        slow_callback_detector = Mock()
+        dispatch_engine = dispatch.DispatchEngine(Mock(), Mock(), workers=0,
+                                                  slow_callback_detector=slow_callback_detector)
+
+        dispatch_engine.start()
+        slow_callback_detector.start.assert_called_once_with()
+
+        dispatch_engine.stop()
+        slow_callback_detector.stop.assert_called_once_with()
+
+
+    @patch('mqtt_remote.dispatch.logger')
+    def test_outcome_logged_with_fields(self, mock_logger, command_message):
+        mock_logger.isEnabledFor.return_value = True
+        callback_caller = Mock()
+        callback_caller.validated_callback_caller.return_value = None
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(), workers=0)
+
+        dispatch_engine.submit(command_message())
+
+        extra = mock_logger.debug.call_args.kwargs['extra']
+        assert extra['command'] == 'name'
+        assert extra['topic'] == 'topic'
+        assert extra['outcome'] == 'ok'
+        assert extra['latency'] >= 0
+
+
+    def test_outcome_metrics(self, command_message):
+        callback_caller = Mock()
+        callback_caller.validated_callback_caller.return_value = None
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(), workers=0)
+        dispatched = metrics.COMMANDS_DISPATCHED.value(('name', 'ok'))
+        timed = metrics.COMMAND_DURATION.histogram(('name',)).snapshot()['count']
+
+        dispatch_engine.submit(command_message())
+
+        assert metrics.COMMANDS_DISPATCHED.value(('name', 'ok')) == dispatched + 1
+        assert metrics.COMMAND_DURATION.histogram(('name',)).snapshot()['count'] == timed + 1
+
+
+    def test_rejected_outcome(self):
+        callback_caller = Mock()
+        callback_caller.valid_command_message.return_value = False
+        audit_journal = Mock()
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(), workers=0,
+                                                  audit_journal=audit_journal)
+        rejected = metrics.COMMANDS_DISPATCHED.value(('<unknown>', 'rejected'))
+        cmd_msg = message.CommandMessage('topic', {'command': 'bogus', 'attributes': {}}, 0,
+                                         False)
+
+        dispatch_engine.submit(cmd_msg)
+
+        callback_caller.validated_callback_caller.assert_not_called()
+        assert metrics.COMMANDS_DISPATCHED.value(('<unknown>', 'rejected')) == rejected + 1
+        assert ('bogus', 'rejected') not in metrics.COMMANDS_DISPATCHED.values()
+        assert ('bogus',) not in metrics.COMMAND_DURATION.histograms()
+        assert audit_journal.append.call_args.args[:2] == (cmd_msg, 'rejected')
+
+
+    def test_queue_wait_metric(self, command_message):
+        callback_caller = Mock()
+        callback_caller.validated_callback_caller.return_value = None
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(), workers=1)
+        waits = metrics.DISPATCH_QUEUE_WAIT.histogram().snapshot()['count']
+
+        dispatch_engine.start()
+        dispatch_engine.submit(command_message())
+        dispatch_engine.stop()
+
+        assert metrics.DISPATCH_QUEUE_WAIT.histogram().snapshot()['count'] == waits + 1
@@ -0,0 +1,57 @@
+import math
+
+import pytest
+
+from mqtt_remote.histogram import LatencyHistogram
+
+
+
+class TestLatencyHistogram:
+
+    def test_no_buckets(self):
+        with pytest.raises(ValueError):
+            LatencyHistogram([])
+
+
+    def test_snapshot(self):
+        histogram = LatencyHistogram([0.01, 0.1, 1])
+
+        for latency in (0.005, 0.05, 0.05, 5):
+            histogram.observe(latency)
+
+        snapshot = histogram.snapshot()
+        assert snapshot['buckets'] == [(0.01, 1), (0.1, 3), (1, 3), (math.inf, 4)]
+        assert snapshot['count'] == 4
+        assert snapshot['sum'] == pytest.approx(5.105)
+        assert snapshot['max'] == 5
+
+
+    @pytest.mark.parametrize('percent, expected', [(0, 0.01), (25, 0.01), (50, 0.1),
+                                                   (75, 0.1), (100, 5)])
+    def test_percentile(self, percent, expected):
+        histogram = LatencyHistogram([0.01, 0.1, 1])
+
+        for latency in (0.005, 0.05, 0.05, 5):
+            histogram.observe(latency)
+
+        assert histogram.percentile(percent) == expected
+
+
+    def test_percentile_capped_at_max(self):
+        histogram = LatencyHistogram([0.01, 0.1, 1])
+        histogram.observe(0.05)
+
+        assert histogram.percentile(99) == 0.05
+
+
+    def test_percentile_empty(self):
+        assert LatencyHistogram().percentile(99) == 0.0
+
+
+    def test_reset(self):
+        histogram = LatencyHistogram()
+        histogram.observe(0.05)
+
+        histogram.reset()
+
+        assert histogram.snapshot()['count'] == 0
@@ -0,0 +1,89 @@
+from unittest.mock import patch
+
+import pytest
+
+import mqtt_remote.journal as journal
+
+
+
+@pytest.fixture
+def publish_journal(tmp_path):
+    publish_journal = journal.PublishJournal(str(tmp_path / 'outbound.db'))
+    publish_journal.open()
+    yield publish_journal
+    publish_journal.close()
+
+
+
+class TestPublishJournal:
+
+    def test_invalid_fsync(self):
+        with pytest.raises(ValueError):
+            journal.PublishJournal('outbound.db', fsync='spam')
+
+
+    def test_append_not_opened(self):
+        with pytest.raises(RuntimeError):
+            journal.PublishJournal(':memory:').append('topic', 'payload', 1, False)
+
+
+    def test_append_and_pending(self, publish_journal):
+        first = publish_journal.append('topic', 'one', 1, False)
+        second = publish_journal.append('topic', b'two', 2, True)
+
+        assert publish_journal.pending() == [(first, 'topic', 'one', 1, False),
+                                             (second, 'topic', b'two', 2, True)]
+        assert publish_journal.pending(limit=1) == [(first, 'topic', 'one', 1, False)]
+        assert len(publish_journal) == 2
+
+
+    def test_acknowledge(self, publish_journal):
+        first = publish_journal.append('topic', 'one', 1, False)
+        second = publish_journal.append('topic', 'two', 1, False)
+
+        publish_journal.acknowledge(first)
+        publish_journal.acknowledge(first)
+
+        assert [entry[0] for entry in publish_journal.pending()] == [second]
+        assert len(publish_journal) == 1
+
+
+    def test_survives_reopening(self, tmp_path):
+        path = str(tmp_path / 'outbound.db')
+        publish_journal = journal.PublishJournal(path)
+        publish_journal.open()
+        entry_id = publish_journal.append('topic', 'one', 1, False)
+        publish_journal.close()
+
+        reopened = journal.PublishJournal(path)
+        reopened.open()
+
+        assert reopened.pending() == [(entry_id, 'topic', 'one', 1, False)]
+        assert len(reopened) == 1
+        reopened.close()
+
+
+    @patch('mqtt_remote.journal.logger')
+    def test_max_messages(self, mock_logger, publish_journal):
+        publish_journal.max_messages = 2
+
+        for payload in ['one', 'two', 'three']:
+            publish_journal.append('topic', payload, 1, False)
+
+        assert [entry[2] for entry in publish_journal.pending()] == ['two', 'three']
+        assert publish_journal.dropped == 1
+        mock_logger.warning.assert_called_with(
+            'Publish journal is full: oldest pending publish discarded (max_messages: 2)')
+
+
+    def test_compaction(self, publish_journal):
+        publish_journal.compact_interval = 2
+        entry_ids = [publish_journal.append('topic', 'x' * 10000, 1, False) for _ in range(3)]
+
+        with patch.object(publish_journal, '_compact',
+                          wraps=publish_journal._compact) as mock_compact:
+            for entry_id in entry_ids:
+                publish_journal.acknowledge(entry_id)
+
+        mock_compact.assert_called_once()
+        assert publish_journal.pending() == []
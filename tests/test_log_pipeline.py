@@ -0,0 +1,168 @@
+import json
+import logging
+import sys
+from unittest.mock import patch
+
+from mqtt_remote.log_pipeline import BackgroundLogging, JsonFormatter, LogSampler
+
+
+
+def log_record(name='mqtt_remote.mqtt_client', level=logging.DEBUG, msg='sent (mid: %s)',
+               args=(1,)):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+
+
+class _ListHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+
+    def emit(self, record):
+        self.records.append(self.format(record))
+
+
+
+class TestLogSampler:
+
+    def test_keeps_every_record_by_default(self):
+        log_sampler = LogSampler()
+
+        assert all(log_sampler.filter(log_record()) for _ in range(100))
+        assert log_sampler.sampled_out == 0
+        assert log_sampler.suppressed == 0
+
+
+    def test_sampling(self):
+        log_sampler = LogSampler({'mqtt_remote': 10})
+
+        kept = [log_sampler.filter(log_record()) for _ in range(100)]
+
+        assert kept.count(True) == 10
+        assert log_sampler.sampled_out == 90
+
+
+    def test_sampling_only_matching_loggers_below_warning(self):
+        log_sampler = LogSampler({'mqtt_remote.mqtt_client': 10})
+
+        assert all(log_sampler.filter(log_record(name='mqtt_remote.message'))
+                   for _ in range(10))
+        assert all(log_sampler.filter(log_record(level=logging.WARNING)) for _ in range(10))
+        assert all(log_sampler.filter(log_record(name='mqtt_remote.mqtt_client_other'))
+                   for _ in range(10))
+
+
+    @patch('mqtt_remote.log_pipeline.time')
+    def test_rate_limit(self, mock_time):
+        log_sampler = LogSampler(max_per_second=3)
+        mock_time.monotonic.return_value = 100.0
+
+        kept = [log_sampler.filter(log_record(args=(mid,))) for mid in range(5)]
+        other = log_sampler.filter(log_record(msg='other'))
+
+        assert kept == [True, True, True, False, False]
+        assert other
+        assert log_sampler.suppressed == 2
+
+        mock_time.monotonic.return_value = 101.0
+        assert log_sampler.filter(log_record())
+
+
+    def test_decision_shared_by_handlers(self):
+        log_sampler = LogSampler({'mqtt_remote': 2})
+
+        for _ in range(4):
+            record = log_record()
+            assert log_sampler.filter(record) == log_sampler.filter(record)
+
+        assert log_sampler.sampled_out == 2
+
+
+
+class TestBackgroundLogging:
+
+    def test_writes_records_from_background_thread(self):
+        handler = _ListHandler()
+        handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+        background_logging = BackgroundLogging([handler])
+        background_logging.start()
+
+        background_logging.handler.handle(log_record(level=logging.INFO))
+        background_logging.stop()
+
+        assert handler.records == ['INFO: sent (mid: 1)']
+
+
+    def test_message_built_before_queued(self):
+        background_logging = BackgroundLogging([_ListHandler()])
+        record = log_record()
+
+        prepared = background_logging.handler.prepare(record)
+
+        assert prepared.msg == 'sent (mid: 1)'
+        assert prepared.args is None
+        assert record.args == (1,)
+
+
+    def test_dropped_when_queue_full(self):
+        background_logging = BackgroundLogging([_ListHandler()], queue_size=2)
+
+        for _ in range(5):
+            background_logging.handler.handle(log_record())
+
+        assert background_logging.metrics() == {'queued': 2, 'dropped': 3, 'sampled_out': 0,
+                                                'suppressed': 0}
+
+
+    def test_log_sampler(self):
+        log_sampler = LogSampler({'mqtt_remote': 5})
+        background_logging = BackgroundLogging([_ListHandler()], log_sampler=log_sampler)
+
+        for _ in range(10):
+            background_logging.handler.handle(log_record())
+
+        metrics = background_logging.metrics()
+        assert metrics['queued'] == 2
+        assert metrics['sampled_out'] == 8
+
+
+
+class TestJsonFormatter:
+
+    def test_format(self):
+        record = log_record(level=logging.INFO)
+
+        output = json.loads(JsonFormatter().format(record))
+
+        assert output['level'] == 'INFO'
+        assert output['logger'] == 'mqtt_remote.mqtt_client'
+        assert output['message'] == 'sent (mid: 1)'
+        assert 'time' in output
+        assert 'command' not in output
+
+
+    def test_format_extra_fields(self):
+        record = log_record()
+        record.__dict__.update({'command': 'volume_up', 'topic': 'spam', 'latency': 0.25,
+                                'outcome': 'ok'})
+
+        output = json.loads(JsonFormatter().format(record))
+
+        assert output['command'] == 'volume_up'
+        assert output['topic'] == 'spam'
+        assert output['latency'] == 0.25
+        assert output['outcome'] == 'ok'
+
+
+    def test_format_exception(self):
+        try:
+            raise RuntimeError('fail')
+        except RuntimeError:
+            record = logging.LogRecord('name', logging.ERROR, __file__, 1, 'failed', None,
+                                       sys.exc_info())
+
+        output = json.loads(JsonFormatter().format(record))
+
+        assert 'RuntimeError: fail' in output['exception']
@@ -1,4 +1,6 @@
 from unittest.mock import Mock, patch
+import base64
+import json
 
 import pytest
 
@@ -36,6 +38,24 @@ class CallbackTwo(message.CommandMessageCallback):
 
 
 
+class SchemaCallback(message.CommandMessageCallback):
+    def __init__(self):
+        self.__message_name = 'schema'
+        self.payload_schema = message.PayloadSchema(
+            message.PayloadField('vol', ['attributes', 'vol'], int, 0, 100))
+
+    @property
+    def message_name(self):
+        return self.__message_name
+
+    def execute(self, message):
+        pass
+
+    def execute_batch(self, messages):
+        pass
+
+
+
 class DisabledCallback(message.CommandMessageCallback):
     def __init__(self):
         self.__message_name = 'three'
@@ -102,6 +122,17 @@ class TestCommandMessage:
         assert msg.payload == {}
 
 
+    @patch('mqtt_remote.message.time.monotonic', return_value=100.0)
+    @pytest.mark.parametrize('expires_at, expected', [(None, False),
+                                                      (99.0, True),
+                                                      (101.0, False)])
+    def test_expired(self, mock_monotonic, expires_at, expected):
+        msg = message.CommandMessage('topic', {'command': 'command', 'attributes': {}}, 0, False)
+        msg.expires_at = expires_at
+
+        assert msg.expired() is expected
+
+
 
 class TestPahoToCommandMessageConvertor:
     def paho_mqtt_msg(self, payload):
@@ -127,6 +158,38 @@ class TestPahoToCommandMessageConvertor:
         assert cmd_msg.call_args[0][1] == expected_output
 
 
+    def test_convert_message_expiry_interval(self):
+        paho_mqtt_msg = self.paho_mqtt_msg(b'{"command": "name", "attributes": {}}')
+        paho_mqtt_msg.properties.MessageExpiryInterval = 5
+        paho_mqtt_msg.timestamp = 100.0
+
+        convertor = message.PahoToCommandMessageConvertor()
+        output = convertor.convert(paho_mqtt_msg)
+
+        assert output.expires_at == 105.0
+
+
+    def test_convert_response_topic(self):
+        paho_mqtt_msg = self.paho_mqtt_msg(b'{"command": "name", "attributes": {}}')
+        paho_mqtt_msg.properties.ResponseTopic = 'reply'
+        paho_mqtt_msg.properties.CorrelationData = b'1'
+
+        convertor = message.PahoToCommandMessageConvertor()
+        output = convertor.convert(paho_mqtt_msg)
+
+        assert (output.response_topic, output.correlation_data) == ('reply', b'1')
+
+
+    def test_convert_no_message_expiry_interval(self):
+        paho_mqtt_msg = self.paho_mqtt_msg(b'{"command": "name", "attributes": {}}')
+        del paho_mqtt_msg.properties
+
+        convertor = message.PahoToCommandMessageConvertor()
+        output = convertor.convert(paho_mqtt_msg)
+
+        assert output.expires_at is None
+
+
     def test_convert_empty_payload(self):
         payload = b'{}'
         paho_mqtt_msg = self.paho_mqtt_msg(payload)
@@ -186,6 +249,104 @@ class TestConvertedCommandMessageForwarder:
         forwarder.forward(raw_message)
 
         forwarder.message_convertor.convert.assert_called_with(raw_message)
+        callback.assert_called_with(message_convertor.convert.return_value)
+
+
+    def test_forward_sets_fingerprint(self):
+        message_convertor = Mock()
+        callback = Mock()
+        dead_letter_handler = Mock()
+        dead_letter_handler.quarantined.return_value = False
+        raw_message = Mock()
+
+        forwarder = message.ConvertedCommandMessageForwarder(message_convertor, callback,
+                                                             dead_letter_handler)
+        forwarder.forward(raw_message)
+
+        dead_letter_handler.fingerprint.assert_called_with(raw_message)
+        assert (message_convertor.convert.return_value.fingerprint
+                == dead_letter_handler.fingerprint.return_value)
+        callback.assert_called_with(message_convertor.convert.return_value)
+
+
+    def test_forward_quarantined(self):
+        message_convertor = Mock()
+        callback = Mock()
+        dead_letter_handler = Mock()
+        dead_letter_handler.quarantined.return_value = True
+
+        forwarder = message.ConvertedCommandMessageForwarder(message_convertor, callback,
+                                                             dead_letter_handler)
+        forwarder.forward(Mock())
+
+        message_convertor.convert.assert_not_called()
+        callback.assert_not_called()
+
+
+    def test_forward_conversion_exception(self):
+        raw_message = Mock()
+        raw_message.payload = b'not json'
+        callback = Mock()
+        dead_letter_handler = Mock()
+        dead_letter_handler.quarantined.return_value = False
+
+        forwarder = message.ConvertedCommandMessageForwarder(
+            message.PahoToCommandMessageConvertor(), callback, dead_letter_handler)
+        forwarder.forward(raw_message)
+
+        callback.assert_not_called()
+        args = dead_letter_handler.conversion_failed.call_args[0]
+        assert args[:2] == (raw_message, dead_letter_handler.fingerprint.return_value)
+        assert isinstance(args[2], json.JSONDecodeError)
+
+
+    @patch('mqtt_remote.message.logger')
+    def test_forward_conversion_exception_no_dead_letter_handler(self, mock_logger):
+        raw_message = Mock()
+        raw_message.payload = b'\xff'
+        callback = Mock()
+
+        forwarder = message.ConvertedCommandMessageForwarder(
+            message.PahoToCommandMessageConvertor(), callback)
+        forwarder.forward(raw_message)
+
+        callback.assert_not_called()
+        assert mock_logger.warning.called
+
+
+    def test_forward_conversion_none(self):
+        message_convertor = Mock()
+        message_convertor.convert.return_value = None
+        callback = Mock()
+        dead_letter_handler = Mock()
+        dead_letter_handler.quarantined.return_value = False
+        raw_message = Mock()
+
+        forwarder = message.ConvertedCommandMessageForwarder(message_convertor, callback,
+                                                             dead_letter_handler)
+        forwarder.forward(raw_message)
+
+        callback.assert_not_called()
+        assert dead_letter_handler.conversion_failed.call_args[0][0] == raw_message
+
+
+    def test_convert(self):
+        message_convertor = Mock()
+        callback = Mock()
+
+        forwarder = message.ConvertedCommandMessageForwarder(message_convertor, callback)
+
+        assert forwarder.convert(Mock()) == message_convertor.convert.return_value
+        callback.assert_not_called()
+
+
+    def test_convert_quarantined(self):
+        dead_letter_handler = Mock()
+        dead_letter_handler.quarantined.return_value = True
+
+        forwarder = message.ConvertedCommandMessageForwarder(Mock(), Mock(), dead_letter_handler)
+
+        assert forwarder.convert(Mock()) is None
 
 
 
@@ -223,8 +384,9 @@ class TestCommandMessageCallbackCaller:
 
         msg_router.add_callback('name', example_function)
 
-        msg_router.callback_caller(command_msg)
+        output = msg_router.callback_caller(command_msg)
 
+        assert output == example_function.return_value
         assert example_function.call_args[0][0].topic == 'topic'
         assert example_function.call_args[0][0].payload == payload
         assert example_function.call_args[0][0].qos == 0
@@ -256,6 +418,130 @@ class TestCommandMessageCallbackCaller:
         mock_logger.warning.assert_called_with(f'No callback registered for: \'name\'')
 
 
+    def test_remove_callback_batch_callback(self, example_function):
+        msg_router = message.CommandMessageCallbackCaller()
+
+        msg_router.add_callback('name', example_function, batch_callback=example_function)
+        msg_router.remove_callback('name')
+
+        assert not msg_router.has_batch_callback('name')
+
+
+    def test_valid_command_message(self, example_function):
+        msg_router = message.CommandMessageCallbackCaller()
+        payload_schema = message.PayloadSchema(
+            message.PayloadField('vol', ['attributes', 'vol'], int, 0, 100))
+        command_message = message.CommandMessage('topic', {"command": "name",
+                                                           "attributes": {"vol": 50}}, 0, False)
+
+        msg_router.add_callback('name', example_function, payload_schema)
+
+        assert msg_router.valid_command_message(command_message)
+        assert command_message.arguments.vol == 50
+        example_function.assert_not_called()
+
+
+    @patch('mqtt_remote.message.logger')
+    def test_valid_command_message_wrong_form(self, mock_logger, example_function):
+        msg_router = message.CommandMessageCallbackCaller()
+        payload_schema = message.PayloadSchema(
+            message.PayloadField('vol', ['attributes', 'vol'], int, 0, 100))
+        command_message = message.CommandMessage('topic', {"command": "name",
+                                                           "attributes": {"vol": 500}}, 0, False)
+
+        msg_router.add_callback('name', example_function, payload_schema)
+
+        assert not msg_router.valid_command_message(command_message)
+        assert mock_logger.error.called
+
+
+    def test_batch_callback_caller(self, example_function):
+        msg_router = message.CommandMessageCallbackCaller()
+        batch_function = Mock()
+        command_messages = [Mock(), Mock()]
+
+        msg_router.add_callback('name', example_function, batch_callback=batch_function)
+        output = msg_router.batch_callback_caller('name', command_messages)
+
+        batch_function.assert_called_with(command_messages)
+        assert output == batch_function.return_value
+        example_function.assert_not_called()
+
+
+    def test_callback_caller_with_payload_schema(self, example_function):
+        msg_router = message.CommandMessageCallbackCaller()
+        payload_schema = message.PayloadSchema(
+            message.PayloadField('vol', ['attributes', 'vol'], int, 0, 100))
+
+        command_message = message.CommandMessage('topic', {"command": "name",
+                                                           "attributes": {"vol": 50}}, 0, False)
+
+        msg_router.add_callback('name', example_function, payload_schema)
+        msg_router.callback_caller(command_message)
+
+        example_function.assert_called_with(command_message)
+        assert command_message.arguments.vol == 50
+
+
+    @patch('mqtt_remote.message.logger')
+    def test_callback_caller_payload_schema_not_satisfied(self, mock_logger, example_function):
+        msg_router = message.CommandMessageCallbackCaller()
+        payload_schema = message.PayloadSchema(
+            message.PayloadField('vol', ['attributes', 'vol'], int, 0, 100))
+
+        command_message = message.CommandMessage('topic', {"command": "name",
+                                                           "attributes": {"vol": 150}}, 0, False)
+
+        msg_router.add_callback('name', example_function, payload_schema)
+        msg_router.callback_caller(command_message)
+
+        example_function.assert_not_called()
+        mock_logger.error.assert_called_with(''.join([
+            'A CommandMessage for the callback: \'name\'must be of the form:\n',
+            '{"command": "name", "attributes": {"vol": <int: 0 to 100>}}']))
+
+
+    def test_callback_caller_callback_keyerror_not_swallowed(self):
+        msg_router = message.CommandMessageCallbackCaller()
+
+        command_message = message.CommandMessage('topic', {"command": "name",
+                                                           "attributes": {}}, 0, False)
+
+        msg_router.add_callback('name', Mock(side_effect=KeyError('key')))
+
+        with pytest.raises(KeyError):
+            msg_router.callback_caller(command_message)
+
+
+    def test_remove_callback_removes_payload_schema(self, example_function):
+        msg_router = message.CommandMessageCallbackCaller()
+        payload_schema = message.PayloadSchema(
+            message.PayloadField('vol', ['attributes', 'vol'], int))
+
+        msg_router.add_callback('name', example_function, payload_schema)
+        msg_router.remove_callback('name')
+
+        assert 'name' not in msg_router._payload_schemas
+
+
+    def test_auto_add_command_message_callbacks_payload_schema(self):
+        msg_router = message.CommandMessageCallbackCaller()
+
+        msg_router.auto_add_command_message_callbacks()
+
+        assert isinstance(msg_router._payload_schemas['schema'], message.CompiledPayloadSchema)
+        assert 'one' not in msg_router._payload_schemas
+
+
+    def test_auto_add_command_message_callbacks_batch_callback(self):
+        msg_router = message.CommandMessageCallbackCaller()
+
+        msg_router.auto_add_command_message_callbacks()
+
+        assert msg_router.has_batch_callback('schema')
+        assert not msg_router.has_batch_callback('one')
+
+
     def test_auto_add_command_message_callbacks(self):
         msg_router = message.CommandMessageCallbackCaller()
 
@@ -361,3 +647,436 @@ class TestLogWrongCommandMessageForm:
         message.log_wrong_command_message_form(callback_name, required_message_form)
 
         mock_logger.error.assert_called_with(error_message)
+
+
+
+class TestPayloadSchema:
+    def payload_schema(self):
+        return message.PayloadSchema(
+            message.PayloadField('name', ['attributes', 'name'], str),
+            message.PayloadField('vol', ['attributes', 'vol'], int, 0, 100),
+            *message.return_message_fields())
+
+
+    def command_msg(self, attributes):
+        return message.CommandMessage('topic', {"command": "name", "attributes": attributes},
+                                      0, False)
+
+
+    def test_extract_valid_payload(self):
+        compiled_schema = self.payload_schema().compile()
+        command_msg = self.command_msg({"name": "spam", "vol": 20,
+                                        "return_message": {"topic": "eggs",
+                                                           "qos": 1,
+                                                           "retain": False}})
+
+        arguments = compiled_schema.extract(command_msg)
+
+        assert arguments == ('spam', 20, 'eggs', 1, False)
+        assert arguments.topic == 'eggs'
+        assert arguments.vol == 20
+
+
+    @pytest.mark.parametrize('attributes', [
+        {"name": "spam", "vol": 20, "return_message": {"topic": "eggs", "qos": 1}},
+        {"name": "spam", "vol": 20, "return_message": "eggs"},
+        {"name": "spam", "vol": "20", "return_message": {"topic": "eggs", "qos": 1,
+                                                         "retain": False}},
+        {"name": "spam", "vol": 101, "return_message": {"topic": "eggs", "qos": 1,
+                                                        "retain": False}},
+        {"name": "spam", "vol": 20, "return_message": {"topic": "eggs", "qos": -1,
+                                                       "retain": False}},
+        {"vol": 20, "return_message": {"topic": "eggs", "qos": 1, "retain": False}}])
+    def test_extract_invalid_payload(self, attributes):
+        compiled_schema = self.payload_schema().compile()
+
+        assert compiled_schema.extract(self.command_msg(attributes)) is None
+
+
+    def test_message_form(self):
+        expected_form = ''.join(['{"command": "cmd", "attributes": {"name": <str>, ',
+                                 '"vol": <int: 0 to 100>, "return_message": {"topic": <str>, ',
+                                 '"qos": <int: 0 to 2>, "retain": <bool>}}}'])
+
+        assert self.payload_schema().message_form('cmd') == expected_form
+        assert self.payload_schema().compile().message_form('cmd') == expected_form
+
+
+    def test_message_form_no_attributes(self):
+        payload_schema = message.PayloadSchema()
+
+        assert payload_schema.message_form('cmd') == '{"command": "cmd", "attributes": {}}'
+
+
+    def test_duplicate_field_names(self):
+        with pytest.raises(ValueError):
+            message.PayloadSchema(message.PayloadField('a', ['attributes', 'a'], int),
+                                  message.PayloadField('a', ['attributes', 'b'], int))
+
+
+    def test_overlapping_fields(self):
+        with pytest.raises(ValueError):
+            message.PayloadSchema(message.PayloadField('a', ['attributes', 'a'], dict),
+                                  message.PayloadField('b', ['attributes', 'a', 'b'], int))
+
+
+
+class TestReplyPayloadSchema:
+    def compiled_schema(self):
+        return message.ReplyPayloadSchema(
+            message.PayloadField('name', ['attributes', 'name'], str)).compile()
+
+
+    def command_msg(self, attributes, **payload):
+        return message.CommandMessage('topic', {"command": "name", "attributes": attributes,
+                                                **payload}, 1, False)
+
+
+    def test_extract_return_message(self):
+        command_msg = self.command_msg({"name": "spam",
+                                        "return_message": {"topic": "eggs",
+                                                           "qos": 1,
+                                                           "retain": False}})
+
+        assert self.compiled_schema().extract(command_msg) == ('spam', 'eggs', 1, False)
+
+
+    def test_extract_mqtt_v5_response_topic(self):
+        command_msg = self.command_msg({"name": "spam"})
+        command_msg.response_topic = 'replies'
+
+        arguments = self.compiled_schema().extract(command_msg)
+
+        assert arguments == ('spam', None, None, None)
+        assert arguments.topic is None
+
+
+    def test_extract_payload_response_topic(self):
+        command_msg = self.command_msg({"name": "spam"}, response_topic='replies')
+
+        assert self.compiled_schema().extract(command_msg) == ('spam', None, None, None)
+
+
+    @pytest.mark.parametrize('attributes, payload', [
+        ({"name": "spam"}, {}),
+        ({"name": "spam", "return_message": {"topic": "eggs", "qos": 1}}, {}),
+        ({}, {"response_topic": "replies"})])
+    def test_extract_invalid_payload(self, attributes, payload):
+        command_msg = self.command_msg(attributes, **payload)
+
+        assert self.compiled_schema().extract(command_msg) is None
+
+
+    def test_message_form(self):
+        expected_form = ''.join(['{"command": "cmd", "attributes": {"name": <str>, ',
+                                 '"return_message": {"topic": <str>, ',
+                                 '"qos": <int: 0 to 2>, "retain": <bool>}}}'])
+
+        assert self.compiled_schema().message_form('cmd') == expected_form
+
+
+
+class TestRedactedPayload:
+    def test_secret_attributes_redacted(self):
+        payload = {'command': 'name', 'attributes': {'token': 'secret', 'vol': 5}}
+
+        output = message.redacted_payload(payload)
+
+        assert output == {'command': 'name', 'attributes': {'token': '***', 'vol': 5}}
+        assert payload['attributes']['token'] == 'secret'
+
+
+    def test_no_secret_attributes(self):
+        payload = {'command': 'name', 'attributes': {'vol': 5}}
+
+        assert message.redacted_payload(payload) is payload
+
+
+
+class TestChunkPayloads:
+    def test_chunk_payloads(self):
+        data = b'0123456789'
+
+        payloads = list(message.chunk_payloads(data, 4, transfer_id='id'))
+
+        assert [p['command'] for p in payloads] == [message.CHUNK_COMMAND_NAME] * 3
+        assert [p['attributes']['sequence'] for p in payloads] == [0, 1, 2]
+        assert all(p['attributes']['total'] == 3 for p in payloads)
+        assert all(p['attributes']['size'] == 10 for p in payloads)
+        assert b''.join(base64.b64decode(p['attributes']['data']) for p in payloads) == data
+        assert 'message' not in payloads[0]['attributes']
+
+
+    def test_chunk_payloads_message_payload(self):
+        message_payload = {"command": "name", "attributes": {}}
+
+        payloads = list(message.chunk_payloads('abcdef', 4, message_payload))
+
+        assert payloads[0]['attributes']['message'] == message_payload
+        assert 'message' not in payloads[1]['attributes']
+
+
+    def test_chunk_payloads_empty_data(self):
+        payloads = list(message.chunk_payloads(b'', 4))
+
+        assert len(payloads) == 1
+        assert payloads[0]['attributes']['total'] == 1
+
+
+    def test_chunk_payloads_invalid_chunk_size(self):
+        with pytest.raises(ValueError):
+            list(message.chunk_payloads(b'data', 0))
+
+
+    def test_publish_chunked(self):
+        publish_function = Mock()
+
+        transfer_id = message.publish_chunked(publish_function, 'topic', b'0123456789', 1,
+                                              False, 4)
+
+        assert publish_function.call_count == 3
+        topic, payload, qos, retain = publish_function.call_args[0]
+        assert (topic, qos, retain) == ('topic', 1, False)
+        assert json.loads(payload)['attributes']['transfer_id'] == transfer_id
+
+
+
+class TestChunkReassembler:
+    def chunk_messages(self, data, chunk_size, message_payload=None, transfer_id=None):
+        compiled_schema = message.CHUNK_PAYLOAD_SCHEMA.compile()
+        chunk_messages = []
+
+        for payload in message.chunk_payloads(data, chunk_size, message_payload, transfer_id):
+            chunk_message = message.CommandMessage('topic', payload, 1, False)
+            chunk_message.arguments = compiled_schema.extract(chunk_message)
+            chunk_messages.append(chunk_message)
+
+        return chunk_messages
+
+
+    def test_reassemble_command_payload(self):
+        callback = Mock()
+        payload = {"command": "name", "attributes": {"text": "spam" * 100}}
+
+        reassembler = message.ChunkReassembler(callback)
+        for chunk_message in self.chunk_messages(json.dumps(payload), 64):
+            reassembler.receive(chunk_message)
+
+        completed_message = callback.call_args[0][0]
+        assert completed_message.payload == payload
+        assert completed_message.topic == 'topic'
+        assert completed_message.attachment is None
+
+
+    def test_reassemble_out_of_order_with_attachment(self):
+        data = bytes(range(256)) * 10
+        message_payload = {"command": "name", "attributes": {}}
+        received = []
+
+        def callback(command_message):
+            received.append((command_message.payload, command_message.attachment.read()))
+
+        reassembler = message.ChunkReassembler(callback, spool_size=100)
+        for chunk_message in reversed(self.chunk_messages(data, 100, message_payload)):
+            reassembler.receive(chunk_message)
+
+        assert received == [(message_payload, data)]
+
+
+    def test_duplicate_parts_ignored(self):
+        callback = Mock()
+        chunk_messages = self.chunk_messages(b'0123456789', 4, {"command": "name",
+                                                                "attributes": {}})
+
+        reassembler = message.ChunkReassembler(callback)
+        for chunk_message in [chunk_messages[0], chunk_messages[0], chunk_messages[1]]:
+            reassembler.receive(chunk_message)
+
+        callback.assert_not_called()
+
+        reassembler.receive(chunk_messages[2])
+
+        callback.assert_called_once()
+
+
+    @patch('mqtt_remote.message.logger')
+    def test_checksum_failure(self, mock_logger):
+        callback = Mock()
+        chunk_messages = self.chunk_messages(b'0123456789', 4, {"command": "name",
+                                                                "attributes": {}})
+        for chunk_message in chunk_messages:
+            chunk_message.arguments = chunk_message.arguments._replace(checksum='bad')
+
+        reassembler = message.ChunkReassembler(callback)
+        for chunk_message in chunk_messages:
+            reassembler.receive(chunk_message)
+
+        callback.assert_not_called()
+        mock_logger.warning.assert_called_with(''.join([
+            f"Chunked transfer '{chunk_messages[0].arguments.transfer_id}' ",
+            "failed its checksum"]))
+
+
+    @patch('mqtt_remote.message.logger')
+    def test_transfer_too_large(self, mock_logger):
+        callback = Mock()
+
+        reassembler = message.ChunkReassembler(callback, max_transfer_size=5)
+        for chunk_message in self.chunk_messages(b'0123456789', 4, transfer_id='id'):
+            reassembler.receive(chunk_message)
+
+        callback.assert_not_called()
+        mock_logger.warning.assert_called_with(''.join([
+            "Chunked transfer 'id' rejected: 10 bytes exceeds the maximum of 5 bytes"]))
+
+
+    @patch('mqtt_remote.message.logger')
+    def test_max_transfers(self, mock_logger):
+        callback = Mock()
+
+        reassembler = message.ChunkReassembler(callback, max_transfers=1)
+        reassembler.receive(self.chunk_messages(b'0123456789', 4, transfer_id='one')[0])
+        reassembler.receive(self.chunk_messages(b'0123456789', 4, transfer_id='two')[0])
+
+        mock_logger.warning.assert_called_with(''.join([
+            "Chunked transfer 'two' rejected: 1 transfers already in progress"]))
+
+
+    @patch('mqtt_remote.message.logger')
+    def test_incomplete_transfer_times_out(self, mock_logger):
+        callback = Mock()
+        clock = Mock(return_value=0)
+        chunk_messages = self.chunk_messages(b'0123456789', 4, transfer_id='id')
+
+        reassembler = message.ChunkReassembler(callback, timeout=10, clock=clock)
+        reassembler.receive(chunk_messages[0])
+
+        clock.return_value = 11
+        reassembler.receive(chunk_messages[1])
+        reassembler.receive(chunk_messages[2])
+
+        callback.assert_not_called()
+        mock_logger.warning.assert_any_call(
+            "Chunked transfer 'id' timed out: 1 of 3 parts received")
+
+
+    def test_attachment_owned_by_command_message(self):
+        callback = Mock()
+        chunk_messages = self.chunk_messages(b'0123456789', 4, {"command": "name",
+                                                                "attributes": {}})
+
+        reassembler = message.ChunkReassembler(callback)
+        for chunk_message in chunk_messages:
+            reassembler.receive(chunk_message)
+
+        completed_message = callback.call_args[0][0]
+        attachment = completed_message.attachment
+        assert attachment.read() == b'0123456789'
+
+        completed_message.close_attachment()
+
+        assert attachment.closed
+        assert completed_message.attachment is None
+
+
+    @patch('mqtt_remote.message.logger')
+    def test_abandoned_transfer_swept(self, mock_logger):
+        reassembler = message.ChunkReassembler(Mock(), timeout=0.01)
+        reassembler.receive(self.chunk_messages(b'0123456789', 4, transfer_id='id')[0])
+        sweeper = reassembler._sweeper
+
+        sweeper.join(5)
+
+        assert not sweeper.is_alive()
+        assert reassembler._transfers == {}
+        assert reassembler._sweeper is None
+        mock_logger.warning.assert_called_with(
+            "Chunked transfer 'id' timed out: 1 of 3 parts received")
+
+
+    @patch('mqtt_remote.message.logger')
+    def test_invalid_part(self, mock_logger):
+        callback = Mock()
+        chunk_message = self.chunk_messages(b'0123456789', 4, transfer_id='id')[0]
+        chunk_message.arguments = chunk_message.arguments._replace(data='AAAA')
+
+        reassembler = message.ChunkReassembler(callback)
+        reassembler.receive(chunk_message)
+
+        mock_logger.warning.assert_called_with(
+            "Chunked transfer 'id': part 0 is invalid and was ignored")
+
+
+
+def reply_message(qos=1, **payload):
+    payload = {'command': 'name', 'attributes': {}, **payload}
+    return message.CommandMessage('topic', payload, qos, False)
+
+
+
+class TestReply:
+    def test_reply_mqtt_v5(self):
+        mqtt_publish = Mock()
+        command_message = reply_message()
+        command_message.response_topic = 'reply'
+        command_message.correlation_data = b'1'
+
+        assert message.reply(mqtt_publish, command_message, 'spam')
+
+        assert mqtt_publish.call_args[0] == ('reply', 'spam', 1, False)
+        assert mqtt_publish.call_args[1]['properties'].CorrelationData == b'1'
+
+
+    def test_reply_envelope(self):
+        mqtt_publish = Mock()
+        command_message = reply_message(response_topic='reply', correlation_data='1')
+
+        assert message.reply(mqtt_publish, command_message, 'spam')
+
+        topic, payload, qos, retain = mqtt_publish.call_args[0]
+        assert (topic, qos, retain) == ('reply', 1, False)
+        assert json.loads(payload) == {'correlation_data': '1', 'payload': 'spam'}
+
+
+    def test_reply_return_message(self):
+        mqtt_publish = Mock()
+        command_message = reply_message(
+            attributes={'return_message': {'topic': 'reply', 'qos': 2, 'retain': True}})
+
+        assert message.reply(mqtt_publish, command_message, 'spam')
+
+        mqtt_publish.assert_called_once_with('reply', 'spam', 2, True)
+
+
+    @patch('mqtt_remote.message.logger')
+    def test_reply_no_address(self, mock_logger):
+        mqtt_publish = Mock()
+        command_message = reply_message(
+            attributes={'return_message': {'topic': 'reply', 'qos': 3, 'retain': True}})
+
+        assert not message.reply(mqtt_publish, command_message, 'spam')
+
+        mqtt_publish.assert_not_called()
+        mock_logger.warning.assert_called_once()
+
+
+    def test_callback_reply(self):
+        callback = CallbackOne()
+        callback.mqtt_publish = Mock()
+
+        callback.reply(reply_message(response_topic='reply'), 'spam')
+
+        callback.mqtt_publish.assert_called_once_with('reply', 'spam', 1, False)
+
+
+    def test_group_by_reply_address(self):
+        command_messages = [reply_message(response_topic='a', correlation_data='1'),
+                            reply_message(response_topic='a', correlation_data='2'),
+                            reply_message(response_topic='b'),
+                            reply_message(response_topic='b'),
+                            reply_message()]
+
+        output = message.group_by_reply_address(command_messages)
+
+        assert list(output.values()) == [[command_messages[0]], [command_messages[1]],
+                                         command_messages[2:4]]
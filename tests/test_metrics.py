@@ -0,0 +1,164 @@
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import mqtt_remote.metrics as metrics
+
+
+
+class TestCounter:
+
+    def test_inc(self):
+        counter = metrics.Counter('spam_total', 'Spam')
+
+        counter.inc()
+        counter.inc(2)
+
+        assert counter.value() == 3
+
+
+    def test_inc_labels(self):
+        counter = metrics.Counter('spam_total', 'Spam', ['command'])
+
+        counter.inc(labels=('one',))
+        counter.inc(labels=('two',))
+        counter.inc(labels=('one',))
+
+        assert counter.values() == {('one',): 2, ('two',): 1}
+
+
+    def test_inc_threads(self):
+        counter = metrics.Counter('spam_total', 'Spam')
+
+        def count():
+            for _ in range(1000):
+                counter.inc()
+
+        threads = [threading.Thread(target=count) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert counter.value() == 4000
+
+
+    def test_collect(self):
+        counter = metrics.Counter('spam_total', 'Spam eaten', ['command'])
+        counter.inc(labels=('say "hi"\n',))
+
+        assert counter.collect() == ['# HELP spam_total Spam eaten',
+                                     '# TYPE spam_total counter',
+                                     'spam_total{command="say \\"hi\\"\\n"} 1']
+
+
+
+class TestHistogram:
+
+    def test_collect(self):
+        histogram = metrics.Histogram('spam_seconds', 'Spam time', ['command'], [0.1, 1])
+
+        histogram.observe(0.05, labels=('one',))
+        histogram.observe(0.5, labels=('one',))
+
+        assert histogram.collect() == ['# HELP spam_seconds Spam time',
+                                       '# TYPE spam_seconds histogram',
+                                       'spam_seconds_bucket{command="one",le="0.1"} 1',
+                                       'spam_seconds_bucket{command="one",le="1"} 2',
+                                       'spam_seconds_bucket{command="one",le="+Inf"} 2',
+                                       'spam_seconds_sum{command="one"} 0.55',
+                                       'spam_seconds_count{command="one"} 2']
+
+
+
+class TestGauge:
+
+    def test_collect(self):
+        gauge = metrics.Gauge('spam_depth', 'Spam queued', lambda: 7)
+
+        assert gauge.collect()[-1] == 'spam_depth 7'
+
+
+    def test_collect_labels(self):
+        gauge = metrics.Gauge('spam_depth', 'Spam queued', lambda: {('a',): 1}, ['queue'])
+
+        assert gauge.collect()[-1] == 'spam_depth{queue="a"} 1'
+
+
+    def test_collect_error(self):
+        def broken():
+            raise RuntimeError('fail')
+
+        gauge = metrics.Gauge('spam_depth', 'Spam queued', broken)
+
+        assert gauge.collect() == ['# HELP spam_depth Spam queued',
+                                   '# TYPE spam_depth gauge']
+
+
+
+class TestMetricsRegistry:
+
+    def test_counter_registered_once(self):
+        registry = metrics.MetricsRegistry()
+
+        counter = registry.counter('spam_total', 'Spam', ['command'])
+
+        assert registry.counter('spam_total', 'Spam', ['command']) is counter
+        assert registry.get('spam_total') is counter
+
+
+    def test_conflicting_metric(self):
+        registry = metrics.MetricsRegistry()
+        registry.counter('spam_total', 'Spam')
+
+        with pytest.raises(ValueError):
+            registry.histogram('spam_total', 'Spam')
+        with pytest.raises(ValueError):
+            registry.counter('spam_total', 'Spam', ['command'])
+        with pytest.raises(ValueError):
+            registry.gauge('spam_total', 'Spam', lambda: 1)
+
+
+    def test_exposition(self):
+        registry = metrics.MetricsRegistry()
+        registry.counter('b_total', 'B').inc()
+        registry.gauge('a_depth', 'A', lambda: 2)
+
+        assert registry.exposition() == '\n'.join(['# HELP a_depth A',
+                                                   '# TYPE a_depth gauge',
+                                                   'a_depth 2',
+                                                   '# HELP b_total B',
+                                                   '# TYPE b_total counter',
+                                                   'b_total 1']) + '\n'
+
+
+    def test_unregister(self):
+        registry = metrics.MetricsRegistry()
+        registry.gauge('a_depth', 'A', lambda: 2)
+
+        registry.unregister('a_depth')
+
+        assert registry.exposition() == '\n'
+
+
+
+class TestMetricsServer:
+
+    def test_serves_metrics(self):
+        registry = metrics.MetricsRegistry()
+        registry.counter('spam_total', 'Spam').inc()
+        metrics_server = metrics.MetricsServer(registry, '127.0.0.1', 0)
+        metrics_server.start()
+
+        try:
+            url = f'http://127.0.0.1:{metrics_server.port}'
+            with urllib.request.urlopen(f'{url}/metrics', timeout=5) as response:
+                assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+                assert 'spam_total 1' in response.read().decode('utf-8')
+
+            with pytest.raises(urllib.error.HTTPError):
+                urllib.request.urlopen(f'{url}/other', timeout=5)
+        finally:
+            metrics_server.stop()
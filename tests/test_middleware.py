@@ -0,0 +1,124 @@
+from unittest.mock import Mock
+
+import pytest
+
+from mqtt_remote.middleware import MiddlewarePipeline
+
+
+
+def upper(message):
+    return message.upper()
+
+
+def drop(message):
+    return None
+
+
+
+class TestMiddlewarePipeline:
+
+    def test_process(self):
+        dispatch = Mock()
+        middleware = MiddlewarePipeline([('upper', upper), ('dispatch', dispatch)])
+
+        middleware.process('spam')
+
+        dispatch.assert_called_once_with('SPAM')
+
+
+    def test_process_no_stages(self):
+        middleware = MiddlewarePipeline()
+
+        assert not middleware
+        assert middleware.process('spam') == 'spam'
+
+
+    def test_stage_stops_message(self):
+        dispatch = Mock()
+        middleware = MiddlewarePipeline([('drop', drop), ('dispatch', dispatch)])
+
+        assert middleware.process('spam') is None
+        dispatch.assert_not_called()
+
+
+    def test_add_before_and_after(self):
+        middleware = MiddlewarePipeline([('convert', upper), ('dispatch', Mock())])
+
+        middleware.add('auth', upper, before='convert')
+        middleware.add('route', upper, after='convert')
+
+        assert middleware.names() == ['auth', 'convert', 'route', 'dispatch']
+
+
+    @pytest.mark.parametrize('name, kwargs', [('convert', {}),
+                                              ('auth', {'before': 'spam'}),
+                                              ('auth', {'after': 'spam'}),
+                                              ('auth', {'before': 'convert',
+                                                        'after': 'convert'})])
+    def test_add_invalid(self, name, kwargs):
+        middleware = MiddlewarePipeline([('convert', upper)])
+
+        with pytest.raises(ValueError):
+            middleware.add(name, upper, **kwargs)
+
+
+    def test_remove(self):
+        middleware = MiddlewarePipeline([('drop', drop), ('upper', upper)])
+
+        middleware.remove('drop')
+
+        assert middleware.process('spam') == 'SPAM'
+        with pytest.raises(ValueError):
+            middleware.remove('drop')
+
+
+    def test_change_whilst_processing(self):
+        middleware = MiddlewarePipeline()
+        seen = []
+
+        def remove_self(message):
+            middleware.remove('remove_self')
+            return message
+
+        middleware.add('remove_self', remove_self)
+        middleware.add('record', seen.append)
+        middleware.process('spam')
+        middleware.process('eggs')
+
+        assert middleware.names() == ['record']
+        assert seen == ['spam', 'eggs']
+
+
+    def test_stage_metrics(self):
+        middleware = MiddlewarePipeline([('upper', upper), ('drop', drop), ('dispatch', Mock())],
+                                        timed=True)
+
+        middleware.process('spam')
+        middleware.process('eggs')
+
+        metrics = middleware.stage_metrics()
+        assert list(metrics) == ['upper', 'drop', 'dispatch']
+        assert (metrics['upper']['calls'], metrics['upper']['dropped']) == (2, 0)
+        assert (metrics['drop']['calls'], metrics['drop']['dropped']) == (2, 2)
+        assert metrics['dispatch']['calls'] == 0
+        assert metrics['drop']['time_max'] >= 0
+
+
+    def test_stage_metrics_last_stage_not_dropped(self):
+        middleware = MiddlewarePipeline([('upper', upper), ('dispatch', drop)], timed=True)
+
+        middleware.process('spam')
+
+        metrics = middleware.stage_metrics()
+        assert (metrics['dispatch']['calls'], metrics['dispatch']['dropped']) == (1, 0)
+
+
+    def test_stage_metrics_untimed(self):
+        middleware = MiddlewarePipeline([('upper', upper)])
+
+        middleware.process('spam')
+        assert middleware.stage_metrics()['upper']['calls'] == 0
+
+        middleware.timed = True
+        middleware.process('spam')
+        assert middleware.stage_metrics()['upper']['calls'] == 1
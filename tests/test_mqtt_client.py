@@ -1,12 +1,33 @@
-from unittest.mock import Mock, patch, NonCallableMock
+from unittest.mock import Mock, patch, NonCallableMock, call
+import time
+import threading
 
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from paho.mqtt.reasoncodes import ReasonCodes
 import pytest
 
+import mqtt_remote.metrics as metrics
+import mqtt_remote.mqtt_client as mqtt_client_module
 from mqtt_remote.mqtt_client import CallbackSet
+from mqtt_remote.reconnect import ReconnectSupervisor
 
 
 
+def tracked(*ages):
+    """Returns a table of tracked publishes, keyed by message id from 0, published 'ages'
+    seconds ago
+    """
+    handles = {}
+    for mid, age in enumerate(ages):
+        handle = mqtt_client_module.PublishHandle('topic', 1)
+        handle.mid = mid
+        handle.published -= age
+        handles[mid] = handle
+    return handles
+
+
 class TestCallbackSet:
     def callback(self, suffix):
         callback = Mock()
@@ -14,6 +35,19 @@ class TestCallbackSet:
         return callback
 
 
+    def test_remove_whilst_iterating(self):
+        callback_set = CallbackSet()
+        callback_one = self.callback('one')
+        callback_two = self.callback('two')
+        callback_set.add(callback_one)
+        callback_set.add(callback_two)
+
+        for callback in callback_set:
+            callback_set.remove(callback)
+
+        assert not callback_set
+
+
     @patch('mqtt_remote.mqtt_client.logger')
     def test_add_valid_callback(self, mock_logger):
         callback_set = CallbackSet()
@@ -121,16 +155,16 @@ class TestMQTTClient:
         mock_logger.info.assert_called_with("MQTTClient has started")
 
 
-    @patch('mqtt_remote.mqtt_client.logger')
-    def test_start_blocking_connectionrefusederror(self, mock_logger, mqtt_client):
+    def test_start_retries_first_connection(self, mqtt_client, mqtt_config):
         mqtt_client.initialise()
 
-        error = ConnectionRefusedError('TestError')
-        mqtt_client._mqtt_client.connect.side_effect = error
-
         mqtt_client.start('blocking')
 
-        mock_logger.warning.assert_called_with(error)
+        mqtt_client._mqtt_client.connect_async.assert_called_with(
+            host=mqtt_config["broker_ip"], port=mqtt_config["broker_port"],
+            keepalive=mqtt_config["broker_keepalive"])
+        mqtt_client._mqtt_client.loop_forever.assert_called_with(retry_first_connection=True)
+        mqtt_client._mqtt_client.connect.assert_not_called()
 
 
     def test_start_invalid_loop_type(self, mqtt_client):
@@ -154,6 +188,325 @@ class TestMQTTClient:
         mock_logger.info.assert_called_with("MQTTClient has stopped")
 
 
+    def test_pending_publish_count(self, mqtt_client):
+        mqtt_client._publish_mid = tracked(0, 0)
+
+        assert mqtt_client.pending_publish_count() == 2
+
+
+    @patch('mqtt_remote.mqtt_client.logger')
+    def test_publish_many(self, mock_logger, mqtt_client):
+        mqtt_client.initialise()
+        mqtt_client._mqtt_client.publish.side_effect = [(0, 1), (1, 2)]
+        messages = [('topic', 'one', 0, False), ('topic', 'two', 1, True)]
+
+        output = mqtt_client.publish_many(messages)
+
+        assert [handle.mid for handle in output] == [1, 2]
+        assert mqtt_client._publish_mid[1] is output[0]
+        assert isinstance(output[1].future.exception(), mqtt_client_module.PublishError)
+        mqtt_client._mqtt_client.publish.assert_called_with('topic', payload='two', qos=1,
+                                                           retain=True)
+        mock_logger.warning.assert_called_once_with(''.join([
+            "Message publishing: preperation error or problem connecting to MQTT Broker: ",
+            f"{mqtt.error_string(1)} (mid: 2)"]))
+        mock_logger.debug.assert_called_with("Preparations for sending %d of %d messages succeeded",
+                                             1, 2)
+
+
+    def test_publish_many_no_initialisation(self, mqtt_client):
+        with pytest.raises(RuntimeError):
+            mqtt_client.publish_many([('topic', 'one', 0, False)])
+
+
+    def test_invalid_queue_full_policy(self, mqtt_config):
+        with pytest.raises(ValueError):
+            mqtt_client_module.MQTTClient(*[mqtt_config[key] for key in [
+                "broker_user_name", "broker_password", "broker_ip", "broker_port",
+                "broker_keepalive", "subscription_topics", "mqtt_client_id",
+                "mqtt_clean_session", "mqtt_protocol", "mqtt_transport", "log_client"]],
+                queue_full_policy='spam')
+
+
+    @patch('mqtt_remote.mqtt_client.logger')
+    def test_publish_queue_full_drop(self, mock_logger, mqtt_client, pub_msg):
+        mqtt_client.initialise()
+        mqtt_client.max_queued = 1
+        mqtt_client.queue_full_policy = 'drop'
+        mqtt_client._publish_mid = tracked(0)
+
+        mqtt_client.publish(pub_msg.topic, pub_msg.message, pub_msg.qos, pub_msg.retain)
+
+        mqtt_client._mqtt_client.publish.assert_not_called()
+        assert mqtt_client.outbound_metrics()['dropped'] == 1
+        mock_logger.warning.assert_called_with(
+            "Outbound queue is full: message dropped (max_queued: 1)")
+
+
+    def test_publish_queue_full_raise(self, mqtt_client, pub_msg):
+        mqtt_client.initialise()
+        mqtt_client.max_queued = 1
+        mqtt_client.queue_full_policy = 'raise'
+        mqtt_client._publish_mid = tracked(0)
+
+        with pytest.raises(mqtt_client_module.OutboundQueueFullError):
+            mqtt_client.publish(pub_msg.topic, pub_msg.message, pub_msg.qos, pub_msg.retain)
+
+
+    def test_publish_queue_full_block(self, mqtt_client, pub_msg):
+        mqtt_client.initialise()
+        mqtt_client.max_queued = 1
+        mqtt_client._mqtt_client.publish.return_value = (0, 1)
+        mqtt_client._publish_mid = tracked(0)
+        timer = threading.Timer(0.01, mqtt_client._on_publish, (mqtt_client._mqtt_client, "", 0))
+        timer.start()
+
+        mqtt_client.publish(pub_msg.topic, pub_msg.message, pub_msg.qos, pub_msg.retain)
+
+        timer.join()
+        mqtt_client._mqtt_client.publish.assert_called_once()
+        metrics = mqtt_client.outbound_metrics()
+        assert (metrics['blocked'], metrics['dropped'], metrics['queue_depth']) == (1, 0, 1)
+
+
+    def test_publish_queue_full_block_timeout(self, mqtt_client, pub_msg):
+        mqtt_client.initialise()
+        mqtt_client.max_queued = 1
+        mqtt_client.queue_full_timeout = 0.01
+        mqtt_client._publish_mid = tracked(0)
+
+        mqtt_client.publish(pub_msg.topic, pub_msg.message, pub_msg.qos, pub_msg.retain)
+
+        mqtt_client._mqtt_client.publish.assert_not_called()
+        assert mqtt_client.outbound_metrics()['dropped'] == 1
+
+
+    def test_publish_queue_full_block_network_thread(self, mqtt_client, pub_msg):
+        mqtt_client.initialise()
+        mqtt_client.max_queued = 1
+        mqtt_client._network_thread = threading.current_thread()
+        mqtt_client._publish_mid = tracked(0)
+
+        mqtt_client.publish(pub_msg.topic, pub_msg.message, pub_msg.qos, pub_msg.retain)
+
+        metrics = mqtt_client.outbound_metrics()
+        assert (metrics['blocked'], metrics['dropped']) == (0, 1)
+
+
+    def test_publish_many_queue_full(self, mqtt_client):
+        mqtt_client.initialise()
+        mqtt_client.max_queued = 1
+        mqtt_client.queue_full_policy = 'drop'
+        mqtt_client._mqtt_client.publish.return_value = (0, 1)
+
+        output = mqtt_client.publish_many([('topic', 'one', 0, False), ('topic', 'two', 0, False)])
+
+        assert output[0].mid == 1
+        assert output[1].mid is None
+        assert isinstance(output[1].future.exception(), mqtt_client_module.PublishError)
+        mqtt_client._mqtt_client.publish.assert_called_once()
+
+
+    def test_outbound_metrics(self, mqtt_client):
+        mqtt_client.initialise()
+        mqtt_client._mqtt_client._inflight_messages = 3
+        mqtt_client._publish_mid = tracked(1, 0)
+
+        metrics = mqtt_client.outbound_metrics()
+
+        assert metrics['queue_depth'] == 2
+        assert metrics['inflight'] == 3
+        assert metrics['oldest_age'] >= 1
+        assert metrics['time_in_queue_avg'] == 0.0
+
+
+    def test_publish_handle_delivered(self, mqtt_client):
+        mqtt_client.initialise()
+        mqtt_client._mqtt_client.publish.return_value = (0, 1)
+
+        handle = mqtt_client.publish('topic', 'message', 1, False)
+        assert not handle.done()
+        mqtt_client._on_publish(mqtt_client._mqtt_client, "", 1)
+
+        latency = handle.wait(1)
+        assert (handle.mid, handle.latency) == (1, latency)
+        assert latency >= 0
+        assert mqtt_client.delivery_latency.snapshot()['count'] == 1
+        assert mqtt_client.outbound_metrics()['delivery_latency_p99'] == pytest.approx(latency)
+
+
+    @pytest.mark.parametrize('result, qos', [(mqtt.MQTT_ERR_QUEUE_SIZE, 1),
+                                             (mqtt.MQTT_ERR_NO_CONN, 0)])
+    def test_publish_handle_refused(self, mqtt_client, result, qos):
+        mqtt_client.initialise()
+        mqtt_client._mqtt_client.publish.return_value = (result, 1)
+
+        handle = mqtt_client.publish('topic', 'message', qos, False)
+
+        with pytest.raises(mqtt_client_module.PublishError):
+            handle.wait(1)
+        assert mqtt_client._publish_mid == {}
+
+
+    def test_publish_handle_dropped(self, mqtt_client, pub_msg):
+        mqtt_client.initialise()
+        mqtt_client.max_queued = 1
+        mqtt_client.queue_full_policy = 'drop'
+        mqtt_client._publish_mid = tracked(0)
+
+        handle = mqtt_client.publish(pub_msg.topic, pub_msg.message, pub_msg.qos, pub_msg.retain)
+
+        assert isinstance(handle.future.exception(), mqtt_client_module.PublishError)
+
+
+    def test_publish_handle_expired(self, mqtt_client):
+        mqtt_client.initialise()
+        mqtt_client.delivery_timeout = 10
+        mqtt_client._mqtt_client.publish.return_value = (0, 2)
+        mqtt_client._publish_mid = tracked(11)
+        expired = mqtt_client._publish_mid[0]
+
+        handle = mqtt_client.publish('topic', 'message', 1, False)
+
+        assert isinstance(expired.future.exception(), mqtt_client_module.PublishError)
+        assert list(mqtt_client._publish_mid) == [2]
+        assert not handle.done()
+        assert mqtt_client.outbound_metrics()['expired'] == 1
+
+
+    def test_publish_handle_mid_reused(self, mqtt_client):
+        mqtt_client.initialise()
+        mqtt_client._mqtt_client.publish.return_value = (0, 0)
+        mqtt_client._publish_mid = tracked(1)
+        replaced = mqtt_client._publish_mid[0]
+
+        handle = mqtt_client.publish('topic', 'message', 1, False)
+
+        assert isinstance(replaced.future.exception(), mqtt_client_module.PublishError)
+        assert mqtt_client._publish_mid[0] is handle
+
+
+    def test_publish_handle_stale_early_confirmation(self, mqtt_client):
+        mqtt_client.initialise()
+        mqtt_client._mqtt_client.publish.return_value = (0, 1)
+        mqtt_client._early_publish_mid[1] = time.monotonic() - 1
+
+        handle = mqtt_client.publish('topic', 'message', 1, False)
+
+        assert not handle.done()
+        assert list(mqtt_client._publish_mid) == [1]
+
+
+    def test_publish_journaled(self, mqtt_client):
+        mqtt_client.journal = Mock()
+        mqtt_client.journal.__len__ = Mock(return_value=0)
+        mqtt_client.journal.append.return_value = 7
+        mqtt_client.initialise()
+        mqtt_client._mqtt_client.publish.return_value = (0, 1)
+
+        mqtt_client.publish('topic', 'message', 1, False)
+        mqtt_client.publish('topic', 'message', 0, False)
+
+        mqtt_client.journal.append.assert_called_once_with('topic', 'message', 1, False)
+        mqtt_client._on_publish(mqtt_client._mqtt_client, "", 1)
+        mqtt_client.journal.acknowledge.assert_called_once_with(7)
+        assert mqtt_client._journal_handed == set()
+
+
+    def test_journal_replayed_on_connect(self, mqtt_client):
+        mqtt_client.journal = Mock()
+        mqtt_client.journal.__len__ = Mock(return_value=2)
+        mqtt_client.journal.pending.return_value = [(1, 'topic', 'one', 1, False),
+                                                    (2, 'topic', 'two', 2, True)]
+        mqtt_client.initialise()
+        mqtt_client._mqtt_client.publish.return_value = (0, 5)
+        mqtt_client._mqtt_client.subscribe.return_value = (0, 6)
+
+        mqtt_client._on_connect(mqtt_client._mqtt_client, None, None, 0)
+        mqtt_client._on_connect(mqtt_client._mqtt_client, None, None, 0)
+
+        assert mqtt_client._mqtt_client.publish.call_args_list == [
+            call('topic', payload='one', qos=1, retain=False),
+            call('topic', payload='two', qos=2, retain=True)]
+        assert mqtt_client._journal_handed == {1, 2}
+
+
+    def test_journal_replay_paused_when_refused(self, mqtt_client):
+        mqtt_client.journal = Mock()
+        mqtt_client.journal.__len__ = Mock(return_value=2)
+        mqtt_client.journal.pending.return_value = [(1, 'topic', 'one', 1, False),
+                                                    (2, 'topic', 'two', 1, False)]
+        mqtt_client.initialise()
+        mqtt_client._connected = True
+        mqtt_client._mqtt_client.publish.return_value = (mqtt.MQTT_ERR_QUEUE_SIZE, 0)
+
+        mqtt_client._replay_journal()
+
+        mqtt_client._mqtt_client.publish.assert_called_once()
+        assert mqtt_client._journal_handed == set()
+        assert mqtt_client._journal_backlog
+
+
+    def test_publish_coalesced(self, mqtt_client, pub_msg):
+        mqtt_client.initialise()
+        mqtt_client.coalesce_window = 0.002
+        mqtt_client._mqtt_client.publish.return_value = (0, 1)
+        mqtt_client._mqtt_client.socket.return_value = None
+
+        handle = mqtt_client.publish(pub_msg.topic, pub_msg.message, pub_msg.qos, pub_msg.retain)
+
+        mqtt_client._mqtt_client.publish.assert_not_called()
+        assert mqtt_client.pending_publish_count() == 1
+
+        assert mqtt_client.flush_coalesced() == 1
+        mqtt_client._mqtt_client.publish.assert_called_once_with(
+            pub_msg.topic, payload=pub_msg.message, qos=pub_msg.qos, retain=pub_msg.retain)
+        assert mqtt_client.flush_coalesced() == 0
+        assert mqtt_client._publish_mid[1] is handle
+
+
+    def test_publish_many_coalesced(self, mqtt_client):
+        mqtt_client.initialise()
+        mqtt_client.coalesce_window = 0.002
+        mqtt_client._mqtt_client.publish.side_effect = [(0, 1), (0, 2)]
+        mqtt_client._mqtt_client.socket.return_value = None
+
+        handles = mqtt_client.publish_many([('topic', 'one', 1, False), ('topic', 'two', 1, False)])
+
+        mqtt_client._mqtt_client.publish.assert_not_called()
+        assert mqtt_client.flush_coalesced() == 2
+        assert [mqtt_client._publish_mid[mid] for mid in (1, 2)] == handles
+
+
+    @patch('mqtt_remote.mqtt_client.socket')
+    def test_flush_coalesced_corks_socket(self, mock_socket, mqtt_client, pub_msg):
+        mqtt_client.initialise()
+        mqtt_client.coalesce_window = 0.002
+        mqtt_client._mqtt_client.publish.return_value = (0, 1)
+        paho_socket = mqtt_client._mqtt_client.socket.return_value
+
+        mqtt_client.publish(pub_msg.topic, pub_msg.message, pub_msg.qos, pub_msg.retain)
+        mqtt_client.flush_coalesced()
+
+        assert [call.args for call in paho_socket.setsockopt.call_args_list] == [
+            (mock_socket.IPPROTO_TCP, mock_socket.TCP_CORK, 1),
+            (mock_socket.IPPROTO_TCP, mock_socket.TCP_CORK, 0)]
+
+
+    def test_stop_flushes_coalesced(self, mqtt_client, pub_msg):
+        mqtt_client.initialise()
+        mqtt_client.coalesce_window = 60
+        mqtt_client._mqtt_client.publish.return_value = (0, 1)
+        mqtt_client._mqtt_client.socket.return_value = None
+
+        mqtt_client.start('non_blocking')
+        mqtt_client.publish(pub_msg.topic, pub_msg.message, pub_msg.qos, pub_msg.retain)
+        time.sleep(0.01)
+        mqtt_client.stop()
+
+        mqtt_client._mqtt_client.publish.assert_called_once()
+
+
     def test_publish_no_initialisation(self, mqtt_client, pub_msg):
         with pytest.raises(RuntimeError) as excinfo:
             mqtt_client.publish(pub_msg.topic, pub_msg.message, pub_msg.qos, pub_msg.retain)
@@ -173,9 +526,9 @@ class TestMQTTClient:
         mqtt_client.publish(pub_msg.topic, pub_msg.message, pub_msg.qos, pub_msg.retain)
 
         log_message = ("".join(["Preperations for sending message and ",
-                                f"connecting to MQTT Broker succeeded (mid: {mid})"]))
+                                "connecting to MQTT Broker succeeded (mid: %s)"]))
 
-        mock_logger.debug.assert_called_with(log_message)
+        mock_logger.debug.assert_called_with(log_message, mid)
 
 
     @patch('mqtt_remote.mqtt_client.logger')
@@ -277,13 +630,143 @@ class TestMQTTClient:
 
     @patch('mqtt_remote.mqtt_client.logger')
     def test__on_disconnect_rc_one(self, mock_logger, mqtt_client):
+        mqtt_client.reconnect_supervisor = ReconnectSupervisor(jitter=0)
         mqtt_client.initialise()
 
         rc = 1
 
         mqtt_client._on_disconnect(mqtt_client._mqtt_client, "", rc)
 
-        mock_logger.warning.assert_called_with("Unexpected loss of connection to MQTT Broker")
+        mock_logger.warning.assert_called_with(''.join(["Unexpected loss of connection to ",
+                                                        "MQTT Broker, reconnecting in 1.0 s"]))
+        mqtt_client._mqtt_client.reconnect_delay_set.assert_called_with(1.0, 1.0)
+
+
+    @patch('mqtt_remote.mqtt_client.logger')
+    def test__on_connect_fail(self, mock_logger, mqtt_client):
+        mqtt_client.reconnect_supervisor = ReconnectSupervisor(min_delay=2, jitter=0)
+        mqtt_client.initialise()
+
+        mqtt_client._on_connect_fail(mqtt_client._mqtt_client, None)
+        mqtt_client._on_connect_fail(mqtt_client._mqtt_client, None)
+
+        mqtt_client._mqtt_client.reconnect_delay_set.assert_called_with(4, 4)
+        mock_logger.warning.assert_called_with(
+            "Unable to connect to MQTT Broker, retrying in 4.0 s")
+        assert mqtt_client.connection_metrics()['failures'] == 2
+
+
+    @patch('mqtt_remote.mqtt_client.logger')
+    def test__on_connect_after_disconnect(self, mock_logger, mqtt_client):
+        mqtt_client.initialise()
+        mqtt_client._mqtt_client.subscribe.return_value = (0, 1)
+
+        mqtt_client._on_connect(mqtt_client._mqtt_client, "", "", 0)
+        mqtt_client._on_disconnect(mqtt_client._mqtt_client, "", 1)
+        mqtt_client._on_connect(mqtt_client._mqtt_client, "", "", 0)
+
+        metrics = mqtt_client.connection_metrics()
+        assert (metrics['attempts'], metrics['reconnects'], metrics['connected']) == (2, 1, True)
+        assert any(args[0].startswith('Reconnected to MQTT Broker after')
+                   for args, _ in mock_logger.info.call_args_list)
+
+
+    def test_initialise_mqtt_v5(self, mqtt_client):
+        mqtt_client.mqtt_protocol = mqtt.MQTTv5
+        mqtt_client.receive_maximum = 100
+        mqtt_client.mqtt_clean_session = False
+
+        with patch('paho.mqtt.client.Client') as mock_client:
+            mqtt_client.initialise()
+            mqtt_client.start('non_blocking')
+
+        assert mock_client.call_args[1]['clean_session'] is None
+        connect_kwargs = mqtt_client._mqtt_client.connect_async.call_args[1]
+        assert connect_kwargs['clean_start'] is False
+        assert connect_kwargs['properties'].ReceiveMaximum == 100
+        assert connect_kwargs['properties'].SessionExpiryInterval == 0xFFFFFFFF
+
+
+    def test__on_connect_mqtt_v5(self, mqtt_client):
+        mqtt_client.mqtt_protocol = mqtt.MQTTv5
+        mqtt_client.topic_alias_maximum = 16
+        mqtt_client.initialise()
+        mqtt_client._mqtt_client.subscribe.return_value = (0, 1)
+        properties = Properties(PacketTypes.CONNACK)
+        properties.TopicAliasMaximum = 2
+        properties.ReceiveMaximum = 5
+
+        mqtt_client._on_connect(mqtt_client._mqtt_client, "", {},
+                                ReasonCodes(PacketTypes.CONNACK, 'Success'), properties)
+
+        assert mqtt_client._topic_alias_limit == 2
+        mqtt_client._mqtt_client.max_inflight_messages_set.assert_called_with(5)
+
+
+    @patch('mqtt_remote.mqtt_client.logger')
+    def test__on_connect_mqtt_v5_refused(self, mock_logger, mqtt_client):
+        mqtt_client.mqtt_protocol = mqtt.MQTTv5
+        mqtt_client.initialise()
+        mqtt_client._mqtt_client.subscribe.return_value = (0, 1)
+
+        mqtt_client._on_connect(mqtt_client._mqtt_client, "", {},
+                                ReasonCodes(PacketTypes.CONNACK, identifier=135),
+                                Properties(PacketTypes.CONNACK))
+
+        mock_logger.warning.assert_any_call("Connection refused by MQTT Broker: Not authorized")
+        assert mqtt_client._topic_alias_limit == 0
+
+
+    def test_publish_topic_aliases(self, mqtt_client):
+        mqtt_client.mqtt_protocol = mqtt.MQTTv5
+        mqtt_client.topic_alias_maximum = 2
+        mqtt_client.initialise()
+        mqtt_client._mqtt_client.publish.return_value = (0, 1)
+        mqtt_client._reset_topic_aliases(10)
+
+        for topic in ('spam', 'spam', 'eggs', 'ham', 'spam'):
+            mqtt_client.publish(topic, 'message', 0, False)
+        mqtt_client.publish('spam', 'message', 1, False)
+
+        sent = [(call[0][0], call[1].get('properties'))
+                for call in mqtt_client._mqtt_client.publish.call_args_list]
+        assert [(topic, properties.TopicAlias if properties else None)
+                for topic, properties in sent] == [('spam', 1), ('', 1), ('eggs', 2),
+                                                   ('ham', 1), ('spam', 2), ('spam', None)]
+
+
+    def test_publish_properties(self, mqtt_client):
+        mqtt_client.mqtt_protocol = mqtt.MQTTv5
+        mqtt_client.topic_alias_maximum = 2
+        mqtt_client.initialise()
+        mqtt_client._mqtt_client.publish.return_value = (0, 1)
+        mqtt_client._reset_topic_aliases(10)
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.CorrelationData = b'1'
+
+        mqtt_client.publish('spam', 'message', 0, False, properties)
+        mqtt_client.publish('eggs', 'message', 1, False, properties)
+
+        first, second = mqtt_client._mqtt_client.publish.call_args_list
+        assert first[1]['properties'].CorrelationData == b'1'
+        assert first[1]['properties'].TopicAlias == 1
+        assert second[1]['properties'] is properties
+        assert not hasattr(properties, 'TopicAlias')
+
+
+    def test_publish_topic_aliases_reset_on_disconnect(self, mqtt_client):
+        mqtt_client.mqtt_protocol = mqtt.MQTTv5
+        mqtt_client.topic_alias_maximum = 2
+        mqtt_client.initialise()
+        mqtt_client._mqtt_client.publish.return_value = (0, 1)
+        mqtt_client._reset_topic_aliases(10)
+        mqtt_client.publish('spam', 'message', 0, False)
+
+        mqtt_client._on_disconnect(mqtt_client._mqtt_client, "", 1, None)
+        mqtt_client.publish('spam', 'message', 0, False)
+
+        mqtt_client._mqtt_client.publish.assert_called_with('spam', payload='message', qos=0,
+                                                            retain=False)
 
 
     @patch('mqtt_remote.mqtt_client.logger')
@@ -294,7 +777,17 @@ class TestMQTTClient:
 
         mqtt_client._on_log(mqtt_client._mqtt_client, "", "logging.DEBUG", log_string)
 
-        mock_logger.debug.assert_called_with(f"PAHO: {log_string}")
+        mock_logger.debug.assert_called_with("PAHO: %s", log_string)
+
+
+    def test_initialise_on_log_only_set_when_logging_client(self, mqtt_client):
+        mqtt_client.log_client = False
+        mqtt_client.initialise()
+        assert mqtt_client._mqtt_client.on_log != mqtt_client._on_log
+
+        mqtt_client.log_client = True
+        mqtt_client.initialise()
+        assert mqtt_client._mqtt_client.on_log == mqtt_client._on_log
 
 
     def test__on_message_one_function(self, mqtt_client):
@@ -312,6 +805,18 @@ class TestMQTTClient:
         object_one.callback.assert_called_with(message)
 
 
+    def test__on_message_counted(self, mqtt_client):
+        mqtt_client.initialise()
+        callback = Mock()
+        callback.__name__ = 'callback'
+        mqtt_client.on_message_callbacks.add(callback)
+        received = metrics.MESSAGES_RECEIVED.value()
+
+        mqtt_client._on_message(mqtt_client._mqtt_client, "", "message")
+
+        assert metrics.MESSAGES_RECEIVED.value() == received + 1
+
+
     def test__on_message_two_functions(self, mqtt_client):
         mqtt_client.initialise()
 
@@ -332,6 +837,20 @@ class TestMQTTClient:
         object_two.callback.assert_called_with(message)
 
 
+    def test__on_message_middleware(self, mqtt_client):
+        mqtt_client.initialise()
+        stage = Mock()
+        callback = Mock()
+        callback.__name__ = 'callback'
+        mqtt_client.middleware.add('stage', stage)
+        mqtt_client.on_message_callbacks.add(callback)
+
+        mqtt_client._on_message(mqtt_client._mqtt_client, "", "message")
+
+        stage.assert_called_once_with("message")
+        callback.assert_called_once_with("message")
+
+
     @patch('mqtt_remote.mqtt_client.logger')
     def test__on_message_no_functions(self, mock_logger, mqtt_client):
         mqtt_client.initialise()
@@ -351,12 +870,14 @@ class TestMQTTClient:
 
         mid = 0
 
-        mqtt_client._publish_mid = {mid}
+        mqtt_client._publish_mid = tracked(0)
 
         mqtt_client._on_publish(mqtt_client._mqtt_client, "", mid)
 
         mock_logger.debug.assert_called_with(''.join(["Message successfully sent ",
-                                                      f"to the MQTT Broker (mid: {mid})"]))
+                                                      "to the MQTT Broker (mid: %s)"]), mid)
+        assert mqtt_client._publish_mid == {}
+        assert mqtt_client.outbound_metrics()['sent'] == 1
 
 
     @patch('mqtt_remote.mqtt_client.logger')
@@ -364,12 +885,30 @@ class TestMQTTClient:
         mid_in_publish = 0
         mid_for_message = 1
 
-        mqtt_client._publish_mid = {mid_in_publish}
+        mqtt_client._publish_mid = tracked(0)
 
         mqtt_client._on_publish(mqtt_client._mqtt_client, "", mid_for_message)
 
-        mock_logger.warning.assert_called_with(''.join(["Problem sending the message to the",
-                                                        f" MQTT Broker (mid: {mid_for_message})"]))
+        mock_logger.warning.assert_not_called()
+        assert list(mqtt_client._early_publish_mid) == [mid_for_message]
+        assert list(mqtt_client._publish_mid) == [mid_in_publish]
+
+
+    def test__on_publish_before_publish_returns(self, mqtt_client, pub_msg):
+        mqtt_client.initialise()
+
+        def publish(*args, **kwargs):
+            mqtt_client._on_publish(mqtt_client._mqtt_client, "", 1)
+            return (0, 1)
+
+        mqtt_client._mqtt_client.publish.side_effect = publish
+
+        handle = mqtt_client.publish(pub_msg.topic, pub_msg.message, pub_msg.qos, pub_msg.retain)
+
+        assert mqtt_client._publish_mid == {}
+        assert not mqtt_client._early_publish_mid
+        assert mqtt_client.outbound_metrics()['sent'] == 1
+        assert handle.wait(1) >= 0
 
 
     @patch('mqtt_remote.mqtt_client.logger')
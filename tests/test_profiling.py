@@ -0,0 +1,275 @@
+from unittest.mock import Mock, patch
+import json
+import threading
+import tracemalloc
+
+import pytest
+
+import mqtt_remote.message as message
+import mqtt_remote.profiling as profiling
+
+
+
+def profiling_config(**overrides):
+    config = {'enabled': True,
+              'token': 'secret',
+              'output_dir': '',
+              'max_duration': 60,
+              'chunk_size': 65536}
+    config.update(overrides)
+    return config
+
+
+@pytest.fixture
+def command_message(command_message):
+    def create_command_message(command, attributes, callback):
+        cmd_msg = command_message(command, {'token': 'secret', **attributes})
+        if callback.payload_schema is not None:
+            cmd_msg.arguments = callback.payload_schema.compile().extract(cmd_msg)
+        return cmd_msg
+    return create_command_message
+
+
+def return_message():
+    return {'topic': 'reports', 'qos': 1, 'retain': False}
+
+
+def reassembled(mqtt_publish):
+    """Reassembles the chunked transfer published with a Mock publish function
+    """
+    completed = []
+    chunk_reassembler = message.ChunkReassembler(
+        lambda cmd_msg: completed.append((cmd_msg.payload, cmd_msg.attachment.read())))
+    schema = message.CHUNK_PAYLOAD_SCHEMA.compile()
+
+    for call in mqtt_publish.call_args_list:
+        topic, payload, qos, retain = call.args
+        chunk_message = message.CommandMessage(topic, json.loads(payload), qos, retain)
+        chunk_message.arguments = schema.extract(chunk_message)
+        chunk_reassembler.receive(chunk_message)
+
+    assert len(completed) == 1
+    return completed[0][0], completed[0][1].decode('utf-8')
+
+
+
+class TestSampleStacks:
+
+    def test_samples_other_threads(self):
+        release = threading.Event()
+        thread = threading.Thread(target=release.wait, args=(5,), name='waiting')
+        thread.start()
+        try:
+            samples, stacks = profiling.sample_stacks(0.02, interval=0.001)
+        finally:
+            release.set()
+            thread.join()
+
+        assert samples >= 1
+        threads = {stack[0] for stack in stacks}
+        assert 'waiting' in threads
+        assert threading.current_thread().name not in threads
+        waiting = [stack for stack in stacks if stack[0] == 'waiting'][0]
+        assert waiting[-1][2] == 'wait'
+
+
+    def test_cpu_profile_report(self):
+        outer = ('a.py', 1, 'outer')
+        inner = ('b.py', 5, 'inner')
+        stacks = {('main', outer, inner): 3, ('main', outer): 1}
+
+        report = profiling.cpu_profile_report(4, profiling.Counter(stacks), 1.0)
+
+        lines = report.splitlines()
+        assert lines[0] == 'CPU profile: 4 samples over 1.0 s, 1 thread(s)'
+        assert lines[3].split() == ['3', '75.0', '3', '75.0', 'inner', '(b.py:5)']
+        assert lines[4].split() == ['1', '25.0', '4', '100.0', 'outer', '(a.py:1)']
+        assert lines[-1].split() == ['4', 'main']
+
+
+    def test_cpu_profile_report_folded(self):
+        stacks = profiling.Counter({('main', ('a.py', 1, 'outer'), ('b.py', 5, 'inner')): 3})
+
+        report = profiling.cpu_profile_report(3, stacks, 1.0, folded=True)
+
+        assert report == 'main;outer (a.py:1);inner (b.py:5) 3'
+
+
+
+class TestProfilingCallback:
+
+    def test_abstract(self):
+        with pytest.raises(TypeError):
+            profiling._ProfilingCallback(profiling_config(), Mock())
+
+
+
+class TestCpuProfileCallback:
+
+    def test_profile_published(self, command_message):
+        mqtt_publish = Mock()
+        callback = profiling.CpuProfileCallback(profiling_config(chunk_size=64), mqtt_publish)
+        cmd_msg = command_message(profiling.PROFILE_CPU_COMMAND_NAME,
+                                  {'duration': 0.1, 'return_message': return_message()},
+                                  callback)
+        callback._running.acquire()
+
+        with patch('mqtt_remote.profiling.sample_stacks',
+                   return_value=(2, profiling.Counter({('main', ('a.py', 1, 'f')): 2}))):
+            callback._profile(cmd_msg)
+
+        payload, report = reassembled(mqtt_publish)
+        assert payload['command'] == 'mqtt_remote_profile_cpu_report'
+        assert payload['attributes']['file_name'].endswith('.txt')
+        assert report.startswith('CPU profile: 2 samples over 0.1 s')
+        assert mqtt_publish.call_args.args[0] == 'reports'
+        assert not callback._running.locked()
+
+
+    def test_duration_limited(self, command_message):
+        callback = profiling.CpuProfileCallback(profiling_config(max_duration=5), Mock())
+        cmd_msg = command_message(profiling.PROFILE_CPU_COMMAND_NAME, {'duration': 10}, callback)
+
+        assert cmd_msg.arguments is None
+
+
+    @patch('mqtt_remote.profiling.logger')
+    def test_one_profile_at_a_time(self, mock_logger, command_message):
+        callback = profiling.CpuProfileCallback(profiling_config(), Mock())
+        cmd_msg = command_message(profiling.PROFILE_CPU_COMMAND_NAME, {'duration': 1}, callback)
+        callback._running.acquire()
+
+        with patch('mqtt_remote.profiling.threading.Thread') as mock_thread:
+            callback.execute(cmd_msg)
+
+        mock_thread.assert_not_called()
+        mock_logger.warning.assert_called_once()
+
+
+    @patch('mqtt_remote.profiling.logger')
+    def test_token_required(self, mock_logger, command_message):
+        callback = profiling.CpuProfileCallback(profiling_config(), Mock())
+
+        with patch('mqtt_remote.profiling.threading.Thread') as mock_thread:
+            callback.execute(command_message(profiling.PROFILE_CPU_COMMAND_NAME,
+                                             {'duration': 1, 'token': 'wrong'}, callback))
+            mock_thread.assert_not_called()
+
+            callback.execute(command_message(profiling.PROFILE_CPU_COMMAND_NAME,
+                                             {'duration': 1}, callback))
+            mock_thread.assert_called_once()
+
+        callback.config['token'] = ''
+        with patch('mqtt_remote.profiling.threading.Thread') as mock_thread:
+            callback.execute(command_message(profiling.PROFILE_CPU_COMMAND_NAME,
+                                             {'duration': 1, 'token': ''}, callback))
+            mock_thread.assert_not_called()
+
+
+
+class TestMemoryProfileCallback:
+
+    @pytest.fixture(autouse=True)
+    def stop_tracemalloc(self):
+        yield
+        tracemalloc.stop()
+
+
+    def test_start_snapshot_stop(self, tmp_path, command_message):
+        callback = profiling.MemoryProfileCallback(profiling_config(output_dir=str(tmp_path)),
+                                                   Mock())
+
+        callback.execute(command_message(profiling.PROFILE_MEMORY_COMMAND_NAME,
+                                         {'action': 'start', 'frames': 2}, callback))
+        assert tracemalloc.is_tracing()
+        assert tracemalloc.get_traceback_limit() == 2
+
+        kept = [bytearray(1024) for _ in range(100)]
+        callback.execute(command_message(profiling.PROFILE_MEMORY_COMMAND_NAME,
+                                         {'action': 'snapshot', 'limit': 5}, callback))
+        del kept
+
+        callback.execute(command_message(profiling.PROFILE_MEMORY_COMMAND_NAME,
+                                         {'action': 'stop'}, callback))
+        assert not tracemalloc.is_tracing()
+
+        reports = sorted(tmp_path.iterdir())
+        assert len(reports) == 3
+        contents = [path.read_text() for path in reports]
+        assert any('differences since the previous snapshot' in text for text in contents)
+        assert any('test_profiling.py' in text for text in contents)
+
+
+    @patch('mqtt_remote.profiling.logger')
+    def test_unknown_action(self, mock_logger, command_message):
+        callback = profiling.MemoryProfileCallback(profiling_config(), Mock())
+
+        callback.execute(command_message(profiling.PROFILE_MEMORY_COMMAND_NAME,
+                                         {'action': 'spam'}, callback))
+
+        assert not tracemalloc.is_tracing()
+        mock_logger.warning.assert_called_once()
+
+
+
+class TestThreadDumpCallback:
+
+    def test_dump_published(self, command_message):
+        mqtt_publish = Mock()
+        callback = profiling.ThreadDumpCallback(profiling_config(), mqtt_publish)
+
+        callback.execute(command_message(profiling.DUMP_THREADS_COMMAND_NAME,
+                                         {'objects': 5, 'return_message': return_message()},
+                                         callback))
+
+        _, report = reassembled(mqtt_publish)
+        assert f"Thread '{threading.current_thread().name}'" in report
+        assert 'test_dump_published' in report
+        assert 'Generation 0:' in report
+        assert 'Top 5 object types:' in report
+
+
+    @patch('mqtt_remote.profiling.logger')
+    def test_nowhere_to_deliver(self, mock_logger, command_message):
+        mqtt_publish = Mock()
+        callback = profiling.ThreadDumpCallback(profiling_config(), mqtt_publish)
+
+        assert callback.deliver(command_message(profiling.DUMP_THREADS_COMMAND_NAME, {},
+                                                callback), 'report') is None
+
+        mqtt_publish.assert_not_called()
+        mock_logger.warning.assert_called_once()
+
+
+
+class TestAddProfilingCallbacks:
+
+    def test_disabled(self):
+        callback_caller = message.CommandMessageCallbackCaller()
+
+        assert profiling.add_profiling_callbacks(callback_caller,
+                                                 profiling_config(enabled=False)) == []
+        assert callback_caller.get_callbacks() == {}
+
+
+    def test_enabled(self):
+        callback_caller = message.CommandMessageCallbackCaller()
+        callback_caller.mqtt_publish = Mock()
+
+        callbacks = profiling.add_profiling_callbacks(callback_caller, profiling_config())
+
+        assert sorted(callback_caller.get_callbacks()) == ['mqtt_remote_dump_threads',
+                                                           'mqtt_remote_profile_cpu',
+                                                           'mqtt_remote_profile_memory']
+        assert all(callback.mqtt_publish is callback_caller.mqtt_publish
+                   for callback in callbacks)
+
+
+    @patch('mqtt_remote.profiling.logger')
+    def test_no_token(self, mock_logger):
+        callback_caller = message.CommandMessageCallbackCaller()
+
+        assert profiling.add_profiling_callbacks(callback_caller,
+                                                 profiling_config(token='')) == []
+        assert callback_caller.get_callbacks() == {}
+        mock_logger.warning.assert_called_once()
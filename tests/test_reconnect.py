@@ -0,0 +1,102 @@
+from unittest.mock import Mock, patch
+
+import pytest
+
+import mqtt_remote.reconnect as reconnect
+
+
+
+def supervisor(**kwargs):
+    kwargs.setdefault('rand', Mock(return_value=0))
+    kwargs.setdefault('clock', Mock(return_value=0))
+    return reconnect.ReconnectSupervisor(**kwargs)
+
+
+
+class TestReconnectSupervisor:
+
+    def test_invalid_dns_policy(self):
+        with pytest.raises(ValueError):
+            reconnect.ReconnectSupervisor(dns_policy='spam')
+
+
+    def test_backoff(self):
+        reconnect_supervisor = supervisor(min_delay=1, max_delay=5)
+
+        delays = [reconnect_supervisor.connection_failed() for _ in range(5)]
+
+        assert delays == [1, 2, 4, 5, 5]
+
+
+    def test_jitter(self):
+        reconnect_supervisor = supervisor(min_delay=4, jitter=0.5, rand=Mock(return_value=0.5))
+
+        assert reconnect_supervisor.connection_failed() == 3
+
+
+    def test_backoff_reset_on_connection(self):
+        reconnect_supervisor = supervisor(min_delay=1)
+        reconnect_supervisor.connection_failed()
+        reconnect_supervisor.connection_failed()
+
+        reconnect_supervisor.connected()
+
+        assert reconnect_supervisor.disconnected() == 1
+
+
+    def test_backoff_continues_when_connection_refused(self):
+        reconnect_supervisor = supervisor(min_delay=1)
+
+        reconnect_supervisor.connection_failed()
+        reconnect_supervisor.connection_failed()
+
+        assert reconnect_supervisor.disconnected() == 2
+
+
+    def test_downtime(self):
+        clock = Mock(return_value=0)
+        reconnect_supervisor = supervisor(clock=clock)
+
+        assert reconnect_supervisor.connected() is None
+        clock.return_value = 10
+        reconnect_supervisor.disconnected()
+        clock.return_value = 13
+        assert reconnect_supervisor.metrics()['downtime_current'] == 3
+        reconnect_supervisor.connection_failed()
+        clock.return_value = 15
+
+        assert reconnect_supervisor.connected() == 5
+        metrics = reconnect_supervisor.metrics()
+        assert metrics == {'attempts': 3, 'failures': 1, 'reconnects': 1, 'connected': True,
+                           'downtime_total': 5, 'downtime_current': 0.0, 'last_delay': 1.0}
+
+
+    def test_address_always(self):
+        reconnect_supervisor = supervisor()
+
+        assert reconnect_supervisor.address('broker', 1883) == 'broker'
+
+
+    @patch('mqtt_remote.reconnect.socket.getaddrinfo')
+    def test_address_cached(self, mock_getaddrinfo):
+        mock_getaddrinfo.return_value = [(None, None, None, '', ('10.0.0.1', 1883))]
+        reconnect_supervisor = supervisor(dns_policy='cached', dns_refresh_failures=2)
+
+        assert reconnect_supervisor.address('broker', 1883) == '10.0.0.1'
+        reconnect_supervisor.connection_failed()
+        assert reconnect_supervisor.address('broker', 1883) == '10.0.0.1'
+        assert mock_getaddrinfo.call_count == 1
+
+        mock_getaddrinfo.return_value = [(None, None, None, '', ('10.0.0.2', 1883))]
+        reconnect_supervisor.connection_failed()
+
+        assert reconnect_supervisor.address('broker', 1883) == '10.0.0.2'
+        assert mock_getaddrinfo.call_count == 2
+
+
+    @patch('mqtt_remote.reconnect.socket.getaddrinfo')
+    def test_address_resolution_failure(self, mock_getaddrinfo):
+        mock_getaddrinfo.side_effect = OSError('no such host')
+        reconnect_supervisor = supervisor(dns_policy='cached')
+
+        assert reconnect_supervisor.address('broker', 1883) == 'broker'
@@ -1,5 +1,7 @@
 from unittest.mock import patch, Mock
 
+import pytest
+
 import mqtt_remote.remote as remote
 import mqtt_remote.config as config
 
@@ -16,25 +18,55 @@ class TestRemote:
         assert install_path == '\\installation_path'
 
 
+    @patch('mqtt_remote.log_pipeline.BackgroundLogging')
+    @patch('mqtt_remote.log_pipeline.LogSampler')
     @patch('mqtt_remote.remote.logging')
-    def test_configure_logging(self, mock_logging, completed_config):
+    def test_configure_logging(self, mock_logging, mock_log_sampler, mock_background_logging,
+                               completed_config):
         output_file_name = completed_config['logging']['output_file']['name']
         output_file_maxsize = completed_config['logging']['output_file']['max_size']
         output_file_backups = completed_config['logging']['output_file']['max_backups']
         logging_level = completed_config['logging']['pylevel']
         logging_format = completed_config['logging']['log_format']
 
-        remote.configure_logging(completed_config)
+        output = remote.configure_logging(completed_config)
 
         mock_logging.handlers.RotatingFileHandler.assert_called_with(
             output_file_name,
             maxBytes=output_file_maxsize,
             backupCount=output_file_backups)
         mock_logging.StreamHandler.assert_called_with()
+        mock_logging.Formatter.assert_called_with(logging_format)
+        mock_log_sampler.assert_called_with({}, 0)
+
+        logging_handlers = [mock_logging.handlers.RotatingFileHandler.return_value,
+                            mock_logging.StreamHandler.return_value]
+        mock_background_logging.assert_called_with(logging_handlers, 10000,
+                                                   mock_log_sampler.return_value)
+        assert output == mock_background_logging.return_value
+        output.start.assert_called_with()
+        mock_logging.basicConfig.assert_called_with(level=logging_level,
+                                                    handlers=[output.handler])
+
+
+    @patch('mqtt_remote.log_pipeline.BackgroundLogging')
+    @patch('mqtt_remote.remote.logging')
+    def test_configure_logging_no_queue(self, mock_logging, mock_background_logging,
+                                        completed_config):
+        completed_config['logging']['queue_size'] = 0
+        completed_config['logging']['max_per_second'] = 5
+
+        output = remote.configure_logging(completed_config)
+
+        assert output is None
+        mock_background_logging.assert_not_called()
 
         logging_handlers = [mock_logging.handlers.RotatingFileHandler.return_value,
                             mock_logging.StreamHandler.return_value]
-        mock_logging.basicConfig.assert_called_with(level=logging_level, format=logging_format,
+        for handler in logging_handlers:
+            log_sampler = handler.addFilter.call_args[0][0]
+            assert log_sampler.max_per_second == 5
+        mock_logging.basicConfig.assert_called_with(level=completed_config['logging']['pylevel'],
                                                     handlers=logging_handlers)
 
 
@@ -61,20 +93,294 @@ class TestRemote:
         assert output == callback_caller
 
 
-    def test_setup_message_forwarder(self):
-        message_forwarder = Mock()
+    @patch('mqtt_remote.dead_letter.DeadLetterHandler')
+    def test_create_dead_letter_handler(self, mock_dead_letter_handler, completed_config):
+        mqtt_software_client = Mock()
+        dead_letter_config = completed_config['dead_letter']
+
+        output = remote.create_dead_letter_handler(mqtt_software_client, completed_config)
+
+        mock_dead_letter_handler.assert_called_with(mqtt_software_client.publish,
+                                                    dead_letter_config['topic'],
+                                                    dead_letter_config['qos'],
+                                                    dead_letter_config['quarantine_threshold'],
+                                                    dead_letter_config['quarantine_size'],
+                                                    dead_letter_config['quarantine_duration'],
+                                                    dead_letter_config['payload_excerpt'],
+                                                    dead_letter_config['max_per_second'])
+        assert output == mock_dead_letter_handler.return_value
+
+
+    @patch('mqtt_remote.audit.AuditJournal')
+    def test_create_audit_journal(self, mock_audit_journal, completed_config):
+        audit_config = completed_config['audit']
+
+        assert remote.create_audit_journal(completed_config) is None
+        mock_audit_journal.assert_not_called()
+
+        audit_config['path'] = 'audit.bin'
+        output = remote.create_audit_journal(completed_config)
+
+        mock_audit_journal.assert_called_with('audit.bin',
+                                              audit_config['max_size'],
+                                              audit_config['max_backups'],
+                                              audit_config['flush_interval'])
+        assert output == mock_audit_journal.return_value
+
+
+    @patch('mqtt_remote.watchdog.SlowCallbackDetector')
+    def test_create_slow_callback_detector(self, mock_slow_callback_detector,
+                                           completed_config):
+        mqtt_software_client = Mock()
+        slow_callbacks_config = completed_config['slow_callbacks']
+
+        output = remote.create_slow_callback_detector(mqtt_software_client, completed_config)
+
+        mock_slow_callback_detector.assert_called_with(slow_callbacks_config['threshold'],
+                                                       mqtt_software_client.publish,
+                                                       slow_callbacks_config['topic'],
+                                                       slow_callbacks_config['qos'],
+                                                       slow_callbacks_config['max_per_minute'],
+                                                       slow_callbacks_config['attributes_excerpt'])
+        assert output == mock_slow_callback_detector.return_value
+
+        slow_callbacks_config['threshold'] = 0
+        assert remote.create_slow_callback_detector(mqtt_software_client,
+                                                    completed_config) is None
+
+
+    @patch('mqtt_remote.remote.create_slow_callback_detector')
+    @patch('mqtt_remote.remote.create_audit_journal')
+    @patch('mqtt_remote.dispatch.DispatchEngine')
+    @patch('mqtt_remote.dispatch.StreamPublisher')
+    def test_create_dispatch_engine(self, mock_stream_publisher, mock_dispatch_engine,
+                                    mock_create_audit_journal,
+                                    mock_create_slow_callback_detector, completed_config):
+        callback_caller = Mock()
+        mqtt_software_client = Mock()
+        dead_letter_handler = Mock()
+        dispatch_config = completed_config['dispatch']
+
+        output = remote.create_dispatch_engine(callback_caller, mqtt_software_client,
+                                               completed_config, dead_letter_handler)
+
+        mock_stream_publisher.assert_called_with(mqtt_software_client.publish,
+                                                 dispatch_config['stream_batch_size'],
+                                                 dispatch_config['stream_max_pending'],
+                                                 mqtt_software_client.pending_publish_count,
+                                                 dispatch_config['stream_flow_control_timeout'])
+        mock_dispatch_engine.assert_called_with(callback_caller,
+                                                mock_stream_publisher.return_value,
+                                                dispatch_config['workers'],
+                                                dispatch_config['max_queued'],
+                                                dispatch_config['batch_max_items'],
+                                                dispatch_config['batch_max_delay'],
+                                                dead_letter_handler,
+                                                mock_create_audit_journal.return_value,
+                                                mock_create_slow_callback_detector.return_value)
+        mock_create_audit_journal.assert_called_with(completed_config)
+        mock_create_slow_callback_detector.assert_called_with(mqtt_software_client,
+                                                              completed_config)
+        mock_dispatch_engine.return_value.start.assert_called_once_with()
+        assert output == mock_dispatch_engine.return_value
+        assert (remote.metrics.REGISTRY.get('mqtt_remote_dispatch_queue_depth').function
+                == mock_dispatch_engine.return_value.queue_depth)
+        remote.metrics.REGISTRY.unregister('mqtt_remote_dispatch_queue_depth')
+
+
+    @patch('mqtt_remote.remote.create_slow_callback_detector')
+    @patch('mqtt_remote.remote.create_audit_journal')
+    @patch('mqtt_remote.dispatch.DispatchEngine')
+    @patch('mqtt_remote.dispatch.StreamPublisher')
+    def test_create_dispatch_engine_asyncio_backend(self, mock_stream_publisher,
+                                                    mock_dispatch_engine,
+                                                    mock_create_audit_journal,
+                                                    mock_create_slow_callback_detector,
+                                                    completed_config):
+        completed_config['mqtt_session']['backend'] = 'asyncio'
+        completed_config['dispatch']['workers'] = 4
+
+        remote.create_dispatch_engine(Mock(), Mock(), completed_config)
+
+        assert mock_dispatch_engine.call_args[0][2] == 4
+        remote.metrics.REGISTRY.unregister('mqtt_remote_dispatch_queue_depth')
+
+
+    @patch('mqtt_remote.message.ChunkReassembler')
+    def test_setup_chunk_reassembler(self, mock_chunk_reassembler, completed_config):
+        callback_caller = Mock()
+        dispatch_engine = Mock()
+        chunking_config = completed_config['chunking']
+
+        output = remote.setup_chunk_reassembler(callback_caller, dispatch_engine,
+                                                completed_config)
+
+        mock_chunk_reassembler.assert_called_with(dispatch_engine.submit,
+                                                  chunking_config['spool_size'],
+                                                  chunking_config['max_transfer_size'],
+                                                  chunking_config['max_transfers'],
+                                                  chunking_config['timeout'])
+        callback_caller.add_callback.assert_called_with(
+            'mqtt_remote_chunk', mock_chunk_reassembler.return_value.receive,
+            remote.message.CHUNK_PAYLOAD_SCHEMA)
+        assert output == mock_chunk_reassembler.return_value
+
+
+    @patch('mqtt_remote.profiling.add_profiling_callbacks')
+    def test_setup_profiling(self, mock_add_profiling_callbacks, completed_config):
         callback_caller = Mock()
+
+        output = remote.setup_profiling(callback_caller, completed_config)
+
+        mock_add_profiling_callbacks.assert_called_with(callback_caller,
+                                                        completed_config['profiling'])
+        assert output == mock_add_profiling_callbacks.return_value
+
+
+    def test_setup_message_forwarder(self):
+        message_forwarder = remote.message.ConvertedCommandMessageForwarder(None, None)
         message_convertor = Mock()
+        dead_letter_handler = Mock()
+        tracer = Mock()
 
-        output = remote.setup_message_forwarder(message_forwarder, callback_caller,
-                                                message_convertor)
+        output = remote.setup_message_forwarder(message_forwarder, message_convertor,
+                                                dead_letter_handler, tracer)
 
         assert output.message_convertor == message_convertor
-        assert output.callback == callback_caller.callback_caller
+        assert output.callback is None
+        assert output.dead_letter_handler == dead_letter_handler
+        assert output.tracer == tracer
+
+
+    def test_setup_middleware(self, completed_config):
+        middleware_pipeline = remote.middleware.MiddlewarePipeline()
+        message_forwarder = Mock()
+        dispatch_engine = Mock()
+        command_router = Mock()
+        completed_config['middleware']['timing'] = True
+
+        output = remote.setup_middleware(middleware_pipeline, message_forwarder,
+                                         dispatch_engine, completed_config, command_router)
+
+        assert output is middleware_pipeline
+        assert output.names() == ['convert', 'route', 'dispatch']
+        assert output.timed
+        command_router.admit.return_value = message_forwarder.convert.return_value
+        output.process('raw message')
+        message_forwarder.convert.assert_called_once_with('raw message')
+        dispatch_engine.submit.assert_called_once_with(message_forwarder.convert.return_value)
+
+
+    def test_setup_middleware_no_command_router(self, completed_config):
+        output = remote.setup_middleware(remote.middleware.MiddlewarePipeline(), Mock(),
+                                         Mock(), completed_config)
+
+        assert output.names() == ['convert', 'dispatch']
+
+
+    def test_subscription_identity(self, completed_config):
+        assert remote.subscription_identity(completed_config) == ('this_client', 'this_client',
+                                                                   None)
+
+
+    @pytest.mark.parametrize('name, shared_group', [('this_client', 'workers'),
+                                                    ('$share/workers/this_client', '')])
+    def test_subscription_identity_shared(self, name, shared_group, completed_config):
+        this_mqtt_client = completed_config['subscriptions']['this_mqtt_client']
+        this_mqtt_client['name'] = name
+        this_mqtt_client['shared_group'] = shared_group
+        this_mqtt_client['worker_id'] = 'worker_1'
+
+        assert remote.subscription_identity(completed_config) == (
+            '$share/workers/this_client', 'this_client-worker_1', 'worker_1')
+
+
+    @patch('mqtt_remote.routing.default_worker_id', return_value='host-42')
+    def test_subscription_identity_default_worker_id(self, mock_default_worker_id,
+                                                     completed_config):
+        completed_config['subscriptions']['this_mqtt_client']['shared_group'] = 'workers'
+
+        _, mqtt_client_id, worker_id = remote.subscription_identity(completed_config)
+
+        assert (mqtt_client_id, worker_id) == ('this_client-host-42', 'host-42')
+
+
+    @patch('mqtt_remote.routing.CommandRouter')
+    def test_create_command_router(self, mock_command_router, completed_config):
+        mqtt_software_client = Mock()
+        this_mqtt_client = completed_config['subscriptions']['this_mqtt_client']
+        this_mqtt_client['name'] = '$share/workers/this_client'
+        this_mqtt_client['worker_id'] = 'worker_1'
+        completed_config['routing']['pinned_commands'] = {'spam': 'worker_1'}
+
+        output = remote.create_command_router(mqtt_software_client, completed_config)
+
+        mock_command_router.assert_called_with(mqtt_software_client.publish, 'this_client',
+                                               'worker_1', {'spam': 'worker_1'}, 1024)
+        assert output == mock_command_router.return_value
+
+
+    @patch('mqtt_remote.journal.PublishJournal')
+    def test_create_publish_journal(self, mock_publish_journal, completed_config):
+        journal_config = completed_config['journal']
+        journal_config['path'] = 'outbound.db'
+
+        output = remote.create_publish_journal(completed_config)
+
+        mock_publish_journal.assert_called_with('outbound.db',
+                                                journal_config['max_messages'],
+                                                journal_config['fsync'],
+                                                journal_config['compact_interval'])
+        assert output == mock_publish_journal.return_value
+
+
+    def test_create_publish_journal_disabled(self, completed_config):
+        completed_config['journal']['path'] = ''
+
+        assert remote.create_publish_journal(completed_config) is None
+
+
+    @patch('mqtt_remote.reconnect.ReconnectSupervisor')
+    def test_create_reconnect_supervisor(self, mock_reconnect_supervisor, completed_config):
+        reconnect_config = completed_config['reconnect']
+
+        output = remote.create_reconnect_supervisor(completed_config)
+
+        mock_reconnect_supervisor.assert_called_with(reconnect_config['min_delay'],
+                                                     reconnect_config['max_delay'],
+                                                     reconnect_config['jitter'],
+                                                     reconnect_config['connect_timeout'],
+                                                     reconnect_config['dns_policy'],
+                                                     reconnect_config['dns_refresh_failures'])
+        assert output == mock_reconnect_supervisor.return_value
+
+
+    @patch('mqtt_remote.remote.create_reconnect_supervisor')
+    @patch('mqtt_remote.remote.create_publish_journal')
+    @patch('mqtt_remote.asyncio_client.AsyncioMQTTClient')
+    def test_create_mqtt_software_client_asyncio(self, mock_asyncio_mqtt_client,
+                                                 mock_create_publish_journal,
+                                                 mock_create_reconnect_supervisor,
+                                                 completed_config):
+        completed_config['mqtt_session']['backend'] = 'asyncio'
+
+        client = remote.create_mqtt_software_client(completed_config)
 
+        assert client == mock_asyncio_mqtt_client.return_value
 
+
+    def test_create_mqtt_software_client_invalid_backend(self, completed_config):
+        completed_config['mqtt_session']['backend'] = 'spam'
+
+        with pytest.raises(ValueError):
+            remote.create_mqtt_software_client(completed_config)
+
+
+    @patch('mqtt_remote.remote.create_reconnect_supervisor')
+    @patch('mqtt_remote.remote.create_publish_journal')
     @patch('mqtt_remote.mqtt_client.MQTTClient')
-    def test_create_mqtt_software_client(self, mock_mqtt_client, completed_config):
+    def test_create_mqtt_software_client(self, mock_mqtt_client, mock_create_publish_journal,
+                                         mock_create_reconnect_supervisor, completed_config):
         mock_mqtt_client.return_value = 'client'
         subscription_config = completed_config['subscriptions']
         subscription_topic = subscription_config['this_mqtt_client']['name']
@@ -92,11 +398,59 @@ class TestRemote:
                                             completed_config['mqtt_session']['clean'],
                                             completed_config['mqtt_session']['pyprotocol'],
                                             completed_config['mqtt_session']['transport'],
-                                            completed_config['logging']['log_base_client'])
+                                            completed_config['logging']['log_base_client'],
+                                            completed_config['outbound']['coalesce_window'],
+                                            completed_config['outbound']['max_inflight'],
+                                            completed_config['outbound']['max_queued'],
+                                            completed_config['outbound']['queue_full_policy'],
+                                            completed_config['outbound']['queue_full_timeout'],
+                                            mock_create_publish_journal.return_value,
+                                            mock_create_reconnect_supervisor.return_value,
+                                            1001,
+                                            16,
+                                            completed_config['outbound']['delivery_timeout'])
         assert client == 'client'
 
 
+    @pytest.mark.parametrize('configured, workers, max_queued, expected', [(50, 1, 1000, 50),
+                                                                           (0, 4, 100, 104),
+                                                                           (0, 1, 0, 0),
+                                                                           (0, 1, 99999, 65535)])
+    def test_receive_maximum(self, configured, workers, max_queued, expected, completed_config):
+        completed_config['mqtt_v5']['receive_maximum'] = configured
+        completed_config['dispatch']['workers'] = workers
+        completed_config['dispatch']['max_queued'] = max_queued
+
+        assert remote.receive_maximum(completed_config) == expected
+
+
+    @patch('mqtt_remote.remote.create_reconnect_supervisor')
+    @patch('mqtt_remote.remote.create_publish_journal')
+    @patch('mqtt_remote.mqtt_client.MQTTClient')
+    def test_create_mqtt_software_client_shared(self, mock_mqtt_client,
+                                                mock_create_publish_journal,
+                                                mock_create_reconnect_supervisor,
+                                                completed_config):
+        this_mqtt_client = completed_config['subscriptions']['this_mqtt_client']
+        this_mqtt_client['shared_group'] = 'workers'
+        this_mqtt_client['worker_id'] = 'worker_1'
+
+        remote.create_mqtt_software_client(completed_config)
+
+        arguments = mock_mqtt_client.call_args[0]
+        assert arguments[5] == [('$share/workers/this_client', 0),
+                                ('mqtt_remote/workers/this_client-worker_1', 0)]
+        assert arguments[6] == 'this_client-worker_1'
+
+
+    @patch('mqtt_remote.remote.setup_profiling')
+    @patch('mqtt_remote.remote.create_tracer', return_value=None)
+    @patch('mqtt_remote.remote.setup_middleware')
+    @patch('mqtt_remote.remote.create_command_router')
     @patch('mqtt_remote.remote.setup_message_forwarder')
+    @patch('mqtt_remote.remote.setup_chunk_reassembler')
+    @patch('mqtt_remote.remote.create_dispatch_engine')
+    @patch('mqtt_remote.remote.create_dead_letter_handler')
     @patch('mqtt_remote.remote.setup_callback_caller')
     @patch('mqtt_remote.message.ConvertedCommandMessageForwarder')
     @patch('mqtt_remote.message.PahoToCommandMessageConvertor')
@@ -105,33 +459,107 @@ class TestRemote:
                                         mock_paho_to_command_message_convertor,
                                         mock_converted_command_message_forwarder,
                                         mock_setup_callback_caller,
-                                        mock_setup_message_forwarder):
+                                        mock_create_dead_letter_handler,
+                                        mock_create_dispatch_engine,
+                                        mock_setup_chunk_reassembler,
+                                        mock_setup_message_forwarder,
+                                        mock_create_command_router,
+                                        mock_setup_middleware,
+                                        mock_create_tracer,
+                                        mock_setup_profiling):
         mqtt_software_client = Mock()
         completed_config = Mock()
 
         output = remote.setup_mqtt_software_client(mqtt_software_client, completed_config)
 
+        mock_create_tracer.assert_called_with(mqtt_software_client, completed_config)
+
         mock_command_message_callback_caller.assert_called_with()
         mock_paho_to_command_message_convertor.assert_called_with()
         mock_converted_command_message_forwarder.assert_called_with(
-            mock_paho_to_command_message_convertor.return_value,
-            mock_command_message_callback_caller.return_value)
+            mock_paho_to_command_message_convertor.return_value, None)
 
         mock_setup_callback_caller.assert_called_with(
             mock_command_message_callback_caller.return_value,
             mqtt_software_client.publish,
             completed_config)
 
+        mock_create_dead_letter_handler.assert_called_with(mqtt_software_client,
+                                                           completed_config)
+
+        mock_create_dispatch_engine.assert_called_with(
+            mock_setup_callback_caller.return_value,
+            mqtt_software_client,
+            completed_config,
+            mock_create_dead_letter_handler.return_value)
+
+        mock_setup_chunk_reassembler.assert_called_with(mock_setup_callback_caller.return_value,
+                                                        mock_create_dispatch_engine.return_value,
+                                                        completed_config)
+        mock_setup_profiling.assert_called_with(mock_setup_callback_caller.return_value,
+                                                completed_config)
+
         mock_setup_message_forwarder.assert_called_with(
             mock_converted_command_message_forwarder.return_value,
-            mock_setup_callback_caller.return_value,
-            mock_paho_to_command_message_convertor.return_value)
+            mock_paho_to_command_message_convertor.return_value,
+            mock_create_dead_letter_handler.return_value,
+            None)
 
-        mqtt_software_client.on_message_callbacks.add.assert_called_with(
-            mock_setup_message_forwarder.return_value.forward)
+        mock_setup_middleware.assert_called_with(mqtt_software_client.middleware,
+                                                 mock_setup_message_forwarder.return_value,
+                                                 mock_create_dispatch_engine.return_value,
+                                                 completed_config,
+                                                 mock_create_command_router.return_value)
 
         mqtt_software_client.initialise.assert_called_with()
-        assert output == mqtt_software_client
+        assert (mock_create_dispatch_engine.return_value.event_loop
+                == mqtt_software_client.event_loop)
+        assert output == (mqtt_software_client, mock_create_dispatch_engine.return_value, None)
+
+
+    @patch('mqtt_remote.remote.setup_callback_caller')
+    @patch('mqtt_remote.remote.create_dispatch_engine')
+    @patch('mqtt_remote.remote.create_tracer')
+    def test_setup_mqtt_software_client_tracer(self, mock_create_tracer,
+                                               mock_create_dispatch_engine,
+                                               mock_setup_callback_caller, completed_config):
+        mqtt_software_client = Mock()
+        tracer = mock_create_tracer.return_value
+
+        remote.setup_mqtt_software_client(mqtt_software_client, completed_config)
+
+        tracer.wrap_publish.assert_called_with(mqtt_software_client.publish)
+        assert (mock_setup_callback_caller.call_args[0][1]
+                == tracer.wrap_publish.return_value)
+
+
+    def test_create_tracer_disabled(self, completed_config):
+        assert remote.create_tracer(Mock(), completed_config) is None
+
+
+    @patch('mqtt_remote.tracing.FileTraceExporter')
+    def test_create_tracer_file(self, mock_file_trace_exporter, completed_config):
+        mqtt_software_client = Mock(mqtt_protocol=remote.mqtt.MQTTv5)
+        completed_config['tracing']['path'] = 'traces.jsonl'
+
+        output = remote.create_tracer(mqtt_software_client, completed_config)
+
+        mock_file_trace_exporter.assert_called_with('traces.jsonl')
+        assert output.exporter == mock_file_trace_exporter.return_value
+        assert output.sample_rate == 0.01
+        assert output.mqtt_v5
+
+
+    def test_create_tracer_topic(self, completed_config):
+        mqtt_software_client = Mock(mqtt_protocol=remote.mqtt.MQTTv311)
+        completed_config['tracing']['topic'] = 'traces'
+
+        output = remote.create_tracer(mqtt_software_client, completed_config)
+
+        assert isinstance(output.exporter, remote.tracing.MQTTTraceExporter)
+        assert output.exporter.publish == mqtt_software_client.publish
+        assert output.exporter.topic == 'traces'
+        assert not output.mqtt_v5
 
 
     @patch('mqtt_remote.remote.setup_mqtt_software_client')
@@ -150,6 +578,8 @@ class TestRemote:
         assert output == mock_setup_mqtt_software_client.return_value
 
 
+    @patch('mqtt_remote.remote.start_stats_publisher')
+    @patch('mqtt_remote.remote.start_metrics_server')
     @patch('mqtt_remote.remote.start')
     @patch('mqtt_remote.remote.create_configured_mqtt_software_client')
     @patch('mqtt_remote.remote.load_all_callbacks')
@@ -159,9 +589,17 @@ class TestRemote:
                         mock_configure_logging,
                         mock_load_all_callbacks,
                         mock_create_configured_mqtt_software_client,
-                        mock_start):
+                        mock_start,
+                        mock_start_metrics_server,
+                        mock_start_stats_publisher):
+        mqtt_software_client = Mock()
+        dispatch_engine = Mock()
+        tracer = Mock()
+        mock_create_configured_mqtt_software_client.return_value = (mqtt_software_client,
+                                                                    dispatch_engine,
+                                                                    tracer)
 
-        remote.auto_start()
+        remote.auto_start([])
 
         mock_completed_config_from_file.assert_called_with(config.YAML_CONFIG_FILE)
         mock_configure_logging.assert_called_with(mock_completed_config_from_file.return_value)
@@ -169,7 +607,143 @@ class TestRemote:
         mock_create_configured_mqtt_software_client.assert_called_with(
             mock_completed_config_from_file.return_value)
 
-        mock_start.assert_called_with(mock_create_configured_mqtt_software_client.return_value)
+        mock_start.assert_called_with(mqtt_software_client)
+        dispatch_engine.stop.assert_called_with()
+        tracer.close.assert_called_with()
+        mock_start_metrics_server.assert_called_with(mqtt_software_client,
+                                                     mock_completed_config_from_file.return_value)
+        mock_start_metrics_server.return_value.stop.assert_called_with()
+        mock_start_stats_publisher.assert_called_with(mqtt_software_client,
+                                                      mock_completed_config_from_file.return_value)
+        mock_start_stats_publisher.return_value.stop.assert_called_with()
+        mock_configure_logging.return_value.stop.assert_called_with()
+
+
+    @patch('mqtt_remote.remote.start_stats_publisher')
+    @patch('mqtt_remote.remote.start_metrics_server')
+    @patch('mqtt_remote.remote.start')
+    @patch('mqtt_remote.remote.create_configured_multiprocess_mqtt_software_client')
+    @patch('mqtt_remote.remote.load_all_callbacks')
+    @patch('mqtt_remote.remote.configure_logging')
+    @patch('mqtt_remote.config.completed_config_from_file')
+    def test_auto_start_workers(self, mock_completed_config_from_file,
+                                mock_configure_logging,
+                                mock_load_all_callbacks,
+                                mock_create_configured_multiprocess_mqtt_software_client,
+                                mock_start,
+                                mock_start_metrics_server,
+                                mock_start_stats_publisher):
+        mqtt_software_client = Mock()
+        worker_pool = Mock()
+        mock_create_configured_multiprocess_mqtt_software_client.return_value = (
+            mqtt_software_client, worker_pool)
+
+        remote.auto_start(['--workers', '4'])
+
+        mock_load_all_callbacks.assert_not_called()
+        mock_create_configured_multiprocess_mqtt_software_client.assert_called_with(
+            mock_completed_config_from_file.return_value, 4)
+        mock_start.assert_called_with(mqtt_software_client)
+        worker_pool.stop.assert_called_with()
+        mock_start_metrics_server.assert_called_with(mqtt_software_client,
+                                                     mock_completed_config_from_file.return_value)
+        mock_start_stats_publisher.assert_called_with(mqtt_software_client,
+                                                      mock_completed_config_from_file.return_value)
+        mock_start_stats_publisher.return_value.stop.assert_called_with()
+        mock_configure_logging.return_value.stop.assert_called_with()
+
+
+    def test_start_metrics_server_disabled(self, completed_config):
+        assert remote.start_metrics_server(Mock(), completed_config) is None
+
+
+    @patch('mqtt_remote.metrics.MetricsServer')
+    def test_start_metrics_server(self, mock_metrics_server, completed_config):
+        mqtt_software_client = Mock()
+        mqtt_software_client.pending_publish_count.return_value = 3
+        completed_config['metrics']['enabled'] = True
+
+        output = remote.start_metrics_server(mqtt_software_client, completed_config)
+
+        mock_metrics_server.assert_called_with(remote.metrics.REGISTRY, '127.0.0.1', 9464)
+        output.start.assert_called_once_with()
+        assert output == mock_metrics_server.return_value
+        assert 'mqtt_remote_outbound_queue_depth 3' in remote.metrics.REGISTRY.exposition()
+        remote.metrics.REGISTRY.unregister('mqtt_remote_outbound_queue_depth')
+
+
+    def test_start_stats_publisher_disabled(self, completed_config):
+        assert remote.start_stats_publisher(Mock(), completed_config) is None
+
+
+    @patch('mqtt_remote.stats.StatsPublisher')
+    def test_start_stats_publisher(self, mock_stats_publisher, completed_config):
+        mqtt_software_client = Mock()
+        completed_config['stats'].update({'interval': 30, 'qos': 1, 'retain': True})
+
+        output = remote.start_stats_publisher(mqtt_software_client, completed_config)
+
+        mock_stats_publisher.assert_called_with(mqtt_software_client.publish,
+                                                'this_client/$stats', 30,
+                                                1, True)
+        output.start.assert_called_once_with()
+        assert output == mock_stats_publisher.return_value
+        assert (remote.metrics.REGISTRY.get('mqtt_remote_outbound_queue_depth').function
+                == mqtt_software_client.pending_publish_count)
+        remote.metrics.REGISTRY.unregister('mqtt_remote_outbound_queue_depth')
+
+
+    def test_parse_arguments(self):
+        assert remote.parse_arguments([]).workers == 0
+        assert remote.parse_arguments(['--workers', '2']).workers == 2
+
+
+    @patch('mqtt_remote.workers.WorkerPool')
+    def test_create_worker_pool(self, mock_worker_pool, completed_config):
+        mqtt_software_client = Mock()
+        dead_letter_handler = Mock()
+
+        output = remote.create_worker_pool(mqtt_software_client, completed_config, 4,
+                                           dead_letter_handler)
+
+        mock_worker_pool.assert_called_with(completed_config, 4, mqtt_software_client.publish,
+                                            dead_letter_handler,
+                                            max_queued=completed_config['dispatch']['max_queued'])
+        mock_worker_pool.return_value.start.assert_called_once_with()
+        assert output == mock_worker_pool.return_value
+
+        mock_worker_pool.return_value.outstanding.return_value = [1, 2]
+        assert 'mqtt_remote_worker_queue_depth 3' in remote.metrics.REGISTRY.exposition()
+        remote.metrics.REGISTRY.unregister('mqtt_remote_worker_queue_depth')
+
+
+    @patch('mqtt_remote.remote.setup_middleware')
+    @patch('mqtt_remote.remote.create_command_router')
+    @patch('mqtt_remote.remote.create_worker_pool')
+    @patch('mqtt_remote.remote.create_dead_letter_handler')
+    @patch('mqtt_remote.message.ConvertedCommandMessageForwarder')
+    def test_setup_multiprocess_mqtt_software_client(self,
+                                                     mock_converted_command_message_forwarder,
+                                                     mock_create_dead_letter_handler,
+                                                     mock_create_worker_pool,
+                                                     mock_create_command_router,
+                                                     mock_setup_middleware):
+        mqtt_software_client = Mock()
+        completed_config = Mock()
+
+        output = remote.setup_multiprocess_mqtt_software_client(mqtt_software_client,
+                                                                completed_config, 4)
+
+        mock_create_worker_pool.assert_called_with(mqtt_software_client, completed_config, 4,
+                                                   mock_create_dead_letter_handler.return_value)
+        message_forwarder = mock_converted_command_message_forwarder.return_value
+        command_router = mock_create_command_router.return_value
+        mock_setup_middleware.assert_called_with(mqtt_software_client.middleware,
+                                                 message_forwarder,
+                                                 mock_create_worker_pool.return_value,
+                                                 completed_config, command_router)
+        mqtt_software_client.initialise.assert_called_with()
+        assert output == (mqtt_software_client, mock_create_worker_pool.return_value)
 
 
     def test_start_no_keyboard_interrupt(self):
@@ -0,0 +1,166 @@
+from unittest.mock import Mock, patch
+import json
+import time
+
+import pytest
+
+import mqtt_remote.routing as routing
+
+
+
+def router(**kwargs):
+    kwargs.setdefault('mqtt_publish', Mock())
+    kwargs.setdefault('mqtt_client_id', 'eggs')
+    kwargs.setdefault('callback', Mock())
+    return routing.CommandRouter(**kwargs)
+
+
+
+class TestTopics:
+
+    def test_shared_topic(self):
+        assert routing.shared_topic('spam', 'workers') == '$share/workers/spam'
+
+
+    def test_shared_topic_no_group(self):
+        assert routing.shared_topic('spam', '') == 'spam'
+
+
+    @pytest.mark.parametrize('topic, expected', [('$share/workers/spam/eggs',
+                                                  ('workers', 'spam/eggs')),
+                                                 ('spam', ('', 'spam'))])
+    def test_split_shared_topic(self, topic, expected):
+        assert routing.split_shared_topic(topic) == expected
+
+
+    @pytest.mark.parametrize('topic', ['$share/workers', '$share//spam'])
+    def test_split_shared_topic_invalid(self, topic):
+        with pytest.raises(ValueError):
+            routing.split_shared_topic(topic)
+
+
+    @patch('mqtt_remote.routing.os.getpid', return_value=42)
+    @patch('mqtt_remote.routing.socket.gethostname', return_value='host')
+    def test_default_worker_id(self, mock_gethostname, mock_getpid):
+        assert routing.default_worker_id() == 'host-42'
+
+
+    def test_worker_topic(self):
+        client_id = routing.worker_client_id('spam', 'worker_1')
+
+        assert client_id == 'spam-worker_1'
+        assert routing.worker_topic(client_id) == 'mqtt_remote/workers/spam-worker_1'
+
+
+
+class TestCommandRouter:
+
+    def test_route(self, command_message):
+        command_router = router()
+        inbound = command_message()
+
+        command_router.route(inbound)
+
+        command_router.callback.assert_called_once_with(inbound)
+
+
+    def test_admit(self, command_message):
+        command_router = router()
+        inbound = command_message(message_id='1')
+
+        assert command_router.admit(inbound) is inbound
+        assert command_router.admit(command_message(message_id='1')) is None
+        command_router.callback.assert_not_called()
+
+
+    def test_route_duplicate(self, command_message):
+        command_router = router()
+
+        command_router.route(command_message(message_id='1'))
+        command_router.route(command_message(message_id='1'))
+        command_router.route(command_message(message_id='2'))
+
+        assert command_router.callback.call_count == 2
+        assert command_router.duplicates == 1
+
+
+    def test_route_duplicate_evicted(self, command_message):
+        command_router = router(dedup_size=1)
+
+        for message_id in ('1', '2', '1'):
+            command_router.route(command_message(message_id=message_id))
+
+        assert command_router.callback.call_count == 3
+
+
+    def test_route_dedup_disabled(self, command_message):
+        command_router = router(dedup_size=0)
+
+        command_router.route(command_message(message_id='1'))
+        command_router.route(command_message(message_id='1'))
+
+        assert command_router.callback.call_count == 2
+
+
+    def test_route_pinned_elsewhere(self, command_message):
+        command_router = router(worker_id='worker_2', pinned_commands={'volume_up': 'worker_1'})
+        inbound = command_message(qos=1, message_id='1')
+
+        command_router.route(inbound)
+
+        command_router.callback.assert_not_called()
+        topic, payload, qos, retain = command_router.mqtt_publish.call_args[0]
+        assert topic == 'mqtt_remote/workers/eggs-worker_1'
+        assert json.loads(payload) == inbound.payload
+        assert (qos, retain) == (1, False)
+        assert command_router.forwarded == 1
+
+
+    def test_route_pinned_elsewhere_mqtt_v5(self, command_message):
+        command_router = router(worker_id='worker_2', pinned_commands={'volume_up': 'worker_1'})
+        inbound = command_message()
+        inbound.response_topic = 'replies'
+        inbound.correlation_data = b'request-1'
+        inbound.expires_at = time.monotonic() + 9.5
+        inbound.trace = Mock()
+        inbound.trace.traceparent.return_value = 'traceparent'
+
+        command_router.route(inbound)
+
+        args, kwargs = command_router.mqtt_publish.call_args
+        assert json.loads(args[1]) == dict(inbound.payload, traceparent='traceparent')
+        properties = kwargs['properties']
+        assert properties.ResponseTopic == 'replies'
+        assert properties.CorrelationData == b'request-1'
+        assert properties.MessageExpiryInterval == 10
+        assert 'traceparent' not in inbound.payload
+
+
+    def test_route_pinned_here(self, command_message):
+        command_router = router(worker_id='worker_1', pinned_commands={'volume_up': 'worker_1'})
+
+        command_router.route(command_message())
+
+        command_router.mqtt_publish.assert_not_called()
+        command_router.callback.assert_called_once()
+
+
+    def test_route_forwarded_not_forwarded_again(self, command_message):
+        command_router = router(worker_id='worker_2', pinned_commands={'volume_up': 'worker_1'})
+
+        command_router.route(command_message(topic=command_router.topic))
+
+        command_router.mqtt_publish.assert_not_called()
+        command_router.callback.assert_called_once()
+
+
+    @patch('mqtt_remote.routing.logger')
+    def test_route_pinned_not_shared(self, mock_logger, command_message):
+        command_router = router(pinned_commands={'volume_up': 'worker_1'})
+
+        command_router.route(command_message())
+
+        mock_logger.warning.assert_called_once()
+        assert command_router.topic is None
+        command_router.mqtt_publish.assert_not_called()
+        command_router.callback.assert_called_once()
@@ -0,0 +1,172 @@
+from unittest.mock import Mock
+import asyncio
+import json
+
+import paho.mqtt.client as mqtt
+import pytest
+
+import mqtt_remote.message as message
+import mqtt_remote.rpc_client as rpc_client
+
+
+
+@pytest.fixture
+def remote(paho_message):
+    def create_remote(client, reverse=False):
+        """Replies to every request the way MQTT Remote does, in reverse order if 'reverse'
+        """
+        convertor = message.PahoToCommandMessageConvertor()
+        requests = []
+
+        def publish(topic, payload, qos, retain, properties=None):
+            requests.append(convertor.convert(paho_message(topic, payload, properties)))
+            if not reverse:
+                reply_all()
+
+        def reply_all():
+            while requests:
+                command_message = requests.pop(-1 if reverse else 0)
+                text = command_message.payload['attributes']['text']
+
+                def reply_publish(topic, payload, qos, retain, properties=None):
+                    for callback in client.on_message_callbacks:
+                        callback(paho_message(topic, payload, properties))
+
+                message.reply(reply_publish, command_message, text[::-1])
+
+        client.publish.side_effect = publish
+        return reply_all
+    return create_remote
+
+
+@pytest.fixture
+def rpc(fake_mqtt_client):
+    client = fake_mqtt_client()
+    rpc = rpc_client.RPCClient(client, 'MyPC', timeout=0.05)
+    yield rpc
+    rpc.close()
+
+
+
+class TestRPCClient:
+
+    def test_subscribes_to_response_topic(self, rpc):
+        assert rpc.response_topic == 'mqtt_remote/replies/orchestrator'
+        assert rpc.mqtt_client.subscription_topics == [(rpc.response_topic, 1)]
+
+
+    def test_call(self, rpc, remote):
+        remote(rpc.mqtt_client)
+
+        assert rpc.call('reverse_string', {'text': 'spam'}) == 'maps'
+
+        topic, payload, qos, retain = rpc.mqtt_client.publish.call_args[0]
+        payload = json.loads(payload)
+        assert (topic, qos, retain) == ('MyPC', 1, False)
+        assert payload['response_topic'] == rpc.response_topic
+        assert payload['message_id'] == payload['correlation_data']
+        assert rpc.pending() == 0
+
+
+    def test_call_mqtt_v5(self, remote, fake_mqtt_client):
+        rpc = rpc_client.RPCClient(fake_mqtt_client(mqtt.MQTTv5), 'MyPC', timeout=0.05)
+        remote(rpc.mqtt_client)
+
+        try:
+            assert rpc.call('reverse_string', {'text': 'spam'}) == 'maps'
+        finally:
+            rpc.close()
+
+        properties = rpc.mqtt_client.publish.call_args[0][4]
+        assert properties.ResponseTopic == rpc.response_topic
+
+
+    def test_request_traceparent(self, fake_mqtt_client):
+        rpc = rpc_client.RPCClient(fake_mqtt_client(mqtt.MQTTv5), 'MyPC', timeout=0.05)
+        traceparent = '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01'
+
+        rpc.request('reverse_string', {'text': 'spam'}, traceparent=traceparent)
+        rpc.close()
+
+        _, payload, _, _, properties = rpc.mqtt_client.publish.call_args[0]
+        assert json.loads(payload)['traceparent'] == traceparent
+        assert properties.UserProperty == [('traceparent', traceparent)]
+
+
+    def test_pipelined_requests(self, rpc, remote):
+        reply_all = remote(rpc.mqtt_client, reverse=True)
+
+        futures = [rpc.request('reverse_string', {'text': text}) for text in ('spam', 'eggs')]
+        assert rpc.pending() == 2
+        reply_all()
+
+        assert [future.result(1) for future in futures] == ['maps', 'sgge']
+
+
+    def test_call_async(self, rpc, remote):
+        remote(rpc.mqtt_client)
+
+        assert asyncio.run(rpc.call_async('reverse_string', {'text': 'spam'})) == 'maps'
+
+
+    def test_timeout(self, rpc):
+        with pytest.raises(rpc_client.RPCTimeoutError):
+            rpc.call('reverse_string', {'text': 'spam'})
+
+        assert rpc.timed_out == 1
+        assert rpc.pending() == 0
+
+
+    def test_retries(self, rpc):
+        future = rpc.request('reverse_string', {'text': 'spam'}, retries=2)
+
+        with pytest.raises(rpc_client.RPCTimeoutError):
+            future.result(1)
+
+        assert rpc.mqtt_client.publish.call_count == 3
+        assert len({call[0][1] for call in rpc.mqtt_client.publish.call_args_list}) == 1
+        assert rpc.retried == 2
+
+
+    def test_late_reply_ignored(self, rpc, remote):
+        reply_all = remote(rpc.mqtt_client, reverse=True)
+        future = rpc.request('reverse_string', {'text': 'spam'})
+
+        with pytest.raises(rpc_client.RPCTimeoutError):
+            future.result(1)
+        reply_all()
+
+        assert isinstance(future.exception(), rpc_client.RPCTimeoutError)
+
+
+    def test_close(self, fake_mqtt_client):
+        rpc = rpc_client.RPCClient(fake_mqtt_client(), 'MyPC')
+        future = rpc.request('reverse_string', {'text': 'spam'})
+
+        rpc.close()
+
+        assert isinstance(future.exception(), rpc_client.RPCError)
+        assert not rpc.mqtt_client.on_message_callbacks
+        with pytest.raises(rpc_client.RPCError):
+            rpc.request('reverse_string', {'text': 'spam'})
+
+
+
+class TestRPCClientPool:
+
+    def test_no_clients(self):
+        with pytest.raises(ValueError):
+            rpc_client.RPCClientPool([])
+
+
+    def test_request_least_pending(self):
+        rpc_clients = [Mock(), Mock()]
+        rpc_clients[0].pending.return_value = 3
+        rpc_clients[1].pending.return_value = 1
+        pool = rpc_client.RPCClientPool(rpc_clients)
+
+        pool.request('reverse_string', {'text': 'spam'})
+
+        rpc_clients[0].request.assert_not_called()
+        rpc_clients[1].request.assert_called_once_with('reverse_string', {'text': 'spam'}, None,
+                                                       None, None)
@@ -0,0 +1,161 @@
+from unittest.mock import patch
+import json
+
+import pytest
+
+import mqtt_remote.message as message
+import mqtt_remote.scatter_gather as scatter_gather
+
+
+
+@pytest.fixture
+def nodes(paho_message):
+    def create_nodes(client, volumes):
+        """Replies to each command with the node's volume, as GetSpeakerVolume does. Nodes
+        with a volume of None don't reply
+        """
+        convertor = message.PahoToCommandMessageConvertor()
+
+        def reply_publish(topic, payload, qos, retain):
+            for callback in client.on_message_callbacks:
+                callback(paho_message(topic, payload))
+
+        def publish(topic, payload, qos, retain):
+            if volumes.get(topic) is not None:
+                command_message = convertor.convert(paho_message(topic, payload))
+                message.reply(reply_publish, command_message, str(volumes[topic]))
+
+        client.publish.side_effect = publish
+    return create_nodes
+
+
+
+class TestScatterGather:
+
+    def test_subscribes_to_gather_topic(self, fake_mqtt_client):
+        client = fake_mqtt_client()
+
+        gather = scatter_gather.ScatterGather(client)
+
+        assert client.subscription_topics == [('mqtt_remote/gather/orchestrator/#', 1)]
+        assert gather.receive in client.on_message_callbacks
+
+
+    def test_broadcast(self, fake_mqtt_client, nodes):
+        client = fake_mqtt_client()
+        nodes(client, {'lounge': 10, 'kitchen': 20})
+        gather = scatter_gather.ScatterGather(client)
+
+        result = gather.broadcast('get_speaker_volume', ['lounge', 'kitchen'], timeout=1)
+
+        assert [(reply.node, reply.payload) for reply in result.replies] == [('lounge', '10'),
+                                                                              ('kitchen', '20')]
+        assert all(reply.latency >= 0 for reply in result.replies)
+        assert (result.missing, result.complete, result.quorum_reached) == ([], True, True)
+
+
+    def test_broadcast_return_message(self, fake_mqtt_client):
+        client = fake_mqtt_client()
+        gather = scatter_gather.ScatterGather(client)
+
+        gather.broadcast('get_speaker_volume', ['lounge'], {'spam': 1}, timeout=0)
+
+        topic, payload, qos, retain = client.publish.call_args[0]
+        attributes = json.loads(payload)['attributes']
+        assert (topic, qos, retain) == ('lounge', 1, False)
+        assert attributes['spam'] == 1
+        assert attributes['return_message']['topic'].startswith(
+            'mqtt_remote/gather/orchestrator/')
+
+
+    def test_broadcast_timeout_partial(self, fake_mqtt_client, nodes):
+        client = fake_mqtt_client()
+        nodes(client, {'lounge': 10})
+        gather = scatter_gather.ScatterGather(client)
+
+        result = gather.broadcast('get_speaker_volume', ['lounge', 'kitchen'], timeout=0.05)
+
+        assert [reply.node for reply in result.replies] == ['lounge']
+        assert (result.missing, result.complete, result.quorum_reached) == (['kitchen'], False,
+                                                                            False)
+
+
+    def test_broadcast_quorum(self, fake_mqtt_client, nodes):
+        client = fake_mqtt_client()
+        nodes(client, {'lounge': 10})
+        gather = scatter_gather.ScatterGather(client)
+
+        result = gather.broadcast('get_speaker_volume', ['lounge', 'kitchen'], quorum=1,
+                                  timeout=5)
+
+        assert result.quorum_reached
+        assert not result.complete
+        assert result.elapsed < 5
+
+
+    @pytest.mark.parametrize('node_list, quorum', [([], None), (['lounge'], 0),
+                                                   (['lounge'], 2)])
+    def test_broadcast_invalid(self, node_list, quorum, fake_mqtt_client):
+        gather = scatter_gather.ScatterGather(fake_mqtt_client())
+
+        with pytest.raises(ValueError):
+            gather.broadcast('get_speaker_volume', node_list, quorum=quorum)
+
+
+    def test_receive_late_reply_ignored(self, fake_mqtt_client, paho_message):
+        gather = scatter_gather.ScatterGather(fake_mqtt_client())
+
+        gather.receive(paho_message('mqtt_remote/gather/orchestrator/unknown/0', 'spam'))
+
+        assert gather._gathers == {}
+
+
+
+class TestCommandLine:
+
+    def test_parse_arguments(self):
+        arguments = scatter_gather.parse_arguments(['get_speaker_volume', '--nodes', 'lounge',
+                                                    'kitchen', '--attributes', '{"spam": 1}',
+                                                    '--quorum', '1'])
+
+        assert arguments.command == 'get_speaker_volume'
+        assert arguments.nodes == ['lounge', 'kitchen']
+        assert arguments.attributes == {'spam': 1}
+        assert (arguments.quorum, arguments.timeout, arguments.qos) == (1, 10.0, 1)
+
+
+    def test_create_broadcast_mqtt_client(self, completed_config):
+        client = scatter_gather.create_broadcast_mqtt_client(completed_config)
+
+        assert client.subscription_topics == []
+        assert client.mqtt_client_id.startswith('mr_broadcast-')
+        assert client.broker_ip == completed_config['mqtt_broker']['ip']
+
+
+    def test_result_as_dict(self):
+        result = scatter_gather.GatherResult(
+            [scatter_gather.NodeReply('lounge', '10', 0.1),
+             scatter_gather.NodeReply('kitchen', b'\xff', 0.2)], ['study'], False, True, 0.3)
+
+        assert scatter_gather.result_as_dict(result) == {
+            'replies': {'lounge': {'payload': '10', 'latency': 0.1},
+                        'kitchen': {'payload': 'ff', 'latency': 0.2}},
+            'missing': ['study'], 'complete': False, 'quorum_reached': True, 'elapsed': 0.3}
+
+
+    @patch('mqtt_remote.scatter_gather.create_broadcast_mqtt_client')
+    @patch('mqtt_remote.config.completed_config_from_file')
+    def test_auto_broadcast(self, mock_completed_config_from_file,
+                            mock_create_broadcast_mqtt_client, capsys, fake_mqtt_client, nodes):
+        client = fake_mqtt_client()
+        client.subscribed = True
+        nodes(client, {'lounge': 10})
+        mock_create_broadcast_mqtt_client.return_value = client
+
+        exit_code = scatter_gather.auto_broadcast(['get_speaker_volume', '--nodes', 'lounge',
+                                                   '--timeout', '1'])
+
+        assert exit_code == 0
+        assert json.loads(capsys.readouterr().out)['replies']['lounge']['payload'] == '10'
+        client.start.assert_called_once_with('non_blocking')
+        client.stop.assert_called_once_with()
@@ -0,0 +1,120 @@
+import json
+from unittest.mock import Mock, patch
+
+import mqtt_remote.metrics as metrics
+import mqtt_remote.stats as stats
+
+
+
+def registry():
+    metrics_registry = metrics.MetricsRegistry()
+    metrics_registry.counter('mqtt_remote_messages_received_total', 'Received')
+    metrics_registry.counter('mqtt_remote_commands_dispatched_total', 'Dispatched',
+                             ['command', 'outcome'])
+    metrics_registry.histogram('mqtt_remote_command_duration_seconds', 'Duration', ['command'],
+                               [0.1, 1])
+    metrics_registry.gauge('mqtt_remote_outbound_queue_depth', 'Outbound', lambda: 4)
+    return metrics_registry
+
+
+
+class TestStats:
+
+    def test_stats_topic(self):
+        assert stats.stats_topic('spam') == 'spam/$stats'
+
+
+    def test_resident_memory(self):
+        assert stats.resident_memory() > 0
+
+
+
+class TestStatsPublisher:
+
+    @patch('mqtt_remote.stats.time')
+    def test_snapshot_rates(self, mock_time):
+        metrics_registry = registry()
+        received = metrics_registry.get('mqtt_remote_messages_received_total')
+        dispatched = metrics_registry.get('mqtt_remote_commands_dispatched_total')
+        mock_time.monotonic.return_value = 0.0
+        stats_publisher = stats.StatsPublisher(Mock(), 'spam/$stats', registry=metrics_registry)
+
+        received.inc(20)
+        dispatched.inc(labels=('volume_up', 'ok'))
+        dispatched.inc(labels=('volume_up', 'error'))
+        mock_time.monotonic.return_value = 10.0
+        snapshot = stats_publisher.snapshot()
+
+        assert snapshot['interval'] == 10.0
+        assert snapshot['rates']['received'] == 2.0
+        assert snapshot['rates']['dispatched'] == 0.2
+        assert snapshot['rates']['errors'] == 0.1
+        assert snapshot['rates']['published'] == 0.0
+        assert snapshot['errors']['callback'] == 1
+        assert snapshot['queues'] == {'outbound_queue_depth': 4}
+
+        received.inc(5)
+        mock_time.monotonic.return_value = 15.0
+        snapshot = stats_publisher.snapshot()
+
+        assert snapshot['rates']['received'] == 1.0
+        assert snapshot['rates']['errors'] == 0.0
+        assert snapshot['errors']['callback'] == 1
+
+
+    def test_snapshot_latency_since_previous(self):
+        metrics_registry = registry()
+        duration = metrics_registry.get('mqtt_remote_command_duration_seconds')
+        stats_publisher = stats.StatsPublisher(Mock(), 'spam/$stats', registry=metrics_registry)
+
+        for _ in range(10):
+            duration.observe(0.5, labels=('volume_up',))
+        duration.observe(0.05, labels=('mute',))
+        first = stats_publisher.snapshot()
+
+        for _ in range(10):
+            duration.observe(0.05, labels=('mute',))
+        second = stats_publisher.snapshot()
+        third = stats_publisher.snapshot()
+
+        assert first['latency']['command_p50'] == 0.5
+        assert second['latency']['command_p99'] == 0.1
+        assert third['latency']['command_p99'] == 0.0
+        assert 'publish_p99' not in first['latency']
+
+
+    def test_publish_snapshot(self):
+        publish = Mock()
+        stats_publisher = stats.StatsPublisher(publish, 'spam/$stats', qos=1, retain=True,
+                                               registry=registry())
+
+        stats_publisher.publish_snapshot()
+
+        topic, payload, qos, retain = publish.call_args[0]
+        assert (topic, qos, retain) == ('spam/$stats', 1, True)
+        assert json.loads(payload)['queues'] == {'outbound_queue_depth': 4}
+
+
+    @patch('mqtt_remote.stats.logger')
+    def test_publish_snapshot_error(self, mock_logger):
+        publish = Mock(side_effect=RuntimeError('queue full'))
+        stats_publisher = stats.StatsPublisher(publish, 'spam/$stats', registry=registry())
+
+        stats_publisher.publish_snapshot()
+
+        mock_logger.warning.assert_called_once()
+
+
+    def test_start_stop(self):
+        publish = Mock()
+        stats_publisher = stats.StatsPublisher(publish, 'spam/$stats', interval=0.01,
+                                               registry=registry())
+
+        stats_publisher.start()
+        for _ in range(500):
+            if publish.called:
+                break
+            stats.time.sleep(0.01)
+        stats_publisher.stop()
+
+        assert publish.called
@@ -0,0 +1,220 @@
+from concurrent.futures import Future
+from unittest.mock import Mock
+import json
+import os
+import pickle
+import time
+
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+import mqtt_remote.dispatch as dispatch
+import mqtt_remote.message as message
+import mqtt_remote.tracing as tracing
+
+
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+SPAN_ID = '00f067aa0ba902b7'
+
+
+def traceparent_properties(traceparent):
+    properties = Properties(PacketTypes.PUBLISH)
+    properties.UserProperty = (tracing.TRACEPARENT_KEY, traceparent)
+    return properties
+
+
+
+class TestTraceparent:
+
+    def test_format_and_parse(self):
+        traceparent = tracing.format_traceparent(TRACE_ID, SPAN_ID)
+
+        assert traceparent == f'00-{TRACE_ID}-{SPAN_ID}-01'
+        assert tracing.parse_traceparent(traceparent) == (TRACE_ID, SPAN_ID, True)
+        assert tracing.parse_traceparent(f'00-{TRACE_ID}-{SPAN_ID}-00') == (TRACE_ID, SPAN_ID,
+                                                                            False)
+
+
+    def test_parse_invalid(self):
+        assert tracing.parse_traceparent(None) is None
+        assert tracing.parse_traceparent('spam') is None
+        assert tracing.parse_traceparent(f'00-{"0" * 32}-{SPAN_ID}-01') is None
+        assert tracing.parse_traceparent(f'00-{"x" * 32}-{SPAN_ID}-01') is None
+
+
+    def test_received_traceparent(self, command_message, paho_message):
+        traceparent = tracing.format_traceparent(TRACE_ID, SPAN_ID)
+        cmd_msg = command_message(traceparent='envelope')
+        payload = json.dumps(cmd_msg.payload)
+
+        assert tracing.received_traceparent(
+            paho_message('spam', payload, traceparent_properties(traceparent)),
+            cmd_msg) == traceparent
+        assert tracing.received_traceparent(paho_message('spam', payload), cmd_msg) == 'envelope'
+        assert tracing.received_traceparent(paho_message('spam', '{}'), command_message()) is None
+
+
+
+class TestTracer:
+
+    def test_begin_not_sampled(self, command_message, paho_message):
+        tracer = tracing.Tracer(Mock(), sample_rate=0.0)
+
+        assert tracer.begin(paho_message('spam', '{}'), command_message(), 1.0) is None
+
+
+    def test_begin_sampled(self, command_message, paho_message):
+        tracer = tracing.Tracer(Mock(), sample_rate=1.0)
+        paho_msg = paho_message('spam', '{}')
+        paho_msg.timestamp = 0.5
+
+        trace = tracer.begin(paho_msg, command_message(), 1.0)
+
+        assert len(trace.trace_id) == 32
+        assert trace.parent_id is None
+        assert trace.command == 'volume_up'
+        assert [stage for stage, _ in trace.stages] == ['receipt', 'on_message', 'convert']
+        assert trace.stages[:2] == [('receipt', 0.5), ('on_message', 1.0)]
+
+
+    def test_begin_continues_received_trace(self, command_message, paho_message):
+        tracer = tracing.Tracer(Mock(), sample_rate=0.0)
+        traceparent = tracing.format_traceparent(TRACE_ID, SPAN_ID)
+
+        unsampled_traceparent = f'00-{TRACE_ID}-{SPAN_ID}-00'
+
+        trace = tracer.begin(paho_message('spam', '{}', traceparent_properties(traceparent)),
+                             command_message(), 1.0)
+        unsampled = tracer.begin(paho_message('spam', '{}',
+                                              traceparent_properties(unsampled_traceparent)),
+                                 command_message(), 1.0)
+
+        assert (trace.trace_id, trace.parent_id) == (TRACE_ID, SPAN_ID)
+        assert unsampled is None
+
+
+    def test_finish_exports_span(self, command_message, paho_message):
+        exporter = Mock()
+        tracer = tracing.Tracer(exporter, sample_rate=1.0)
+        trace = tracer.begin(paho_message('spam', '{}'), command_message(), 1.0)
+
+        trace.finish('ok')
+        trace.finish('ok')
+
+        span = exporter.export.call_args[0][0]
+        exporter.export.assert_called_once()
+        assert span['trace_id'] == trace.trace_id
+        assert span['span_id'] == trace.span_id
+        assert span['outcome'] == 'ok'
+        assert [stage for stage, _ in span['stages']][-1] == 'executed'
+        assert span['stages'][0][1] == 0.0
+
+
+    def test_pickled_trace_not_exported(self, command_message, paho_message):
+        exporter = Mock()
+        tracer = tracing.Tracer(exporter, sample_rate=1.0)
+        trace = tracer.begin(paho_message('spam', '{}'), command_message(), 1.0)
+
+        copy = pickle.loads(pickle.dumps(trace))
+        copy.finish('ok')
+
+        assert copy.trace_id == trace.trace_id
+        exporter.export.assert_not_called()
+
+
+    def test_wrap_publish_not_traced(self):
+        publish = Mock()
+        traced_publish = tracing.Tracer(Mock(), mqtt_v5=True).wrap_publish(publish)
+
+        output = traced_publish('reply', 'spam', 1, False)
+
+        publish.assert_called_once_with('reply', 'spam', 1, False)
+        assert output == publish.return_value
+
+
+    def test_wrap_publish_traced(self, command_message, paho_message):
+        exporter = Mock()
+        tracer = tracing.Tracer(exporter, sample_rate=1.0, mqtt_v5=True)
+        trace = tracer.begin(paho_message('spam', '{}'), command_message(), 1.0)
+        handle = Mock(future=Future())
+        publish = Mock(return_value=handle)
+
+        token = tracing.activate(trace)
+        try:
+            assert tracing.current_traceparent() == trace.traceparent()
+            tracer.wrap_publish(publish)('reply', 'spam', 1, False)
+        finally:
+            tracing.deactivate(token)
+        handle.future.set_result(0.25)
+
+        properties = publish.call_args[1]['properties']
+        _, parent_id, _ = tracing.parse_traceparent(properties.UserProperty[0][1])
+        span = exporter.export.call_args[0][0]
+        assert trace.stages[-1][0] == 'publish'
+        assert (span['name'], span['topic'], span['duration']) == ('publish', 'reply', 0.25)
+        assert span['span_id'] == parent_id
+        assert span['parent_id'] == trace.span_id
+        assert tracing.current_trace() is None
+
+
+    def test_export_error(self):
+        exporter = Mock()
+        exporter.export.side_effect = OSError('fail')
+
+        tracing.Tracer(exporter).export({})
+
+
+
+class TestFileTraceExporter:
+
+    def test_export(self, tmp_path):
+        path = str(tmp_path / 'traces.jsonl')
+        exporter = tracing.FileTraceExporter(path)
+
+        exporter.export({'trace_id': TRACE_ID})
+        exporter.export({'trace_id': 'other'})
+        exporter.close()
+
+        with open(path, encoding='utf-8') as trace_file:
+            spans = [json.loads(line) for line in trace_file]
+        assert spans == [{'trace_id': TRACE_ID}, {'trace_id': 'other'}]
+
+
+    def test_background_flush(self, tmp_path):
+        path = str(tmp_path / 'traces.jsonl')
+        exporter = tracing.FileTraceExporter(path, flush_interval=0.01)
+
+        exporter.export({'trace_id': TRACE_ID})
+        for _ in range(500):
+            if os.path.exists(path) and os.path.getsize(path) > 0:
+                break
+            time.sleep(0.01)
+
+        with open(path, encoding='utf-8') as trace_file:
+            spans = [json.loads(line) for line in trace_file]
+        assert spans == [{'trace_id': TRACE_ID}]
+        exporter.close()
+        assert exporter._thread is None
+
+
+
+class TestTracedDispatch:
+
+    def test_stages(self, paho_message):
+        exporter = Mock()
+        tracer = tracing.Tracer(exporter, sample_rate=1.0)
+        callback_caller = message.CommandMessageCallbackCaller()
+        callback_caller.add_callback('volume_up', Mock())
+        dispatch_engine = dispatch.DispatchEngine(callback_caller, Mock(), workers=0)
+        message_forwarder = message.ConvertedCommandMessageForwarder(
+            message.PahoToCommandMessageConvertor(), dispatch_engine.submit)
+        message_forwarder.tracer = tracer
+
+        payload = json.dumps({'command': 'volume_up', 'attributes': {}})
+        message_forwarder.forward(paho_message('spam', payload))
+
+        span = exporter.export.call_args[0][0]
+        assert [stage for stage, _ in span['stages']] == ['receipt', 'on_message', 'convert',
+                                                          'validate', 'executed']
+        assert span['outcome'] == 'ok'
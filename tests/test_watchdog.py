@@ -0,0 +1,168 @@
+from unittest.mock import Mock, patch
+import json
+import threading
+
+import mqtt_remote.metrics as metrics
+import mqtt_remote.watchdog as watchdog
+
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+
+    def __call__(self):
+        return self.now
+
+
+
+class TestSlowCallbackDetector:
+
+    @patch('mqtt_remote.watchdog.logger')
+    def test_check_reports_once(self, mock_logger, command_message):
+        clock = Clock()
+        slow_callback_detector = watchdog.SlowCallbackDetector(1.0, clock=clock)
+        slow_before = metrics.SLOW_CALLBACKS.values().get(('volume_up',), 0)
+
+        execution = slow_callback_detector.started(command_message(attributes={'vol': 5}))
+        clock.now = 0.5
+        slow_callback_detector.check()
+        mock_logger.warning.assert_not_called()
+
+        clock.now = 1.5
+        slow_callback_detector.check()
+        slow_callback_detector.check()
+
+        mock_logger.warning.assert_called_once()
+        log = mock_logger.warning.call_args.args[0]
+        assert "'volume_up' callback has been executing for 1.500 s" in log
+        assert '{"vol": 5}' in log
+        assert 'test_check_reports_once' in log
+        assert slow_callback_detector.counts == {'slow': 1, 'suppressed': 0}
+        assert metrics.SLOW_CALLBACKS.values()[('volume_up',)] == slow_before + 1
+
+        slow_callback_detector.finished(execution)
+        mock_logger.info.assert_called_once()
+
+
+    @patch('mqtt_remote.watchdog.logger')
+    def test_finished_not_reported(self, mock_logger, command_message):
+        clock = Clock()
+        slow_callback_detector = watchdog.SlowCallbackDetector(1.0, clock=clock)
+
+        slow_callback_detector.finished(slow_callback_detector.started(command_message()))
+        clock.now = 2.0
+        slow_callback_detector.check()
+
+        mock_logger.warning.assert_not_called()
+        mock_logger.info.assert_not_called()
+
+
+    @patch('mqtt_remote.watchdog.logger')
+    def test_max_per_minute(self, mock_logger, command_message):
+        clock = Clock()
+        slow_callback_detector = watchdog.SlowCallbackDetector(1.0, max_per_minute=1,
+                                                               clock=clock)
+
+        slow_callback_detector.started(command_message())
+        slow_callback_detector.started(command_message())
+        clock.now = 1.0
+        slow_callback_detector.check()
+
+        assert slow_callback_detector.counts == {'slow': 2, 'suppressed': 1}
+        logs = [call.args[0] for call in mock_logger.warning.call_args_list]
+        assert sum('max_per_minute reached' in log for log in logs) == 1
+
+        clock.now = 61.0
+        slow_callback_detector.started(command_message())
+        clock.now = 62.0
+        slow_callback_detector.check()
+
+        assert slow_callback_detector.counts == {'slow': 3, 'suppressed': 1}
+
+
+    @patch('mqtt_remote.watchdog.logger')
+    def test_publish(self, mock_logger, command_message):
+        clock = Clock()
+        mqtt_publish = Mock()
+        slow_callback_detector = watchdog.SlowCallbackDetector(1.0, mqtt_publish, 'slow', 1,
+                                                               attributes_excerpt=10,
+                                                               clock=clock)
+
+        slow_callback_detector.started(command_message(attributes={'text': 'a' * 20}), 3)
+        clock.now = 2.0
+        slow_callback_detector.check()
+
+        topic, payload, qos, retain = mqtt_publish.call_args.args
+        report = json.loads(payload)
+        assert (topic, qos, retain) == ('slow', 1, False)
+        assert report['command'] == 'volume_up'
+        assert report['topic'] == 'spam'
+        assert report['elapsed'] == 2.0
+        assert report['thread'] == threading.current_thread().name
+        assert report['batch_size'] == 3
+        assert report['attributes'] == '{"text": "...'
+        assert 'test_publish' in report['stack']
+
+
+    @patch('mqtt_remote.watchdog.logger')
+    def test_token_redacted(self, mock_logger, command_message):
+        clock = Clock()
+        mqtt_publish = Mock()
+        slow_callback_detector = watchdog.SlowCallbackDetector(1.0, mqtt_publish, 'slow',
+                                                               clock=clock)
+
+        slow_callback_detector.started(command_message(attributes={'token': 'secret'}))
+        clock.now = 2.0
+        slow_callback_detector.check()
+
+        assert 'secret' not in mock_logger.warning.call_args.args[0]
+        assert json.loads(mqtt_publish.call_args.args[1])['attributes'] == '{"token": "***"}'
+
+
+    @patch('mqtt_remote.watchdog.logger')
+    def test_publish_error(self, mock_logger, command_message):
+        clock = Clock()
+        mqtt_publish = Mock(side_effect=RuntimeError('fail'))
+        slow_callback_detector = watchdog.SlowCallbackDetector(1.0, mqtt_publish, 'slow',
+                                                               clock=clock)
+
+        slow_callback_detector.started(command_message())
+        clock.now = 2.0
+        slow_callback_detector.check()
+
+        assert mock_logger.warning.call_count == 2
+
+
+    @patch('mqtt_remote.watchdog.logger')
+    def test_watchdog_thread(self, mock_logger, command_message):
+        callback_started = threading.Event()
+        release = threading.Event()
+        slow_callback_detector = watchdog.SlowCallbackDetector(0.05)
+
+        def slow_callback():
+            execution = slow_callback_detector.started(command_message())
+            callback_started.set()
+            release.wait(5)
+            slow_callback_detector.finished(execution)
+
+        slow_callback_detector.start()
+        thread = threading.Thread(target=slow_callback, name='slow_callback')
+        thread.start()
+        try:
+            callback_started.wait(5)
+            for _ in range(100):
+                if slow_callback_detector.counts['slow']:
+                    break
+                threading.Event().wait(0.05)
+        finally:
+            release.set()
+            thread.join()
+            slow_callback_detector.stop()
+
+        assert slow_callback_detector.counts['slow'] == 1
+        log = mock_logger.warning.call_args.args[0]
+        assert "on thread 'slow_callback'" in log
+        assert 'release.wait(5)' in log
@@ -0,0 +1,112 @@
+from unittest.mock import Mock, patch
+import os
+
+import pytest
+
+import mqtt_remote.message as message
+import mqtt_remote.workers as workers
+
+
+
+def echo_callbacks(callback_caller):
+    """Loaded in each worker process: 'echo' publishes its attributes back, 'fail' raises and
+    'crash' kills the worker
+    """
+    def echo(command_message):
+        callback_caller.mqtt_publish('echo', command_message.payload['attributes']['text'],
+                                     1, False)
+
+    def fail(command_message):
+        raise ValueError('fail')
+
+    def crash(command_message):
+        os._exit(3)
+
+    callback_caller.add_callback('echo', echo)
+    callback_caller.add_callback('fail', fail)
+    callback_caller.add_callback('crash', crash)
+
+
+@pytest.fixture
+def worker_pool(completed_config):
+    pool = workers.WorkerPool(completed_config, 2, Mock(), Mock(),
+                              callback_loader=echo_callbacks, restart_delay=0.1)
+    pool.start()
+    yield pool
+    pool.stop()
+
+
+
+class TestWorkerPool:
+
+    def test_invalid_processes(self, completed_config):
+        with pytest.raises(ValueError):
+            workers.WorkerPool(completed_config, 0, Mock())
+
+
+    def test_select_worker_least_outstanding(self, completed_config, command_message):
+        pool = workers.WorkerPool(completed_config, 3, Mock())
+        pool._outstanding[0][1] = Mock()
+        pool._outstanding[1][2] = Mock()
+
+        assert pool._select_worker(command_message('echo')) == 2
+
+
+    def test_select_worker_chunked_transfer(self, completed_config, command_message):
+        pool = workers.WorkerPool(completed_config, 3, Mock())
+        parts = [command_message(message.CHUNK_COMMAND_NAME, {'transfer_id': 'abc', 'sequence': n})
+                 for n in range(3)]
+
+        selected = set()
+        for number, part in enumerate(parts):
+            selected.add(pool._select_worker(part))
+            pool._outstanding[number][number] = part
+
+        assert len(selected) == 1
+
+
+    @patch('mqtt_remote.workers.logger')
+    def test_submit_full(self, mock_logger, completed_config, command_message):
+        pool = workers.WorkerPool(completed_config, 1, Mock(), max_queued=1)
+        pool._outstanding[0][0] = Mock()
+        pool._inbound[0] = Mock()
+
+        pool.submit(command_message('echo', {'text': 'eggs'}))
+
+        pool._inbound[0].put.assert_not_called()
+        mock_logger.warning.assert_called_once()
+
+
+    def test_publish_from_worker(self, worker_pool, command_message, wait_until):
+        for number in range(4):
+            worker_pool.submit(command_message('echo', {'text': f'eggs {number}'}))
+
+        assert wait_until(lambda: worker_pool.mqtt_publish.call_count == 4)
+        assert sorted(call[0][1] for call in worker_pool.mqtt_publish.call_args_list) == [
+            f'eggs {number}' for number in range(4)]
+        assert wait_until(lambda: worker_pool.outstanding() == [0, 0])
+
+
+    def test_callback_exception(self, worker_pool, command_message, wait_until):
+        inbound = command_message('fail')
+
+        worker_pool.submit(inbound)
+
+        assert wait_until(lambda: worker_pool.dead_letter_handler.execution_failed.called)
+        failed_message, error = worker_pool.dead_letter_handler.execution_failed.call_args[0]
+        assert failed_message.payload == inbound.payload
+        assert isinstance(error, ValueError)
+
+
+    def test_worker_restarted(self, worker_pool, command_message, wait_until):
+        worker_pool.submit(command_message('crash'))
+
+        assert wait_until(lambda: worker_pool.dead_letter_handler.execution_failed.called)
+        _, error = worker_pool.dead_letter_handler.execution_failed.call_args[0]
+        assert isinstance(error, workers.WorkerProcessError)
+        assert wait_until(lambda: worker_pool.restarts == 1)
+
+        for _ in range(2):
+            worker_pool.submit(command_message('echo', {'text': 'eggs'}))
+
+        assert wait_until(lambda: worker_pool.mqtt_publish.call_count == 2)